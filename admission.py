@@ -0,0 +1,131 @@
+# Admission control for renders shared by all sessions of the Streamlit server
+
+"""
+Renders are CPU and memory heavy, and every session of a hosted app runs in the same
+process. RENDER_ADMISSION admits renders in arrival order while their combined CPU and
+memory estimates fit within the budgets, and queues the others. Budgets are set with
+SKI_TRACKS_RENDER_CPUS (default: number of CPUs) and SKI_TRACKS_RENDER_MEMORY_MB
+(default 4096). A job larger than a budget is clamped to it, so it runs alone.
+"""
+
+import itertools
+import os
+import threading
+from collections import deque
+from contextlib import contextmanager
+from typing import Callable, Iterator, Optional
+
+from profiling import stage
+
+# How often a waiting job reports its queue position, in seconds
+WAIT_POLL_SECONDS = 0.5
+
+# Bytes per pixel of an RGBA canvas, with headroom for the encoder and basemap copies
+_BYTES_PER_PIXEL = 4 * 3
+# Bytes per track point held by the renderers
+_BYTES_PER_POINT = 64
+# Interpreter, figure and basemap overhead of a render
+_BASE_RENDER_BYTES = 128 * 1024**2
+
+
+def estimate_render_memory(width_inches:float, aspect:float, dpi:int, points:int=0) -> int:
+    """
+    Rough peak memory of a render in bytes.
+    Args:
+        width_inches (float): Figure width in inches.
+        aspect (float): Figure height divided by its width.
+        dpi (int): Resolution of the render.
+        points (int): Number of track points drawn.
+    """
+    pixels = (width_inches * dpi) * (width_inches * aspect * dpi)
+    return int(_BASE_RENDER_BYTES + pixels * _BYTES_PER_PIXEL + points * _BYTES_PER_POINT)
+
+
+class AdmissionController:
+    """
+    First-in first-out admission of jobs within a CPU and a memory budget.
+    A job waits until every job queued before it has been admitted and enough of
+    both budgets is free, so large jobs are not starved by a stream of small ones.
+    Args:
+        cpu_budget (float): Number of CPUs that admitted jobs may use together.
+        memory_budget (int): Bytes of memory that admitted jobs may use together.
+    """
+
+    def __init__(self, cpu_budget:float, memory_budget:int):
+        self.cpu_budget = cpu_budget
+        self.memory_budget = memory_budget
+        self._cpu_in_use = 0.0
+        self._memory_in_use = 0
+        self._running = 0
+        self._queue = deque()
+        self._tickets = itertools.count()
+        self._condition = threading.Condition()
+
+    def _fits(self, cpu:float, memory_bytes:int) -> bool:
+        # An idle controller always admits the job at the head of the queue
+        return self._running == 0 or (
+            self._cpu_in_use + cpu <= self.cpu_budget
+            and self._memory_in_use + memory_bytes <= self.memory_budget
+        )
+
+    @contextmanager
+    def admit(
+        self,
+        cpu:float=1.0,
+        memory_bytes:int=0,
+        on_wait:Optional[Callable[[int, int], None]]=None
+    ) -> Iterator[None]:
+        """
+        Context manager that blocks until the job is admitted and releases its budget on exit.
+        Args:
+            cpu (float): Number of CPUs the job uses.
+            memory_bytes (int): Peak memory of the job in bytes.
+            on_wait (callable, optional): Called with the 1-based queue position and the
+                queue length while the job waits, at least every WAIT_POLL_SECONDS.
+        """
+        cpu = min(cpu, self.cpu_budget)
+        memory_bytes = min(memory_bytes, self.memory_budget)
+        ticket = next(self._tickets)
+        with stage("render_admission", cpu=cpu, memory_mb=round(memory_bytes / 1024**2)) as admission_stage:
+            with self._condition:
+                self._queue.append(ticket)
+                try:
+                    while self._queue[0] != ticket or not self._fits(cpu, memory_bytes):
+                        if on_wait is not None:
+                            on_wait(self._queue.index(ticket) + 1, len(self._queue))
+                        self._condition.wait(WAIT_POLL_SECONDS)
+                finally:
+                    self._queue.remove(ticket)
+                    # The next job in the queue may fit now
+                    self._condition.notify_all()
+                self._cpu_in_use += cpu
+                self._memory_in_use += memory_bytes
+                self._running += 1
+                admission_stage.add(running=self._running)
+        try:
+            yield
+        finally:
+            with self._condition:
+                self._cpu_in_use -= cpu
+                self._memory_in_use -= memory_bytes
+                self._running -= 1
+                self._condition.notify_all()
+
+    def status(self) -> dict:
+        """Running and queued jobs and the budgets in use"""
+        with self._condition:
+            return {
+                "running": self._running,
+                "queued": len(self._queue),
+                "cpu_in_use": self._cpu_in_use,
+                "cpu_budget": self.cpu_budget,
+                "memory_in_use_mb": round(self._memory_in_use / 1024**2),
+                "memory_budget_mb": round(self.memory_budget / 1024**2),
+            }
+
+
+# Process-wide admission of static map and animation renders
+RENDER_ADMISSION = AdmissionController(
+    cpu_budget=float(os.environ.get("SKI_TRACKS_RENDER_CPUS", str(os.cpu_count() or 1))),
+    memory_budget=int(os.environ.get("SKI_TRACKS_RENDER_MEMORY_MB", "4096")) * 1024**2
+)
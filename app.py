@@ -5,14 +5,6 @@
 
 - Select tracks from overall list
 
-- Support for tracks longer than 1 day
--- If track spans over multiple days
--- Need to adjust duration for animation
--- Need to adjust custom time range slider
--- Display day + time, or only time with hours?
--- max(number of unique dates * 24, length of track in hours) for sliders etc
-
-
 - Custom NSEW padding for map bounds
 - Coordinates on map
 - Calculate lat/lon bounds in app, pass into generate_map
@@ -28,7 +20,6 @@
 
 """
 
-import base64
 import hashlib
 import json
 from tracemalloc import start
@@ -37,14 +28,25 @@ import pandas as pd
 import os
 import streamlit as st
 
+from admission import RENDER_ADMISSION
 from animation import show_animation_options, generate_display_animation
+from duplicates import DUPLICATE_POLICIES, REPORT_COLUMNS, find_duplicate_files, resolve_duplicate_tracks
+from live_view import display_live_map, get_live_tracks, show_live_tracking_options
+from map_matching import get_segment_matches, load_resort_features
 from parse_gpx import parse_gpx_files
-from providers import PROVIDERS
+from profile_charts import show_profile_charts
+from profiling import Profiler, activate
+from segmentation import segment_tracks
+from shared_cache import cache_stats
 from state_management import initialize_session_state, on_files_uploaded
 from static_map import show_static_map_options, generate_display_static_map
-from track_selection import show_track_selection
+from track_selection import add_track_ids, show_track_selection
+from timeline import SECONDS_PER_DAY, add_timeline
+from track_stats import get_track_stats
 from static_map import show_static_map_options, generate_display_static_map
-from util import check_params_changed, get_binary_file_downloader_html
+from util import check_params_changed, format_seconds
+from video_store import delete_video
+from warmup import restart_warmup
 
 
 def on_files_uploaded():
@@ -59,9 +61,12 @@ def on_files_uploaded():
     st.session_state.stat_map_generated = False
     st.session_state.animation_generated = False
     
-    # Reset binary data to release memory
-    st.session_state.animation_bytes = None
+    # Reset data to release memory
     st.session_state.df_combined = None
+    st.session_state.segment_index = None
+    st.session_state.track_summary = None
+    st.session_state.duplicate_report = []
+    st.session_state.session_export = None
     
     # Reset parameter tracking
     st.session_state.stat_params_hash = ""
@@ -69,30 +74,146 @@ def on_files_uploaded():
     st.session_state.stat_current_params = {}
     st.session_state.anim_current_params = {}
     
-    # Clean up temporary animation file if it exists
+    # Delete the rendered animation of the previous files
     if animation_file_path is not None:
         try:
-            if os.path.exists(animation_file_path):
-                os.unlink(animation_file_path)
-                st.session_state.animation_file = None
+            delete_video(animation_file_path)
+            st.session_state.animation_file = None
         except OSError as e:
-            st.warning(f"Could not delete temporary file: {e}")
-    
-    # Reset checkbox states to ensure track selection is refreshed
-    if "checkbox_states" in st.session_state:
-        del st.session_state.checkbox_states
+            st.warning(f"Could not delete rendered animation: {e}")
+
 
 def display_file_info(df_combined):
     with st.expander("File and Track Information", expanded=False):
-        track_info = ""
-        for file_name in sorted(df_combined["file_name"].unique()):
-            track_info += f"File: {file_name} - {len(df_combined[df_combined['file_name'] == file_name]['track_name'].unique())} track(s)\n"
-            for track_name in sorted(df_combined[df_combined["file_name"] == file_name]["track_name"].unique()):
-                track_points = len(df_combined[df_combined["track_name"] == track_name])
-                track_info += f"  - {track_name} - {track_points} points\n"
-            track_info += "\n"
-            
-        st.text_area("", track_info, height=200, disabled=True)
+        track_stats, segment_stats = get_track_stats(df_combined)
+
+        num_files = track_stats["file_name"].nunique()
+        st.write(f"{num_files} file(s), {len(track_stats)} track(s), {int(track_stats['points'].sum())} points")
+
+        duplicate_report = st.session_state.get("duplicate_report") or []
+        if duplicate_report:
+            st.warning(f"Found {len(duplicate_report)} duplicate file(s) or recording(s)")
+            st.dataframe(pd.DataFrame(duplicate_report, columns=REPORT_COLUMNS), hide_index=True)
+
+        st.dataframe(
+            pd.DataFrame({
+                "File": track_stats["file_name"],
+                "Track": track_stats["track_name"],
+                "Points": track_stats["points"],
+                "Start": (track_stats["start_seconds"] % SECONDS_PER_DAY).map(format_seconds),
+                "Duration": track_stats["duration_seconds"].map(format_seconds),
+                "Distance (km)": (track_stats["distance_m"] / 1000).round(2),
+                "Vertical drop (m)": track_stats["vertical_drop_m"].round(0),
+                "Max speed (km/h)": (track_stats["max_speed_mps"] * 3.6).round(1),
+                "Avg speed (km/h)": (track_stats["avg_speed_mps"] * 3.6).round(1),
+                "Runs": track_stats["runs"],
+                "Lifts": track_stats["lifts"],
+            }),
+            hide_index=True
+        )
+
+        if not segment_stats.empty:
+            show_runs = st.checkbox("Show individual runs", value=False, key="show_run_stats")
+            if show_runs:
+                runs = segment_stats[segment_stats["segment_type"] == "run"]
+                resort_map_path = st.text_input(
+                    "Resort map (local OpenStreetMap extract)",
+                    value=os.environ.get("RESORT_OSM_PATH", ""),
+                    key="resort_map_path",
+                    help="Path of an .osm, .osm.gz or .osm.bz2 file with the resort's pistes and lifts, used to name the runs and lifts."
+                )
+                run_names = pd.DataFrame(index=runs.index, columns=["feature_name", "via_lift"])
+                if resort_map_path:
+                    if os.path.isfile(resort_map_path):
+                        with st.spinner("Matching runs to pistes..."):
+                            matches = get_segment_matches(df_combined, load_resort_features(resort_map_path))
+                        run_names = runs[["file_name", "track_name", "segment_number"]].merge(
+                            matches[["file_name", "track_name", "segment_number", "feature_name", "via_lift"]],
+                            on=["file_name", "track_name", "segment_number"],
+                            how="left"
+                        ).set_index(runs.index)
+                    else:
+                        st.warning(f"Resort map {resort_map_path} not found")
+                st.dataframe(
+                    pd.DataFrame({
+                        "File": runs["file_name"],
+                        "Track": runs["track_name"],
+                        "Segment": runs["segment_number"],
+                        "Piste": run_names["feature_name"],
+                        "Via lift": run_names["via_lift"],
+                        "Start": (runs["start_seconds"] % SECONDS_PER_DAY).map(format_seconds),
+                        "Duration": runs["duration_seconds"].map(format_seconds),
+                        "Distance (km)": (runs["distance_m"] / 1000).round(2),
+                        "Vertical drop (m)": runs["vertical_drop_m"].round(0),
+                        "Max speed (km/h)": (runs["max_speed_mps"] * 3.6).round(1),
+                        "Avg speed (km/h)": (runs["avg_speed_mps"] * 3.6).round(1),
+                    }),
+                    hide_index=True
+                )
+
+
+def display_session_export(df_combined):
+    """Export the processed tracks, segments and statistics so they can be reloaded without parsing"""
+    if st.button("Export session", help="Save the processed tracks as Parquet files in a zip archive, which can be uploaded again instead of the GPX files."):
+        with st.spinner("Exporting session..."):
+            # pyarrow is only loaded when a session is exported or restored
+            from session_io import session_to_zip
+            st.session_state.session_export = session_to_zip(
+                df_combined,
+                st.session_state.segment_index,
+                st.session_state.duplicate_report
+            )
+    if st.session_state.session_export is not None:
+        st.download_button("Download session", st.session_state.session_export, file_name="gpx_session.zip", mime="application/zip")
+
+
+# Options the basemaps and indexes prepared by the warm-up depend on
+WARMUP_PARAMS = [
+    "stat_map_style", "stat_lat_min", "stat_lat_max", "stat_lon_min", "stat_lon_max", "stat_render_mode", "stat_segment_types",
+    "anim_map_style", "anim_lat_min", "anim_lat_max", "anim_lon_min", "anim_lon_max", "anim_time_axis", "anim_resample",
+    "anim_start_seconds", "anim_end_seconds", "anim_fps", "anim_duration",
+]
+
+
+def warm_up_selection(df_selected_tracks, stat_params, anim_params):
+    """
+    Prepare the basemaps and indexes of the selected tracks in the background, restarting
+    when the selection or the options they depend on change.
+    """
+    params = {**stat_params, **anim_params}
+    # The loaded table is kept in the session state, so its identity only changes with the data
+    key = (
+        id(st.session_state.df_combined),
+        frozenset(st.session_state.selected_track_ids or ()),
+        tuple(str(params[name]) for name in WARMUP_PARAMS)
+    )
+    st.session_state.warmup_job = restart_warmup(st.session_state.warmup_job, key, df_selected_tracks, stat_params, anim_params)
+
+
+def display_diagnostics(profiler):
+    with st.expander("Diagnostics", expanded=False):
+        # Shared by all sessions of the server
+        st.caption("Shared caches and render queue")
+        st.dataframe(pd.DataFrame(cache_stats()), hide_index=True)
+        st.dataframe(pd.DataFrame([RENDER_ADMISSION.status()]), hide_index=True)
+        if st.session_state.warmup_job is not None:
+            st.caption("Background warm-up of the selected tracks")
+            st.dataframe(pd.DataFrame(st.session_state.warmup_job.status()), hide_index=True)
+        summary = profiler.summarize()
+        if not summary:
+            st.write("No stages recorded yet. Generate a map or an animation to collect timings.")
+            return
+        st.dataframe(pd.DataFrame(summary), hide_index=True)
+        if profiler.dropped_events:
+            st.caption(f"The exports hold the latest {len(profiler.events)} events, {profiler.dropped_events} older events are only in the summary.")
+        json_col, trace_col, clear_col = st.columns(3)
+        with json_col:
+            st.download_button("Download JSON", profiler.to_json(), file_name="diagnostics.json", mime="application/json")
+        with trace_col:
+            st.download_button("Download Chrome trace", profiler.to_chrome_trace(), file_name="diagnostics_trace.json", mime="application/json")
+        with clear_col:
+            if st.button("Clear diagnostics"):
+                profiler.clear()
 
 
 # Streamlit app
@@ -103,6 +224,12 @@ def main():
     # Initialize session state variables
     initialize_session_state()
 
+    # Optional per-stage timing instrumentation for this session
+    diagnostics_enabled = st.sidebar.checkbox("Enable diagnostics", value=False, key="diagnostics_enabled")
+    if diagnostics_enabled and st.session_state.profiler is None:
+        st.session_state.profiler = Profiler()
+    activate(st.session_state.profiler if diagnostics_enabled else None)
+
     # Set up main layout with middle column at 75% width for content
     left_col, middle_col, right_col = st.columns([1, 6, 1])
 
@@ -123,13 +250,64 @@ def main():
             accept_multiple_files=True, 
             on_change=on_files_uploaded
         )
+        duplicate_policy = st.radio(
+            "Duplicate recordings",
+            DUPLICATE_POLICIES,
+            index=0,
+            horizontal=True,
+            key="duplicate_policy",
+            on_change=on_files_uploaded,
+            help="Identical files are always skipped. Tracks with identical points and overlapping recordings of the same activity (for example from a watch and a phone) are kept, skipped or merged into the recording with the most points."
+        )
+
+        session_file = st.file_uploader(
+            "Or restore an exported session",
+            type=["zip"],
+            key="session_file",
+            on_change=on_files_uploaded
+        )
+
+        live_params = show_live_tracking_options()
 
         # Process GPX files
         df_combined = None
-        if uploaded_files:
+        if not uploaded_files and session_file is not None:
             if st.session_state.df_combined is None:
+                try:
+                    with st.spinner("Restoring session..."):
+                        from session_io import read_session
+                        df_combined, segment_index, duplicate_report = read_session(session_file)
+                    st.session_state.segment_index = segment_index
+                    st.session_state.duplicate_report = duplicate_report
+                    df_combined = add_track_ids(df_combined)
+                except Exception as e:
+                    st.error(f"Could not restore session: {e}")
+                st.session_state.df_combined = df_combined
+            else:
+                df_combined = st.session_state.df_combined
+
+            if df_combined is not None and not df_combined.empty:
+                st.success("Restored session")
+                display_file_info(df_combined)
+                display_session_export(df_combined)
+        elif uploaded_files:
+            if st.session_state.df_combined is None:
+                parse_errors = []
+                unique_files, file_report = find_duplicate_files(uploaded_files)
                 with st.spinner("Processing GPX files..."):
-                    df_combined = parse_gpx_files(uploaded_files)
+                    df_combined = parse_gpx_files(unique_files, errors=parse_errors)
+                for parse_error in parse_errors:
+                    st.error(parse_error)
+                if df_combined is not None and not df_combined.empty:
+                    # Put all tracks on one multi-day timeline
+                    df_combined = add_timeline(df_combined)
+                    with st.spinner("Checking for duplicate recordings..."):
+                        df_combined, track_report = resolve_duplicate_tracks(df_combined, duplicate_policy)
+                    st.session_state.duplicate_report = file_report + track_report
+                    with st.spinner("Detecting lifts and runs..."):
+                        df_combined, segment_index = segment_tracks(df_combined)
+                    st.session_state.segment_index = segment_index
+                    df_combined = add_track_ids(df_combined)
                 st.session_state.df_combined = df_combined
             else:
                 df_combined = st.session_state.df_combined
@@ -138,6 +316,16 @@ def main():
                 st.success(f"Loaded and parsed GPX file(s)")
                 # Show file info in expander
                 display_file_info(df_combined)
+                display_session_export(df_combined)
+        elif live_params["live_enabled"]:
+            # Live tracks grow between reruns, only the tracks with new points are processed
+            df_combined, segment_index = get_live_tracks(live_params)
+            st.session_state.segment_index = segment_index
+            st.session_state.df_combined = df_combined
+            display_live_map(live_params)
+            if df_combined is not None and not df_combined.empty:
+                display_file_info(df_combined)
+                display_session_export(df_combined)
         
         st.divider()
 
@@ -166,6 +354,9 @@ def main():
 
         if df_selected_tracks is not None and not df_selected_tracks.empty:
             anim_params = show_animation_options(df_selected_tracks)
+
+            # Download basemaps and build indexes while the options are being set
+            warm_up_selection(df_selected_tracks, stat_params, anim_params)
             
             # # Check if parameters have changed
             # anim_params_changed, anim_current_hash = check_params_changed(
@@ -186,5 +377,13 @@ def main():
 
             st.divider()
 
+            # Profile charts, with a time cursor linked to the animation
+            show_profile_charts(df_selected_tracks, anim_params)
+
+            st.divider()
+
+        if diagnostics_enabled:
+            display_diagnostics(st.session_state.profiler)
+
 if __name__ == "__main__":
     main()
@@ -0,0 +1,572 @@
+# Headless batch rendering of static maps and animations
+
+"""
+Render many static maps and animations from the command line, without Streamlit.
+
+Usage:
+    python batch_render.py TRACKS JOB_SPEC [--output-dir DIR] [--workers N] [--cache-dir DIR]
+                           [--duplicates {Keep,Skip,Merge}] [--report PATH]
+                           [--chunked] [--chunk-memory-mb MB]
+
+TRACKS is a directory of GPX files (searched recursively), a .zip/.tar archive,
+or a session exported from the app (directory or zip), which is loaded without parsing.
+JOB_SPEC is a JSON or YAML file of the form:
+
+    defaults:                 # optional, applied to every job
+      stat_map_style: USTopo
+    jobs:
+      - name: day-1-map
+        type: static          # "static" or "animation"
+        output: day-1.png     # optional, relative to --output-dir
+        files: ["2024-02-1*"] # optional glob patterns on file names, which are
+                              # paths relative to TRACKS without the .gpx extension
+        tracks: ["Morning"]   # optional track names
+        params:
+          stat_title: Day 1
+          stat_lat_padding: 0.2
+
+Parameters use the same names as show_static_map_options (stat_*) and
+show_animation_options (anim_*). Map bounds that are not given are computed from
+the selected tracks with the optional stat_/anim_ lat and lon padding.
+A static job with stat_render_mode "Small multiples" draws one panel per track,
+file or day (stat_panel_group) and composites them into one image. Its panels are
+rendered in the job's worker process, as the jobs already run in parallel.
+
+With --chunked, archives larger than memory are parsed one file at a time into a
+chunked store on disk (see chunked.py) and every job streams it in chunks of about
+--chunk-memory-mb, so peak memory does not grow with the archive. Static maps are
+binned or simplified chunk by chunk, animations load only their selected tracks,
+thinned to the animation's time resolution. Duplicate recordings are only detected
+as identical files in this mode.
+"""
+
+import argparse
+import concurrent.futures
+import fnmatch
+import hashlib
+import json
+import os
+import posixpath
+import shutil
+import tarfile
+import tempfile
+import time
+import zipfile
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+import pandas as pd
+
+# Render modules are imported lazily inside worker processes
+JOB_TYPES = ("static", "animation")
+PADDING_PARAMS = {
+    "static": ("stat_lat_padding", "stat_lon_padding"),
+    "animation": ("anim_lat_padding", "anim_lon_padding"),
+}
+
+_worker_df = None
+_worker_store = None
+_worker_chunk_rows = None
+
+
+class LocalGpxFile:
+    """GPX file read from disk, exposing the same interface as a Streamlit uploaded file"""
+
+    def __init__(self, name:str, data:bytes):
+        self.name = name
+        self.data = data
+
+    def getvalue(self) -> bytes:
+        return self.data
+
+
+def load_track_sources(path:str) -> List[LocalGpxFile]:
+    """
+    Load GPX files from a directory or a .zip/.tar archive.
+    Args:
+        path (str): Directory or archive path.
+    Returns:
+        list: GPX files sorted by name.
+    """
+    return list(iter_track_sources(path))
+
+
+def _source_name(relative_path:str) -> str:
+    """Name of a GPX file from its path relative to the directory or archive root"""
+    # Files of the same name in different folders stay separate files
+    return posixpath.normpath(relative_path.replace(os.sep, "/"))
+
+
+def iter_track_sources(path:str) -> Iterator[LocalGpxFile]:
+    """
+    Read the GPX files of a directory or a .zip/.tar archive one at a time, sorted by name.
+    Files are named by their path relative to the directory or archive root.
+    """
+    if os.path.isdir(path):
+        file_paths = []
+        for root, _, file_names in os.walk(path):
+            file_paths.extend(os.path.join(root, file_name) for file_name in file_names if file_name.lower().endswith(".gpx"))
+        for name, file_path in sorted((_source_name(os.path.relpath(file_path, path)), file_path) for file_path in file_paths):
+            with open(file_path, "rb") as f:
+                yield LocalGpxFile(name, f.read())
+    elif zipfile.is_zipfile(path):
+        with zipfile.ZipFile(path) as archive:
+            members = [member for member in archive.namelist() if member.lower().endswith(".gpx")]
+            for name, member in sorted((_source_name(member), member) for member in members):
+                yield LocalGpxFile(name, archive.read(member))
+    elif tarfile.is_tarfile(path):
+        with tarfile.open(path) as archive:
+            members = [member for member in archive.getmembers() if member.isfile() and member.name.lower().endswith(".gpx")]
+            for name, member in sorted(((_source_name(member.name), member) for member in members), key=lambda item: item[0]):
+                yield LocalGpxFile(name, archive.extractfile(member).read())
+    else:
+        raise ValueError(f"{path} is not a directory or a supported archive")
+
+
+def parse_source_with_cache(source:LocalGpxFile, parse_cache_dir:str, errors:Optional[List[str]]=None) -> Optional[pd.DataFrame]:
+    """Parse one GPX file, reusing its result cached on disk by content hash"""
+    from parse_gpx import parse_gpx_files
+
+    content_hash = hashlib.sha1(source.name.encode() + b"\0" + source.data).hexdigest()
+    cache_path = os.path.join(parse_cache_dir, f"{content_hash}.pkl")
+    if os.path.exists(cache_path):
+        return pd.read_pickle(cache_path)
+    df = parse_gpx_files([source], errors=errors)
+    if df is None:
+        return None
+    # Write atomically so concurrent workers never read a partial file
+    tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+    df.to_pickle(tmp_path)
+    os.replace(tmp_path, cache_path)
+    return df
+
+
+def parse_with_cache(
+    sources:List[LocalGpxFile],
+    cache_dir:str,
+    errors:Optional[List[str]]=None,
+    duplicate_policy:str="Keep",
+    duplicate_report:Optional[List[Dict[str, Any]]]=None
+) -> Optional[pd.DataFrame]:
+    """
+    Parse GPX files, reusing per-file results cached on disk by content hash.
+    Args:
+        sources (list): GPX files to parse.
+        cache_dir (str): Directory of the shared cache.
+        errors (list, optional): List that parse error messages are appended to.
+        duplicate_policy (str): One of DUPLICATE_POLICIES, applied to duplicate recordings.
+        duplicate_report (list, optional): List that duplicate report rows are appended to.
+    Returns:
+        pd.DataFrame: Combined track data, or None if no points were parsed.
+    """
+    from duplicates import find_duplicate_files, resolve_duplicate_tracks
+    from segmentation import segment_tracks
+    from timeline import add_timeline
+
+    parse_cache_dir = os.path.join(cache_dir, "parsed")
+    os.makedirs(parse_cache_dir, exist_ok=True)
+
+    sources, file_report = find_duplicate_files(sources)
+    df_list = []
+    for source in sources:
+        df = parse_source_with_cache(source, parse_cache_dir, errors=errors)
+        if df is not None:
+            df_list.append(df)
+
+    if df_list:
+        df = add_timeline(pd.concat(df_list, ignore_index=True))
+        df, track_report = resolve_duplicate_tracks(df, duplicate_policy)
+        if duplicate_report is not None:
+            duplicate_report.extend(file_report + track_report)
+        df, _ = segment_tracks(df)
+        return df
+    return None
+
+
+def load_tracks(
+    tracks_path:str,
+    cache_dir:str,
+    errors:Optional[List[str]]=None,
+    duplicate_policy:str="Keep",
+    duplicate_report:Optional[List[Dict[str, Any]]]=None
+) -> Tuple[Optional[pd.DataFrame], int]:
+    """
+    Load the track data of a saved session, or parse the GPX files of a directory or archive.
+    Returns:
+        tuple: Combined track data (None if no points were loaded) and the number of GPX files parsed.
+    """
+    from session_io import is_session, read_session
+
+    if is_session(tracks_path):
+        df, _, session_report = read_session(tracks_path)
+        if duplicate_report is not None:
+            duplicate_report.extend(session_report)
+        return df, 0
+    sources = load_track_sources(tracks_path)
+    return parse_with_cache(sources, cache_dir, errors=errors, duplicate_policy=duplicate_policy, duplicate_report=duplicate_report), len(sources)
+
+
+def build_chunked_store(
+    tracks_path:str,
+    cache_dir:str,
+    store_path:str,
+    errors:Optional[List[str]]=None,
+    duplicate_report:Optional[List[Dict[str, Any]]]=None
+) -> Tuple[Any, int]:
+    """
+    Parse the GPX files of a directory or archive one at a time into a chunked store.
+    Returns:
+        tuple: The ChunkedTrackStore and the number of GPX files read.
+    """
+    from chunked import ChunkedTrackStore
+    from session_io import is_session
+
+    if is_session(tracks_path):
+        raise ValueError("Chunked processing reads GPX directories and archives, load exported sessions without --chunked")
+    parse_cache_dir = os.path.join(cache_dir, "parsed")
+    os.makedirs(parse_cache_dir, exist_ok=True)
+
+    num_files = 0
+    def counted_sources():
+        nonlocal num_files
+        for source in iter_track_sources(tracks_path):
+            num_files += 1
+            yield source
+
+    store = ChunkedTrackStore.create(
+        store_path,
+        counted_sources(),
+        parse=lambda source: parse_source_with_cache(source, parse_cache_dir, errors=errors),
+        duplicate_report=duplicate_report
+    )
+    return store, num_files
+
+
+def load_job_spec(path:str) -> Dict[str, Any]:
+    """Load a JSON or YAML job spec"""
+    with open(path, "r") as f:
+        if path.lower().endswith((".yaml", ".yml")):
+            import yaml
+            spec = yaml.safe_load(f)
+        else:
+            spec = json.load(f)
+    if not isinstance(spec, dict) or not isinstance(spec.get("jobs"), list):
+        raise ValueError("Job spec must be a mapping with a 'jobs' list")
+    return spec
+
+
+def build_jobs(spec:Dict[str, Any]) -> List[Dict[str, Any]]:
+    """
+    Validate the jobs of a spec and merge their parameters with the defaults.
+    Returns:
+        list: Jobs with name, type, output, files, tracks and complete params.
+    """
+    from generate_animation import DEFAULT_ANIMATION_PARAMS
+    from generate_map import DEFAULT_STATIC_MAP_PARAMS
+
+    default_params = {
+        "static": DEFAULT_STATIC_MAP_PARAMS,
+        "animation": DEFAULT_ANIMATION_PARAMS,
+    }
+    spec_defaults = spec.get("defaults", {}) or {}
+
+    jobs = []
+    names = set()
+    for k1, job in enumerate(spec["jobs"]):
+        job_type = job.get("type", "static")
+        if job_type not in JOB_TYPES:
+            raise ValueError(f"Job {k1}: invalid type '{job_type}'. Use one of {JOB_TYPES}.")
+        name = str(job.get("name", f"job-{k1:03d}"))
+        if name in names:
+            raise ValueError(f"Job {k1}: duplicate name '{name}'")
+        names.add(name)
+
+        valid_keys = set(default_params[job_type]) | set(PADDING_PARAMS[job_type])
+        prefix = "stat_" if job_type == "static" else "anim_"
+        params = dict(default_params[job_type])
+        params.update({key: value for key, value in spec_defaults.items() if key.startswith(prefix)})
+        params.update(job.get("params", {}) or {})
+        unknown = set(params) - valid_keys
+        if unknown:
+            raise ValueError(f"Job '{name}': unknown parameters {sorted(unknown)}")
+
+        extension = ".png" if job_type == "static" else ".mp4"
+        jobs.append({
+            "name": name,
+            "type": job_type,
+            "output": job.get("output", f"{name}{extension}"),
+            "files": job.get("files"),
+            "tracks": job.get("tracks"),
+            "params": params,
+        })
+    return jobs
+
+
+def select_job_tracks(df:pd.DataFrame, job:Dict[str, Any]) -> pd.DataFrame:
+    """Filter the combined track data to the files and tracks of a job"""
+    mask = pd.Series(True, index=df.index)
+    if job["files"]:
+        file_names = df["file_name"].unique()
+        matched = [name for name in file_names if any(fnmatch.fnmatch(name, pattern) for pattern in job["files"])]
+        mask &= df["file_name"].isin(matched)
+    if job["tracks"]:
+        mask &= df["track_name"].isin(job["tracks"])
+    return df[mask]
+
+
+def resolve_job_params(df:pd.DataFrame, job:Dict[str, Any]) -> Dict[str, Any]:
+    """Fill in map bounds and time range that the job spec left unset"""
+    from map_bounds import get_default_map_bounds
+
+    params = dict(job["params"])
+    lat_padding_key, lon_padding_key = PADDING_PARAMS[job["type"]]
+    prefix = "stat_" if job["type"] == "static" else "anim_"
+
+    bound_keys = [f"{prefix}lat_min", f"{prefix}lat_max", f"{prefix}lon_min", f"{prefix}lon_max"]
+    default_bounds = get_default_map_bounds(
+        df,
+        lat_padding=params.pop(lat_padding_key, 0.125),
+        lon_padding=params.pop(lon_padding_key, 0.125)
+    )
+    for key, default in zip(bound_keys, default_bounds):
+        if params[key] is None:
+            params[key] = float(default)
+
+    if params[f"{prefix}start_seconds"] is None:
+        params[f"{prefix}start_seconds"] = float(df["elapsed_seconds"].min())
+    if params[f"{prefix}end_seconds"] is None:
+        params[f"{prefix}end_seconds"] = float(df["elapsed_seconds"].max())
+    return params
+
+
+def _init_worker(tracks_path:str, cache_dir:str, duplicate_policy:str="Keep", store_path:Optional[str]=None, chunk_rows:Optional[int]=None) -> None:
+    """Load the track data, or open the chunked store, and configure the shared caches in a worker process"""
+    global _worker_df, _worker_store, _worker_chunk_rows
+
+    import matplotlib
+    matplotlib.use("Agg")
+    import contextily as ctx
+
+    ctx.set_cache_dir(os.path.join(cache_dir, "tiles"))
+    if store_path is not None:
+        from chunked import ChunkedTrackStore
+        _worker_store = ChunkedTrackStore(store_path)
+        _worker_chunk_rows = chunk_rows
+    else:
+        _worker_df = load_tracks(tracks_path, cache_dir, duplicate_policy=duplicate_policy)[0]
+
+
+def _run_chunked_job(job:Dict[str, Any], result:Dict[str, Any]) -> None:
+    """Render a job from the chunked store of the worker, filling in the counts of the result"""
+    store = _worker_store
+    track_ids = store.track_ids(job["files"], job["tracks"])
+    if track_ids.size == 0:
+        raise ValueError("No points match the job's files and tracks")
+    selected = store.tracks[store.tracks["track_id"].isin(track_ids)]
+    result["tracks"] = int(selected["track_name"].nunique())
+    result["points"] = int(selected["rows"].sum())
+    params = resolve_job_params(store.extent_frame(track_ids), job)
+
+    os.makedirs(os.path.dirname(os.path.abspath(result["output"])), exist_ok=True)
+    if job["type"] == "static":
+        if params["stat_render_mode"] == "Small multiples":
+            raise ValueError("Small multiples are not supported in chunked mode")
+        from chunked import render_chunked_static_map
+        from render_cache import figure_to_bytes
+
+        fig = render_chunked_static_map(store, track_ids, params, max_rows=_worker_chunk_rows)
+        image_format = os.path.splitext(result["output"])[1].lstrip(".").lower() or "png"
+        with open(result["output"], "wb") as f:
+            f.write(figure_to_bytes(fig, fmt=image_format))
+    else:
+        from generate_animation import render_animation
+        from resample import frame_resample_step
+
+        # On the absolute time axis, points closer in time than the resampling step are not drawn
+        step = None
+        if params["anim_time_axis"] == "Absolute":
+            step = frame_resample_step(params["anim_start_seconds"], params["anim_end_seconds"], params["anim_fps"], params["anim_duration"])
+        df = store.to_frame(track_ids, params["anim_start_seconds"], params["anim_end_seconds"], step=step, max_rows=_worker_chunk_rows)
+        render_animation(df, params, output_file=result["output"])
+
+
+def run_job(job:Dict[str, Any], output_dir:str) -> Dict[str, Any]:
+    """
+    Render a single job in a worker process.
+    Returns:
+        dict: Report entry with status, output path, timings and counts.
+    """
+    job_start = time.perf_counter()
+    result = {
+        "name": job["name"],
+        "type": job["type"],
+        "output": os.path.join(output_dir, job["output"]),
+        "status": "ok",
+        "error": None,
+        "tracks": 0,
+        "points": 0,
+        "seconds": 0.0,
+    }
+    try:
+        if _worker_store is not None:
+            _run_chunked_job(job, result)
+        else:
+            df = select_job_tracks(_worker_df, job)
+            if df.empty:
+                raise ValueError("No points match the job's files and tracks")
+            result["tracks"] = int(df["track_name"].nunique())
+            result["points"] = int(len(df))
+            params = resolve_job_params(df, job)
+
+            os.makedirs(os.path.dirname(os.path.abspath(result["output"])), exist_ok=True)
+            if job["type"] == "static" and params["stat_render_mode"] == "Small multiples":
+                from small_multiples import image_to_bytes, render_small_multiples
+
+                image = render_small_multiples(
+                    df, params,
+                    group_by=params["stat_panel_group"],
+                    columns=params["stat_panel_columns"],
+                    bounds_mode=params["stat_panel_bounds"],
+                    workers=1
+                )
+                image_format = os.path.splitext(result["output"])[1].lstrip(".").lower() or "png"
+                with open(result["output"], "wb") as f:
+                    f.write(image_to_bytes(image, fmt=image_format))
+            elif job["type"] == "static":
+                from generate_map import render_static_map
+                from render_cache import figure_to_bytes
+
+                fig = render_static_map(df, params)
+                image_format = os.path.splitext(result["output"])[1].lstrip(".").lower() or "png"
+                with open(result["output"], "wb") as f:
+                    f.write(figure_to_bytes(fig, fmt=image_format))
+            else:
+                from generate_animation import render_animation
+
+                render_animation(df, params, output_file=result["output"])
+        result["bytes"] = os.path.getsize(result["output"])
+    except Exception as e:
+        result["status"] = "error"
+        result["error"] = f"{type(e).__name__}: {e}"
+    result["seconds"] = round(time.perf_counter() - job_start, 4)
+    return result
+
+
+def run_batch(
+    tracks_path:str,
+    spec_path:str,
+    output_dir:str,
+    workers:int,
+    cache_dir:str,
+    duplicate_policy:str="Keep",
+    chunk_memory_mb:Optional[int]=None
+) -> Dict[str, Any]:
+    """
+    Parse the tracks once, then render every job of the spec across a process pool.
+    With chunk_memory_mb, the tracks are parsed into a chunked store on disk that the
+    workers stream in chunks of about that many megabytes each.
+    Returns:
+        dict: Machine-readable run report.
+    """
+    run_start = time.perf_counter()
+    jobs = build_jobs(load_job_spec(spec_path))
+
+    # Parse once in the parent to populate the shared parse cache for the workers
+    parse_start = time.perf_counter()
+    parse_errors = []
+    duplicate_report = []
+    store_dir = None
+    chunk_rows = None
+    if chunk_memory_mb is not None:
+        from chunked import rows_per_chunk
+
+        os.makedirs(cache_dir, exist_ok=True)
+        store_dir = tempfile.mkdtemp(prefix="chunked-", dir=cache_dir)
+        chunk_rows = rows_per_chunk(chunk_memory_mb * 1024 * 1024)
+        try:
+            store, num_files = build_chunked_store(tracks_path, cache_dir, store_dir, errors=parse_errors, duplicate_report=duplicate_report)
+            num_points = store.num_rows
+        except ValueError as e:
+            parse_errors.append(str(e))
+            num_files, num_points = 0, 0
+        df = None
+    else:
+        df, num_files = load_tracks(tracks_path, cache_dir, errors=parse_errors, duplicate_policy=duplicate_policy, duplicate_report=duplicate_report)
+        num_points = 0 if df is None else int(len(df))
+    parse_seconds = time.perf_counter() - parse_start
+
+    report = {
+        "tracks_path": os.path.abspath(tracks_path),
+        "spec_path": os.path.abspath(spec_path),
+        "output_dir": os.path.abspath(output_dir),
+        "workers": workers,
+        "parse": {
+            "files": num_files,
+            "points": num_points,
+            "seconds": round(parse_seconds, 4),
+            "errors": parse_errors,
+            "duplicate_policy": duplicate_policy,
+            "duplicates": duplicate_report,
+        },
+        "jobs": [],
+    }
+    if chunk_rows is not None:
+        report["parse"]["chunk_rows"] = chunk_rows
+
+    try:
+        if num_points == 0:
+            report["jobs"] = [
+                {"name": job["name"], "type": job["type"], "status": "error", "error": "No track data parsed"}
+                for job in jobs
+            ]
+        else:
+            with concurrent.futures.ProcessPoolExecutor(
+                max_workers=workers,
+                initializer=_init_worker,
+                initargs=(tracks_path, cache_dir, duplicate_policy, store_dir, chunk_rows)
+            ) as executor:
+                futures = [executor.submit(run_job, job, output_dir) for job in jobs]
+                report["jobs"] = [future.result() for future in futures]
+    finally:
+        if store_dir is not None:
+            shutil.rmtree(store_dir, ignore_errors=True)
+
+    report["failed_jobs"] = sum(job["status"] != "ok" for job in report["jobs"])
+    report["total_seconds"] = round(time.perf_counter() - run_start, 4)
+    return report
+
+
+def main(argv:Optional[List[str]]=None) -> int:
+    parser = argparse.ArgumentParser(description="Render static maps and animations of GPX tracks without the Streamlit app.")
+    parser.add_argument("tracks", help="Directory of GPX files, a .zip/.tar archive or an exported session")
+    parser.add_argument("spec", help="JSON or YAML job spec")
+    parser.add_argument("--output-dir", default="renders", help="Directory for rendered outputs (default: renders)")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="Number of worker processes")
+    parser.add_argument("--cache-dir", default=os.path.join(os.path.expanduser("~"), ".cache", "ski-tracks"), help="Shared tile and parse cache directory")
+    parser.add_argument("--duplicates", choices=["Keep", "Skip", "Merge"], default="Keep", help="Keep, skip or merge duplicate and overlapping recordings (default: Keep)")
+    parser.add_argument("--report", default=None, help="Path of the JSON run report (default: OUTPUT_DIR/report.json)")
+    parser.add_argument("--chunked", action="store_true", help="Process archives larger than memory in chunks streamed from disk")
+    parser.add_argument("--chunk-memory-mb", type=int, default=None, help="Working memory per worker in chunked mode (default: SKI_TRACKS_CHUNK_MB or 256), implies --chunked")
+    args = parser.parse_args(argv)
+
+    chunk_memory_mb = args.chunk_memory_mb
+    if args.chunked and chunk_memory_mb is None:
+        chunk_memory_mb = int(os.environ.get("SKI_TRACKS_CHUNK_MB", "256"))
+    if chunk_memory_mb is not None and args.duplicates != "Keep":
+        parser.error("--duplicates Skip and Merge compare whole recordings and are not available in chunked mode")
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    report = run_batch(args.tracks, args.spec, args.output_dir, max(args.workers, 1), args.cache_dir, args.duplicates, chunk_memory_mb)
+
+    report_path = args.report or os.path.join(args.output_dir, "report.json")
+    with open(report_path, "w") as f:
+        json.dump(report, f, indent=2)
+
+    for job in report["jobs"]:
+        status = job["status"] if job["status"] == "ok" else f"{job['status']}: {job['error']}"
+        print(f"{job['name']}: {status} ({job.get('seconds', 0):.2f} s)")
+    print(f"Report written to {report_path}")
+    return 1 if report["failed_jobs"] else 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
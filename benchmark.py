@@ -0,0 +1,272 @@
+# Benchmark suite for parsing, selection and rendering
+
+"""
+Benchmark the main processing stages on synthetic ski days with an offline basemap.
+
+Usage:
+    python benchmark.py [--tracks N] [--hours H] [--sample-interval S] [--repeat R] [--output PATH]
+    python benchmark.py --compare BASELINE.json CURRENT.json [--threshold 0.1]
+    python benchmark.py --import-breakdown [MODULE]
+
+Results are written as JSON (default: benchmark_results/<commit>.json) so runs
+from different commits can be compared with --compare. The timed calibration
+renders in the results are used by render_planner to estimate render times.
+"""
+
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import time
+from datetime import datetime, timezone
+from typing import Any, Callable, Dict, List, Optional
+
+import matplotlib
+matplotlib.use("Agg")
+import matplotlib.animation as animation
+import matplotlib.pyplot as plt
+
+import map_layers
+from batch_render import LocalGpxFile
+from generate_animation import generate_animation
+from generate_map import generate_map
+from density_map import generate_density_map
+from parse_gpx import parse_gpx_files
+from render_cache import figure_to_bytes
+from render_planner import run_calibration
+from synthetic_tracks import generate_ski_days, stub_fetch_basemap_image, track_to_gpx
+from track_selection import add_track_ids, filter_selected_tracks
+
+
+class FrameDrawWriter(animation.AbstractMovieWriter):
+    """Movie writer that rasterizes every frame like a real encoder but discards the pixels"""
+
+    def setup(self, fig, outfile, dpi=None):
+        super().setup(fig, outfile, dpi=dpi)
+        self.frames = 0
+
+    def grab_frame(self, **savefig_kwargs):
+        self.fig.set_dpi(self.dpi)
+        self.fig.canvas.draw()
+        self.fig.canvas.buffer_rgba()
+        self.frames += 1
+
+    def finish(self):
+        pass
+
+
+def time_call(func:Callable[[], Any], repeat:int, setup:Optional[Callable[[], None]]=None) -> Dict[str, Any]:
+    """Time a function over several runs and return the run times and their median"""
+    runs = []
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        func()
+        runs.append(time.perf_counter() - start)
+    return {"seconds": statistics.median(runs), "runs": runs}
+
+
+def clear_layer_caches() -> None:
+    """Empty the cached render layers so a render is measured cold"""
+    map_layers.BASEMAP_CACHE.clear()
+    map_layers._geometry_cache.clear()
+
+
+# Modules whose cold start is measured, the app page and the batch CLI
+STARTUP_MODULES = ["app", "batch_render"]
+
+
+def measure_startup(module:str, repeat:int) -> Dict[str, Any]:
+    """Time importing a module in a fresh interpreter, which is the cold start of the app or CLI"""
+    runs = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        subprocess.run(
+            [sys.executable, "-c", f"import {module}"],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            capture_output=True, check=True
+        )
+        runs.append(time.perf_counter() - start)
+    return {"seconds": statistics.median(runs), "runs": runs}
+
+
+def import_breakdown(module:str, top:int=15) -> List[Dict[str, Any]]:
+    """
+    Cumulative import time of the direct imports of a module, from python -X importtime.
+    Returns:
+        list: Rows with the module name and its cumulative import time in seconds, slowest first.
+    """
+    stderr = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        cwd=os.path.dirname(os.path.abspath(__file__)),
+        capture_output=True, text=True, check=True
+    ).stderr
+    packages = {}
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        # Direct imports of the module are indented one level, nested ones are already counted in them
+        if name.startswith("   ") and not name.startswith("    "):
+            packages[name.strip()] = packages.get(name.strip(), 0) + int(cumulative) / 1e6
+    return [
+        {"module": name, "seconds": seconds}
+        for name, seconds in sorted(packages.items(), key=lambda item: item[1], reverse=True)[:top]
+    ]
+
+
+def get_commit() -> Optional[str]:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmarks(tracks:int, hours:float, sample_interval:float, repeat:int, frames:int) -> Dict[str, Any]:
+    """
+    Run the benchmark suite on synthetic data.
+    Returns:
+        dict: Benchmark results keyed by stage name.
+    """
+    # Render against an offline stub basemap so results do not depend on the network
+    map_layers.fetch_basemap_image = stub_fetch_basemap_image
+
+    df = generate_ski_days(tracks, duration_hours=hours, sample_interval=sample_interval)
+    num_points = len(df)
+    gpx_files = [
+        LocalGpxFile(f"{file_name}.gpx", track_to_gpx(track_data).encode())
+        for file_name, track_data in df.groupby("file_name")
+    ]
+    start_time = float(df["elapsed_seconds"].min())
+    end_time = float(df["elapsed_seconds"].max())
+    results = {}
+
+    for module in STARTUP_MODULES:
+        results[f"startup_{module}"] = measure_startup(module, repeat)
+
+    results["parse"] = time_call(lambda: parse_gpx_files(gpx_files), repeat)
+
+    df = add_track_ids(df)
+    half_track_ids = list(df["track_id"].cat.categories[::2])
+    results["selection"] = time_call(lambda: filter_selected_tracks(df, half_track_ids), repeat)
+
+    def render_static():
+        figure_to_bytes(generate_map(df, fig_width=12, start_time=start_time, end_time=end_time, show_start_end_points=True))
+
+    results["static_render_cold"] = time_call(render_static, repeat, setup=clear_layer_caches)
+    results["static_render_warm"] = time_call(render_static, repeat)
+
+    def render_density():
+        figure_to_bytes(generate_density_map(df, fig_width=12, start_time=start_time, end_time=end_time))
+
+    results["density_render"] = time_call(render_density, repeat)
+
+    # Animation frames are drawn with a writer that rasterizes without encoding
+    fps = 24
+    duration = max(frames // fps, 1)
+
+    def render_animation_frames():
+        writer = FrameDrawWriter(fps=fps)
+        generate_animation(
+            df, fps=fps, duration=duration, dpi=100, fig_width=12,
+            start_time=start_time, end_time=end_time, writer=writer
+        )
+
+    results["animation_frames"] = time_call(render_animation_frames, repeat)
+    results["animation_frames"]["frames"] = fps * duration + 1
+    results["animation_frames"]["seconds_per_frame"] = results["animation_frames"]["seconds"] / (fps * duration + 1)
+
+    # Renders of varied size timed for the render time estimates of render_planner
+    calibration_start = time.perf_counter()
+    calibration_samples = run_calibration(repeat)
+    results["render_calibration"] = {"seconds": time.perf_counter() - calibration_start, "samples": calibration_samples}
+
+    results["parse"]["points_per_second"] = num_points / results["parse"]["seconds"]
+    plt.close("all")
+
+    return {
+        "commit": get_commit(),
+        "timestamp": datetime.now(timezone.utc).isoformat(),
+        "python": sys.version.split()[0],
+        "platform": platform.platform(),
+        "config": {
+            "tracks": tracks,
+            "hours": hours,
+            "sample_interval": sample_interval,
+            "repeat": repeat,
+            "points": num_points,
+        },
+        "results": results,
+    }
+
+
+def compare_results(baseline:Dict[str, Any], current:Dict[str, Any], threshold:float) -> List[str]:
+    """
+    Print a comparison of two result files and return the names of regressed stages.
+    A stage regresses when its median time grows by more than the threshold fraction.
+    """
+    regressions = []
+    print(f"{'stage':<22}{'baseline (s)':>14}{'current (s)':>14}{'ratio':>8}")
+    for name, current_result in current["results"].items():
+        baseline_result = baseline["results"].get(name)
+        if baseline_result is None:
+            print(f"{name:<22}{'-':>14}{current_result['seconds']:>14.4f}{'-':>8}")
+            continue
+        ratio = current_result["seconds"] / baseline_result["seconds"]
+        flag = ""
+        if ratio > 1 + threshold:
+            regressions.append(name)
+            flag = "  REGRESSION"
+        print(f"{name:<22}{baseline_result['seconds']:>14.4f}{current_result['seconds']:>14.4f}{ratio:>8.2f}{flag}")
+    if baseline.get("config") != current.get("config"):
+        print("Warning: the two runs used different benchmark configurations.")
+    return regressions
+
+
+def main(argv:Optional[List[str]]=None) -> int:
+    parser = argparse.ArgumentParser(description="Benchmark parsing, selection and rendering on synthetic ski days.")
+    parser.add_argument("--tracks", type=int, default=8, help="Number of synthetic tracks")
+    parser.add_argument("--hours", type=float, default=6.0, help="Duration of each track in hours")
+    parser.add_argument("--sample-interval", type=float, default=1.0, help="Seconds between recorded points")
+    parser.add_argument("--repeat", type=int, default=3, help="Number of runs per benchmark")
+    parser.add_argument("--frames", type=int, default=48, help="Approximate number of animation frames to draw")
+    parser.add_argument("--output", default=None, help="Path of the JSON results file")
+    parser.add_argument("--compare", nargs=2, metavar=("BASELINE", "CURRENT"), help="Compare two results files")
+    parser.add_argument("--threshold", type=float, default=0.1, help="Relative slowdown reported as a regression")
+    parser.add_argument("--import-breakdown", nargs="?", const="app", metavar="MODULE", help="Print the slowest imports of a module (default: app)")
+    args = parser.parse_args(argv)
+
+    if args.import_breakdown:
+        for row in import_breakdown(args.import_breakdown):
+            print(f"{row['module']:<40}{row['seconds']:>10.4f} s")
+        return 0
+
+    if args.compare:
+        with open(args.compare[0]) as f:
+            baseline = json.load(f)
+        with open(args.compare[1]) as f:
+            current = json.load(f)
+        return 1 if compare_results(baseline, current, args.threshold) else 0
+
+    report = run_benchmarks(args.tracks, args.hours, args.sample_interval, args.repeat, args.frames)
+    output = args.output or os.path.join("benchmark_results", f"{report['commit'] or 'local'}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w") as f:
+        json.dump(report, f, indent=2)
+
+    for name, result in report["results"].items():
+        print(f"{name:<22}{result['seconds']:>10.4f} s")
+    print(f"Results written to {output}")
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,535 @@
+# Out-of-core processing of track archives larger than memory
+
+"""
+A ChunkedTrackStore keeps the points of many GPX files in one Parquet file on disk,
+sorted by track and time, with compact columns: an int32 track id in place of the
+file and track names (which are kept in the manifest), the local wall-clock time as
+int64 nanoseconds, float32 elevation and an int8 segment type code. Files are parsed,
+normalized and segmented one at a time while the store is built, so only one file is
+held in memory.
+
+Readers stream bounded chunks in track order. A track can span several chunks. Such
+a chunk starts with the last point of the previous chunk, so segments across the
+boundary are kept. Selection, simplification to the output
+resolution, density binning and static map rendering run chunk by chunk. Peak memory
+follows the chunk budget (SKI_TRACKS_CHUNK_MB) rather than the size of the data.
+"""
+
+import fnmatch
+import json
+import os
+from dataclasses import dataclass
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Sequence
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from density_map import _bin_points, _bin_segments, density_grid_geometry, lonlat_to_mercator
+from profiling import stage
+from segmentation import SEGMENT_TYPES
+from shared_cache import cache_size_mb
+from timeline import SECONDS_PER_DAY
+
+# Working memory of the processing steps, the main knob of peak memory
+CHUNK_MEMORY_BYTES = cache_size_mb("SKI_TRACKS_CHUNK_MB", 256)
+
+# Memory per row of a chunk: the decoded Arrow batch, its pandas columns and the
+# projected coordinates and masks of the processing steps
+BYTES_PER_CHUNK_ROW = 200
+
+# Rows per Parquet row group, the unit that readers decode and skip
+ROW_GROUP_ROWS = 131_072
+
+# Simplified lines keep one point per cell of this fraction of an output pixel
+SIMPLIFY_PIXEL_FRACTION = 0.5
+
+POINTS_FILE = "points.parquet"
+MANIFEST_FILE = "manifest.json"
+
+POINT_SCHEMA = pa.schema([
+    ("track_id", pa.int32()),
+    ("local_time", pa.int64()),
+    ("latitude", pa.float64()),
+    ("longitude", pa.float64()),
+    ("elevation", pa.float32()),
+    ("segment_code", pa.int8()),
+])
+
+
+def rows_per_chunk(memory_bytes:Optional[int]=None) -> int:
+    """Number of rows of a chunk that fits in a memory budget, CHUNK_MEMORY_BYTES if None"""
+    memory_bytes = CHUNK_MEMORY_BYTES if memory_bytes is None else memory_bytes
+    return max(int(memory_bytes // BYTES_PER_CHUNK_ROW), 1024)
+
+
+@dataclass
+class PointChunk:
+    """
+    Points of a chunk with 'track_id', 'elapsed_seconds', 'latitude', 'longitude',
+    'elevation' and 'segment_code' columns. When continued is True the first row
+    repeats the last row of the previous chunk, whose track goes on in this chunk.
+    """
+    points: pd.DataFrame
+    continued: bool = False
+
+
+def _local_time_ns(timestamps:pd.Series) -> np.ndarray:
+    """Local wall-clock time of timestamps as int64 nanoseconds, dropping their timezone"""
+    if getattr(timestamps.dt, "tz", None) is not None:
+        timestamps = timestamps.dt.tz_localize(None)
+    return timestamps.to_numpy().astype("datetime64[ns]").astype(np.int64)
+
+
+def _keep_changes(track_id:np.ndarray, keys:Sequence[np.ndarray], continued:bool) -> np.ndarray:
+    """
+    Rows where a track starts or ends or any of the keys changes. The last row of a
+    chunk is kept since its track may end there, and a carried over row is dropped.
+    """
+    n = track_id.size
+    keep = np.ones(n, dtype=bool)
+    if n > 1:
+        changed = track_id[1:] != track_id[:-1]
+        track_end = changed.copy()
+        for key in keys:
+            changed |= key[1:] != key[:-1]
+        keep[1:] = changed
+        keep[:-1] |= track_end
+    if continued:
+        keep[0] = False
+    return keep
+
+
+class ChunkedTrackStore:
+    """
+    Points of many tracks in a Parquet file on disk, read in bounded chunks.
+    Args:
+        path (str): Directory of the store, as written by create.
+    """
+
+    def __init__(self, path:str):
+        self.path = path
+        with open(os.path.join(path, MANIFEST_FILE), "r") as f:
+            manifest = json.load(f)
+        self.origin_ns = int(manifest["origin_ns"])
+        self.num_rows = int(manifest["rows"])
+        self.duplicate_report = manifest.get("duplicates", [])
+        self.tracks = pd.DataFrame(manifest["tracks"], columns=[
+            "track_id", "file_name", "track_name", "rows",
+            "start_ns", "end_ns", "lat_min", "lat_max", "lon_min", "lon_max",
+        ])
+        self.tracks["start_seconds"] = (self.tracks["start_ns"] - self.origin_ns) / 1e9
+        self.tracks["end_seconds"] = (self.tracks["end_ns"] - self.origin_ns) / 1e9
+
+    @property
+    def points_path(self) -> str:
+        return os.path.join(self.path, POINTS_FILE)
+
+    @classmethod
+    def create(
+        cls,
+        path:str,
+        sources:Iterable[Any],
+        parse:Callable[[Any], Optional[pd.DataFrame]],
+        duplicate_report:Optional[List[Dict[str, Any]]]=None
+    ) -> "ChunkedTrackStore":
+        """
+        Build a store from GPX files, parsing and segmenting one file at a time.
+        Args:
+            path (str): New directory of the store.
+            sources (iterable): GPX files, objects with a name attribute and a getvalue
+                method. They can be generated lazily and are read one at a time.
+            parse (callable): Parses one file into its track data, None if it has no points.
+            duplicate_report (list, optional): List that report rows of identical files are appended to.
+        Returns:
+            ChunkedTrackStore: The new store.
+        """
+        from duplicates import iter_unique_files
+        from segmentation import segment_tracks
+
+        os.makedirs(path, exist_ok=True)
+        file_report = []
+        tracks = []
+        pending = []
+        pending_rows = 0
+        with stage("chunked_ingest") as ingest_stage, pq.ParquetWriter(os.path.join(path, POINTS_FILE), POINT_SCHEMA) as writer:
+            for source in iter_unique_files(sources, file_report):
+                df = parse(source)
+                if df is None or df.empty:
+                    continue
+                df, _ = segment_tracks(df)
+
+                track_names = df["track_name"].to_numpy()
+                starts = np.flatnonzero(np.append(True, track_names[1:] != track_names[:-1]))
+                ends = np.append(starts[1:], len(df))
+                track_ids = np.repeat(np.arange(len(tracks), len(tracks) + starts.size, dtype=np.int32), ends - starts)
+                local_time = _local_time_ns(df["timestamp"])
+                latitude = df["latitude"].to_numpy(dtype=np.float64)
+                longitude = df["longitude"].to_numpy(dtype=np.float64)
+                for start, end in zip(starts, ends):
+                    tracks.append({
+                        "track_id": len(tracks),
+                        "file_name": str(df["file_name"].iat[start]),
+                        "track_name": track_names[start],
+                        "rows": int(end - start),
+                        "start_ns": int(local_time[start]),
+                        "end_ns": int(local_time[end - 1]),
+                        "lat_min": float(latitude[start:end].min()),
+                        "lat_max": float(latitude[start:end].max()),
+                        "lon_min": float(longitude[start:end].min()),
+                        "lon_max": float(longitude[start:end].max()),
+                    })
+
+                pending.append(pa.Table.from_arrays([
+                    pa.array(track_ids),
+                    pa.array(local_time),
+                    pa.array(latitude),
+                    pa.array(longitude),
+                    pa.array(df["elevation"].to_numpy(dtype=np.float32, na_value=np.nan)),
+                    pa.array(df["segment_type"].cat.codes.to_numpy().astype(np.int8)),
+                ], schema=POINT_SCHEMA))
+                pending_rows += len(df)
+
+                # Write whole row groups and keep the remainder for the next files
+                if pending_rows >= ROW_GROUP_ROWS:
+                    table = pa.concat_tables(pending)
+                    full_rows = pending_rows - pending_rows % ROW_GROUP_ROWS
+                    writer.write_table(table.slice(0, full_rows), row_group_size=ROW_GROUP_ROWS)
+                    pending = [table.slice(full_rows)]
+                    pending_rows -= full_rows
+            if pending_rows:
+                writer.write_table(pa.concat_tables(pending), row_group_size=ROW_GROUP_ROWS)
+            ingest_stage.add(points=sum(track["rows"] for track in tracks), tracks=len(tracks))
+
+        if not tracks:
+            raise ValueError("No track points were parsed")
+        # The timeline starts at midnight of the earliest day, as add_timeline does
+        first_ns = min(track["start_ns"] for track in tracks)
+        origin_ns = int(pd.Timestamp(first_ns).normalize().value)
+        with open(os.path.join(path, MANIFEST_FILE), "w") as f:
+            json.dump({
+                "origin_ns": origin_ns,
+                "rows": sum(track["rows"] for track in tracks),
+                "tracks": tracks,
+                "duplicates": file_report,
+            }, f)
+        if duplicate_report is not None:
+            duplicate_report.extend(file_report)
+        return cls(path)
+
+    def track_ids(self, files:Optional[Sequence[str]]=None, tracks:Optional[Sequence[str]]=None) -> np.ndarray:
+        """Sorted ids of the tracks matching glob patterns on file names and a list of track names"""
+        mask = np.ones(len(self.tracks), dtype=bool)
+        if files:
+            mask &= np.array([any(fnmatch.fnmatch(name, pattern) for pattern in files) for name in self.tracks["file_name"]], dtype=bool)
+        if tracks:
+            mask &= self.tracks["track_name"].isin(tracks).to_numpy()
+        return self.tracks["track_id"].to_numpy()[mask].astype(np.int32)
+
+    def extent_frame(self, track_ids:np.ndarray) -> pd.DataFrame:
+        """
+        Two rows holding the minimum and maximum latitude, longitude and time of the tracks,
+        from the manifest. Functions computing bounds from min and max accept it in place of the data.
+        """
+        selected = self.tracks[self.tracks["track_id"].isin(track_ids)]
+        return pd.DataFrame({
+            "latitude": [selected["lat_min"].min(), selected["lat_max"].max()],
+            "longitude": [selected["lon_min"].min(), selected["lon_max"].max()],
+            "elapsed_seconds": [selected["start_seconds"].min(), selected["end_seconds"].max()],
+        })
+
+    def _to_points(self, table:pa.Table) -> pd.DataFrame:
+        df = table.to_pandas()
+        df["elapsed_seconds"] = (df.pop("local_time").to_numpy() - self.origin_ns) / 1e9
+        return df
+
+    def _time_ns(self, seconds:Optional[float]) -> Optional[int]:
+        return None if seconds is None else self.origin_ns + int(round(seconds * 1e9))
+
+    def _row_groups(self, parquet_file:pq.ParquetFile, track_ids:Optional[np.ndarray], start_ns:Optional[int], end_ns:Optional[int]) -> List[int]:
+        """Row groups that can hold points of the tracks within the time range, from their statistics"""
+        metadata = parquet_file.metadata
+        id_column = POINT_SCHEMA.get_field_index("track_id")
+        time_column = POINT_SCHEMA.get_field_index("local_time")
+        row_groups = []
+        for k1 in range(metadata.num_row_groups):
+            id_stats = metadata.row_group(k1).column(id_column).statistics
+            time_stats = metadata.row_group(k1).column(time_column).statistics
+            if track_ids is not None and id_stats is not None and id_stats.has_min_max:
+                first = np.searchsorted(track_ids, id_stats.min, side="left")
+                if first >= track_ids.size or track_ids[first] > id_stats.max:
+                    continue
+            if time_stats is not None and time_stats.has_min_max:
+                if (start_ns is not None and time_stats.max < start_ns) or (end_ns is not None and time_stats.min > end_ns):
+                    continue
+            row_groups.append(k1)
+        return row_groups
+
+    def iter_chunks(
+        self,
+        track_ids:Optional[np.ndarray]=None,
+        start_time:Optional[float]=None,
+        end_time:Optional[float]=None,
+        max_rows:Optional[int]=None
+    ) -> Iterator[PointChunk]:
+        """
+        Stream the points of the tracks in track order, sorted by time within each track.
+        Args:
+            track_ids (np.ndarray, optional): Sorted ids of the tracks to read, all if None.
+            start_time, end_time (float, optional): Time range in seconds on the timeline, all points if None.
+            max_rows (int, optional): Rows read per chunk, rows_per_chunk() if None.
+        Yields:
+            PointChunk: Chunks of at most max_rows points, plus the carried over row.
+        """
+        max_rows = rows_per_chunk() if max_rows is None else max_rows
+        start_ns, end_ns = self._time_ns(start_time), self._time_ns(end_time)
+        parquet_file = pq.ParquetFile(self.points_path)
+        row_groups = self._row_groups(parquet_file, track_ids, start_ns, end_ns)
+        if not row_groups:
+            return
+        carry = None
+        for batch in parquet_file.iter_batches(batch_size=max_rows, row_groups=row_groups):
+            with stage("chunk_read", rows=batch.num_rows):
+                table = pa.Table.from_batches([batch])
+                keep = np.ones(table.num_rows, dtype=bool)
+                if track_ids is not None:
+                    keep &= np.isin(table.column("track_id").to_numpy(), track_ids)
+                if start_ns is not None or end_ns is not None:
+                    local_time = table.column("local_time").to_numpy()
+                    if start_ns is not None:
+                        keep &= local_time >= start_ns
+                    if end_ns is not None:
+                        keep &= local_time <= end_ns
+                if not keep.all():
+                    table = table.filter(pa.array(keep))
+                if table.num_rows == 0:
+                    continue
+                points = self._to_points(table)
+
+            continued = carry is not None and carry["track_id"].iat[0] == points["track_id"].iat[0]
+            if continued:
+                points = pd.concat([carry, points], ignore_index=True)
+            carry = points.iloc[-1:].reset_index(drop=True)
+            yield PointChunk(points, continued)
+
+    def to_frame(
+        self,
+        track_ids:Optional[np.ndarray]=None,
+        start_time:Optional[float]=None,
+        end_time:Optional[float]=None,
+        step:Optional[float]=None,
+        max_rows:Optional[int]=None
+    ) -> pd.DataFrame:
+        """
+        Load the points of the tracks as combined track data, as parse_gpx_files, add_timeline
+        and segment_tracks produce it, with categorical names and float32 elevation.
+        Args:
+            track_ids (np.ndarray, optional): Sorted ids of the tracks to load, all if None.
+            start_time, end_time (float, optional): Time range in seconds on the timeline, all points if None.
+            step (float, optional): Keep only the first point of every step seconds of each track
+                and its last point. The chunks are thinned as they are read, so memory follows
+                the thinned result and one chunk.
+            max_rows (int, optional): Rows read per chunk.
+        Returns:
+            pd.DataFrame: Track data sorted by track and time.
+        """
+        parts = []
+        for chunk in self.iter_chunks(track_ids, start_time, end_time, max_rows):
+            points = chunk.points
+            if step is not None:
+                time_bucket = np.floor(points["elapsed_seconds"].to_numpy() / step)
+                keep = _keep_changes(points["track_id"].to_numpy(), [time_bucket], chunk.continued)
+            else:
+                keep = np.ones(len(points), dtype=bool)
+                keep[0] = not chunk.continued
+            parts.append(points[keep])
+        if not parts:
+            return pd.DataFrame(columns=["file_name", "track_name", "timestamp", "latitude", "longitude", "elevation", "elapsed_seconds"])
+        return self._track_data(pd.concat(parts, ignore_index=True))
+
+    def _track_data(self, points:pd.DataFrame) -> pd.DataFrame:
+        """Turn points of the store into track data with names, timestamps and timeline columns"""
+        # Track ids are the rows of the manifest, names are looked up as category codes
+        track_ids = points["track_id"].to_numpy()
+        file_codes, file_names = pd.factorize(self.tracks["file_name"])
+        track_codes, track_names = pd.factorize(self.tracks["track_name"])
+        elapsed = points["elapsed_seconds"].to_numpy()
+        day_index = np.floor(elapsed / SECONDS_PER_DAY)
+        return pd.DataFrame({
+            "file_name": pd.Categorical.from_codes(file_codes[track_ids], categories=file_names),
+            "track_name": pd.Categorical.from_codes(track_codes[track_ids], categories=track_names),
+            "timestamp": pd.Timestamp(self.origin_ns) + pd.to_timedelta(elapsed, unit="s"),
+            "latitude": points["latitude"].to_numpy(),
+            "longitude": points["longitude"].to_numpy(),
+            "elevation": points["elevation"].to_numpy(),
+            "elapsed_seconds": elapsed,
+            "day_index": day_index.astype(np.int16),
+            "time_of_day": elapsed - day_index * SECONDS_PER_DAY,
+            "segment_type": pd.Categorical.from_codes(points["segment_code"].to_numpy(), categories=SEGMENT_TYPES),
+        })
+
+
+def simplified_track_data(
+    store:ChunkedTrackStore,
+    track_ids:np.ndarray,
+    *,
+    lat_min:float,
+    lat_max:float,
+    lon_min:float,
+    lon_max:float,
+    width_px:int,
+    height_px:int,
+    start_time:Optional[float]=None,
+    end_time:Optional[float]=None,
+    max_rows:Optional[int]=None
+) -> pd.DataFrame:
+    """
+    Load the tracks simplified to the resolution of an output image. Of consecutive points
+    within the same cell of SIMPLIFY_PIXEL_FRACTION pixels only the first is kept, along
+    with the first and last point of every track and the points where the segment type
+    changes, so the result grows with the image size rather than the number of points.
+    Args:
+        store (ChunkedTrackStore): Store to read.
+        track_ids (np.ndarray): Sorted ids of the tracks.
+        lat_min, lat_max, lon_min, lon_max (float): Bounds of the output image.
+        width_px, height_px (int): Size of the output image in pixels.
+        start_time, end_time (float, optional): Time range in seconds on the timeline.
+        max_rows (int, optional): Rows read per chunk.
+    Returns:
+        pd.DataFrame: Simplified track data.
+    """
+    cell_lon = (lon_max - lon_min) / max(width_px, 1) * SIMPLIFY_PIXEL_FRACTION
+    cell_lat = (lat_max - lat_min) / max(height_px, 1) * SIMPLIFY_PIXEL_FRACTION
+    parts = []
+    with stage("chunked_simplify") as simplify_stage:
+        for chunk in store.iter_chunks(track_ids, start_time, end_time, max_rows):
+            points = chunk.points
+            keep = _keep_changes(
+                points["track_id"].to_numpy(),
+                [
+                    np.floor((points["longitude"].to_numpy() - lon_min) / cell_lon),
+                    np.floor((points["latitude"].to_numpy() - lat_min) / cell_lat),
+                    points["segment_code"].to_numpy(),
+                ],
+                chunk.continued
+            )
+            parts.append(points[keep])
+        kept = pd.concat(parts, ignore_index=True) if parts else None
+        simplify_stage.add(points=0 if kept is None else len(kept))
+    if kept is None:
+        raise ValueError("No points in the selected time range")
+    return store._track_data(kept)
+
+
+def chunked_density_grid(
+    store:ChunkedTrackStore,
+    track_ids:np.ndarray,
+    *,
+    lat_min:float,
+    lat_max:float,
+    lon_min:float,
+    lon_max:float,
+    resolution:int=512,
+    interpolate:bool=True,
+    start_time:Optional[float]=None,
+    end_time:Optional[float]=None,
+    max_rows:Optional[int]=None
+) -> np.ndarray:
+    """
+    Accumulate the density grid of compute_density_grid over the chunks of a store.
+    Returns:
+        np.ndarray: Count grid of shape (ny, nx) with row 0 at the southern edge.
+    """
+    x_min, y_min, cell_x, cell_y, ny, nx = density_grid_geometry(lat_min, lat_max, lon_min, lon_max, resolution)
+    grid = np.zeros((ny, nx), dtype=np.float64)
+    # The last point of a chunk is binned once it is known whether its track goes on
+    pending_last = None
+    with stage("chunked_density", resolution=resolution):
+        for chunk in store.iter_chunks(track_ids, start_time, end_time, max_rows):
+            track_codes = chunk.points["track_id"].to_numpy()
+            x, y = lonlat_to_mercator(chunk.points["longitude"].to_numpy(), chunk.points["latitude"].to_numpy())
+            if not interpolate:
+                first = 1 if chunk.continued else 0
+                _bin_points(grid, x[first:], y[first:], x_min, y_min, cell_x, cell_y)
+                continue
+
+            if pending_last is not None and not chunk.continued:
+                _bin_points(grid, *pending_last, x_min, y_min, cell_x, cell_y)
+            same_track = np.append(track_codes[1:] == track_codes[:-1], False)
+            _bin_segments(grid, x, y, same_track, x_min, y_min, cell_x, cell_y)
+            # Segment sampling covers each segment's start, add the final point of every track
+            track_last = np.flatnonzero(~same_track)[:-1]
+            _bin_points(grid, x[track_last], y[track_last], x_min, y_min, cell_x, cell_y)
+            pending_last = (x[-1:], y[-1:])
+        if pending_last is not None:
+            _bin_points(grid, *pending_last, x_min, y_min, cell_x, cell_y)
+    return grid
+
+
+def render_chunked_static_map(
+    store:ChunkedTrackStore,
+    track_ids:np.ndarray,
+    stat_params:Dict[str, Any],
+    dpi:int=200,
+    max_rows:Optional[int]=None
+):
+    """
+    Render a static map of tracks of a store with bounded memory. Density heatmaps are
+    accumulated chunk by chunk, track lines are simplified to the output resolution
+    chunk by chunk before they are drawn.
+    Args:
+        store (ChunkedTrackStore): Store to read.
+        track_ids (np.ndarray): Sorted ids of the tracks.
+        stat_params (dict): Static map parameters with the map bounds set.
+        dpi (int): Resolution the figure is saved at.
+        max_rows (int, optional): Rows read per chunk.
+    Returns:
+        fig (matplotlib.figure.Figure): The generated map figure.
+    """
+    from density_map import generate_density_map
+    from generate_map import render_static_map
+
+    bounds = {
+        "lat_min": stat_params["stat_lat_min"],
+        "lat_max": stat_params["stat_lat_max"],
+        "lon_min": stat_params["stat_lon_min"],
+        "lon_max": stat_params["stat_lon_max"],
+    }
+    if stat_params["stat_render_mode"] == "Density heatmap":
+        grid = chunked_density_grid(
+            store,
+            track_ids,
+            **bounds,
+            resolution=stat_params["stat_density_resolution"],
+            interpolate=stat_params["stat_density_interpolate"],
+            start_time=stat_params["stat_start_seconds"],
+            end_time=stat_params["stat_end_seconds"],
+            max_rows=max_rows
+        )
+        return generate_density_map(
+            None,
+            map_style=stat_params["stat_map_style"],
+            fig_width=int(stat_params["stat_fig_width"]),
+            show_coordinates=stat_params["stat_show_coordinates"],
+            title=stat_params["stat_title"],
+            resolution=stat_params["stat_density_resolution"],
+            scaling=stat_params["stat_density_scaling"],
+            cmap=stat_params["stat_density_cmap"],
+            grid=grid,
+            **bounds
+        )
+
+    fig_width = int(stat_params["stat_fig_width"])
+    aspect = (bounds["lat_max"] - bounds["lat_min"]) / (bounds["lon_max"] - bounds["lon_min"])
+    df = simplified_track_data(
+        store,
+        track_ids,
+        **bounds,
+        width_px=int(fig_width * dpi),
+        height_px=int(fig_width * aspect * dpi),
+        start_time=stat_params["stat_start_seconds"],
+        end_time=stat_params["stat_end_seconds"],
+        max_rows=max_rows
+    )
+    return render_static_map(df, stat_params)
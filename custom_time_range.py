@@ -1,66 +1,64 @@
 #
 
-import numpy as np
 import pandas as pd
 import streamlit as st
 
+from timeline import SECONDS_PER_DAY, format_timeline_time, get_timeline_index, get_timeline_origin
+
+# Step of the time range slider
+TIME_STEP_SECONDS = 15 * 60
+
 
 def get_custom_time_range(df_selected_tracks, prefix:str):
     """
     Custom time range selection for animation based on selected tracks.
-    Allows users to select a specific time range for the animation.
+    Allows users to select a specific time range on the absolute multi-day timeline.
+    Returns:
+        tuple: Start and end seconds on the timeline, or (None, None) for the whole data range.
     """
 
-    start_seconds = 0
-    end_seconds = 24 * 3600
+    start_seconds = None
+    end_seconds = None
     with st.expander("Custom Time Range", expanded=False):
-        
-        if df_selected_tracks is not None and not df_selected_tracks.empty:
 
-            num_days = np.ceil(df_selected_tracks["elapsed_seconds"].max() / (24*3600))
-            num_days = int(max(num_days, 1))
-
-            data_time_min_hour = int(np.floor(df_selected_tracks["elapsed_seconds"].min() / 3600))
-            data_time_min_minute = int(np.floor((df_selected_tracks["elapsed_seconds"].min() % 3600) / 60))
+        if df_selected_tracks is not None and not df_selected_tracks.empty:
 
-            data_time_max_hour = int(np.floor(df_selected_tracks["elapsed_seconds"].max() / 3600 - 24*(num_days-1)))
-            data_time_max_minute = int(np.floor((df_selected_tracks["elapsed_seconds"].max() % 3600) / 60))
+            timeline_index = get_timeline_index(df_selected_tracks)
+            min_time = timeline_index.start
+            max_time = timeline_index.end
+            num_days = int(max_time // SECONDS_PER_DAY - min_time // SECONDS_PER_DAY) + 1
 
-            st.write(f"Data time range: Day {1} at {data_time_min_hour:02d}:{data_time_min_minute:02d}  -  Day {num_days} at {data_time_max_hour:02d}:{data_time_max_minute:02d}")
+            st.write(f"Data time range: {format_timeline_time(min_time)}  -  {format_timeline_time(max_time)} ({len(timeline_index.active_days())} day(s) with data)")
 
-            min_time = df_selected_tracks["elapsed_seconds"].min()
+            # Default to the data range widened to whole 30-minute intervals
             min_time_rounded = min_time - (min_time % (30*60))
-            max_time = df_selected_tracks["elapsed_seconds"].max()
-            max_time_rounded = max_time - (max_time % (30*60)) + 30*60
+            max_time_rounded = min(max_time - (max_time % (30*60)) + 30*60, (max_time // SECONDS_PER_DAY + 1) * SECONDS_PER_DAY)
 
-            time_options = []
-            for hour in range(num_days*24 + 1):
-                for minute in [0, 15, 30, 45]:
-                    if hour == num_days*24 and minute > 0:
-                        continue
-                    time_options.append(f"{hour:02d}:{minute:02d}")
-
-            # Default to nearest 30-minute intervals
-            time_slider_default_start_idx = min(int(2*np.floor(min_time_rounded / (30*60))), len(time_options)-1)
-            time_slider_default_end_idx = min(int(2*np.ceil(max_time_rounded / (30*60))), len(time_options)-1)
-
-            # Create a range slider using the select_slider
-            time_slider_selected_range = st.select_slider(
+            # The slider works on datetimes on the data's local calendar
+            origin = get_timeline_origin(df_selected_tracks).to_pydatetime()
+            slider_min = origin + pd.Timedelta(seconds=min_time_rounded).to_pytimedelta()
+            slider_max = origin + pd.Timedelta(seconds=max_time_rounded).to_pytimedelta()
+            time_slider_selected_range = st.slider(
                 "Time range",
-                options=time_options,
-                value=(time_options[time_slider_default_start_idx], time_options[time_slider_default_end_idx]),
-                key=f"{prefix}_time_slider_range"
+                min_value=slider_min,
+                max_value=slider_max,
+                value=(slider_min, slider_max),
+                step=pd.Timedelta(seconds=TIME_STEP_SECONDS).to_pytimedelta(),
+                format="MMM D HH:mm" if num_days > 1 else "HH:mm",
+                # Keyed by the data range so a stale selection outside it is never reused
+                key=f"{prefix}_time_slider_range_{int(min_time_rounded)}_{int(max_time_rounded)}"
             )
 
             start_time_selected, end_time_selected = time_slider_selected_range
+            start_seconds = (start_time_selected - origin).total_seconds()
+            end_seconds = (end_time_selected - origin).total_seconds()
 
-            start_hour, start_minute = map(int, start_time_selected.split(":"))
-            end_hour, end_minute = map(int, end_time_selected.split(":"))
-
-            start_seconds = 3600 * start_hour + 60 * start_minute
-            end_seconds = 3600 * end_hour + 60 * end_minute
+            # The whole range is passed as None so renderers can skip time filtering
+            if start_seconds <= min_time and end_seconds >= max_time:
+                start_seconds = None
+                end_seconds = None
 
         else:
             st.write("No data available for custom time range selection. Upload GPX files and select one or more tracks.")
-    
-    return start_seconds, end_seconds
\ No newline at end of file
+
+    return start_seconds, end_seconds
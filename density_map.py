@@ -0,0 +1,383 @@
+# Density heatmap rendering for large numbers of tracks
+
+import numpy as np
+import pandas as pd
+from collections import OrderedDict
+from typing import Optional, Tuple
+
+from map_layers import draw_basemap_layer, get_basemap_layer
+from profiling import stage
+from spatial_index import get_spatial_index
+from timeline import get_timeline_index
+from util import get_dataframe_hash
+
+# Radius of the spherical Web Mercator projection (EPSG:3857) in meters
+EARTH_RADIUS_M = 6378137.0
+
+# Number of interpolated samples generated per chunk when binning segments.
+# Keeps peak memory bounded independently of the number of points.
+DENSITY_CHUNK_SIZE = 2_000_000
+
+# Upper bound on the number of samples interpolated along a single segment
+MAX_SAMPLES_PER_SEGMENT = 256
+
+DENSITY_SCALINGS = ["log", "eq_hist", "linear"]
+DENSITY_COLORMAPS = ["inferno", "magma", "plasma", "viridis", "hot", "turbo"]
+
+# Small LRU cache of density grids keyed by data hash, bounds and resolution
+_DENSITY_GRID_CACHE_SIZE = 8
+_density_grid_cache = OrderedDict()
+
+
+def lonlat_to_mercator(lon, lat) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Project longitude and latitude in degrees to Web Mercator meters.
+    Args:
+        lon (array-like): Longitudes in degrees.
+        lat (array-like): Latitudes in degrees.
+    Returns:
+        tuple: Arrays of x and y coordinates in meters.
+    """
+    lon = np.asarray(lon, dtype=np.float64)
+    lat = np.clip(np.asarray(lat, dtype=np.float64), -85.05112878, 85.05112878)
+    x = EARTH_RADIUS_M * np.radians(lon)
+    y = EARTH_RADIUS_M * np.log(np.tan(np.pi / 4 + np.radians(lat) / 2))
+    return x, y
+
+
+def mercator_to_lat(y) -> np.ndarray:
+    """Convert Web Mercator y coordinates in meters back to latitude in degrees."""
+    return np.degrees(2 * np.arctan(np.exp(np.asarray(y, dtype=np.float64) / EARTH_RADIUS_M)) - np.pi / 2)
+
+
+def _bin_points(grid:np.ndarray, x:np.ndarray, y:np.ndarray, x_min:float, y_min:float, cell_x:float, cell_y:float) -> None:
+    """Add projected points to a 2D count grid in place using integer binning and bincount."""
+    ny, nx = grid.shape
+    fx = (x - x_min) / cell_x
+    fy = (y - y_min) / cell_y
+    inside = (fx >= 0) & (fx <= nx) & (fy >= 0) & (fy <= ny)
+    # Points exactly on the northern or eastern edge belong to the last cell
+    ix = np.minimum(fx[inside].astype(np.int64), nx - 1)
+    iy = np.minimum(fy[inside].astype(np.int64), ny - 1)
+    flat_idx = iy * nx + ix
+    grid += np.bincount(flat_idx, minlength=nx * ny).reshape(ny, nx)
+
+
+def _bin_segments(
+    grid:np.ndarray,
+    x:np.ndarray,
+    y:np.ndarray,
+    same_track:np.ndarray,
+    x_min:float,
+    y_min:float,
+    cell_x:float,
+    cell_y:float
+) -> None:
+    """
+    Add points interpolated along consecutive track segments to a count grid.
+    Each segment is sampled roughly once per grid cell it crosses so that fast,
+    sparsely sampled sections contribute as much as slow, densely sampled ones.
+    """
+    seg_start = np.flatnonzero(same_track)
+    if seg_start.size == 0:
+        return
+
+    dx = x[seg_start + 1] - x[seg_start]
+    dy = y[seg_start + 1] - y[seg_start]
+    cells_crossed = np.maximum(np.abs(dx) / cell_x, np.abs(dy) / cell_y)
+    samples = np.clip(np.ceil(cells_crossed), 1, MAX_SAMPLES_PER_SEGMENT).astype(np.int64)
+
+    # Process segments in chunks so the interpolated sample arrays stay bounded
+    sample_ends = np.cumsum(samples)
+    chunk_first = 0
+    while chunk_first < seg_start.size:
+        chunk_base = sample_ends[chunk_first - 1] if chunk_first > 0 else 0
+        chunk_last = int(np.searchsorted(sample_ends, chunk_base + DENSITY_CHUNK_SIZE, side="right"))
+        chunk_last = max(chunk_last, chunk_first + 1)
+
+        chunk_samples = samples[chunk_first:chunk_last]
+        seg_idx = np.repeat(np.arange(chunk_first, chunk_last), chunk_samples)
+        offsets = np.arange(seg_idx.size) - np.repeat(np.cumsum(chunk_samples) - chunk_samples, chunk_samples)
+        fraction = offsets / samples[seg_idx]
+
+        px = x[seg_start[seg_idx]] + fraction * dx[seg_idx]
+        py = y[seg_start[seg_idx]] + fraction * dy[seg_idx]
+        _bin_points(grid, px, py, x_min, y_min, cell_x, cell_y)
+
+        chunk_first = chunk_last
+
+
+def density_grid_geometry(lat_min:float, lat_max:float, lon_min:float, lon_max:float, resolution:int) -> Tuple[float, float, float, float, int, int]:
+    """Return the Web Mercator origin, cell size and shape (x_min, y_min, cell_x, cell_y, ny, nx) of a density grid"""
+    x_min, y_min = lonlat_to_mercator(lon_min, lat_min)
+    x_max, y_max = lonlat_to_mercator(lon_max, lat_max)
+    nx = int(resolution)
+    ny = max(int(np.round(nx * (y_max - y_min) / (x_max - x_min))), 1)
+    return x_min, y_min, (x_max - x_min) / nx, (y_max - y_min) / ny, ny, nx
+
+
+def compute_density_grid(
+    df:pd.DataFrame,
+    *,
+    lat_min:float,
+    lat_max:float,
+    lon_min:float,
+    lon_max:float,
+    resolution:int=512,
+    interpolate:bool=True,
+    start_time:Optional[float]=None,
+    end_time:Optional[float]=None
+) -> np.ndarray:
+    """
+    Bin track points into a 2D count grid in Web Mercator coordinates.
+    Args:
+        df (pd.DataFrame): DataFrame containing GPX track data with columns 'latitude', 'longitude', 'track_name' and 'elapsed_seconds'.
+        lat_min, lat_max, lon_min, lon_max (float): Bounds of the grid.
+        resolution (int): Number of grid cells along the horizontal axis.
+        interpolate (bool): Whether to bin points interpolated along segments instead of only the recorded points.
+        start_time, end_time (float, optional): Time range in seconds to include, all points if None.
+    Returns:
+        np.ndarray: Count grid of shape (ny, nx) with row 0 at the southern edge.
+    """
+    x_min, y_min, cell_x, cell_y, ny, nx = density_grid_geometry(lat_min, lat_max, lon_min, lon_max, resolution)
+    grid = np.zeros((ny, nx), dtype=np.float64)
+
+    # Rows within the time range by binary search on the timeline index
+    in_range = get_timeline_index(df).rows_in_range(start_time, end_time)
+    if in_range.size == 0:
+        return grid
+    elapsed = df["elapsed_seconds"].to_numpy()
+
+    track_codes = pd.factorize(df["track_name"])[0][in_range]
+    elapsed = elapsed[in_range]
+    order = np.lexsort((elapsed, track_codes))
+    track_codes = track_codes[order]
+
+    x, y = lonlat_to_mercator(
+        df["longitude"].to_numpy()[in_range][order],
+        df["latitude"].to_numpy()[in_range][order]
+    )
+
+    if interpolate and x.size > 1:
+        same_track = np.append(track_codes[1:] == track_codes[:-1], False)
+        _bin_segments(grid, x, y, same_track, x_min, y_min, cell_x, cell_y)
+        # Segment sampling covers each segment's start, add the final point of every track
+        track_last = np.flatnonzero(~same_track)
+        _bin_points(grid, x[track_last], y[track_last], x_min, y_min, cell_x, cell_y)
+    else:
+        for chunk_first in range(0, x.size, DENSITY_CHUNK_SIZE):
+            chunk = slice(chunk_first, chunk_first + DENSITY_CHUNK_SIZE)
+            _bin_points(grid, x[chunk], y[chunk], x_min, y_min, cell_x, cell_y)
+
+    return grid
+
+
+def get_density_grid(
+    df:pd.DataFrame,
+    *,
+    lat_min:float,
+    lat_max:float,
+    lon_min:float,
+    lon_max:float,
+    resolution:int=512,
+    interpolate:bool=True,
+    start_time:Optional[float]=None,
+    end_time:Optional[float]=None
+) -> np.ndarray:
+    """Return the density grid for the given data, bounds and resolution, using the cache when possible."""
+    cache_key = (
+        get_dataframe_hash(df, ["track_name", "elapsed_seconds", "latitude", "longitude"]),
+        float(lat_min), float(lat_max), float(lon_min), float(lon_max),
+        int(resolution), bool(interpolate),
+        None if start_time is None else float(start_time),
+        None if end_time is None else float(end_time)
+    )
+    if cache_key in _density_grid_cache:
+        _density_grid_cache.move_to_end(cache_key)
+        return _density_grid_cache[cache_key]
+
+    # Only bin the segments intersecting the bounds, split into pieces at the gaps
+    spatial_index = get_spatial_index(df)
+    if not spatial_index.covers(lat_min, lat_max, lon_min, lon_max):
+        with stage("spatial_query"):
+            rows, pieces = spatial_index.visible_rows(spatial_index.query_bbox(lat_min, lat_max, lon_min, lon_max))
+        df = pd.DataFrame({
+            "track_name": pieces,
+            "elapsed_seconds": df["elapsed_seconds"].to_numpy()[rows],
+            "latitude": df["latitude"].to_numpy()[rows],
+            "longitude": df["longitude"].to_numpy()[rows],
+        })
+
+    grid = compute_density_grid(
+        df,
+        lat_min=lat_min,
+        lat_max=lat_max,
+        lon_min=lon_min,
+        lon_max=lon_max,
+        resolution=resolution,
+        interpolate=interpolate,
+        start_time=start_time,
+        end_time=end_time
+    )
+    _density_grid_cache[cache_key] = grid
+    while len(_density_grid_cache) > _DENSITY_GRID_CACHE_SIZE:
+        _density_grid_cache.popitem(last=False)
+    return grid
+
+
+def scale_density(grid:np.ndarray, scaling:str="log") -> np.ndarray:
+    """
+    Scale a count grid to the range [0, 1] for color mapping.
+    Args:
+        grid (np.ndarray): Count grid.
+        scaling (str): One of "log", "eq_hist" (histogram equalization) or "linear".
+    Returns:
+        np.ndarray: Scaled grid with NaN in empty cells so they render transparent.
+    """
+    scaled = np.full(grid.shape, np.nan)
+    occupied = grid > 0
+    if not occupied.any():
+        return scaled
+
+    values = grid[occupied]
+    if scaling == "log":
+        values = np.log1p(values)
+        value_max = values.max()
+        scaled[occupied] = values / value_max if value_max > 0 else 1.0
+    elif scaling == "eq_hist":
+        # Map each count to its position in the cumulative distribution of occupied cells
+        unique_values, counts = np.unique(values, return_counts=True)
+        cdf = np.cumsum(counts) / values.size
+        if unique_values.size == 1:
+            scaled[occupied] = 1.0
+        else:
+            cdf = (cdf - cdf[0]) / (1.0 - cdf[0])
+            scaled[occupied] = np.interp(values, unique_values, cdf)
+    elif scaling == "linear":
+        scaled[occupied] = values / values.max()
+    else:
+        raise ValueError(f"Invalid density scaling '{scaling}'. Use one of {DENSITY_SCALINGS}.")
+    return scaled
+
+
+def resample_rows_to_latitude(grid:np.ndarray, lat_min:float, lat_max:float) -> np.ndarray:
+    """
+    Resample the rows of a grid binned uniformly in Mercator y so they are uniform in latitude.
+    The map axes use EPSG:4326, so this keeps the image aligned with the basemap.
+    """
+    ny = grid.shape[0]
+    _, y_min = lonlat_to_mercator(0.0, lat_min)
+    _, y_max = lonlat_to_mercator(0.0, lat_max)
+    row_lat = lat_min + (np.arange(ny) + 0.5) * (lat_max - lat_min) / ny
+    _, row_y = lonlat_to_mercator(0.0, row_lat)
+    source_rows = np.clip(np.floor((row_y - y_min) / (y_max - y_min) * ny).astype(np.int64), 0, ny - 1)
+    return grid[source_rows]
+
+
+def generate_density_map(
+    df,
+    *,
+    map_style="USTopo",
+    fig_width=8,
+    lat_min=None,
+    lat_max=None,
+    lon_min=None,
+    lon_max=None,
+    title="",
+    show_coordinates=False,
+    resolution=512,
+    scaling="log",
+    cmap="inferno",
+    interpolate=True,
+    alpha=0.85,
+    start_time=None,
+    end_time=None,
+    grid=None
+):
+    """
+    Generate a static map with a density heatmap of the GPX tracks drawn as a single image layer.
+    Args:
+        df (pd.DataFrame): DataFrame containing GPX track data with columns 'latitude', 'longitude', 'track_name' and 'elapsed_seconds'.
+        map_style (str): Style of the basemap to use.
+        fig_width (float): Width of the figure in inches.
+        lat_min, lat_max, lon_min, lon_max (float): Optional latitude and longitude bounds for the map.
+        title (str): Title of the map.
+        show_coordinates (bool): Whether to show coordinates on the axes.
+        resolution (int): Number of density cells along the horizontal axis.
+        scaling (str): Color scaling of the counts, one of "log", "eq_hist" or "linear".
+        cmap (str): Name of the matplotlib colormap.
+        interpolate (bool): Whether to bin points interpolated along segments.
+        alpha (float): Opacity of the heatmap layer.
+        start_time, end_time (float, optional): Time range in seconds on the timeline, all points if None.
+        grid (np.ndarray, optional): Count grid of the given bounds computed elsewhere, such as
+            accumulated chunk by chunk by chunked.py. df may then be None.
+    Returns:
+        fig (matplotlib.figure.Figure): The generated map figure.
+    """
+    # pyplot is imported on first render so the map options load without it
+    import matplotlib.pyplot as plt
+
+    fig_lat_min, fig_lat_max, fig_lon_min, fig_lon_max = lat_min, lat_max, lon_min, lon_max
+    if not (lat_min and lat_max and lon_min and lon_max):
+        # Determine the latitude and longitude difference of the tracks
+        track_lat_delta = df["latitude"].max() - df["latitude"].min()
+        track_lon_delta = df["longitude"].max() - df["longitude"].min()
+
+        # Calculate default latitude and longitude bounds if not provided
+        fig_lat_min = lat_min if lat_min else df["latitude"].min() - 0.125 * track_lat_delta
+        fig_lat_max = lat_max if lat_max else df["latitude"].max() + 0.125 * track_lat_delta
+        fig_lon_min = lon_min if lon_min else df["longitude"].min() - 0.125 * track_lon_delta
+        fig_lon_max = lon_max if lon_max else df["longitude"].max() + 0.125 * track_lon_delta
+
+    # Calculate figure aspect ratio and height from latitude and longitude bounds
+    fig_lat_lon_ratio = (fig_lat_max - fig_lat_min) / (fig_lon_max - fig_lon_min)
+    fig_height = np.round(fig_width * fig_lat_lon_ratio, 2)
+
+    basemap_layer = get_basemap_layer(map_style, fig_lat_min, fig_lat_max, fig_lon_min, fig_lon_max)
+
+    fig, ax = plt.subplots(figsize=(fig_width, fig_height))
+    ax.set_xlim(fig_lon_min, fig_lon_max)
+    ax.set_ylim(fig_lat_min, fig_lat_max)
+    draw_basemap_layer(ax, basemap_layer, attribution_size=2)
+
+    if grid is None:
+        grid = get_density_grid(
+            df,
+            lat_min=fig_lat_min,
+            lat_max=fig_lat_max,
+            lon_min=fig_lon_min,
+            lon_max=fig_lon_max,
+            resolution=resolution,
+            interpolate=interpolate,
+            start_time=start_time,
+            end_time=end_time
+        )
+    scaled = resample_rows_to_latitude(scale_density(grid, scaling), fig_lat_min, fig_lat_max)
+
+    ax.imshow(
+        scaled,
+        extent=(fig_lon_min, fig_lon_max, fig_lat_min, fig_lat_max),
+        origin="lower",
+        cmap=cmap,
+        vmin=0.0,
+        vmax=1.0,
+        alpha=alpha,
+        interpolation="nearest",
+        aspect=ax.get_aspect(),
+        zorder=2
+    )
+    ax.set_xlim(fig_lon_min, fig_lon_max)
+    ax.set_ylim(fig_lat_min, fig_lat_max)
+
+    ax.set_xlabel("")
+    ax.set_ylabel("")
+
+    if not show_coordinates:
+        ax.tick_params(left=False, bottom=False, labelleft=False, labelbottom=False)
+
+    if title != "":
+        ax.set_title(title, fontsize=12)
+
+    plt.tight_layout()
+
+    return fig
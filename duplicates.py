@@ -0,0 +1,274 @@
+# Detection of duplicate and overlapping recordings
+
+import hashlib
+import numpy as np
+import pandas as pd
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple
+
+from geo import haversine_distance
+from profiling import stage
+
+DUPLICATE_POLICIES = ["Keep", "Skip", "Merge"]
+
+# Overlapping recordings are compared at this spacing over their common time range
+SIMILARITY_STEP_SECONDS = 10.0
+# Fraction of the shorter recording's duration that must overlap the other one
+MIN_TIME_OVERLAP = 0.8
+# Fraction of the aligned samples that must be within MAX_MATCH_DISTANCE_M of each other
+MIN_MATCH_FRACTION = 0.9
+MAX_MATCH_DISTANCE_M = 30.0
+# When merging, points of a duplicate only fill gaps longer than this in the kept recording
+MERGE_GAP_SECONDS = 30.0
+
+REPORT_COLUMNS = [
+    "kind", "file_name", "track_name", "duplicate_of_file", "duplicate_of_track",
+    "time_overlap", "median_distance_m", "action",
+]
+
+
+def find_duplicate_files(files:List[Any]) -> Tuple[List[Any], List[Dict[str, Any]]]:
+    """
+    Drop files whose content is identical to an earlier file, before they are parsed.
+    Args:
+        files (list): Uploaded files, objects with a name attribute and a getvalue method.
+    Returns:
+        tuple:
+            list: Files with unique content, in their original order.
+            list: Report rows for the dropped files.
+    """
+    report = []
+    unique_files = list(iter_unique_files(files, report))
+    return unique_files, report
+
+
+def iter_unique_files(files:Iterable[Any], report:List[Dict[str, Any]]) -> Iterator[Any]:
+    """
+    Yield the files whose content differs from every earlier file, appending report
+    rows for the dropped ones. Only content hashes are kept, so files can be read one
+    at a time.
+    """
+    seen = {}
+    for file in files:
+        content_hash = hashlib.sha1(file.getvalue()).hexdigest()
+        if content_hash in seen:
+            report.append({
+                "kind": "identical file",
+                "file_name": file.name,
+                "track_name": "",
+                "duplicate_of_file": seen[content_hash],
+                "duplicate_of_track": "",
+                "time_overlap": 1.0,
+                "median_distance_m": 0.0,
+                "action": "skipped",
+            })
+            continue
+        seen[content_hash] = file.name
+        yield file
+
+
+def _track_table(df:pd.DataFrame) -> Tuple[pd.DataFrame, pd.DataFrame, np.ndarray]:
+    """Sort the points by track and time and return one row per track with its row range and extent"""
+    df = df.iloc[np.lexsort((
+        df["elapsed_seconds"].to_numpy(),
+        df.groupby(["file_name", "track_name"], sort=True).ngroup().to_numpy()
+    ))].reset_index(drop=True)
+    file_names = df["file_name"].to_numpy()
+    track_names = df["track_name"].to_numpy()
+    n = len(df)
+    track_start = np.ones(n, dtype=bool)
+    track_start[1:] = (file_names[1:] != file_names[:-1]) | (track_names[1:] != track_names[:-1])
+    first = np.flatnonzero(track_start)
+    end = np.append(first[1:], n)
+    row_hashes = pd.util.hash_pandas_object(df[["elapsed_seconds", "latitude", "longitude"]], index=False).to_numpy()
+    tracks = pd.DataFrame({
+        "file_name": file_names[first],
+        "track_name": track_names[first],
+        "first_row": first,
+        "end_row": end,
+        "points": end - first,
+        "start_seconds": df["elapsed_seconds"].to_numpy()[first],
+        "end_seconds": df["elapsed_seconds"].to_numpy()[end - 1],
+        "lat_min": np.minimum.reduceat(df["latitude"].to_numpy(), first),
+        "lat_max": np.maximum.reduceat(df["latitude"].to_numpy(), first),
+        "lon_min": np.minimum.reduceat(df["longitude"].to_numpy(), first),
+        "lon_max": np.maximum.reduceat(df["longitude"].to_numpy(), first),
+        "content_hash": [hashlib.md5(row_hashes[a:b].tobytes()).hexdigest() for a, b in zip(first, end)],
+    })
+    return df, tracks, row_hashes
+
+
+def compare_recordings(df:pd.DataFrame, tracks:pd.DataFrame, a:int, b:int) -> Optional[Tuple[float, float, float]]:
+    """
+    Compare two recordings aligned on their common time range.
+    Returns:
+        tuple: Time overlap as a fraction of the shorter recording, fraction of aligned samples
+            within MAX_MATCH_DISTANCE_M and median distance in meters, or None if they do not overlap.
+    """
+    track_a = tracks.iloc[a]
+    track_b = tracks.iloc[b]
+    overlap_start = max(track_a["start_seconds"], track_b["start_seconds"])
+    overlap_end = min(track_a["end_seconds"], track_b["end_seconds"])
+    shorter = min(track_a["end_seconds"] - track_a["start_seconds"], track_b["end_seconds"] - track_b["start_seconds"])
+    if overlap_end <= overlap_start or shorter <= 0:
+        return None
+    time_overlap = (overlap_end - overlap_start) / shorter
+
+    grid = np.arange(overlap_start, overlap_end + SIMILARITY_STEP_SECONDS / 2, SIMILARITY_STEP_SECONDS)
+    aligned = []
+    for track in (track_a, track_b):
+        rows = slice(track["first_row"], track["end_row"])
+        times = df["elapsed_seconds"].to_numpy()[rows]
+        aligned.append((
+            np.interp(grid, times, df["latitude"].to_numpy()[rows]),
+            np.interp(grid, times, df["longitude"].to_numpy()[rows]),
+        ))
+    distance = haversine_distance(aligned[0][0], aligned[0][1], aligned[1][0], aligned[1][1])
+    return time_overlap, float(np.mean(distance <= MAX_MATCH_DISTANCE_M)), float(np.median(distance))
+
+
+def _candidate_pairs(tracks:pd.DataFrame) -> List[Tuple[int, int]]:
+    """Pairs of tracks whose time ranges and bounding boxes overlap, found with a sweep over start times"""
+    order = np.argsort(tracks["start_seconds"].to_numpy(), kind="stable")
+    starts = tracks["start_seconds"].to_numpy()[order]
+    ends = tracks["end_seconds"].to_numpy()[order]
+    pairs = []
+    for k1 in range(order.size):
+        # Tracks starting before this one ends
+        last = np.searchsorted(starts, ends[k1], side="right")
+        for k2 in range(k1 + 1, last):
+            a, b = order[k1], order[k2]
+            if (
+                tracks.at[a, "lat_max"] >= tracks.at[b, "lat_min"] and tracks.at[b, "lat_max"] >= tracks.at[a, "lat_min"]
+                and tracks.at[a, "lon_max"] >= tracks.at[b, "lon_min"] and tracks.at[b, "lon_max"] >= tracks.at[a, "lon_min"]
+            ):
+                pairs.append((a, b))
+    return pairs
+
+
+def _merge_rows(df:pd.DataFrame, tracks:pd.DataFrame, primary:int, duplicates:List[int]) -> np.ndarray:
+    """Rows of the duplicates that fill gaps longer than MERGE_GAP_SECONDS in the primary recording"""
+    elapsed = df["elapsed_seconds"].to_numpy()
+    primary_times = elapsed[tracks.at[primary, "first_row"]:tracks.at[primary, "end_row"]]
+    fill_rows = []
+    for duplicate in duplicates:
+        rows = np.arange(tracks.at[duplicate, "first_row"], tracks.at[duplicate, "end_row"])
+        times = elapsed[rows]
+        right = np.clip(np.searchsorted(primary_times, times), 0, primary_times.size - 1)
+        left = np.clip(right - 1, 0, primary_times.size - 1)
+        nearest = np.minimum(np.abs(primary_times[right] - times), np.abs(times - primary_times[left]))
+        fill_rows.append(rows[nearest > MERGE_GAP_SECONDS / 2])
+    return np.concatenate(fill_rows) if fill_rows else np.empty(0, dtype=np.int64)
+
+
+def resolve_duplicate_tracks(df:pd.DataFrame, policy:str="Keep") -> Tuple[pd.DataFrame, List[Dict[str, Any]]]:
+    """
+    Find identical and overlapping recordings of the same activity and apply a policy.
+    Identical tracks have the same points. Overlapping recordings (for example a watch
+    and a phone) overlap in time for at least MIN_TIME_OVERLAP of the shorter one, and
+    at least MIN_MATCH_FRACTION of their time-aligned positions are within MAX_MATCH_DISTANCE_M.
+    In each group of duplicates the recording with the most points is kept as primary.
+    Args:
+        df (pd.DataFrame): Track data on the absolute timeline.
+        policy (str): "Keep" reports duplicates only, "Skip" drops the other recordings of
+            each group and "Merge" adds their points where the primary has gaps.
+    Returns:
+        tuple:
+            pd.DataFrame: Track data after applying the policy, sorted by file, track and time.
+            list: Report rows, see REPORT_COLUMNS.
+    """
+    if policy not in DUPLICATE_POLICIES:
+        raise ValueError(f"Invalid duplicate policy {policy!r}. Use one of {DUPLICATE_POLICIES}.")
+    if df is None or df.empty:
+        return df, []
+
+    with stage("duplicate_detection", points=len(df)) as duplicate_stage:
+        df, tracks, _ = _track_table(df)
+
+        # Union of tracks into groups of duplicates
+        parent = list(range(len(tracks)))
+
+        def find(k1):
+            while parent[k1] != k1:
+                parent[k1] = parent[parent[k1]]
+                k1 = parent[k1]
+            return k1
+
+        for _, same_content in tracks.groupby("content_hash", sort=False):
+            indices = same_content.index.to_list()
+            for other in indices[1:]:
+                parent[find(other)] = find(indices[0])
+
+        comparisons = {}
+        candidate_pairs = _candidate_pairs(tracks)
+        for a, b in candidate_pairs:
+            if find(a) == find(b):
+                continue
+            comparison = compare_recordings(df, tracks, a, b)
+            comparisons[(min(a, b), max(a, b))] = comparison
+            if comparison is None:
+                continue
+            time_overlap, match_fraction, _ = comparison
+            if time_overlap >= MIN_TIME_OVERLAP and match_fraction >= MIN_MATCH_FRACTION:
+                parent[find(b)] = find(a)
+        duplicate_stage.add(tracks=len(tracks), compared=len(candidate_pairs))
+
+        def compare_with_primary(primary, other):
+            """Kind, time overlap and median distance of a duplicate against the primary recording"""
+            if tracks.at[primary, "content_hash"] == tracks.at[other, "content_hash"]:
+                return "identical track", 1.0, 0.0
+            # Groups of three or more can join tracks that were not compared with the primary
+            pair = (min(primary, other), max(primary, other))
+            if pair not in comparisons:
+                comparisons[pair] = compare_recordings(df, tracks, primary, other)
+            if comparisons[pair] is None:
+                return "overlapping recording", 0.0, float("nan")
+            time_overlap, _, median_distance = comparisons[pair]
+            return "overlapping recording", time_overlap, median_distance
+
+        groups = {}
+        for k1 in range(len(tracks)):
+            groups.setdefault(find(k1), []).append(k1)
+
+        report = []
+        drop_rows = []
+        merged_parts = []
+        for members in groups.values():
+            if len(members) < 2:
+                continue
+            primary = max(members, key=lambda k1: (tracks.at[k1, "points"], -k1))
+            others = [k1 for k1 in members if k1 != primary]
+            action = {"Keep": "kept", "Skip": "skipped", "Merge": "merged"}[policy]
+            for other in others:
+                kind, time_overlap, median_distance = compare_with_primary(primary, other)
+                report.append({
+                    "kind": kind,
+                    "file_name": tracks.at[other, "file_name"],
+                    "track_name": tracks.at[other, "track_name"],
+                    "duplicate_of_file": tracks.at[primary, "file_name"],
+                    "duplicate_of_track": tracks.at[primary, "track_name"],
+                    "time_overlap": time_overlap,
+                    "median_distance_m": median_distance,
+                    "action": action,
+                })
+            if policy == "Keep":
+                continue
+            if policy == "Merge":
+                fill_rows = _merge_rows(df, tracks, primary, others)
+                if fill_rows.size:
+                    fill = df.iloc[fill_rows].copy()
+                    fill["file_name"] = tracks.at[primary, "file_name"]
+                    fill["track_name"] = tracks.at[primary, "track_name"]
+                    merged_parts.append(fill)
+            for other in others:
+                drop_rows.append(np.arange(tracks.at[other, "first_row"], tracks.at[other, "end_row"]))
+
+        if drop_rows:
+            keep = np.ones(len(df), dtype=bool)
+            keep[np.concatenate(drop_rows)] = False
+            df = df[keep]
+        if merged_parts:
+            df = pd.concat([df] + merged_parts, ignore_index=True)
+            df = _track_table(df)[0]
+        else:
+            df = df.reset_index(drop=True)
+    return df, report
@@ -0,0 +1,325 @@
+# Animation rendering without any Streamlit dependency
+
+import matplotlib.animation as animation
+from matplotlib.collections import LineCollection
+from matplotlib.colors import to_rgba_array
+from matplotlib.lines import Line2D
+import matplotlib.pyplot as plt
+import numpy as np
+import pandas as pd
+import tempfile
+from typing import Any, Dict, Optional
+
+from map_layers import draw_basemap_layer, get_basemap_layer, get_track_geometry_layer
+from profiling import ProfiledMovieWriter, is_enabled, stage
+from resample import frame_resample_step, get_resampled_tracks
+from timeline import apply_time_axis, select_time_range
+from util import get_distinct_colors
+
+# Trails fade from transparent trail_duration behind the current time to TRAIL_ALPHA at
+# the current position, in TRAIL_FADE_STEPS steps of equal age drawn as one polyline each
+TRAIL_ALPHA = 0.7
+TRAIL_FADE_STEPS = 8
+
+# Default animation parameters, matching the defaults of show_animation_options
+DEFAULT_ANIMATION_PARAMS = {
+    "anim_map_style": "USTopo",
+    "anim_fig_width": 12.0,
+    "anim_lat_min": None,
+    "anim_lat_max": None,
+    "anim_lon_min": None,
+    "anim_lon_max": None,
+    "anim_show_time": True,
+    "anim_show_legend": False,
+    "anim_show_coordinates": False,
+    "anim_marker_size": 6,
+    "anim_line_width": 3,
+    "anim_start_seconds": None,
+    "anim_end_seconds": None,
+    "anim_time_axis": "Absolute",
+    "anim_resample": True,
+    "anim_duration": 20,
+    "anim_fps": 24,
+    "anim_trail_duration": 24 * 3600,
+    "anim_dpi": 150,
+    "anim_title": "",
+}
+
+
+def render_animation(df:pd.DataFrame, anim_params:Dict[str, Any], mode:str="track", output_file:Optional[str]=None) -> Optional[str]:
+    """
+    Render an animation from a dictionary of animation parameters.
+    Args:
+        df (pd.DataFrame): DataFrame containing the selected GPX tracks.
+        anim_params (dict): Parameters as returned by show_animation_options.
+        mode (str): Mode of plotting, either "track" or "file".
+        output_file (str, optional): Path the MP4 file is written to, a new temporary file if None.
+    Returns:
+        str: Path of the rendered MP4 file.
+    """
+    return generate_animation(
+        df,
+        mode=mode,
+        map_style=anim_params["anim_map_style"],
+        lat_min=anim_params["anim_lat_min"],
+        lat_max=anim_params["anim_lat_max"],
+        lon_min=anim_params["anim_lon_min"],
+        lon_max=anim_params["anim_lon_max"],
+        fig_width=anim_params["anim_fig_width"],
+        duration=anim_params["anim_duration"],
+        fps=anim_params["anim_fps"],
+        start_time=anim_params["anim_start_seconds"],
+        end_time=anim_params["anim_end_seconds"],
+        time_axis=anim_params["anim_time_axis"],
+        resample=anim_params["anim_resample"],
+        dpi=anim_params["anim_dpi"],
+        trail_duration=anim_params["anim_trail_duration"],
+        marker_size=anim_params["anim_marker_size"],
+        line_width=anim_params["anim_line_width"],
+        title=anim_params["anim_title"],
+        show_time=anim_params["anim_show_time"],
+        show_legend=anim_params["anim_show_legend"],
+        show_coordinates=anim_params["anim_show_coordinates"],
+        output_file=output_file
+    )
+
+# Function to create the animation
+def generate_animation(
+    df:pd.DataFrame,
+    *,
+    mode:str="track",
+    duration:int=15,
+    fps:int=24,
+    start_time:Optional[int]=None,
+    end_time:Optional[int]=None,
+    time_axis:str="Absolute",
+    resample:bool=True,
+    resample_step:Optional[float]=None,
+    dpi:int=150,
+    trail_duration:int=24*3600,
+    marker_size:int=8,
+    line_width:int=2,
+    map_style:str="USTopo",
+    fig_width:int=8,
+    lat_min:Optional[float]=None,
+    lat_max:Optional[float]=None,
+    lon_min:Optional[float]=None,
+    lon_max:Optional[float]=None,
+    title:str="",
+    show_time:bool=True,
+    show_legend:bool=False,
+    show_coordinates:bool=False,
+    writer:Optional[animation.AbstractMovieWriter]=None,
+    output_file:Optional[str]=None
+) -> Optional[str]:
+    """
+    Create an animation of GPX tracks and return the path of the rendered video file.
+    A custom movie writer can be passed in place of the default FFmpeg MP4 writer.
+    The video is written to output_file, or to a new temporary file if it is None.
+    time_axis is one of TIME_AXES: the absolute timeline, all days overlaid on the same
+    time of day, or days played sequentially with the gaps between them collapsed.
+    With resample, tracks are interpolated onto a uniform time grid (by default with the
+    step of resample.frame_resample_step) and current positions become direct
+    lookups on the grid, while trails are drawn from the recorded points.
+    """
+    # Select the time range on the absolute timeline, then map it to the animation time axis
+    if time_axis != "Absolute":
+        df = select_time_range(df, start_time, end_time)
+        start_time = end_time = None
+    df, format_time = apply_time_axis(df, time_axis)
+
+    # Determine time range if not specified
+    if start_time is None:
+        start_time = df["elapsed_seconds"].min()
+    if end_time is None:
+        end_time = df["elapsed_seconds"].max()
+
+    if mode not in ("track", "file"):
+        raise ValueError("Invalid mode specified. Use 'track' or 'file'.")
+
+    # Determine the latitude and longitude difference of the tracks
+    track_lat_delta = df["latitude"].max() - df["latitude"].min()
+    track_lon_delta = df["longitude"].max() - df["longitude"].min()
+    
+    # Calculate default latitude and longitude bounds if not provided
+    anim_lat_min = lat_min if lat_min else df["latitude"].min() - 0.125 * track_lat_delta
+    anim_lat_max = lat_max if lat_max else df["latitude"].max() + 0.125 * track_lat_delta
+    anim_lon_min = lon_min if lon_min else df["longitude"].min() - 0.125 * track_lon_delta
+    anim_lon_max = lon_max if lon_max else df["longitude"].max() + 0.125 * track_lon_delta
+    
+    fig_lat_diff = anim_lat_max - anim_lat_min
+    fig_lon_diff = anim_lon_max - anim_lon_min
+    
+    fig_lat_lon_ratio = fig_lat_diff / fig_lon_diff
+    
+    fig_height = np.round(fig_width * fig_lat_lon_ratio, 2)
+    
+    # Cached per-track geometry sorted by time, restricted to the segments in view. Trails
+    # are always drawn from the recorded points, a coarse grid would cut corners.
+    geometry_layer = get_track_geometry_layer(
+        df, mode=mode, start_time=start_time, end_time=end_time,
+        bounds=(anim_lat_min, anim_lat_max, anim_lon_min, anim_lon_max)
+    )
+    track_names = geometry_layer.names
+    resampled = None
+    if resample:
+        # Tracks interpolated onto a shared uniform time grid, for the current positions
+        step = resample_step if resample_step else frame_resample_step(start_time, end_time, fps, duration)
+        resampled = get_resampled_tracks(df, step, mode=mode, start_time=start_time, end_time=end_time)
+        track_names = resampled.names
+
+    colors = get_distinct_colors(len(track_names))
+    color_map = dict(zip(track_names, colors))
+    
+    # Create figure and axis
+    fig, ax = plt.subplots(figsize=(fig_width, fig_height))
+    
+    # Set limits
+    ax.set_xlim(anim_lon_min, anim_lon_max)
+    ax.set_ylim(anim_lat_min, anim_lat_max)
+    
+    # Add terrain basemap if requested
+    
+    try:
+        # Add the cached basemap layer
+        basemap_layer = get_basemap_layer(map_style, anim_lat_min, anim_lat_max, anim_lon_min, anim_lon_max)
+        draw_basemap_layer(ax, basemap_layer, attribution_size=4)
+        
+        # Make sure the GPX tracks will be visible on top of the map
+        
+    except Exception as e:
+        print(f"Could not add terrain map: {e}. Continuing without terrain.")
+    
+    # Add a timestamp text
+    time_text = ax.text(0.02, 0.95, "", transform=ax.transAxes, fontsize=12, 
+                        bbox=dict(facecolor="white", alpha=1.0, edgecolor="none"))
+    
+    # Create a legend with the track names
+    if show_legend and len(track_names) > 1:
+        legend_elements = [Line2D([0], [0], color=color_map[name], lw=2, label=name) 
+                           for name in track_names]
+        ax.legend(handles=legend_elements, loc="upper right")
+
+    ax.set_xlabel("")
+    ax.set_ylabel("")
+    if show_coordinates:
+        pass
+    else:
+        ax.tick_params(left=False, bottom=False, labelleft=False, labelbottom=False)
+
+    if title != "":
+        ax.set_title(title, fontsize=12)
+    
+    # All trails are one line collection with a polyline per track and fade step, and
+    # all current positions are one scatter, so the artists do not grow with the tracks
+    track_colors = to_rgba_array([color_map[name] for name in track_names]).reshape(-1, 4)
+    fade_colors = []
+    for k1 in range(TRAIL_FADE_STEPS):
+        step_colors = track_colors.copy()
+        step_colors[:, 3] = TRAIL_ALPHA * (k1 + 1) / TRAIL_FADE_STEPS
+        fade_colors.append(step_colors)
+    trails = LineCollection([], linewidths=line_width, zorder=2)
+    ax.add_collection(trails, autolim=False)
+    positions = ax.scatter(np.empty(0), np.empty(0), s=marker_size ** 2, zorder=3)
+    fade_ages = trail_duration * (1 - np.arange(TRAIL_FADE_STEPS) / TRAIL_FADE_STEPS)
+
+    # Points of all tracks concatenated, found by binary search on a composite (track, time) key.
+    # Tracks without points in view have no trail but keep their position on the resampled grid.
+    empty = np.empty(0)
+    track_times = [geometry_layer.elapsed_seconds.get(name, empty) for name in track_names]
+    track_offsets = np.zeros(len(track_names) + 1, dtype=np.int64)
+    track_offsets[1:] = np.cumsum([times.size for times in track_times])
+    track_span = end_time - start_time + 1.0
+    track_base = np.arange(len(track_names)) * track_span
+    point_keys = np.concatenate([times - start_time + base for times, base in zip(track_times, track_base)] + [empty])
+    point_xy = np.column_stack((
+        np.concatenate([geometry_layer.longitude.get(name, empty) for name in track_names] + [empty]),
+        np.concatenate([geometry_layer.latitude.get(name, empty) for name in track_names] + [empty])
+    ))
+
+    def set_artists(segments, segment_colors, xy, xy_colors):
+        trails.set_segments(segments)
+        trails.set_color(np.concatenate(segment_colors) if segment_colors else np.empty((0, 4)))
+        positions.set_offsets(xy)
+        positions.set_facecolor(xy_colors)
+        positions.set_edgecolor(xy_colors)
+
+    # Initialize with first frame
+    def init():
+        set_artists([], [], np.empty((0, 2)), np.empty((0, 4)))
+        time_text.set_text("")
+        return [trails, positions, time_text]
+    
+    # Update function for each frame
+    def update(frame):
+        animation_time_normalized = min(frame / (fps * duration), 1.0)
+        current_time_seconds = start_time + (end_time - start_time) * animation_time_normalized
+        
+        if show_time:
+            # Format the time as HH:MM, with the day for multi-day timelines
+            display_time_seconds = (np.floor(current_time_seconds / (5*60))) * (5*60)
+            time_text.set_text(f"Time: {format_time(display_time_seconds)}")
+        else:
+            time_text.set_text("")
+
+        # Start times of the fade steps of the trails, oldest first
+        fade_starts = np.maximum(current_time_seconds - fade_ages, start_time)
+        segments = []
+        segment_colors = []
+
+        # Row range of every fade step of every track with a single binary search
+        step_bounds = np.searchsorted(point_keys, track_base[:, None] + (fade_starts - start_time)[None, :], side="left")
+        visible_end = np.searchsorted(point_keys, track_base + (current_time_seconds - start_time), side="right")
+        for k1 in range(TRAIL_FADE_STEPS):
+            step_last = visible_end if k1 == TRAIL_FADE_STEPS - 1 else np.minimum(step_bounds[:, k1 + 1] + 1, visible_end)
+            for k2 in np.flatnonzero(step_last - step_bounds[:, k1] >= 2):
+                segments.append(point_xy[step_bounds[k2, k1]:step_last[k2]])
+                segment_colors.append(fade_colors[k1][k2:k2 + 1])
+
+        if resampled is not None:
+            # Positions are lookups of the last valid sample on the grid
+            last_valid = resampled.last_valid[:, resampled.time_index(current_time_seconds)]
+            visible = last_valid >= 0
+            xy = np.column_stack((
+                resampled.longitude[visible, last_valid[visible]],
+                resampled.latitude[visible, last_valid[visible]]
+            ))
+            set_artists(segments, segment_colors, xy, track_colors[visible])
+            return [trails, positions, time_text]
+
+        visible = visible_end > track_offsets[:-1]
+        set_artists(segments, segment_colors, point_xy[visible_end[visible] - 1], track_colors[visible])
+        return [trails, positions, time_text]
+    
+    # Time every frame update when profiling is enabled
+    if is_enabled():
+        def frame_func(frame):
+            with stage("frame_update", tracks=len(track_names)):
+                return update(frame)
+    else:
+        frame_func = update
+    
+    # Calculate animation duration and frames
+    frames = fps * duration + 1
+    
+    # Create the animation
+    anim = animation.FuncAnimation(
+        fig, frame_func, frames=frames, init_func=init, blit=True, interval=1000/fps
+    )
+    
+    # Save the animation to the output file, or a temporary file, and return its path
+    if output_file is None:
+        with tempfile.NamedTemporaryFile(suffix=".mp4", delete=False) as temp_file:
+            output_file = temp_file.name
+    
+    # Save the animation as an MP4 file
+    if writer is None:
+        writer = animation.FFMpegWriter(fps=fps, metadata=dict(artist="GPX Visualizer"), bitrate=1800)
+    if is_enabled():
+        writer = ProfiledMovieWriter(writer)
+    anim.save(output_file, writer=writer, dpi=dpi)
+    
+    # Close the matplotlib figure to free up memory
+    plt.close(fig)
+    
+    return output_file
\ No newline at end of file
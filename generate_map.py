@@ -0,0 +1,247 @@
+# Static map rendering without any Streamlit dependency
+
+import matplotlib.pyplot as plt
+import numpy as np
+from typing import Any, Dict
+
+from density_map import generate_density_map
+from map_layers import draw_basemap_layer, get_basemap_layer, get_track_geometry_layer
+from segmentation import SEGMENT_COLORS, SEGMENT_TYPES
+from util import get_distinct_colors
+
+# Default static map parameters, matching the defaults of show_static_map_options
+DEFAULT_STATIC_MAP_PARAMS = {
+    "stat_map_style": "USTopo",
+    "stat_fig_width": 12.0,
+    "stat_lat_min": None,
+    "stat_lat_max": None,
+    "stat_lon_min": None,
+    "stat_lon_max": None,
+    "stat_show_start_end_points": True,
+    "stat_show_legend": False,
+    "stat_show_coordinates": False,
+    "stat_line_width": 3,
+    "stat_marker_size": 6,
+    "stat_title": "",
+    "stat_start_seconds": None,
+    "stat_end_seconds": None,
+    "stat_render_mode": "Tracks",
+    "stat_density_resolution": 512,
+    "stat_density_scaling": "log",
+    "stat_density_cmap": "inferno",
+    "stat_density_interpolate": True,
+    "stat_panel_group": "Track",
+    "stat_panel_columns": 0,
+    "stat_panel_bounds": "Shared",
+    "stat_segment_types": None,
+    "stat_color_by": "Track",
+    "stat_resort_map_path": None,
+}
+
+
+def render_static_map(df, stat_params:Dict[str, Any], mode:str="track", track_colors=None):
+    """
+    Render a static map from a dictionary of static map parameters.
+    Args:
+        df (pd.DataFrame): DataFrame containing the selected GPX tracks.
+        stat_params (dict): Parameters as returned by show_static_map_options.
+        mode (str): Mode of plotting, either "track" or "file".
+        track_colors (dict, optional): Color of each track name, distinct colors if None.
+    Returns:
+        fig (matplotlib.figure.Figure): The generated map figure.
+    """
+    if stat_params["stat_render_mode"] == "Density heatmap":
+        return generate_density_map(
+            df,
+            map_style=stat_params["stat_map_style"],
+            fig_width=int(stat_params["stat_fig_width"]),
+            lat_min=stat_params["stat_lat_min"],
+            lat_max=stat_params["stat_lat_max"],
+            lon_min=stat_params["stat_lon_min"],
+            lon_max=stat_params["stat_lon_max"],
+            show_coordinates=stat_params["stat_show_coordinates"],
+            title=stat_params["stat_title"],
+            resolution=stat_params["stat_density_resolution"],
+            scaling=stat_params["stat_density_scaling"],
+            cmap=stat_params["stat_density_cmap"],
+            interpolate=stat_params["stat_density_interpolate"],
+            start_time=stat_params["stat_start_seconds"],
+            end_time=stat_params["stat_end_seconds"]
+        )
+
+    # Legend entries list the named runs of each track when a resort map is given
+    track_labels = None
+    if stat_params.get("stat_resort_map_path") and stat_params["stat_show_legend"] and mode == "track" and "segment_type" in df.columns:
+        from map_matching import get_route_labels, load_resort_features
+        track_labels = get_route_labels(df, load_resort_features(stat_params["stat_resort_map_path"]))
+
+    return generate_map(
+        df,
+        mode=mode,
+        map_style=stat_params["stat_map_style"],
+        fig_width=int(stat_params["stat_fig_width"]),
+        lat_min=stat_params["stat_lat_min"],
+        lat_max=stat_params["stat_lat_max"],
+        lon_min=stat_params["stat_lon_min"],
+        lon_max=stat_params["stat_lon_max"],
+        show_start_end_points=stat_params["stat_show_start_end_points"],
+        show_legend=stat_params["stat_show_legend"],
+        show_coordinates=stat_params["stat_show_coordinates"],
+        line_width=stat_params["stat_line_width"],
+        start_end_marker_size=stat_params["stat_marker_size"],
+        title=stat_params["stat_title"],
+        start_time=stat_params["stat_start_seconds"],
+        end_time=stat_params["stat_end_seconds"],
+        segment_types=stat_params["stat_segment_types"],
+        color_by_segment=stat_params["stat_color_by"] == "Segment type",
+        track_labels=track_labels,
+        track_colors=track_colors
+    )
+
+
+def generate_map(
+    df,
+    *,
+    mode="track",
+    map_style="USTopo",
+    fig_width=8, 
+    lat_min=None,
+    lat_max=None,
+    lon_min=None,
+    lon_max=None,
+    title="",
+    show_start_end_points=False,
+    show_legend=False,
+    show_coordinates=False,
+    line_width=4,
+    start_end_marker_size=8,
+    start_time=None,
+    end_time=None,
+    segment_types=None,
+    color_by_segment=False,
+    track_labels=None,
+    track_colors=None
+):
+    """
+    Generate a static map with GPX tracks plotted on it.
+    Args:
+        df (pd.DataFrame): DataFrame containing GPX track data with columns 'latitude', 'longitude', 'track_name', 'file_name', and 'elapsed_seconds'.
+        mode (str): Mode of plotting, either "track" or "file".
+        map_style (str): Style of the basemap to use.
+        fig_width (float): Width of the figure in inches.
+        lat_min, lat_max, lon_min, lon_max (float): Optional latitude and longitude bounds for the map.
+        title (str): Title of the map.
+        show_start_end_points (bool): Whether to show start and end points of tracks.
+        show_legend (bool): Whether to show a legend for the tracks.
+        show_coordinates (bool): Whether to show coordinates on the axes.
+        line_width (float): Width of the lines representing tracks.
+        start_end_marker_size (int): Size of markers for start and end points.
+        start_time, end_time (float, optional): Time range in seconds on the timeline, all points if None.
+        segment_types (list, optional): Only draw these segment types ("lift", "run", "idle").
+        color_by_segment (bool): Color lines by segment type instead of by track.
+        track_labels (dict, optional): Legend label of each track name, the track name if missing.
+        track_colors (dict, optional): Color of each track name, such as to keep the colors of a
+            larger selection, distinct colors if None.
+    Returns:
+        fig (matplotlib.figure.Figure): The generated map figure.
+    """
+
+    # Determine the latitude and longitude difference of the tracks
+    track_lat_delta = df["latitude"].max() - df["latitude"].min()
+    track_lon_delta = df["longitude"].max() - df["longitude"].min()
+    
+    # Calculate default latitude and longitude bounds if not provided
+    fig_lat_min = lat_min if lat_min else df["latitude"].min() - 0.125 * track_lat_delta
+    fig_lat_max = lat_max if lat_max else df["latitude"].max() + 0.125 * track_lat_delta
+    fig_lon_min = lon_min if lon_min else df["longitude"].min() - 0.125 * track_lon_delta
+    fig_lon_max = lon_max if lon_max else df["longitude"].max() + 0.125 * track_lon_delta
+    
+    # Calculate figure aspect ratio and height from latitude and longitude bounds
+    fig_lat_diff = fig_lat_max - fig_lat_min
+    fig_lon_diff = fig_lon_max - fig_lon_min    
+    fig_lat_lon_ratio = fig_lat_diff / fig_lon_diff
+    fig_height = np.round(fig_width * fig_lat_lon_ratio, 2)
+    
+    # Cached layers: basemap raster and track geometry
+    basemap_layer = get_basemap_layer(map_style, fig_lat_min, fig_lat_max, fig_lon_min, fig_lon_max)
+    view_bounds = (fig_lat_min, fig_lat_max, fig_lon_min, fig_lon_max)
+    geometry_layer = get_track_geometry_layer(df, mode=mode, start_time=start_time, end_time=end_time, segment_types=segment_types, bounds=view_bounds)
+
+    # Create figure and axis
+    fig, ax = plt.subplots(figsize=(fig_width, fig_height))
+    
+    # Set limits
+    ax.set_xlim(fig_lon_min, fig_lon_max)
+    ax.set_ylim(fig_lat_min, fig_lat_max)
+    
+    # Add the basemap
+    draw_basemap_layer(ax, basemap_layer, attribution_size=2)
+
+    ax.set_xlabel("")
+    ax.set_ylabel("")
+    
+    # Generate colors for all tracks
+    track_names = geometry_layer.names
+    color_map = track_colors if track_colors is not None else dict(zip(track_names, get_distinct_colors(len(track_names))))
+
+    # Color each segment type separately, drawing one line per track and type
+    if color_by_segment and "segment_type" in df.columns:
+        visible_types = SEGMENT_TYPES if segment_types is None else [t for t in SEGMENT_TYPES if t in segment_types]
+        for segment_type in visible_types:
+            type_layer = get_track_geometry_layer(df, mode=mode, start_time=start_time, end_time=end_time, segment_types=[segment_type], bounds=view_bounds)
+            label = segment_type
+            for track_name in track_names:
+                if len(type_layer.longitude[track_name]) == 0:
+                    continue
+                ax.plot(
+                    type_layer.longitude[track_name],
+                    type_layer.latitude[track_name],
+                    color=SEGMENT_COLORS[segment_type],
+                    linewidth=line_width,
+                    alpha=1.0,
+                    label=label
+                )
+                label = None
+
+    # Plot all tracks with their full paths
+    for track_name in track_names:
+        track_lon = geometry_layer.longitude[track_name]
+        track_lat = geometry_layer.latitude[track_name]
+
+        if len(track_lon) == 0:
+            continue
+        else:
+
+            # Plot the full track
+            if not (color_by_segment and "segment_type" in df.columns):
+                ax.plot(
+                    track_lon,
+                    track_lat, 
+                    color=color_map[track_name],
+                    linewidth=line_width,
+                    alpha=1.0,
+                    label=track_labels.get(track_name, track_name) if track_labels else track_name
+                )
+            
+            if show_start_end_points:
+                # Mark the start point with a green circle
+                ax.plot(track_lon[0], track_lat[0], 'go', markersize=start_end_marker_size)
+                
+                # Mark the end point with a red square
+                ax.plot(track_lon[-1], track_lat[-1], 'rs', markersize=start_end_marker_size)
+    
+    # Add legend if there are multiple tracks
+    if show_legend:
+        ax.legend(loc='upper right', fontsize=8)
+
+    if show_coordinates:
+        pass
+    else:
+        ax.tick_params(left=False, bottom=False, labelleft=False, labelbottom=False)
+    
+    if title != "":
+        ax.set_title(title, fontsize=12)
+    
+    plt.tight_layout()
+    
+    return fig
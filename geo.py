@@ -0,0 +1,22 @@
+# Vectorized geodesic helpers
+
+import numpy as np
+
+# Mean Earth radius in meters
+EARTH_MEAN_RADIUS_M = 6371008.8
+
+
+def haversine_distance(lat1, lon1, lat2, lon2) -> np.ndarray:
+    """
+    Great-circle distance between coordinate arrays in degrees.
+    Args:
+        lat1, lon1, lat2, lon2 (array-like): Coordinates in degrees.
+    Returns:
+        np.ndarray: Distances in meters.
+    """
+    lat1 = np.radians(lat1)
+    lat2 = np.radians(lat2)
+    dlat = lat2 - lat1
+    dlon = np.radians(np.asarray(lon2) - np.asarray(lon1))
+    a = np.sin(dlat / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin(dlon / 2) ** 2
+    return 2 * EARTH_MEAN_RADIUS_M * np.arcsin(np.sqrt(np.clip(a, 0.0, 1.0)))
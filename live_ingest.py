@@ -0,0 +1,524 @@
+# Incremental ingest of live tracks from growing GPX and NMEA files and a local socket
+
+"""
+Live sources are polled for the points added since the last poll:
+
+    GpxTail       a GPX file that a logger is still writing (not yet well-formed XML)
+    NmeaTail      a file of NMEA 0183 sentences (RMC and GGA)
+    SocketReader  NMEA sentences sent to a local TCP port, one track per sending host
+
+LiveTrackTable appends the new points to their tracks without parsing the earlier
+points again. Only the tracks that received points are put on the timeline,
+segmented and have their map geometry rebuilt; the combined table is assembled
+from the per-track tables when it is requested.
+"""
+
+import glob
+import os
+import re
+import socketserver
+import threading
+from datetime import datetime, timedelta, timezone
+from typing import Iterable, List, Optional, Set, Tuple
+
+import numpy as np
+import pandas as pd
+
+from map_layers import TrackGeometryLayer, put_track_geometry_layer
+from parse_gpx import convert_timestamp_timezone
+from profiling import stage
+from segmentation import segment_tracks
+from timeline import SECONDS_PER_DAY
+from track_selection import add_track_ids
+
+# Columns of a polled point, as in parse_gpx_files before the timezone conversion
+POINT_COLUMNS = ["file_name", "track_name", "timestamp", "latitude", "longitude", "elevation"]
+
+# Files with these extensions are read as NMEA sentences, all others as GPX
+NMEA_EXTENSIONS = (".nmea", ".nmea0183", ".log", ".txt")
+
+# Bytes read from a file per poll, so a large file is caught up over several polls
+MAX_READ_BYTES = 16 * 1024 * 1024
+
+# A point of a track is (file_name, track_name, timestamp, latitude, longitude, elevation)
+Point = Tuple[str, str, datetime, float, float, Optional[float]]
+TrackKey = Tuple[str, str]
+
+
+def _file_stem(path:str) -> str:
+    return os.path.splitext(os.path.basename(path))[0]
+
+
+class _FileTail:
+    """Reads the bytes appended to a file since the last read, starting over if the file is truncated"""
+
+    def __init__(self, path:str):
+        self.path = path
+        self.offset = 0
+
+    def read_new(self) -> bytes:
+        try:
+            size = os.path.getsize(self.path)
+        except OSError:
+            return b""
+        if size < self.offset:
+            # The file was truncated or replaced
+            self.offset = 0
+            self.reset()
+        if size == self.offset:
+            return b""
+        with open(self.path, "rb") as f:
+            f.seek(self.offset)
+            data = f.read(min(size - self.offset, MAX_READ_BYTES))
+        self.offset += len(data)
+        return data
+
+    def reset(self) -> None:
+        pass
+
+
+# Track header names and complete track points of a GPX document
+_GPX_TOKEN = re.compile(
+    rb"<trk[\s>]|<name>(?P<name>.*?)</name>|<trkpt\b(?P<attrs>[^>]*?)(?:/>|>(?P<body>.*?)</trkpt>)",
+    re.DOTALL
+)
+_GPX_ATTR = re.compile(rb"""(lat|lon)\s*=\s*["']([^"']+)["']""")
+_GPX_ELE = re.compile(rb"<ele>\s*([^<\s]+)\s*</ele>")
+_GPX_TIME = re.compile(rb"<time>\s*([^<\s]+)\s*</time>")
+
+
+class GpxTail(_FileTail):
+    """
+    Points appended to a GPX file that is still being written.
+    Complete <trkpt> elements are extracted as they appear, so the file does not
+    have to be well-formed XML until the logger closes it.
+    Args:
+        path (str): Path of the GPX file.
+    """
+
+    def __init__(self, path:str):
+        super().__init__(path)
+        self.file_name = _file_stem(path)
+        self.reset()
+
+    def reset(self) -> None:
+        self._buffer = b""
+        self._track_name = None
+        self._in_track_header = False
+
+    def poll(self) -> List[Point]:
+        self._buffer += self.read_new()
+        points = []
+        consumed = 0
+        for match in _GPX_TOKEN.finditer(self._buffer):
+            token = match.group(0)
+            if token.startswith(b"<trk") and not token.startswith(b"<trkpt"):
+                self._in_track_header = True
+                self._track_name = None
+            elif match.group("name") is not None:
+                # Names of waypoints, routes and points are not track names
+                if self._in_track_header:
+                    self._track_name = match.group("name").decode("utf-8", "replace").strip()
+            else:
+                self._in_track_header = False
+                point = self._parse_point(match.group("attrs"), match.group("body") or b"")
+                if point is not None:
+                    points.append(point)
+            consumed = match.end()
+        # Keep the unfinished tail, which may hold a partly written point
+        self._buffer = self._buffer[consumed:]
+        return points
+
+    def _parse_point(self, attrs:bytes, body:bytes) -> Optional[Point]:
+        coordinates = dict(_GPX_ATTR.findall(attrs))
+        time_match = _GPX_TIME.search(body)
+        if b"lat" not in coordinates or b"lon" not in coordinates or time_match is None:
+            return None
+        ele_match = _GPX_ELE.search(body)
+        try:
+            timestamp = pd.Timestamp(time_match.group(1).decode())
+            if timestamp.tzinfo is None:
+                timestamp = timestamp.tz_localize("UTC")
+            return (
+                self.file_name,
+                self._track_name or self.file_name,
+                timestamp,
+                float(coordinates[b"lat"]),
+                float(coordinates[b"lon"]),
+                float(ele_match.group(1)) if ele_match else None,
+            )
+        except ValueError:
+            return None
+
+
+def _nmea_checksum_ok(sentence:str) -> bool:
+    if "*" not in sentence:
+        return True
+    body, checksum = sentence[1:].rsplit("*", 1)
+    value = 0
+    for char in body:
+        value ^= ord(char)
+    try:
+        return value == int(checksum[:2], 16)
+    except ValueError:
+        return False
+
+
+def _nmea_coordinate(value:str, hemisphere:str) -> float:
+    """Convert an NMEA (d)ddmm.mmmm coordinate to decimal degrees"""
+    degrees_digits = value.index(".") - 2
+    degrees = float(value[:degrees_digits]) + float(value[degrees_digits:]) / 60
+    return -degrees if hemisphere in ("S", "W") else degrees
+
+
+def _nmea_time(value:str) -> Tuple[int, int, int, int]:
+    seconds = float(value[4:])
+    return int(value[:2]), int(value[2:4]), int(seconds), int(round((seconds % 1) * 1e6))
+
+
+class NmeaParser:
+    """
+    Turns NMEA 0183 sentences into points.
+    GGA fixes carry the elevation and are used when the stream has them, with the
+    date of the latest RMC sentence. Streams with RMC sentences only use those.
+    Args:
+        file_name (str): File name of the points.
+        track_name (str): Track name of the points.
+    """
+
+    def __init__(self, file_name:str, track_name:str):
+        self.file_name = file_name
+        self.track_name = track_name
+        self._date = None
+        self._last_time = None
+        self._has_gga = False
+        self._pending_rmc = None
+
+    def feed(self, line:str) -> Optional[Point]:
+        line = line.strip()
+        if not line.startswith("$") or not _nmea_checksum_ok(line):
+            return None
+        fields = line.split("*", 1)[0].split(",")
+        kind = fields[0][3:]
+        try:
+            if kind == "RMC" and len(fields) > 9 and fields[2] == "A":
+                day, month, year = int(fields[9][:2]), int(fields[9][2:4]), 2000 + int(fields[9][4:6])
+                self._date = datetime(year, month, day, tzinfo=timezone.utc).date()
+                if not self._has_gga:
+                    # Held until the next RMC sentence, in case a GGA fix of the same time follows
+                    point, self._pending_rmc = self._pending_rmc, fields
+                    if point is not None:
+                        return self._point(point[1], point[3], point[4], point[5], point[6], None)
+            elif kind == "GGA" and len(fields) > 9 and fields[6] not in ("", "0"):
+                self._has_gga = True
+                self._pending_rmc = None
+                return self._point(fields[1], fields[2], fields[3], fields[4], fields[5], float(fields[9]) if fields[9] else None)
+        except (ValueError, IndexError):
+            return None
+        return None
+
+    def _point(self, time_value, lat, lat_hemisphere, lon, lon_hemisphere, elevation) -> Point:
+        hour, minute, second, microsecond = _nmea_time(time_value)
+        date = self._date or datetime.now(timezone.utc).date()
+        timestamp = datetime(date.year, date.month, date.day, hour, minute, second, microsecond, tzinfo=timezone.utc)
+        # GGA sentences have no date, so a time earlier than the last one is the next day
+        if self._last_time is not None and timestamp < self._last_time - timedelta(hours=12):
+            timestamp += timedelta(days=1)
+            self._date = timestamp.date()
+        self._last_time = timestamp
+        return (
+            self.file_name,
+            self.track_name,
+            pd.Timestamp(timestamp),
+            _nmea_coordinate(lat, lat_hemisphere),
+            _nmea_coordinate(lon, lon_hemisphere),
+            elevation,
+        )
+
+
+class NmeaTail(_FileTail):
+    """
+    Points appended to a file of NMEA sentences, one track per file.
+    Args:
+        path (str): Path of the NMEA log.
+    """
+
+    def __init__(self, path:str):
+        super().__init__(path)
+        self.file_name = _file_stem(path)
+        self.reset()
+
+    def reset(self) -> None:
+        self._partial_line = b""
+        self._parser = NmeaParser(self.file_name, self.file_name)
+
+    def poll(self) -> List[Point]:
+        data = self._partial_line + self.read_new()
+        lines = data.split(b"\n")
+        # The last line may still be written
+        self._partial_line = lines.pop()
+        points = []
+        for line in lines:
+            point = self._parser.feed(line.decode("ascii", "replace"))
+            if point is not None:
+                points.append(point)
+        return points
+
+
+class _NmeaRequestHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        host = self.client_address[0]
+        parser = NmeaParser(self.server.file_name, host)
+        for line in self.rfile:
+            point = parser.feed(line.decode("ascii", "replace"))
+            if point is not None:
+                self.server.add_point(point)
+
+
+class NmeaSocketServer(socketserver.ThreadingTCPServer):
+    """
+    Receives NMEA sentences on a local TCP port, one track per sending host.
+    Received points are kept in arrival order so every session reads them with its own cursor.
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, host:str, port:int):
+        super().__init__((host, port), _NmeaRequestHandler)
+        self.file_name = f"socket-{port}"
+        self._points = []
+        self._points_lock = threading.Lock()
+        self._thread = threading.Thread(target=self.serve_forever, name=f"nmea-socket-{port}", daemon=True)
+        self._thread.start()
+
+    def add_point(self, point:Point) -> None:
+        with self._points_lock:
+            self._points.append(point)
+
+    def points_since(self, cursor:int) -> Tuple[List[Point], int]:
+        with self._points_lock:
+            return self._points[cursor:], len(self._points)
+
+
+_socket_servers = {}
+_socket_servers_lock = threading.Lock()
+
+
+def get_socket_server(port:int, host:str="127.0.0.1") -> NmeaSocketServer:
+    """Return the process-wide server listening on a port, starting it on first use"""
+    with _socket_servers_lock:
+        server = _socket_servers.get((host, port))
+        if server is None:
+            server = NmeaSocketServer(host, port)
+            _socket_servers[(host, port)] = server
+        return server
+
+
+class SocketReader:
+    """Points received by a socket server since the last poll of this reader"""
+
+    def __init__(self, port:int, host:str="127.0.0.1"):
+        self.path = f"{host}:{port}"
+        self.server = get_socket_server(port, host)
+        self.cursor = 0
+
+    def poll(self) -> List[Point]:
+        points, self.cursor = self.server.points_since(self.cursor)
+        return points
+
+
+class LiveSources:
+    """
+    Live sources of the files matching glob patterns and of a socket port.
+    The patterns are matched again on every poll, so files created later are followed too.
+    Files ending in NMEA_EXTENSIONS are read as NMEA, all others as GPX.
+    Args:
+        patterns (list): Paths or glob patterns of growing GPX and NMEA files.
+        socket_port (int, optional): Local TCP port receiving NMEA sentences.
+    """
+
+    def __init__(self, patterns:Iterable[str], socket_port:Optional[int]=None):
+        self.patterns = [os.path.expanduser(pattern.strip()) for pattern in patterns if pattern.strip()]
+        self.sources = {}
+        if socket_port:
+            reader = SocketReader(socket_port)
+            self.sources[reader.path] = reader
+
+    def _update_sources(self) -> None:
+        for pattern in self.patterns:
+            for path in sorted(glob.glob(pattern)):
+                if path in self.sources or not os.path.isfile(path):
+                    continue
+                if path.lower().endswith(NMEA_EXTENSIONS):
+                    self.sources[path] = NmeaTail(path)
+                else:
+                    self.sources[path] = GpxTail(path)
+
+    def poll(self, errors:Optional[List[str]]=None) -> List[Point]:
+        """Points added to every source since the last poll"""
+        self._update_sources()
+        points = []
+        for path, source in self.sources.items():
+            try:
+                points.extend(source.poll())
+            except OSError as e:
+                if errors is not None:
+                    errors.append(f"Could not read {path}: {e}")
+        return points
+
+
+def _timeline_columns(track_df:pd.DataFrame, origin:pd.Timestamp) -> pd.DataFrame:
+    """Add the columns of parse_gpx_files and add_timeline, on a timeline starting at origin"""
+    local_time = track_df["timestamp"].dt.tz_localize(None)
+    elapsed = (local_time - origin).dt.total_seconds().to_numpy()
+    day_index = np.floor(elapsed / SECONDS_PER_DAY)
+    track_df["elapsed_seconds"] = elapsed
+    track_df["time"] = track_df["timestamp"].dt.strftime("%H:%M:%S")
+    track_df["day_index"] = day_index.astype(np.int16)
+    track_df["time_of_day"] = elapsed - day_index * SECONDS_PER_DAY
+    return track_df
+
+
+class LiveTrackTable:
+    """
+    Combined track table that grows as live points arrive.
+    Each track is kept in its own table sorted by time; appending points only
+    processes the tracks that received them.
+    """
+
+    def __init__(self):
+        self.origin = None
+        self.version = 0
+        self._tracks = {}
+        self._segments = {}
+        self._geometry = {}
+        self._changed_at = {}
+        self._combined = None
+
+    @property
+    def num_points(self) -> int:
+        return sum(len(track_df) for track_df in self._tracks.values())
+
+    def track_keys(self) -> List[TrackKey]:
+        return sorted(self._tracks)
+
+    def changed_since(self, version:int) -> Set[TrackKey]:
+        """Tracks that received points after the table had the given version"""
+        return {key for key, changed_at in self._changed_at.items() if changed_at > version}
+
+    def append(self, points:List[Point], errors:Optional[List[str]]=None) -> Set[TrackKey]:
+        """
+        Append polled points to their tracks.
+        Returns:
+            set: (file_name, track_name) of the tracks that changed.
+        """
+        if not points:
+            return set()
+        with stage("live_append", points=len(points)) as append_stage:
+            new_points = pd.DataFrame(points, columns=POINT_COLUMNS)
+            new_points["timestamp"] = pd.to_datetime(new_points["timestamp"], utc=True)
+            new_points["elevation"] = new_points["elevation"].astype(np.float64)
+            new_points = convert_timestamp_timezone(new_points, "timestamp", file_name="live points", errors=errors)
+
+            origin = new_points["timestamp"].dt.tz_localize(None).min().normalize()
+            changed = set()
+            if self.origin is None or origin < self.origin:
+                # Points before the first day move the timeline origin of every track
+                self.origin = origin
+                for key, track_df in self._tracks.items():
+                    self._tracks[key] = _timeline_columns(track_df.drop(columns=["segment_type", "segment_id"]), self.origin)
+                changed.update(self._tracks)
+
+            for key, track_points in new_points.groupby(["file_name", "track_name"], sort=False):
+                track_points = _timeline_columns(track_points.reset_index(drop=True), self.origin)
+                previous = self._tracks.get(key)
+                if previous is not None:
+                    previous = previous.drop(columns=["segment_type", "segment_id"])
+                    track_points = pd.concat([previous, track_points], ignore_index=True)
+                    # Late or repeated points, for example a replay of the same log
+                    if not track_points["elapsed_seconds"].is_monotonic_increasing:
+                        track_points = track_points.sort_values("elapsed_seconds", kind="stable")
+                    track_points = track_points.drop_duplicates("elapsed_seconds", keep="last").reset_index(drop=True)
+                self._tracks[key] = track_points
+                changed.add(key)
+
+            for key in changed:
+                self._tracks[key], self._segments[key] = segment_tracks(self._tracks[key])
+            self._update_geometry(changed)
+            self._combined = None
+            self.version += 1
+            for key in changed:
+                self._changed_at[key] = self.version
+            append_stage.add(tracks=len(changed))
+        return changed
+
+    def poll(self, sources:LiveSources, errors:Optional[List[str]]=None) -> Set[TrackKey]:
+        """Poll the live sources and append their new points, see append"""
+        return self.append(sources.poll(errors=errors), errors=errors)
+
+    def _update_geometry(self, changed:Set[TrackKey]) -> None:
+        """Rebuild the time-sorted coordinates of the changed tracks only"""
+        for key in changed:
+            track_df = self._tracks[key]
+            self._geometry[key] = (
+                track_df["elapsed_seconds"].to_numpy(),
+                track_df["longitude"].to_numpy(),
+                track_df["latitude"].to_numpy(),
+            )
+
+    def geometry_layer(self, mode:str="track", keys:Optional[Iterable[TrackKey]]=None) -> TrackGeometryLayer:
+        """
+        Geometry layer of the tracks, as get_track_geometry_layer would build it from the combined table.
+        Only groups that several tracks share are concatenated again.
+        """
+        group_position = 1 if mode == "track" else 0
+        groups = {}
+        for key in sorted(self._geometry if keys is None else keys):
+            groups.setdefault(key[group_position], []).append(self._geometry[key])
+        layer = TrackGeometryLayer(names=sorted(groups), elapsed_seconds={}, longitude={}, latitude={})
+        for name, parts in groups.items():
+            if len(parts) == 1:
+                elapsed, longitude, latitude = parts[0]
+            else:
+                elapsed = np.concatenate([part[0] for part in parts])
+                order = np.argsort(elapsed, kind="stable")
+                elapsed = elapsed[order]
+                longitude = np.concatenate([part[1] for part in parts])[order]
+                latitude = np.concatenate([part[2] for part in parts])[order]
+            layer.elapsed_seconds[name] = elapsed
+            layer.longitude[name] = longitude
+            layer.latitude[name] = latitude
+        return layer
+
+    def to_frame(self) -> Tuple[Optional[pd.DataFrame], Optional[pd.DataFrame]]:
+        """
+        Combined table and segment index, in the layout of the upload pipeline.
+        The geometry of the combined table is put in the map layer cache, so the
+        static map does not rebuild it.
+        Returns:
+            tuple: Track data with 'track_id', and its segment index, or (None, None) without points.
+        """
+        if not self._tracks:
+            return None, None
+        if self._combined is None:
+            with stage("live_combine", tracks=len(self._tracks)):
+                keys = self.track_keys()
+                df = pd.concat([self._tracks[key] for key in keys], ignore_index=True)
+                segment_parts = []
+                row_offset = 0
+                segment_offset = 0
+                for key in keys:
+                    segments = self._segments[key].copy()
+                    segments["segment_id"] += segment_offset
+                    segments["start_row"] += row_offset
+                    segments["end_row"] += row_offset
+                    segment_parts.append(segments)
+                    row_offset += len(self._tracks[key])
+                    segment_offset += len(segments)
+                segment_index = pd.concat(segment_parts, ignore_index=True)
+                df["segment_id"] = np.repeat(segment_index["segment_id"].to_numpy(), (segment_index["end_row"] - segment_index["start_row"]).to_numpy())
+                df = add_track_ids(df)
+                for mode in ("track", "file"):
+                    put_track_geometry_layer(df, mode, self.geometry_layer(mode))
+            self._combined = (df, segment_index)
+        return self._combined
@@ -0,0 +1,216 @@
+# Live tracking options and live map section for Streamlit app
+
+"""
+The live map keeps one figure per session with a trail line and a position marker
+per track. On each refresh the sources are polled and only the artists of the
+tracks that received points are updated before the figure is encoded again; the
+basemap is drawn again only when a track leaves the mapped area.
+"""
+
+import io
+import os
+import time
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+import numpy as np
+import pandas as pd
+import streamlit as st
+
+from live_ingest import LiveSources, LiveTrackTable
+from map_layers import TrackGeometryLayer, draw_basemap_layer, get_basemap_layer
+from profiling import stage
+from providers import PROVIDERS
+from util import get_distinct_colors
+
+# Fraction of the extent of the tracks added around them when the map is (re)framed
+LIVE_MAP_PADDING = 0.25
+LIVE_MAP_DPI = 100
+
+
+def show_live_tracking_options() -> Dict[str, Any]:
+    """Display the live tracking options and return them"""
+    with st.expander("Live tracking", expanded=st.session_state.get("live_enabled", False)):
+        st.write("Follow GPX or NMEA files that loggers are still writing, or NMEA sentences sent to a local port. Test with `python replay_track.py TRACK.gpx --output live/skier.gpx`.")
+        live_enabled = st.checkbox("Follow live tracks", value=False, key="live_enabled", on_change=on_live_sources_changed)
+        live_patterns = st.text_area(
+            "Files to follow",
+            value=os.environ.get("SKI_TRACKS_LIVE_PATHS", ""),
+            key="live_patterns",
+            on_change=on_live_sources_changed,
+            help="One path or glob pattern per line, for example live/*.gpx. Files ending in .nmea, .log or .txt are read as NMEA."
+        )
+        live_socket_port = st.number_input("NMEA socket port (0 for none)", min_value=0, max_value=65535, value=0, step=1, key="live_socket_port", on_change=on_live_sources_changed)
+        live_col_01, live_col_02, live_col_03 = st.columns(3)
+        with live_col_01:
+            live_refresh_seconds = st.slider("Refresh every (seconds)", min_value=1, max_value=30, value=5, step=1, key="live_refresh_seconds")
+        with live_col_02:
+            live_trail_minutes = st.slider("Trail (minutes)", min_value=1, max_value=240, value=30, step=1, key="live_trail_minutes")
+        with live_col_03:
+            live_map_style = st.selectbox("Map Style", list(PROVIDERS.keys()), index=12, key="live_map_style")
+    return {
+        "live_enabled": live_enabled,
+        "live_patterns": [line for line in live_patterns.splitlines() if line.strip()],
+        "live_socket_port": int(live_socket_port),
+        "live_refresh_seconds": live_refresh_seconds,
+        "live_trail_minutes": live_trail_minutes,
+        "live_map_style": live_map_style,
+    }
+
+
+def on_live_sources_changed():
+    """Callback function executed when the live sources change, starting a new live table"""
+    st.session_state.live_sources = None
+    st.session_state.live_table = None
+    st.session_state.live_map_view = None
+    st.session_state.df_combined = None
+    st.session_state.track_summary = None
+
+
+def poll_live_tracks(live_params:Dict[str, Any]) -> Tuple[LiveTrackTable, Set[Tuple[str, str]], List[str]]:
+    """
+    Poll the live sources of this session and append their new points.
+    Returns:
+        tuple: The live table, the (file_name, track_name) of the changed tracks and error messages.
+    """
+    if st.session_state.get("live_sources") is None:
+        st.session_state.live_sources = LiveSources(live_params["live_patterns"], live_params["live_socket_port"] or None)
+        st.session_state.live_table = LiveTrackTable()
+    errors = []
+    changed = st.session_state.live_table.poll(st.session_state.live_sources, errors=errors)
+    if changed:
+        # The track list and statistics are rebuilt, statistics of unchanged tracks come from the cache
+        st.session_state.track_summary = None
+    return st.session_state.live_table, changed, errors
+
+
+class LiveMapView:
+    """
+    Figure of the live tracks that is updated in place.
+    Args:
+        map_style (str): Style of the basemap.
+        fig_width (float): Width of the figure in inches.
+    """
+
+    def __init__(self, map_style:str, fig_width:float=10.0):
+        self.map_style = map_style
+        self.fig_width = fig_width
+        self.bounds = None
+        self.fig = None
+        self.ax = None
+        self.trails = {}
+        self.markers = {}
+        # Version of the live table the figure shows
+        self.version = -1
+
+    def _frame(self, layer:TrackGeometryLayer) -> None:
+        """Create the figure and basemap around all tracks"""
+        from matplotlib.figure import Figure
+
+        lon_values = np.concatenate([layer.longitude[name] for name in layer.names])
+        lat_values = np.concatenate([layer.latitude[name] for name in layer.names])
+        lat_min, lat_max = np.nanmin(lat_values), np.nanmax(lat_values)
+        lon_min, lon_max = np.nanmin(lon_values), np.nanmax(lon_values)
+        lat_pad = max((lat_max - lat_min) * LIVE_MAP_PADDING, 0.002)
+        lon_pad = max((lon_max - lon_min) * LIVE_MAP_PADDING, 0.002)
+        self.bounds = (lat_min - lat_pad, lat_max + lat_pad, lon_min - lon_pad, lon_max + lon_pad)
+
+        lat_min, lat_max, lon_min, lon_max = self.bounds
+        fig_height = np.round(self.fig_width * (lat_max - lat_min) / (lon_max - lon_min), 2)
+        # A standalone figure, not registered with pyplot, is kept across reruns
+        self.fig = Figure(figsize=(self.fig_width, fig_height))
+        self.ax = self.fig.add_subplot()
+        self.ax.set_xlim(lon_min, lon_max)
+        self.ax.set_ylim(lat_min, lat_max)
+        self.ax.set_xticks([])
+        self.ax.set_yticks([])
+        try:
+            draw_basemap_layer(self.ax, get_basemap_layer(self.map_style, lat_min, lat_max, lon_min, lon_max))
+        except Exception:
+            # Without tiles the tracks are still shown
+            pass
+        self.fig.tight_layout()
+        self.trails = {}
+        self.markers = {}
+
+    def _outside(self, layer:TrackGeometryLayer, names) -> bool:
+        lat_min, lat_max, lon_min, lon_max = self.bounds
+        for name in names:
+            if layer.latitude[name].size == 0:
+                continue
+            lat = layer.latitude[name][-1]
+            lon = layer.longitude[name][-1]
+            if not (lat_min <= lat <= lat_max and lon_min <= lon <= lon_max):
+                return True
+        return False
+
+    def update(self, layer:TrackGeometryLayer, changed_names:Optional[Set[str]], trail_seconds:float) -> None:
+        """
+        Update the trails and positions of the changed tracks.
+        Args:
+            layer (TrackGeometryLayer): Geometry of all live tracks.
+            changed_names (set, optional): Names of the tracks that received points, all if None.
+            trail_seconds (float): Length of the trail behind each position.
+        """
+        if not layer.names:
+            return
+        if changed_names is None or self.fig is None or self._outside(layer, changed_names or []):
+            self._frame(layer)
+            changed_names = set(layer.names)
+        with stage("live_map_update", tracks=len(changed_names)):
+            for name in changed_names:
+                elapsed = layer.elapsed_seconds[name]
+                if elapsed.size == 0:
+                    continue
+                # Trail relative to the latest point of the track, so idle tracks need no update
+                start = np.searchsorted(elapsed, elapsed[-1] - trail_seconds, side="left")
+                lon = layer.longitude[name][start:]
+                lat = layer.latitude[name][start:]
+                if name not in self.trails:
+                    # Colors are assigned in order of appearance and do not change when tracks are added
+                    color = get_distinct_colors(len(self.trails) + 1)[-1]
+                    self.trails[name], = self.ax.plot(lon, lat, linewidth=2, color=color, alpha=0.8)
+                    self.markers[name], = self.ax.plot(lon[-1:], lat[-1:], marker="o", markersize=7, color=color, markeredgecolor="white", linestyle="none")
+                else:
+                    self.trails[name].set_data(lon, lat)
+                    self.markers[name].set_data(lon[-1:], lat[-1:])
+
+    def to_bytes(self) -> bytes:
+        buffer = io.BytesIO()
+        with stage("live_map_encode") as encode_stage:
+            self.fig.savefig(buffer, format="png", dpi=LIVE_MAP_DPI)
+            encode_stage.add(bytes=buffer.tell())
+        return buffer.getvalue()
+
+
+def display_live_map(live_params:Dict[str, Any]) -> None:
+    """Show the live map, refreshed every live_refresh_seconds without rerunning the whole page"""
+
+    @st.fragment(run_every=live_params["live_refresh_seconds"])
+    def live_map_fragment():
+        table, _, errors = poll_live_tracks(live_params)
+        for error in errors:
+            st.error(error)
+        if table.num_points == 0:
+            st.info("Waiting for live points...")
+            return
+
+        view = st.session_state.get("live_map_view")
+        if view is None or view.map_style != live_params["live_map_style"]:
+            view = LiveMapView(live_params["live_map_style"])
+            st.session_state.live_map_view = view
+        # Tracks changed since the figure was drawn, also by polls of full page runs
+        changed_names = None if view.fig is None else {key[1] for key in table.changed_since(view.version)}
+        view.update(table.geometry_layer("track"), changed_names, live_params["live_trail_minutes"] * 60)
+        view.version = table.version
+        st.image(view.to_bytes())
+        st.caption(f"{len(table.track_keys())} live track(s), {table.num_points} points, updated {time.strftime('%H:%M:%S')}")
+
+    live_map_fragment()
+
+
+def get_live_tracks(live_params:Dict[str, Any]) -> Tuple[Optional[pd.DataFrame], Optional[pd.DataFrame]]:
+    """Poll the live sources and return the combined table and segment index of the live tracks"""
+    table, _, errors = poll_live_tracks(live_params)
+    for error in errors:
+        st.error(error)
+    return table.to_frame()
@@ -0,0 +1,262 @@
+# Cached render layers shared by the static map and animation renderers
+#
+# A rendered map is composed of three layers, each cached by only the
+# parameters it depends on:
+#   - basemap raster: map style and bounds
+#   - track geometry: track data, grouping mode and filters, sliced to a
+#     time range by binary search
+#   - decorations: title, legend, time label, line width and marker size
+# Decorations are cheap and are drawn on every render, so changing a purely
+# cosmetic parameter reuses the cached basemap and geometry layers.
+
+import numpy as np
+import pandas as pd
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Sequence, Tuple
+
+from profiling import stage
+from providers import get_provider
+from shared_cache import SharedCache, cache_size_mb
+from spatial_index import INDEX_COLUMNS, get_spatial_index
+from util import get_dataframe_hash
+
+_GEOMETRY_CACHE_SIZE = 16
+
+_geometry_cache = OrderedDict()
+_cache_lock = threading.Lock()
+
+
+@dataclass
+class BasemapLayer:
+    """Basemap raster warped to EPSG:4326 with its extent and attribution"""
+    image: np.ndarray
+    extent: Tuple[float, float, float, float]
+    attribution: str
+
+
+@dataclass
+class TrackGeometryLayer:
+    """Time-sorted coordinates of each track within a time range"""
+    names: List[str]
+    elapsed_seconds: Dict[str, np.ndarray]
+    longitude: Dict[str, np.ndarray]
+    latitude: Dict[str, np.ndarray]
+
+
+def _cache_get(cache:OrderedDict, key):
+    with _cache_lock:
+        value = cache.get(key)
+        if value is not None:
+            cache.move_to_end(key)
+        return value
+
+
+def _cache_put(cache:OrderedDict, key, value, max_size:int) -> None:
+    with _cache_lock:
+        cache[key] = value
+        cache.move_to_end(key)
+        while len(cache) > max_size:
+            cache.popitem(last=False)
+
+
+# Process-wide cache of basemap mosaics, shared by all sessions. Sessions that request
+# the same basemap at the same time wait for a single download.
+BASEMAP_CACHE = SharedCache(
+    max_bytes=cache_size_mb("SKI_TRACKS_BASEMAP_CACHE_MB", 512),
+    size_of=lambda layer: layer.image.nbytes,
+    name="basemaps"
+)
+
+
+def fetch_basemap_image(provider, lat_min:float, lat_max:float, lon_min:float, lon_max:float) -> Tuple[np.ndarray, Tuple[float, float, float, float]]:
+    """
+    Download the basemap tiles covering the bounds and warp them to EPSG:4326.
+    Args:
+        provider (xyzservices.TileProvider): Tile provider.
+        lat_min, lat_max, lon_min, lon_max (float): Bounds of the map.
+    Returns:
+        tuple: Image array and its (left, right, bottom, top) extent in degrees.
+    """
+    # contextily pulls in rasterio and is only imported once a basemap is fetched
+    import contextily as ctx
+
+    with stage("basemap_fetch") as fetch_stage:
+        image, extent = ctx.bounds2img(lon_min, lat_min, lon_max, lat_max, zoom="auto", source=provider, ll=True)
+        fetch_stage.add(pixels=image.shape[0] * image.shape[1], bytes=image.nbytes)
+    with stage("basemap_warp"):
+        image, extent = ctx.warp_tiles(image, extent, t_crs="EPSG:4326")
+    return image, extent
+
+
+def _basemap_cache_key(map_style:str, lat_min:float, lat_max:float, lon_min:float, lon_max:float) -> tuple:
+    return (map_style, float(lat_min), float(lat_max), float(lon_min), float(lon_max))
+
+
+def get_basemap_layer(map_style:str, lat_min:float, lat_max:float, lon_min:float, lon_max:float) -> BasemapLayer:
+    """Return the basemap layer for a map style and bounds, fetching it only on a cache miss"""
+    cache_key = _basemap_cache_key(map_style, lat_min, lat_max, lon_min, lon_max)
+
+    def fetch_layer() -> BasemapLayer:
+        provider = get_provider(map_style)
+        image, extent = fetch_basemap_image(provider, lat_min, lat_max, lon_min, lon_max)
+        return BasemapLayer(image=image, extent=extent, attribution=provider.get("attribution", ""))
+
+    return BASEMAP_CACHE.get_or_create(cache_key, fetch_layer)
+
+
+def put_basemap_layer(map_style:str, lat_min:float, lat_max:float, lon_min:float, lon_max:float, layer:BasemapLayer) -> None:
+    """Cache a basemap layer fetched elsewhere, such as by the process that started this worker"""
+    BASEMAP_CACHE.put(_basemap_cache_key(map_style, lat_min, lat_max, lon_min, lon_max), layer)
+
+
+def draw_basemap_layer(ax, layer:BasemapLayer, attribution_size:int=2) -> None:
+    """Draw a cached basemap layer onto an axis, keeping the current axis limits"""
+    with stage("basemap_draw"):
+        xlim = ax.get_xlim()
+        ylim = ax.get_ylim()
+        ax.imshow(
+            layer.image,
+            extent=layer.extent,
+            interpolation="bilinear",
+            aspect=ax.get_aspect()
+        )
+        ax.set_xlim(xlim)
+        ax.set_ylim(ylim)
+        if layer.attribution:
+            import contextily as ctx
+            ctx.add_attribution(ax, layer.attribution, font_size=attribution_size)
+
+
+def get_track_geometry_layer(
+    df:pd.DataFrame,
+    mode:str="track",
+    start_time:Optional[float]=None,
+    end_time:Optional[float]=None,
+    segment_types:Optional[Sequence[str]]=None,
+    bounds:Optional[Tuple[float, float, float, float]]=None
+) -> TrackGeometryLayer:
+    """
+    Return the time-sorted coordinates of each track within a time range.
+    Args:
+        df (pd.DataFrame): DataFrame containing GPX track data.
+        mode (str): Group points by "track" name or "file" name.
+        start_time, end_time (float, optional): Time range in seconds on the timeline, the whole track if None.
+        segment_types (list, optional): Only keep points of these segment types. Gaps left by
+            removed segments are broken with NaN coordinates so lines are not joined across them.
+        bounds (tuple, optional): (lat_min, lat_max, lon_min, lon_max) of the view. Only segments
+            intersecting the view, found with the spatial index, and the first and last point of
+            each track are kept.
+    Returns:
+        TrackGeometryLayer: Per-track arrays sorted by elapsed seconds.
+    """
+    if mode == "track":
+        group_column = "track_name"
+    elif mode == "file":
+        group_column = "file_name"
+    else:
+        raise ValueError("Invalid mode specified. Use 'track' or 'file'.")
+
+    if segment_types is not None and "segment_type" not in df.columns:
+        segment_types = None
+
+    # Restrict to the view only when it excludes part of the data. The extent of the
+    # points is checked first so the index is not built for a view of all the data.
+    spatial_index = None
+    if bounds is not None:
+        lat_min, lat_max, lon_min, lon_max = bounds
+        if (
+            lat_min <= df["latitude"].min() and lat_max >= df["latitude"].max()
+            and lon_min <= df["longitude"].min() and lon_max >= df["longitude"].max()
+        ):
+            bounds = None
+        else:
+            spatial_index = get_spatial_index(df)
+            if spatial_index.covers(*bounds):
+                spatial_index = None
+                bounds = None
+
+    # The full time range is cached and time ranges are sliced from it by binary search
+    cache_key = _geometry_cache_key(df, group_column, mode, segment_types, bounds)
+    layer = _cache_get(_geometry_cache, cache_key)
+    if layer is None:
+        layer = _build_track_geometry_layer(df, group_column, segment_types, spatial_index, bounds)
+        _cache_put(_geometry_cache, cache_key, layer, _GEOMETRY_CACHE_SIZE)
+    return _slice_track_geometry_layer(layer, start_time, end_time)
+
+
+def _geometry_cache_key(df:pd.DataFrame, group_column:str, mode:str, segment_types, bounds) -> tuple:
+    # Hashed over the columns of the spatial index so one hash of a table serves both caches
+    return (
+        get_dataframe_hash(df, [column for column in INDEX_COLUMNS if column in df.columns]),
+        mode,
+        None if segment_types is None else tuple(sorted(segment_types)),
+        None if bounds is None else tuple(float(bound) for bound in bounds)
+    )
+
+
+def put_track_geometry_layer(df:pd.DataFrame, mode:str, layer:TrackGeometryLayer) -> None:
+    """
+    Cache a geometry layer of all the points of a table that was built elsewhere, such as
+    by updating only the tracks that changed. It is used for views of the whole table.
+    """
+    group_column = "track_name" if mode == "track" else "file_name"
+    _cache_put(_geometry_cache, _geometry_cache_key(df, group_column, mode, None, None), layer, _GEOMETRY_CACHE_SIZE)
+
+
+def _slice_track_geometry_layer(layer:TrackGeometryLayer, start_time:Optional[float], end_time:Optional[float]) -> TrackGeometryLayer:
+    """Return views of the points of each track within a time range"""
+    sliced = TrackGeometryLayer(names=layer.names, elapsed_seconds={}, longitude={}, latitude={})
+    for name in layer.names:
+        track_times = layer.elapsed_seconds[name]
+        lo = 0 if start_time is None else np.searchsorted(track_times, start_time, side="left")
+        hi = track_times.size if end_time is None else np.searchsorted(track_times, end_time, side="right")
+        sliced.elapsed_seconds[name] = track_times[lo:hi]
+        sliced.longitude[name] = layer.longitude[name][lo:hi]
+        sliced.latitude[name] = layer.latitude[name][lo:hi]
+    return sliced
+
+
+def _build_track_geometry_layer(df:pd.DataFrame, group_column:str, segment_types, spatial_index, bounds) -> TrackGeometryLayer:
+    """Sort the points by group and time, apply the segment type and view filters and split per group"""
+    names = sorted(df[group_column].unique())
+    elapsed = df["elapsed_seconds"].to_numpy()
+
+    # Sort once by group and time, then split into per-group views
+    codes = pd.Categorical(df[group_column], categories=names).codes
+    order = np.lexsort((elapsed, codes))
+    codes = codes[order]
+    elapsed = elapsed[order]
+    longitude = df["longitude"].to_numpy()[order]
+    latitude = df["latitude"].to_numpy()[order]
+
+    keep = None
+    if segment_types is not None:
+        keep = df["segment_type"].isin(list(segment_types)).to_numpy()
+    if spatial_index is not None:
+        with stage("spatial_query"):
+            view_rows = spatial_index.row_mask(spatial_index.query_bbox(*bounds), len(df))
+        view_rows[spatial_index.order[spatial_index.track_first]] = True
+        view_rows[spatial_index.order[spatial_index.track_last]] = True
+        keep = view_rows if keep is None else keep & view_rows
+
+    if keep is not None:
+        keep = keep[order]
+        kept_rows = np.flatnonzero(keep)
+        # Break lines where removed points separate two kept points of the same group
+        breaks = np.flatnonzero((np.diff(kept_rows) > 1) & (codes[kept_rows[1:]] == codes[kept_rows[:-1]])) + 1
+        codes = np.insert(codes[kept_rows], breaks, codes[kept_rows][breaks])
+        elapsed = np.insert(elapsed[kept_rows], breaks, elapsed[kept_rows][breaks - 1])
+        longitude = np.insert(longitude[kept_rows], breaks, np.nan)
+        latitude = np.insert(latitude[kept_rows], breaks, np.nan)
+
+    group_bounds = np.searchsorted(codes, np.arange(len(names) + 1))
+
+    layer = TrackGeometryLayer(names=names, elapsed_seconds={}, longitude={}, latitude={})
+    for k1, name in enumerate(names):
+        rows = slice(group_bounds[k1], group_bounds[k1 + 1])
+        layer.elapsed_seconds[name] = elapsed[rows]
+        layer.longitude[name] = longitude[rows]
+        layer.latitude[name] = latitude[rows]
+    return layer
@@ -0,0 +1,490 @@
+# Offline matching of runs and lifts to named pistes and lifts of a local OpenStreetMap extract
+
+"""
+Resort geometry is read from a local OSM XML extract (.osm, .osm.gz or .osm.bz2)
+without any network access. Ways tagged 'piste:type' and lift ways tagged
+'aerialway' are split into short pieces and stored in a sparse grid in a local
+metric projection. Run and lift segments from segment_tracks are matched by
+snapping a sample of their points to the nearest piece of the right kind and
+voting for the most frequent feature name.
+"""
+
+import bz2
+import gzip
+import hashlib
+import os
+import threading
+import xml.etree.ElementTree as ET
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+
+from geo import EARTH_MEAN_RADIUS_M
+from profiling import stage
+from track_stats import _sorted_by_track, _track_hashes
+
+FEATURE_KINDS = ["piste", "lift"]
+PISTE, LIFT = 0, 1
+# Segment type matched against each feature kind
+SEGMENT_FEATURE_KINDS = {"run": PISTE, "lift": LIFT}
+
+# Aerialway values of lifts that carry skiers, stations and pylons are ignored
+LIFT_TYPES = {
+    "cable_car", "gondola", "mixed_lift", "chair_lift", "drag_lift", "t-bar", "j-bar",
+    "platter", "rope_tow", "magic_carpet", "funicular",
+}
+
+# Points farther than this from every feature of the right kind are unmatched
+MAX_MATCH_DISTANCE_M = 40.0
+# A segment takes the name of the feature that most of its sampled points snap to,
+# if at least this fraction of the samples agree
+MIN_MATCHED_FRACTION = 0.5
+# Long segments are matched on an evenly spaced sample of their points
+MAX_SAMPLES_PER_SEGMENT = 200
+# Number of sampled points snapped per vectorized batch, bounds peak memory
+MATCH_CHUNK_SIZE = 50_000
+
+MATCH_COLUMNS = ["file_name", "track_name", "segment_number", "segment_type", "feature_name", "matched_fraction", "via_lift"]
+
+_FEATURES_CACHE_SIZE = 2
+_features_cache = OrderedDict()
+_features_cache_lock = threading.Lock()
+
+_MATCH_CACHE_SIZE = 4096
+_match_cache = OrderedDict()
+_match_cache_lock = threading.Lock()
+
+
+@dataclass
+class ResortFeatures:
+    """
+    Named pistes and lifts split into pieces no longer than half a grid cell.
+    Positions are in meters in an equirectangular projection around (origin_lat, origin_lon).
+    The pieces whose midpoint falls in grid cell cell_keys[i] are
+    cell_pieces[cell_offsets[i]:cell_offsets[i + 1]].
+    """
+    key: str
+    names: List[str]
+    kinds: np.ndarray
+    origin_lat: float
+    origin_lon: float
+    cell_size: float
+    piece_feature: np.ndarray
+    x0: np.ndarray
+    y0: np.ndarray
+    x1: np.ndarray
+    y1: np.ndarray
+    cell_keys: np.ndarray
+    cell_offsets: np.ndarray
+    cell_pieces: np.ndarray
+
+    @property
+    def num_features(self) -> int:
+        return len(self.names)
+
+    def project(self, latitude:np.ndarray, longitude:np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """Project coordinates to meters around the origin"""
+        scale = np.pi / 180 * EARTH_MEAN_RADIUS_M
+        x = (np.asarray(longitude, dtype=np.float64) - self.origin_lon) * scale * np.cos(np.radians(self.origin_lat))
+        y = (np.asarray(latitude, dtype=np.float64) - self.origin_lat) * scale
+        return x, y
+
+    def _cell_key(self, ix:np.ndarray, iy:np.ndarray) -> np.ndarray:
+        # Cell indices are small next to 2**31, so this key is unique per cell
+        return iy.astype(np.int64) * (1 << 32) + ix.astype(np.int64)
+
+    def nearest(self, latitude:np.ndarray, longitude:np.ndarray, kinds:np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Snap points to the nearest feature of a given kind within MAX_MATCH_DISTANCE_M.
+        Candidates are the pieces in the 3x3 grid cells around each point, gathered and
+        measured for all points at once.
+        Args:
+            latitude, longitude (np.ndarray): Point coordinates.
+            kinds (np.ndarray): Feature kind code each point may match (PISTE or LIFT).
+        Returns:
+            tuple: Feature index of each point (-1 if unmatched) and distance in meters (inf if unmatched).
+        """
+        n = len(latitude)
+        feature = np.full(n, -1, dtype=np.int64)
+        distance = np.full(n, np.inf)
+        if n == 0 or self.cell_keys.size == 0:
+            return feature, distance
+
+        px, py = self.project(latitude, longitude)
+        ix = np.floor(px / self.cell_size).astype(np.int64)
+        iy = np.floor(py / self.cell_size).astype(np.int64)
+        # Candidate cell ranges in point-major order, so the expanded pairs stay sorted by point
+        offsets = np.array([-1, 0, 1])
+        keys = self._cell_key(ix[:, None, None] + offsets[None, None, :], iy[:, None, None] + offsets[None, :, None]).ravel()
+        pos = np.minimum(np.searchsorted(self.cell_keys, keys), self.cell_keys.size - 1)
+        found = self.cell_keys[pos] == keys
+        starts = np.where(found, self.cell_offsets[pos], 0)
+        counts = np.where(found, self.cell_offsets[pos + 1] - self.cell_offsets[pos], 0)
+
+        # Expand every (point, cell) pair to its candidate pieces
+        pair_points = np.repeat(np.arange(n), counts.reshape(n, 9).sum(axis=1))
+        local = np.arange(pair_points.size) - np.repeat(np.cumsum(counts) - counts, counts)
+        pieces = self.cell_pieces[np.repeat(starts, counts) + local]
+        same_kind = self.kinds[self.piece_feature[pieces]] == kinds[pair_points]
+        pair_points = pair_points[same_kind]
+        pieces = pieces[same_kind]
+        if pieces.size == 0:
+            return feature, distance
+
+        qx = px[pair_points]
+        qy = py[pair_points]
+        x0 = self.x0[pieces]
+        y0 = self.y0[pieces]
+        dx = self.x1[pieces] - x0
+        dy = self.y1[pieces] - y0
+        length2 = dx * dx + dy * dy
+        t = np.clip(((qx - x0) * dx + (qy - y0) * dy) / np.where(length2 > 0, length2, 1.0), 0.0, 1.0)
+        pair_distance = np.hypot(qx - (x0 + t * dx), qy - (y0 + t * dy))
+
+        # Closest candidate of each point, from a reduction over the contiguous pairs of each point
+        group_first = np.flatnonzero(np.r_[True, pair_points[1:] != pair_points[:-1]])
+        group_points = pair_points[group_first]
+        min_distance = np.minimum.reduceat(pair_distance, group_first)
+        is_min = pair_distance == np.repeat(min_distance, np.diff(np.append(group_first, pair_points.size)))
+        closest = np.flatnonzero(is_min)
+        closest = closest[np.r_[True, pair_points[closest][1:] != pair_points[closest][:-1]]]
+        within = min_distance <= MAX_MATCH_DISTANCE_M
+        feature[group_points[within]] = self.piece_feature[pieces[closest[within]]]
+        distance[group_points[within]] = min_distance[within]
+        return feature, distance
+
+
+def _open_osm(path:str):
+    if path.endswith(".gz"):
+        return gzip.open(path, "rb")
+    if path.endswith(".bz2"):
+        return bz2.open(path, "rb")
+    return open(path, "rb")
+
+
+def _feature_of_way(tags:Dict[str, str]) -> Optional[Tuple[int, str]]:
+    """Kind and name of a piste or lift way, or None for other and unnamed ways"""
+    name = tags.get("name") or tags.get("piste:name") or tags.get("ref")
+    if not name:
+        return None
+    if tags.get("aerialway") in LIFT_TYPES:
+        return LIFT, name
+    # Piste areas are skipped, the distance to their outline says nothing about being on them
+    if "piste:type" in tags and tags.get("area") != "yes":
+        return PISTE, name
+    return None
+
+
+def read_osm_ways(path:str) -> Tuple[List[Tuple[int, str, List[int]]], Dict[int, Tuple[float, float]]]:
+    """
+    Read the named piste and lift ways of an OSM XML extract in two streaming passes,
+    so only the coordinates of nodes used by those ways are kept in memory.
+    Returns:
+        tuple:
+            list: (kind, name, node ids) of each way.
+            dict: Node id to (lat, lon).
+    """
+    ways = []
+    needed_nodes = set()
+    with _open_osm(path) as f:
+        tags = {}
+        refs = []
+        for _, elem in ET.iterparse(f, events=("end",)):
+            if elem.tag == "tag":
+                tags[elem.get("k")] = elem.get("v")
+            elif elem.tag == "nd":
+                refs.append(int(elem.get("ref")))
+            elif elem.tag in ("node", "way", "relation"):
+                if elem.tag == "way":
+                    feature = _feature_of_way(tags)
+                    if feature is not None and len(refs) >= 2:
+                        ways.append((feature[0], feature[1], refs))
+                        needed_nodes.update(refs)
+                tags = {}
+                refs = []
+                elem.clear()
+
+    nodes = {}
+    with _open_osm(path) as f:
+        for _, elem in ET.iterparse(f, events=("end",)):
+            if elem.tag == "node":
+                node_id = int(elem.get("id"))
+                if node_id in needed_nodes:
+                    nodes[node_id] = (float(elem.get("lat")), float(elem.get("lon")))
+                elem.clear()
+            elif elem.tag in ("way", "relation"):
+                elem.clear()
+    return ways, nodes
+
+
+def build_resort_features(ways:List[Tuple[int, str, List[int]]], nodes:Dict[int, Tuple[float, float]], key:str="") -> ResortFeatures:
+    """
+    Build the spatial index of piste and lift features.
+    Ways with the same kind and name are one feature, so a piste mapped as several
+    ways collects the votes of all of them.
+    """
+    names = []
+    kinds = []
+    feature_ids = {}
+    way_lat = []
+    way_lon = []
+    way_feature = []
+    for kind, name, refs in ways:
+        coords = [nodes[ref] for ref in refs if ref in nodes]
+        if len(coords) < 2:
+            continue
+        feature_id = feature_ids.setdefault((kind, name), len(names))
+        if feature_id == len(names):
+            names.append(name)
+            kinds.append(kind)
+        coords = np.asarray(coords)
+        way_lat.append(coords[:, 0])
+        way_lon.append(coords[:, 1])
+        way_feature.append(feature_id)
+
+    cell_size = 2 * MAX_MATCH_DISTANCE_M
+    if not way_lat:
+        empty = np.empty(0)
+        return ResortFeatures(
+            key=key, names=[], kinds=np.empty(0, dtype=np.int8), origin_lat=0.0, origin_lon=0.0, cell_size=cell_size,
+            piece_feature=np.empty(0, dtype=np.int64), x0=empty, y0=empty, x1=empty, y1=empty,
+            cell_keys=np.empty(0, dtype=np.int64), cell_offsets=np.zeros(1, dtype=np.int64), cell_pieces=np.empty(0, dtype=np.int64)
+        )
+
+    all_lat = np.concatenate(way_lat)
+    all_lon = np.concatenate(way_lon)
+    features = ResortFeatures(
+        key=key, names=names, kinds=np.asarray(kinds, dtype=np.int8),
+        origin_lat=float(all_lat.mean()), origin_lon=float(all_lon.mean()), cell_size=cell_size,
+        piece_feature=None, x0=None, y0=None, x1=None, y1=None, cell_keys=None, cell_offsets=None, cell_pieces=None
+    )
+
+    # Consecutive node pairs of each way, split so no piece is longer than half a cell.
+    # A point within MAX_MATCH_DISTANCE_M of a piece then has the piece's midpoint in
+    # its own or a neighboring cell.
+    node_way = np.repeat(np.arange(len(way_lat)), [lat.size for lat in way_lat])
+    x, y = features.project(all_lat, all_lon)
+    same_way = node_way[1:] == node_way[:-1]
+    sx0, sy0 = x[:-1][same_way], y[:-1][same_way]
+    sx1, sy1 = x[1:][same_way], y[1:][same_way]
+    segment_feature = np.asarray(way_feature)[node_way[:-1][same_way]]
+    splits = np.maximum(np.ceil(np.hypot(sx1 - sx0, sy1 - sy0) / (cell_size / 2)), 1).astype(np.int64)
+    segment = np.repeat(np.arange(splits.size), splits)
+    step = np.arange(segment.size) - np.repeat(np.cumsum(splits) - splits, splits)
+    t0 = step / splits[segment]
+    t1 = (step + 1) / splits[segment]
+    features.x0 = sx0[segment] + t0 * (sx1 - sx0)[segment]
+    features.y0 = sy0[segment] + t0 * (sy1 - sy0)[segment]
+    features.x1 = sx0[segment] + t1 * (sx1 - sx0)[segment]
+    features.y1 = sy0[segment] + t1 * (sy1 - sy0)[segment]
+    features.piece_feature = segment_feature[segment]
+
+    cells = features._cell_key(
+        np.floor((features.x0 + features.x1) / 2 / cell_size).astype(np.int64),
+        np.floor((features.y0 + features.y1) / 2 / cell_size).astype(np.int64)
+    )
+    features.cell_pieces = np.argsort(cells, kind="stable")
+    features.cell_keys, counts = np.unique(cells[features.cell_pieces], return_counts=True)
+    features.cell_offsets = np.zeros(counts.size + 1, dtype=np.int64)
+    np.cumsum(counts, out=features.cell_offsets[1:])
+    return features
+
+
+def load_resort_features(path:str) -> ResortFeatures:
+    """
+    Load the piste and lift features of a local OSM extract, reading the file only on a cache miss.
+    Args:
+        path (str): Path of an .osm, .osm.gz or .osm.bz2 file.
+    Returns:
+        ResortFeatures: Indexed features.
+    """
+    path = os.path.abspath(path)
+    file_stat = os.stat(path)
+    key = hashlib.sha1(f"{path}:{file_stat.st_size}:{file_stat.st_mtime_ns}".encode()).hexdigest()
+    with _features_cache_lock:
+        features = _features_cache.get(key)
+        if features is not None:
+            _features_cache.move_to_end(key)
+            return features
+
+    with stage("resort_features_load") as load_stage:
+        ways, nodes = read_osm_ways(path)
+        features = build_resort_features(ways, nodes, key=key)
+        load_stage.add(ways=len(ways), features=features.num_features, pieces=features.piece_feature.size)
+
+    with _features_cache_lock:
+        _features_cache[key] = features
+        while len(_features_cache) > _FEATURES_CACHE_SIZE:
+            _features_cache.popitem(last=False)
+    return features
+
+
+def match_segments(df:pd.DataFrame, features:ResortFeatures) -> pd.DataFrame:
+    """
+    Match the runs and lifts of segmented tracks to named features without caching.
+    Segments are numbered per track as in track_stats.compute_stats.
+    Args:
+        df (pd.DataFrame): Track data with a 'segment_type' column from segment_tracks.
+        features (ResortFeatures): Piste and lift features.
+    Returns:
+        pd.DataFrame: One row per run and lift (MATCH_COLUMNS). 'feature_name' is None for
+            unmatched segments, 'via_lift' is the name of the last matched lift before a run.
+    """
+    if df.empty or "segment_type" not in df.columns:
+        return pd.DataFrame(columns=MATCH_COLUMNS)
+
+    df = _sorted_by_track(df)
+    n = len(df)
+    file_names = df["file_name"].to_numpy()
+    track_names = df["track_name"].to_numpy()
+    track_start = np.ones(n, dtype=bool)
+    track_start[1:] = (file_names[1:] != file_names[:-1]) | (track_names[1:] != track_names[:-1])
+    track_ids = np.cumsum(track_start) - 1
+    segment_types = pd.Categorical(df["segment_type"])
+    segment_codes = segment_types.codes
+    segment_start = track_start.copy()
+    segment_start[1:] |= segment_codes[1:] != segment_codes[:-1]
+    segment_ids = np.cumsum(segment_start) - 1
+    segment_first = np.flatnonzero(segment_start)
+    segment_end = np.append(segment_first[1:], n)
+    segment_type = np.asarray(segment_types.categories, dtype=object)[segment_codes[segment_first]]
+    segment_number = np.arange(segment_first.size) - segment_ids[np.flatnonzero(track_start)][track_ids[segment_first]] + 1
+
+    matched = np.isin(segment_type, list(SEGMENT_FEATURE_KINDS))
+    segments = np.flatnonzero(matched)
+    segment_kind = np.array([SEGMENT_FEATURE_KINDS.get(t, -1) for t in segment_type], dtype=np.int8)
+
+    # Evenly spaced sample rows of every run and lift
+    lengths = segment_end[segments] - segment_first[segments]
+    samples = np.minimum(lengths, MAX_SAMPLES_PER_SEGMENT)
+    sample_segment = np.repeat(segments, samples)
+    local = np.arange(sample_segment.size) - np.repeat(np.cumsum(samples) - samples, samples)
+    sample_rows = segment_first[sample_segment] + (local * np.repeat(lengths, samples)) // np.repeat(samples, samples)
+
+    latitude = df["latitude"].to_numpy(dtype=np.float64)
+    longitude = df["longitude"].to_numpy(dtype=np.float64)
+    sample_feature = np.empty(sample_rows.size, dtype=np.int64)
+    with stage("map_matching", segments=segments.size, samples=sample_rows.size):
+        for chunk_first in range(0, sample_rows.size, MATCH_CHUNK_SIZE):
+            chunk = slice(chunk_first, chunk_first + MATCH_CHUNK_SIZE)
+            rows = sample_rows[chunk]
+            sample_feature[chunk], _ = features.nearest(latitude[rows], longitude[rows], segment_kind[sample_segment[chunk]])
+
+    # Vote for the most frequent feature of each segment
+    voted = sample_feature >= 0
+    num_features = max(features.num_features, 1)
+    pair_keys, votes = np.unique(sample_segment[voted] * num_features + sample_feature[voted], return_counts=True)
+    pair_segment = pair_keys // num_features
+    pair_feature = pair_keys % num_features
+    order = np.lexsort((-votes, pair_segment))
+    best = order[np.flatnonzero(np.r_[True, pair_segment[order][1:] != pair_segment[order][:-1]])]
+    segment_samples = np.zeros(segment_first.size, dtype=np.int64)
+    segment_samples[segments] = samples
+    best_segment = pair_segment[best]
+    fraction = np.zeros(segment_first.size)
+    fraction[best_segment] = votes[best] / segment_samples[best_segment]
+    feature_name = np.full(segment_first.size, None, dtype=object)
+    accepted = fraction[best_segment] >= MIN_MATCHED_FRACTION
+    names = np.asarray(features.names, dtype=object)
+    feature_name[best_segment[accepted]] = names[pair_feature[best][accepted]]
+
+    matches = pd.DataFrame({
+        "file_name": file_names[segment_first],
+        "track_name": track_names[segment_first],
+        "segment_number": segment_number.astype(np.int32),
+        "segment_type": segment_type,
+        "feature_name": feature_name,
+        "matched_fraction": fraction,
+        "track_id": track_ids[segment_first],
+    })[matched]
+    # Each run is reached by the last matched lift before it in the same track
+    lift_names = matches["feature_name"].where(matches["segment_type"] == "lift")
+    matches["via_lift"] = lift_names.groupby(matches["track_id"]).ffill().where(matches["segment_type"] == "run")
+    matches["via_lift"] = matches["via_lift"].astype(object).where(matches["via_lift"].notna(), None)
+    return matches[MATCH_COLUMNS].reset_index(drop=True)
+
+
+def get_segment_matches(df:pd.DataFrame, features:ResortFeatures) -> pd.DataFrame:
+    """
+    Return the piste and lift matches of every run and lift, memoized per track.
+    Tracks are keyed by their names, a hash of their points and the features, so only
+    new tracks are matched when files are added.
+    Args:
+        df (pd.DataFrame): Track data with a 'segment_type' column from segment_tracks.
+        features (ResortFeatures): Piste and lift features.
+    Returns:
+        pd.DataFrame: Matches as returned by match_segments.
+    """
+    if df is None or df.empty or "segment_type" not in df.columns:
+        return pd.DataFrame(columns=MATCH_COLUMNS)
+
+    df = _sorted_by_track(df)
+    n = len(df)
+    file_names = df["file_name"].to_numpy()
+    track_names = df["track_name"].to_numpy()
+    track_start = np.ones(n, dtype=bool)
+    track_start[1:] = (file_names[1:] != file_names[:-1]) | (track_names[1:] != track_names[:-1])
+    track_first = np.flatnonzero(track_start)
+    track_end = np.append(track_first[1:], n)
+
+    keys = [
+        (file_names[first], track_names[first], track_hash, features.key)
+        for first, track_hash in zip(track_first, _track_hashes(df, track_first, track_end))
+    ]
+    with _match_cache_lock:
+        cached = {key: _match_cache[key] for key in keys if key in _match_cache}
+        for key in cached:
+            _match_cache.move_to_end(key)
+
+    missing = [k1 for k1, key in enumerate(keys) if key not in cached]
+    if missing:
+        rows = np.concatenate([np.arange(track_first[k1], track_end[k1]) for k1 in missing])
+        matches = match_segments(df.iloc[rows], features)
+        match_groups = dict(list(matches.groupby(["file_name", "track_name"], sort=False)))
+        with _match_cache_lock:
+            for k1 in missing:
+                key = keys[k1]
+                entry = match_groups.get((key[0], key[1]), matches.iloc[0:0])
+                cached[key] = entry
+                _match_cache[key] = entry
+            while len(_match_cache) > _MATCH_CACHE_SIZE:
+                _match_cache.popitem(last=False)
+
+    frames = [cached[key] for key in keys if not cached[key].empty]
+    if not frames:
+        return pd.DataFrame(columns=MATCH_COLUMNS)
+    return pd.concat(frames, ignore_index=True)
+
+
+def describe_route(run_name:Optional[str], lift_name:Optional[str]) -> str:
+    """Label of a run such as "Run X via Lift Y" """
+    if run_name is None:
+        return "" if lift_name is None else f"Unmatched run via {lift_name}"
+    if lift_name is None:
+        return run_name
+    return f"{run_name} via {lift_name}"
+
+
+def get_route_labels(df:pd.DataFrame, features:ResortFeatures, max_runs:int=3) -> Dict[str, str]:
+    """
+    Legend labels of tracks listing their matched runs, such as "Morning: Run X via Lift Y, ...".
+    Args:
+        df (pd.DataFrame): Track data with a 'segment_type' column from segment_tracks.
+        features (ResortFeatures): Piste and lift features.
+        max_runs (int): Number of runs listed before the rest are counted.
+    Returns:
+        dict: Track name to label, for tracks with at least one matched run.
+    """
+    matches = get_segment_matches(df, features)
+    runs = matches[(matches["segment_type"] == "run") & matches["feature_name"].notna()]
+    labels = {}
+    for track_name, track_runs in runs.groupby("track_name", sort=False):
+        routes = [describe_route(run, lift) for run, lift in zip(track_runs["feature_name"], track_runs["via_lift"])]
+        label = ", ".join(routes[:max_runs])
+        if len(routes) > max_runs:
+            label += f" (+{len(routes) - max_runs} more)"
+        labels[track_name] = f"{track_name}: {label}"
+    return labels
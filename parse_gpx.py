@@ -1,13 +1,30 @@
 #
 
 import gpxpy
+import hashlib
 import os
 import pandas as pd
-import streamlit as st
 import tempfile
+from typing import List, Optional, Tuple
+
+from profiling import stage
+from shared_cache import SharedCache, cache_size_mb
+
+
+def _parsed_file_bytes(value) -> int:
+    track_dfs, _ = value
+    return int(sum(df.memory_usage(deep=True).sum() for df in track_dfs))
+
+
+# Process-wide cache of parsed files, shared by all sessions
+PARSED_FILE_CACHE = SharedCache(
+    max_bytes=cache_size_mb("SKI_TRACKS_PARSE_CACHE_MB", 512),
+    size_of=_parsed_file_bytes,
+    name="parsed files"
+)
 
 # Function to convert timestamps in a DataFrame column to a specified timezone
-def convert_timestamp_timezone(df, column_name, target_tz="US/Pacific", file_name=None):
+def convert_timestamp_timezone(df, column_name, target_tz="US/Pacific", file_name=None, errors=None):
     """
     Convert timestamps in a DataFrame column to the target timezone.
     
@@ -16,6 +33,7 @@ def convert_timestamp_timezone(df, column_name, target_tz="US/Pacific", file_nam
         column_name (str): Name of the column containing timestamps
         target_tz (str): Target timezone to convert to
         file_name (str, optional): Name of the file for warning messages
+        errors (list, optional): List that warning messages are appended to
         
     Returns:
         pd.DataFrame: DataFrame with converted timestamps
@@ -36,99 +54,120 @@ def convert_timestamp_timezone(df, column_name, target_tz="US/Pacific", file_nam
         return df
     except Exception as e:
         # If conversion fails, issue a warning and return original data
-        if file_name:
-            st.warning(f"Could not convert timestamps for {file_name}: {str(e)}. Using as is.")
+        if file_name and errors is not None:
+            errors.append(f"Could not convert timestamps for {file_name}: {str(e)}. Using as is.")
         return original_df
 
 # Load GPX files into a DataFrame
-def parse_gpx_files(uploaded_files) -> pd.DataFrame | None:
+def parse_gpx_files(uploaded_files, errors:Optional[List[str]]=None) -> pd.DataFrame | None:
 
     """
     Load GPX files into a DataFrame.
     Args:
-        uploaded_files (list): List of uploaded GPX files.
+        uploaded_files (list): List of uploaded GPX files, any objects with a name attribute and a getvalue method.
+        errors (list, optional): List that error and warning messages are appended to.
     Returns:
         pd.DataFrame: DataFrame containing track data.
     """
 
+    with stage("parse_gpx_files", files=len(uploaded_files)) as parse_stage:
+        combined_df = _parse_gpx_files(uploaded_files, errors=errors)
+        parse_stage.add(points=0 if combined_df is None else len(combined_df))
+    return combined_df
+
+def _parse_gpx_files(uploaded_files, errors:Optional[List[str]]=None) -> pd.DataFrame | None:
+    """Parse GPX files into a combined DataFrame, see parse_gpx_files."""
     df_list = []
     
     for uploaded_file in uploaded_files:
-        # Save the uploaded file to a temporary file
-        with tempfile.NamedTemporaryFile(delete=False, suffix='.gpx') as tmp_file:
-            tmp_file.write(uploaded_file.getvalue())
-            tmp_path = tmp_file.name
-        
-        try:
-            # Parse the GPX file
-            with open(tmp_path, "r") as f:
-                gpx = gpxpy.parse(f)
-            
-            
-            for track in gpx.tracks:
-                track_points = []
-                for segment in track.segments:
-                    for point in segment.points:
-                        track_points.append(
-                            (uploaded_file.name.replace(".gpx", ""),
-                            track.name,
-                            point.time,
-                            point.latitude,
-                            point.longitude,
-                            point.elevation)
-                        )
-
-                if track_points:  # Only process if there are points
-                    df = pd.DataFrame(track_points, columns=["file_name", "track_name", "timestamp", "latitude", "longitude", "elevation"])
-                    df["timestamp"] = pd.to_datetime(df["timestamp"])
-
-                    df = convert_timestamp_timezone(df, "timestamp", file_name=uploaded_file.name)
-
-
-                    min_track_timestamp = df["timestamp"].min()
-
-                    # Create a datetime object for midnight of the day of the minimum timestamp
-                    if min_track_timestamp.tzinfo is not None:
-                    # Create a timezone-aware datetime object for midnight of the minimum timestamp's day
-                        start_time = pd.Timestamp(
-                            year=min_track_timestamp.year,
-                            month=min_track_timestamp.month,
-                            day=min_track_timestamp.day,
-                            hour=0,
-                            minute=0,
-                            second=0,
-                            tz=min_track_timestamp.tzinfo  # Use the same timezone as your data
-                        )
-                    else:
-                        # If timestamps are timezone-naive, create a naive midnight datetime
-                        start_time = pd.Timestamp(
-                            year=min_track_timestamp.year,
-                            month=min_track_timestamp.month,
-                            day=min_track_timestamp.day,
-                            hour=0,
-                            minute=0,
-                            second=0
-                        )
-
-                    # Calculate the difference in seconds between each timestamp and start_time
-                    df["elapsed_seconds"] = (df["timestamp"] - start_time).dt.total_seconds()
-                    
-                    df["time"] = df["timestamp"].dt.strftime("%H:%M:%S")
-                    
-                    for track_name in sorted(df["track_name"].unique()):
-                        print(f"Track: {track_name}, Points: {len(df[df['track_name'] == track_name])}")
-                        print(f"Elapsed second: {df[df['track_name'] == track_name]['elapsed_seconds'].min()}")
-                        print(f"Elapsed second: {df[df['track_name'] == track_name]['elapsed_seconds'].max()}")
-
-                    df_list.append(df)
-        except Exception as e:
-            st.error(f"Error processing {uploaded_file.name}: {e}")
-        finally:
-            # Delete the temporary file
-            os.unlink(tmp_path)
+        content = uploaded_file.getvalue()
+        # Every session parses an uploaded file once for all sessions, keyed by name and content
+        cache_key = (uploaded_file.name, hashlib.sha1(content).hexdigest())
+        track_dfs, messages = PARSED_FILE_CACHE.get_or_create(
+            cache_key,
+            lambda: _parse_gpx_file(uploaded_file.name, content)
+        )
+        df_list.extend(track_dfs)
+        if errors is not None:
+            errors.extend(messages)
     
     if df_list:
         combined_df = pd.concat(df_list, ignore_index=True)
         return combined_df
     else:
-        return None
\ No newline at end of file
+        return None
+
+def _parse_gpx_file(file_name:str, content:bytes) -> Tuple[List[pd.DataFrame], List[str]]:
+    """Parse one GPX file into one DataFrame per track and the error and warning messages"""
+    df_list = []
+    messages = []
+
+    # Save the uploaded file to a temporary file
+    with tempfile.NamedTemporaryFile(delete=False, suffix='.gpx') as tmp_file:
+        tmp_file.write(content)
+        tmp_path = tmp_file.name
+    
+    try:
+        # Parse the GPX file
+        with open(tmp_path, "r") as f:
+            gpx = gpxpy.parse(f)
+        
+        
+        for track in gpx.tracks:
+            track_points = []
+            for segment in track.segments:
+                for point in segment.points:
+                    track_points.append(
+                        (file_name.replace(".gpx", ""),
+                        track.name,
+                        point.time,
+                        point.latitude,
+                        point.longitude,
+                        point.elevation)
+                    )
+
+            if track_points:  # Only process if there are points
+                df = pd.DataFrame(track_points, columns=["file_name", "track_name", "timestamp", "latitude", "longitude", "elevation"])
+                df["timestamp"] = pd.to_datetime(df["timestamp"])
+
+                df = convert_timestamp_timezone(df, "timestamp", file_name=file_name, errors=messages)
+
+
+                min_track_timestamp = df["timestamp"].min()
+
+                # Create a datetime object for midnight of the day of the minimum timestamp
+                if min_track_timestamp.tzinfo is not None:
+                # Create a timezone-aware datetime object for midnight of the minimum timestamp's day
+                    start_time = pd.Timestamp(
+                        year=min_track_timestamp.year,
+                        month=min_track_timestamp.month,
+                        day=min_track_timestamp.day,
+                        hour=0,
+                        minute=0,
+                        second=0,
+                        tz=min_track_timestamp.tzinfo  # Use the same timezone as your data
+                    )
+                else:
+                    # If timestamps are timezone-naive, create a naive midnight datetime
+                    start_time = pd.Timestamp(
+                        year=min_track_timestamp.year,
+                        month=min_track_timestamp.month,
+                        day=min_track_timestamp.day,
+                        hour=0,
+                        minute=0,
+                        second=0
+                    )
+
+                # Calculate the difference in seconds between each timestamp and start_time
+                df["elapsed_seconds"] = (df["timestamp"] - start_time).dt.total_seconds()
+                
+                df["time"] = df["timestamp"].dt.strftime("%H:%M:%S")
+
+                df_list.append(df)
+    except Exception as e:
+        messages.append(f"Error processing {file_name}: {e}")
+    finally:
+        # Delete the temporary file
+        os.unlink(tmp_path)
+
+    return df_list, messages
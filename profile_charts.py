@@ -0,0 +1,96 @@
+# Elevation and speed profile charts section for Streamlit app
+
+from typing import Any, Dict, Optional
+
+import pandas as pd
+import streamlit as st
+
+from profiles import DOWNSAMPLE_METHODS, PROFILE_METRICS, get_profile_frame
+from timeline import get_timeline_origin
+from util import get_distinct_colors
+
+
+def animation_timeline_time(anim_params:Dict[str, Any], video_seconds:float) -> Optional[float]:
+    """
+    Time on the timeline shown by the animation at a time into the video, as generate_animation
+    maps frames to times. None for time axes other than the absolute timeline.
+    """
+    if anim_params["anim_time_axis"] != "Absolute":
+        return None
+    fraction = min(max(video_seconds / anim_params["anim_duration"], 0.0), 1.0)
+    return anim_params["anim_start_seconds"] + (anim_params["anim_end_seconds"] - anim_params["anim_start_seconds"]) * fraction
+
+
+def show_profile_charts(df_selected_tracks:pd.DataFrame, anim_params:Dict[str, Any]) -> None:
+    """
+    Show elevation and speed charts of the selected tracks, downsampled per track.
+    Args:
+        df_selected_tracks (pd.DataFrame): DataFrame containing the selected GPX tracks.
+        anim_params (dict): Animation parameters, used for the time cursor.
+    """
+    st.header("Elevation and Speed Profiles")
+    st.write("Elevation and speed of the selected tracks over time. Each track is reduced to a fixed number of points that keep the shape of its profile.")
+
+    profile_col_01, profile_col_02, profile_col_03 = st.columns(3)
+    with profile_col_01:
+        metrics = st.multiselect("Charts", list(PROFILE_METRICS.keys()), default=["Elevation", "Speed"], key="profile_metrics")
+    with profile_col_02:
+        points_per_track = st.slider("Points per track", min_value=100, max_value=2000, value=500, step=100, key="profile_points")
+        method = st.radio(
+            "Downsampling",
+            DOWNSAMPLE_METHODS,
+            index=0,
+            horizontal=True,
+            key="profile_method",
+            help="LTTB keeps the points that best preserve the visual shape, Min/max keeps the extremes of each interval"
+        )
+    with profile_col_03:
+        show_cursor = st.checkbox(
+            "Show animation time cursor",
+            value=False,
+            key="profile_show_cursor",
+            help="Mark the time the animation shows at a point of the video. The animation video starts playing from there."
+        )
+        cursor_time = None
+        if show_cursor:
+            video_seconds = st.slider(
+                "Animation time (seconds)",
+                min_value=0.0,
+                max_value=float(anim_params["anim_duration"]),
+                value=0.0,
+                step=0.5,
+                key="profile_cursor_seconds"
+            )
+            cursor_time = animation_timeline_time(anim_params, video_seconds)
+            if cursor_time is None:
+                st.caption("The cursor follows animations on the absolute time axis.")
+
+    if not metrics:
+        return
+
+    import altair as alt
+
+    origin = get_timeline_origin(df_selected_tracks)
+    track_names = sorted(df_selected_tracks["track_name"].unique())
+    # Tracks have the colors of the static map
+    track_colors = ["#{:02x}{:02x}{:02x}".format(*(int(round(255 * c)) for c in color)) for color in get_distinct_colors(len(track_names))]
+    color = alt.Color("track_name:N", title="Track", scale=alt.Scale(domain=track_names, range=track_colors))
+
+    for metric in metrics:
+        frame = get_profile_frame(df_selected_tracks, metric, points_per_track=points_per_track, method=method)
+        frame = frame.assign(time=origin + pd.to_timedelta(frame["elapsed_seconds"], unit="s"))
+        unit = PROFILE_METRICS[metric][1]
+        chart = alt.Chart(frame).mark_line(strokeWidth=1.5).encode(
+            x=alt.X("time:T", title=None),
+            y=alt.Y("value:Q", title=f"{metric} ({unit})", scale=alt.Scale(zero=False)),
+            color=color,
+            tooltip=[
+                alt.Tooltip("track_name:N", title="Track"),
+                alt.Tooltip("time:T", title="Time", format="%H:%M:%S"),
+                alt.Tooltip("value:Q", title=f"{metric} ({unit})", format=".1f"),
+            ]
+        )
+        if cursor_time is not None:
+            cursor = pd.DataFrame({"time": [origin + pd.to_timedelta(cursor_time, unit="s")]})
+            chart = chart + alt.Chart(cursor).mark_rule(color="black", strokeDash=[4, 3]).encode(x="time:T")
+        st.altair_chart(chart.properties(height=220).interactive(bind_y=False), width="stretch")
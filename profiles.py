@@ -0,0 +1,224 @@
+# Elevation and speed profiles of tracks, downsampled for charts
+
+"""
+A profile is a metric of every track over the timeline, kept as per-track columnar
+arrays. Charts get at most a fixed number of points per track. The points are picked
+by Largest-Triangle-Three-Buckets, or as the minimum and maximum of each bucket, so a
+1 Hz ski day reaches the browser as a few hundred points that keep its shape.
+Full-resolution profiles are cached per dataset. Downsampled profiles are cached per
+dataset, metric, method and number of points.
+"""
+
+import numpy as np
+import pandas as pd
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Dict, List
+
+from geo import haversine_distance
+from profiling import stage
+from util import get_dataframe_hash
+
+# Metric names with their profile key and unit
+PROFILE_METRICS = {
+    "Elevation": ("elevation", "m"),
+    "Speed": ("speed", "km/h"),
+}
+DOWNSAMPLE_METHODS = ["LTTB", "Min/max"]
+
+# Speeds are averaged over a centered window of this many seconds to suppress GPS noise
+SPEED_WINDOW_SECONDS = 10.0
+
+_PROFILE_CACHE_SIZE = 8
+_profile_cache = OrderedDict()
+_DOWNSAMPLED_CACHE_SIZE = 64
+_downsampled_cache = OrderedDict()
+_profile_cache_lock = threading.Lock()
+
+
+@dataclass
+class TrackProfiles:
+    """
+    Full-resolution profiles of each track sorted by time.
+    values[key][name] holds the metric with profile key 'elevation' or 'speed' of track name.
+    """
+    names: List[str]
+    elapsed_seconds: Dict[str, np.ndarray]
+    values: Dict[str, Dict[str, np.ndarray]]
+
+
+def lttb_indices(x:np.ndarray, y:np.ndarray, num_out:int) -> np.ndarray:
+    """
+    Indices of the points picked by Largest-Triangle-Three-Buckets.
+    The first and last points are kept and the points between them are split into
+    num_out - 2 buckets. From each bucket the point forming the largest triangle with
+    the point picked from the previous bucket and the mean of the next bucket is kept.
+    Args:
+        x, y (np.ndarray): Coordinates of the points, sorted by x.
+        num_out (int): Number of points to keep.
+    Returns:
+        np.ndarray: Sorted indices of the kept points.
+    """
+    n = x.size
+    if num_out >= n or num_out < 3:
+        return np.arange(n)
+
+    edges = np.linspace(1, n - 1, num_out - 1).astype(np.int64)
+    # Bucket means from cumulative sums, the last point stands in for the bucket after the last one
+    cumulative_x = np.concatenate(([0.0], np.cumsum(x)))
+    cumulative_y = np.concatenate(([0.0], np.cumsum(y)))
+    counts = np.diff(edges)
+    mean_x = np.append((cumulative_x[edges[1:]] - cumulative_x[edges[:-1]]) / counts, x[-1])
+    mean_y = np.append((cumulative_y[edges[1:]] - cumulative_y[edges[:-1]]) / counts, y[-1])
+
+    selected = np.empty(num_out, dtype=np.int64)
+    selected[0] = 0
+    selected[-1] = n - 1
+    previous = 0
+    for k1 in range(num_out - 2):
+        lo, hi = edges[k1], edges[k1 + 1]
+        # Twice the triangle areas, the constant factor does not change the maximum
+        area = np.abs(
+            (x[previous] - mean_x[k1 + 1]) * (y[lo:hi] - y[previous])
+            - (x[previous] - x[lo:hi]) * (mean_y[k1 + 1] - y[previous])
+        )
+        previous = lo + int(np.argmax(area))
+        selected[k1 + 1] = previous
+    return selected
+
+
+def minmax_indices(x:np.ndarray, y:np.ndarray, num_out:int) -> np.ndarray:
+    """
+    Indices of the minimum and maximum point of each of (num_out - 2) // 2 buckets, plus the
+    first and last points, found for all buckets at once by sorting on (bucket, y).
+    Returns:
+        np.ndarray: Sorted indices of the kept points.
+    """
+    n = x.size
+    if num_out >= n or num_out < 4:
+        return np.arange(n)
+    num_buckets = (num_out - 2) // 2
+    bucket = (np.arange(n) * num_buckets // n).astype(np.int64)
+    order = np.lexsort((y, bucket))
+    bucket_starts = np.flatnonzero(np.diff(bucket[order], prepend=-1))
+    bucket_ends = np.append(bucket_starts[1:], n) - 1
+    return np.unique(np.concatenate(([0, n - 1], order[bucket_starts], order[bucket_ends])))
+
+
+def compute_track_profiles(df:pd.DataFrame) -> TrackProfiles:
+    """
+    Compute the elevation and speed profiles of every track without caching.
+    Speeds are the distance travelled over a centered window of SPEED_WINDOW_SECONDS,
+    found by binary search on a composite (track, time) key over all tracks at once.
+    Args:
+        df (pd.DataFrame): Track data with 'track_name', 'elapsed_seconds', 'latitude', 'longitude' and 'elevation'.
+    Returns:
+        TrackProfiles: Per-track profiles in km/h and meters.
+    """
+    names = sorted(df["track_name"].unique())
+    codes = pd.Categorical(df["track_name"], categories=names).codes
+    elapsed = df["elapsed_seconds"].to_numpy(dtype=np.float64)
+    order = np.lexsort((elapsed, codes))
+    codes = codes[order]
+    elapsed = elapsed[order]
+    latitude = df["latitude"].to_numpy(dtype=np.float64)[order]
+    longitude = df["longitude"].to_numpy(dtype=np.float64)[order]
+    # Missing elevations are carried forward within the sorted table
+    elevation = pd.Series(df["elevation"].to_numpy(dtype=np.float64, na_value=np.nan)[order]).ffill().bfill().fillna(0.0).to_numpy()
+
+    n = elapsed.size
+    track_start = np.ones(n, dtype=bool)
+    track_start[1:] = codes[1:] != codes[:-1]
+    step_distance = np.zeros(n)
+    step_distance[1:] = haversine_distance(latitude[:-1], longitude[:-1], latitude[1:], longitude[1:])
+    step_distance[track_start] = 0.0
+    cumulative_distance = np.cumsum(step_distance)
+
+    time_offset = elapsed - elapsed.min() if n else elapsed
+    track_span = (time_offset.max() if n else 0.0) + 2 * SPEED_WINDOW_SECONDS + 1.0
+    key = codes * track_span + time_offset
+    lo = np.searchsorted(key, key - SPEED_WINDOW_SECONDS / 2, side="left")
+    hi = np.minimum(np.searchsorted(key, key + SPEED_WINDOW_SECONDS / 2, side="right"), n) - 1
+    window_seconds = elapsed[hi] - elapsed[lo]
+    speed = np.divide(
+        cumulative_distance[hi] - cumulative_distance[lo],
+        window_seconds,
+        out=np.zeros(n),
+        where=window_seconds > 0
+    ) * 3.6
+
+    group_bounds = np.searchsorted(codes, np.arange(len(names) + 1))
+    profiles = TrackProfiles(names=names, elapsed_seconds={}, values={"elevation": {}, "speed": {}})
+    for k1, name in enumerate(names):
+        rows = slice(group_bounds[k1], group_bounds[k1 + 1])
+        profiles.elapsed_seconds[name] = elapsed[rows]
+        profiles.values["elevation"][name] = elevation[rows]
+        profiles.values["speed"][name] = speed[rows]
+    return profiles
+
+
+def get_track_profiles(df:pd.DataFrame) -> TrackProfiles:
+    """Return the full-resolution profiles of a dataset, computing them only on a cache miss"""
+    cache_key = get_dataframe_hash(df, ["track_name", "elapsed_seconds", "latitude", "longitude", "elevation"])
+    with _profile_cache_lock:
+        profiles = _profile_cache.get(cache_key)
+        if profiles is not None:
+            _profile_cache.move_to_end(cache_key)
+            return profiles
+    with stage("track_profiles", points=len(df)):
+        profiles = compute_track_profiles(df)
+    with _profile_cache_lock:
+        _profile_cache[cache_key] = profiles
+        while len(_profile_cache) > _PROFILE_CACHE_SIZE:
+            _profile_cache.popitem(last=False)
+    return profiles
+
+
+def get_profile_frame(df:pd.DataFrame, metric:str, points_per_track:int=500, method:str="LTTB") -> pd.DataFrame:
+    """
+    Return a downsampled profile of every track for charting, using the cache when possible.
+    Args:
+        df (pd.DataFrame): Track data.
+        metric (str): One of PROFILE_METRICS.
+        points_per_track (int): Maximum number of points kept per track.
+        method (str): One of DOWNSAMPLE_METHODS.
+    Returns:
+        pd.DataFrame: Long table with 'track_name', 'elapsed_seconds' and 'value' columns.
+    """
+    if metric not in PROFILE_METRICS:
+        raise ValueError(f"Invalid metric '{metric}'. Use one of {list(PROFILE_METRICS)}.")
+    if method not in DOWNSAMPLE_METHODS:
+        raise ValueError(f"Invalid method '{method}'. Use one of {DOWNSAMPLE_METHODS}.")
+    profile_key = PROFILE_METRICS[metric][0]
+    cache_key = (
+        get_dataframe_hash(df, ["track_name", "elapsed_seconds", "latitude", "longitude", "elevation"]),
+        profile_key, int(points_per_track), method
+    )
+    with _profile_cache_lock:
+        frame = _downsampled_cache.get(cache_key)
+        if frame is not None:
+            _downsampled_cache.move_to_end(cache_key)
+            return frame
+
+    profiles = get_track_profiles(df)
+    downsample = lttb_indices if method == "LTTB" else minmax_indices
+    parts = []
+    with stage("profile_downsample", tracks=len(profiles.names)) as downsample_stage:
+        for name in profiles.names:
+            elapsed = profiles.elapsed_seconds[name]
+            values = profiles.values[profile_key][name]
+            kept = downsample(elapsed, values, int(points_per_track))
+            parts.append(pd.DataFrame({
+                "track_name": name,
+                "elapsed_seconds": elapsed[kept],
+                "value": values[kept],
+            }))
+        frame = pd.concat(parts, ignore_index=True) if parts else pd.DataFrame(columns=["track_name", "elapsed_seconds", "value"])
+        downsample_stage.add(points=len(frame))
+
+    with _profile_cache_lock:
+        _downsampled_cache[cache_key] = frame
+        while len(_downsampled_cache) > _DOWNSAMPLED_CACHE_SIZE:
+            _downsampled_cache.popitem(last=False)
+    return frame
@@ -0,0 +1,202 @@
+# Lightweight per-stage timing and counter instrumentation
+
+"""
+Stages are recorded with
+
+    with stage("parse_gpx_files", files=3) as parse_stage:
+        ...
+        parse_stage.add(points=1200)
+
+Recording only happens while a Profiler is active in the current context
+(see activate). Otherwise stage() returns a shared no-op object, so the
+instrumentation costs one context variable lookup per call.
+"""
+
+import contextlib
+import contextvars
+import json
+import os
+import threading
+import time
+from collections import deque
+from typing import Any, Dict, List, Optional
+
+
+# Raw events kept per profiler, the oldest are dropped first. Every frame of an
+# animation records a few events, so a long session would otherwise grow without limit.
+MAX_PROFILE_EVENTS = 20000
+
+
+class Profiler:
+    """
+    Collects timed stage events with counters.
+    The summary covers every recorded event, the raw events only the latest MAX_PROFILE_EVENTS.
+    """
+
+    def __init__(self, max_events:int=MAX_PROFILE_EVENTS):
+        self.events = deque(maxlen=max_events)
+        self.dropped_events = 0
+        self._summary = {}
+        self._origin = time.perf_counter()
+        self._lock = threading.Lock()
+
+    def record(self, name:str, start:float, duration:float, counters:Dict[str, Any]) -> None:
+        event = {
+            "name": name,
+            "start": start - self._origin,
+            "duration": duration,
+            "thread": threading.get_ident(),
+            "counters": counters,
+        }
+        with self._lock:
+            if len(self.events) == self.events.maxlen:
+                self.dropped_events += 1
+            self.events.append(event)
+            row = self._summary.setdefault(name, {"stage": name, "calls": 0, "total_seconds": 0.0, "max_seconds": 0.0})
+            row["calls"] += 1
+            row["total_seconds"] += duration
+            row["max_seconds"] = max(row["max_seconds"], duration)
+            for key, value in counters.items():
+                if isinstance(value, (int, float)):
+                    row[key] = row.get(key, 0) + value
+
+    def clear(self) -> None:
+        with self._lock:
+            self.events.clear()
+            self.dropped_events = 0
+            self._summary = {}
+            self._origin = time.perf_counter()
+
+    def summarize(self) -> List[Dict[str, Any]]:
+        """
+        Aggregate the events per stage name.
+        Returns:
+            list: One row per stage with call count, total and max seconds, and summed counters.
+        """
+        with self._lock:
+            rows = [dict(row) for row in self._summary.values()]
+        return sorted(rows, key=lambda row: row["total_seconds"], reverse=True)
+
+    def to_json(self) -> str:
+        """Export the summary and raw events as JSON"""
+        with self._lock:
+            events = list(self.events)
+            dropped_events = self.dropped_events
+        return json.dumps({"summary": self.summarize(), "dropped_events": dropped_events, "events": events}, indent=2, default=str)
+
+    def to_chrome_trace(self) -> str:
+        """Export the events in the Chrome trace event format (chrome://tracing, Perfetto)"""
+        with self._lock:
+            events = list(self.events)
+        trace_events = [
+            {
+                "name": event["name"],
+                "ph": "X",
+                "ts": event["start"] * 1e6,
+                "dur": event["duration"] * 1e6,
+                "pid": os.getpid(),
+                "tid": event["thread"],
+                "args": event["counters"],
+            }
+            for event in events
+        ]
+        return json.dumps({"traceEvents": trace_events, "displayTimeUnit": "ms"}, default=str)
+
+
+class _Stage:
+    """Context manager timing one stage of an active profiler"""
+
+    __slots__ = ("profiler", "name", "counters", "start")
+
+    def __init__(self, profiler:Profiler, name:str, counters:Dict[str, Any]):
+        self.profiler = profiler
+        self.name = name
+        self.counters = counters
+
+    def add(self, **counters) -> None:
+        for key, value in counters.items():
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.profiler.record(self.name, self.start, time.perf_counter() - self.start, self.counters)
+        return False
+
+
+class _NullStage:
+    """Shared no-op stage returned while profiling is disabled"""
+
+    __slots__ = ()
+
+    def add(self, **counters) -> None:
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+
+_NULL_STAGE = _NullStage()
+_active_profiler = contextvars.ContextVar("active_profiler", default=None)
+
+
+def activate(profiler:Optional[Profiler]) -> None:
+    """Make a profiler active in the current context, or disable profiling with None"""
+    _active_profiler.set(profiler)
+
+
+def get_active_profiler() -> Optional[Profiler]:
+    return _active_profiler.get()
+
+
+def is_enabled() -> bool:
+    return _active_profiler.get() is not None
+
+
+def stage(name:str, **counters):
+    """Time a stage and record counters if a profiler is active"""
+    profiler = _active_profiler.get()
+    if profiler is None:
+        return _NULL_STAGE
+    return _Stage(profiler, name, counters)
+
+
+class ProfiledMovieWriter:
+    """
+    Wraps a matplotlib movie writer to time frame rasterization and encoding.
+    grab_frame is recorded as "frame_encode" and closing the encoder as "encoder_finish";
+    the whole save is recorded as "animation_encode" with frame and byte counts.
+    """
+
+    def __init__(self, writer):
+        self._writer = writer
+        self.frames = 0
+
+    def __getattr__(self, name):
+        return getattr(self._writer, name)
+
+    @contextlib.contextmanager
+    def saving(self, fig, outfile, dpi, *args, **kwargs):
+        with stage("animation_encode") as encode_stage:
+            writer_context = self._writer.saving(fig, outfile, dpi, *args, **kwargs)
+            writer_context.__enter__()
+            try:
+                yield self
+            except BaseException as e:
+                if not writer_context.__exit__(type(e), e, e.__traceback__):
+                    raise
+            else:
+                with stage("encoder_finish"):
+                    writer_context.__exit__(None, None, None)
+                output_bytes = os.path.getsize(outfile) if os.path.exists(outfile) else 0
+                encode_stage.add(frames=self.frames, bytes=output_bytes)
+
+    def grab_frame(self, **savefig_kwargs):
+        with stage("frame_encode"):
+            self._writer.grab_frame(**savefig_kwargs)
+        self.frames += 1
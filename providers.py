@@ -1,20 +1,44 @@
 #
 
-import contextily as ctx
+"""
+Map providers by display name. Providers are stored as dotted paths into the
+xyzservices provider registry (the one contextily re-exports as ctx.providers) and
+resolved with get_provider, so listing the map styles does not import contextily.
+"""
+
+from typing import Optional
 
 # Define map providers
 PROVIDERS = {
-    "OpenTopoMap": ctx.providers.OpenTopoMap,
-    "OpenStreetMap": ctx.providers.OpenStreetMap.Mapnik,
-    "StamenTerrain": ctx.providers.Stadia.StamenTerrain,
-    "EsriNatGeoWorldMap": ctx.providers.Esri.NatGeoWorldMap,
-    "EsriWorldPhysical": ctx.providers.Esri.WorldPhysical,
-    "EsriShadedRelief": ctx.providers.Esri.WorldShadedRelief,
-    "EsriWorldImagery": ctx.providers.Esri.WorldImagery,
-    "EsriWorldStreetMap": ctx.providers.Esri.WorldStreetMap,
-    "EsriWorldTerrain": ctx.providers.Esri.WorldTerrain,
-    "EsriWorldTopoMap": ctx.providers.Esri.WorldTopoMap,
-    "USGSImagery": ctx.providers.USGS.USImagery,
-    "USImageryTopo": ctx.providers.USGS.USImageryTopo,
-    "USTopo": ctx.providers.USGS.USTopo,
-}
\ No newline at end of file
+    "OpenTopoMap": "OpenTopoMap",
+    "OpenStreetMap": "OpenStreetMap.Mapnik",
+    "StamenTerrain": "Stadia.StamenTerrain",
+    "EsriNatGeoWorldMap": "Esri.NatGeoWorldMap",
+    "EsriWorldPhysical": "Esri.WorldPhysical",
+    "EsriShadedRelief": "Esri.WorldShadedRelief",
+    "EsriWorldImagery": "Esri.WorldImagery",
+    "EsriWorldStreetMap": "Esri.WorldStreetMap",
+    "EsriWorldTerrain": "Esri.WorldTerrain",
+    "EsriWorldTopoMap": "Esri.WorldTopoMap",
+    "USGSImagery": "USGS.USImagery",
+    "USImageryTopo": "USGS.USImageryTopo",
+    "USTopo": "USGS.USTopo",
+}
+
+DEFAULT_PROVIDER = "USTopo"
+
+
+def get_provider(map_style:Optional[str]):
+    """
+    Resolve a map style to its tile provider, falling back to DEFAULT_PROVIDER.
+    Args:
+        map_style (str): Display name of the map style, a key of PROVIDERS.
+    Returns:
+        xyzservices.TileProvider: Tile provider.
+    """
+    import xyzservices.providers as xyz_providers
+
+    provider = xyz_providers
+    for name in PROVIDERS.get(map_style, PROVIDERS[DEFAULT_PROVIDER]).split("."):
+        provider = provider[name]
+    return provider
@@ -0,0 +1,46 @@
+# Bounded in-memory caches for rendered outputs
+
+import io
+from typing import Optional
+
+from profiling import stage
+from shared_cache import SharedCache, cache_size_mb
+
+
+class ByteLRUCache(SharedCache):
+    """
+    Least-recently-used cache of encoded bytes with a bound on total size.
+    Entries are evicted oldest first once the total size exceeds max_bytes.
+    """
+
+    def __init__(self, max_bytes:int, name:Optional[str]=None):
+        super().__init__(max_bytes, size_of=len, name=name)
+
+
+def figure_to_bytes(fig, fmt:str="png", dpi:int=200) -> bytes:
+    """
+    Render a matplotlib figure to encoded image bytes and close it.
+    Args:
+        fig (matplotlib.figure.Figure): Figure to render.
+        fmt (str): Image format, "png" or "webp".
+        dpi (int): Resolution of the rendered image.
+    Returns:
+        bytes: Encoded image.
+    """
+    import matplotlib.pyplot as plt
+
+    buffer = io.BytesIO()
+    with stage("figure_encode", format=fmt) as encode_stage:
+        try:
+            fig.savefig(buffer, format=fmt, dpi=dpi, bbox_inches="tight")
+        finally:
+            plt.close(fig)
+        encode_stage.add(bytes=buffer.tell())
+    return buffer.getvalue()
+
+
+# Process-wide cache of rendered static maps keyed by (data hash, params hash)
+STATIC_MAP_CACHE = ByteLRUCache(
+    max_bytes=cache_size_mb("SKI_TRACKS_STATIC_MAP_CACHE_MB", 256),
+    name="static maps"
+)
@@ -0,0 +1,354 @@
+# Render time estimates and time-budgeted animation settings
+
+"""
+The time to render an animation is modelled as
+
+    setup_seconds + setup_point_seconds * points
+    + frames * (frame_seconds + pixel_seconds * pixels + trail_point_seconds * trail_points)
+
+where points are the track points and resampled grid samples prepared once, pixels
+the size of a frame and trail_points the average number of trail points drawn in a
+frame. The coefficients are fitted to timed renders of synthetic tracks. The benchmark
+suite stores these timings with its results and the newest results file is used
+(or the file in SKI_TRACKS_RENDER_CALIBRATION). Estimates are then scaled by the
+ratio of measured to estimated time of the renders completed by this process, so
+they follow the speed and load of the host.
+
+plan_within_budget picks the fps, resolution and width closest to the chosen ones
+that render within a time budget.
+"""
+
+import glob
+import json
+import os
+import tempfile
+import threading
+import time
+from dataclasses import dataclass, fields, replace
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+import pandas as pd
+
+from map_bounds import get_default_map_bounds
+from resample import frame_resample_step
+from timeline import SECONDS_PER_DAY
+
+# Ranges of the animation options as (min, max, step)
+FPS_RANGE = (10, 48, 2)
+DPI_RANGE = (100, 300, 25)
+FIG_WIDTH_RANGE = (6.0, 18.0, 0.5)
+
+# Weight of the latest render when the host scale is updated
+HOST_SCALE_WEIGHT = 0.3
+
+# Synthetic renders timed for calibration, varying the frames, the frame size, the
+# points and the trail points, as (tracks, hours, sample interval, fps, duration, dpi,
+# fig_width, trail hours, resample)
+CALIBRATION_RENDERS = [
+    (2, 1.0, 5.0, 10, 2, 60, 6.0, 1.0, True),
+    (2, 1.0, 5.0, 10, 4, 60, 6.0, 1.0, True),
+    (2, 1.0, 5.0, 10, 2, 150, 8.0, 1.0, True),
+    (8, 6.0, 1.0, 10, 1, 60, 6.0, 6.0, True),
+    (8, 6.0, 1.0, 10, 1, 60, 6.0, 6.0, False),
+    (8, 6.0, 1.0, 10, 1, 60, 6.0, 0.5, False),
+]
+
+_cost_model = None
+_host_scale = None
+_planner_lock = threading.Lock()
+
+
+@dataclass
+class AnimationWorkload:
+    """Amount of work of an animation render"""
+    frames: int
+    width_px: int
+    height_px: int
+    points: int
+    trail_points: float
+
+    @property
+    def pixels(self) -> int:
+        return self.width_px * self.height_px
+
+
+@dataclass
+class CostModel:
+    """Coefficients of the render time model in seconds, by default fitted to renders without encoding"""
+    setup_seconds: float = 0.5
+    setup_point_seconds: float = 4e-7
+    frame_seconds: float = 0.04
+    pixel_seconds: float = 8e-8
+    trail_point_seconds: float = 9e-7
+
+    def estimate(self, workload:AnimationWorkload) -> float:
+        """Estimated render time in seconds"""
+        return (
+            self.setup_seconds
+            + self.setup_point_seconds * workload.points
+            + workload.frames * (
+                self.frame_seconds
+                + self.pixel_seconds * workload.pixels
+                + self.trail_point_seconds * workload.trail_points
+            )
+        )
+
+
+@dataclass
+class RenderPlan:
+    """Animation settings chosen for a time budget"""
+    fps: int
+    dpi: int
+    fig_width: float
+    estimate_seconds: float
+    fits: bool
+
+
+def _workload_terms(workload:AnimationWorkload) -> List[float]:
+    return [1.0, workload.points, workload.frames, workload.frames * workload.pixels, workload.frames * workload.trail_points]
+
+
+def workload_stats(df:pd.DataFrame, anim_params:Dict[str, Any]) -> Dict[str, float]:
+    """
+    Properties of the selected tracks and options that the workload depends on, apart
+    from the fps, duration, resolution and width.
+    Args:
+        df (pd.DataFrame): DataFrame containing the selected GPX tracks.
+        anim_params (dict): Parameters as returned by show_animation_options.
+    """
+    elapsed = df["elapsed_seconds"].to_numpy(dtype=np.float64)
+    start_time = anim_params["anim_start_seconds"]
+    end_time = anim_params["anim_end_seconds"]
+    start_time = elapsed.min() if start_time is None else start_time
+    end_time = elapsed.max() if end_time is None else end_time
+    points = int(np.count_nonzero((elapsed >= start_time) & (elapsed <= end_time)))
+    if anim_params["anim_time_axis"] == "Same time of day":
+        time_of_day = elapsed % SECONDS_PER_DAY
+        start_time, end_time = time_of_day.min(), time_of_day.max()
+
+    # The renderers fall back to the default bound for each missing bound
+    bounds = [anim_params[f"anim_{name}"] for name in ("lat_min", "lat_max", "lon_min", "lon_max")]
+    lat_min, lat_max, lon_min, lon_max = [bound if bound else default for bound, default in zip(bounds, get_default_map_bounds(df))]
+    return {
+        "tracks": df["track_name"].nunique(),
+        "points": points,
+        "span": max(float(end_time - start_time), 1.0),
+        "start_time": float(start_time),
+        "end_time": float(end_time),
+        "aspect": (lat_max - lat_min) / max(lon_max - lon_min, 1e-9),
+        "trail_duration": float(anim_params["anim_trail_duration"]),
+        "resample": bool(anim_params["anim_resample"]),
+    }
+
+
+def workload_for(stats:Dict[str, float], fps:int, duration:float, dpi:int, fig_width:float) -> AnimationWorkload:
+    """Workload of rendering the tracks described by workload_stats with these settings"""
+    span = stats["span"]
+    trail = min(stats["trail_duration"], span)
+    # The trail grows from the start of the animation until it is trail_duration long
+    mean_trail = trail - trail ** 2 / (2 * span)
+    points = stats["points"]
+    if stats["resample"]:
+        step = frame_resample_step(stats["start_time"], stats["end_time"], fps, duration)
+        points += stats["tracks"] * span / step
+        trail_points = stats["tracks"] * mean_trail / step
+    else:
+        trail_points = stats["points"] * mean_trail / span
+    return AnimationWorkload(
+        frames=int(fps * duration + 1),
+        width_px=int(round(fig_width * dpi)),
+        height_px=int(round(np.round(fig_width * stats["aspect"], 2) * dpi)),
+        points=int(points),
+        trail_points=float(trail_points),
+    )
+
+
+def animation_workload(df:pd.DataFrame, anim_params:Dict[str, Any]) -> AnimationWorkload:
+    """Workload of rendering an animation with the given parameters"""
+    return workload_for(
+        workload_stats(df, anim_params),
+        anim_params["anim_fps"], anim_params["anim_duration"], anim_params["anim_dpi"], anim_params["anim_fig_width"]
+    )
+
+
+def fit_cost_model(samples:List[Dict[str, Any]]) -> CostModel:
+    """
+    Fit the coefficients to timed renders by least squares, keeping them non-negative.
+    Args:
+        samples (list): Dicts with the AnimationWorkload fields and the measured 'seconds'.
+    Returns:
+        CostModel: Fitted model, coefficients that cannot be fitted are zero.
+    """
+    workload_fields = [field.name for field in fields(AnimationWorkload)]
+    terms = np.array([_workload_terms(AnimationWorkload(**{name: sample[name] for name in workload_fields})) for sample in samples])
+    seconds = np.array([sample["seconds"] for sample in samples], dtype=np.float64)
+    # Relative errors count the same for short and long renders
+    weights = 1.0 / np.maximum(seconds, 1e-3)
+    active = np.ones(terms.shape[1], dtype=bool)
+    coefficients = np.zeros(terms.shape[1])
+    while active.any():
+        solution, *_ = np.linalg.lstsq(terms[:, active] * weights[:, None], seconds * weights, rcond=None)
+        coefficients[:] = 0.0
+        coefficients[active] = solution
+        if (solution >= 0).all():
+            break
+        # Drop the most negative coefficient and fit the others again
+        active[np.flatnonzero(active)[np.argmin(solution)]] = False
+    return CostModel(*coefficients.tolist())
+
+
+def run_calibration(repeat:int=1) -> List[Dict[str, Any]]:
+    """
+    Time synthetic animation renders of CALIBRATION_RENDERS with an offline basemap.
+    Frames are encoded with FFmpeg when it is installed and only rasterized otherwise.
+    Returns:
+        list: Workload fields and the median 'seconds' of each render.
+    """
+    # The rendering stack is only needed to calibrate
+    import matplotlib.animation as animation
+
+    import map_layers
+    from benchmark import FrameDrawWriter
+    from generate_animation import DEFAULT_ANIMATION_PARAMS, generate_animation
+    from synthetic_tracks import generate_ski_days, stub_fetch_basemap_image
+
+    map_layers.fetch_basemap_image = stub_fetch_basemap_image
+    encode = animation.writers.is_available("ffmpeg")
+    samples = []
+    for k1, (tracks, hours, sample_interval, fps, duration, dpi, fig_width, trail_hours, resample) in enumerate(CALIBRATION_RENDERS):
+        df = generate_ski_days(tracks, duration_hours=hours, sample_interval=sample_interval)
+        params = {
+            **DEFAULT_ANIMATION_PARAMS,
+            "anim_fps": fps, "anim_duration": duration, "anim_dpi": dpi, "anim_fig_width": fig_width,
+            "anim_trail_duration": int(trail_hours * 3600), "anim_resample": resample,
+        }
+        runs = []
+        # The first render also loads the rendering stack and is not timed
+        for k2 in range(repeat + (k1 == 0)):
+            # Cached layers are cleared so every render prepares its tracks
+            map_layers._geometry_cache.clear()
+            with tempfile.TemporaryDirectory() as temp_dir:
+                start = time.perf_counter()
+                generate_animation(
+                    df, fps=fps, duration=duration, dpi=dpi, fig_width=fig_width,
+                    trail_duration=params["anim_trail_duration"], resample=resample, resample_step=None,
+                    writer=None if encode else FrameDrawWriter(fps=fps),
+                    output_file=os.path.join(temp_dir, "calibration.mp4")
+                )
+                if k1 > 0 or k2 > 0:
+                    runs.append(time.perf_counter() - start)
+        workload = animation_workload(df, params)
+        samples.append({**{field.name: getattr(workload, field.name) for field in fields(AnimationWorkload)}, "seconds": float(np.median(runs)), "encoded": encode})
+    return samples
+
+
+def load_cost_model(path:Optional[str]=None) -> CostModel:
+    """
+    Fit the model to the calibration renders of a benchmark results file.
+    Args:
+        path (str, optional): Results file, by default SKI_TRACKS_RENDER_CALIBRATION or the newest
+            file in benchmark_results with calibration renders.
+    Returns:
+        CostModel: The fitted model, or the default model without calibration renders.
+    """
+    if path is None:
+        path = os.environ.get("SKI_TRACKS_RENDER_CALIBRATION")
+    candidates = [path] if path else sorted(
+        glob.glob(os.path.join(os.path.dirname(os.path.abspath(__file__)), "benchmark_results", "*.json")),
+        key=os.path.getmtime,
+        reverse=True
+    )
+    for candidate in candidates:
+        try:
+            with open(candidate) as f:
+                samples = json.load(f)["results"]["render_calibration"]["samples"]
+        except (OSError, ValueError, KeyError, TypeError):
+            continue
+        if samples:
+            return fit_cost_model(samples)
+    return CostModel()
+
+
+def get_cost_model() -> CostModel:
+    """Return the calibrated model, scaled by the measured speed of this host"""
+    global _cost_model
+    with _planner_lock:
+        if _cost_model is None:
+            _cost_model = load_cost_model()
+        if _host_scale is None:
+            return _cost_model
+        return replace(
+            _cost_model,
+            setup_seconds=_cost_model.setup_seconds * _host_scale,
+            setup_point_seconds=_cost_model.setup_point_seconds * _host_scale,
+            frame_seconds=_cost_model.frame_seconds * _host_scale,
+            pixel_seconds=_cost_model.pixel_seconds * _host_scale,
+            trail_point_seconds=_cost_model.trail_point_seconds * _host_scale,
+        )
+
+
+def record_render_time(workload:AnimationWorkload, seconds:float) -> None:
+    """Update the host scale with the measured time of a completed render"""
+    global _host_scale
+    get_cost_model()
+    with _planner_lock:
+        estimate = _cost_model.estimate(workload)
+        if estimate <= 0:
+            return
+        ratio = seconds / estimate
+        _host_scale = ratio if _host_scale is None else (1 - HOST_SCALE_WEIGHT) * _host_scale + HOST_SCALE_WEIGHT * ratio
+
+
+def _option_values(value_range, chosen) -> np.ndarray:
+    """Values of an option from its minimum up to the chosen value"""
+    low, high, step = value_range
+    values = np.arange(low, min(chosen, high) + step / 2, step)
+    return np.unique(np.append(values[values <= chosen], chosen))
+
+
+def plan_within_budget(
+    df:pd.DataFrame,
+    anim_params:Dict[str, Any],
+    budget_seconds:float,
+    model:Optional[CostModel]=None
+) -> RenderPlan:
+    """
+    Pick the highest quality settings that render within a time budget.
+    The chosen fps, resolution and width are upper limits. Settings are ranked by the
+    smaller of the fractions of the chosen frame rate and linear resolution (width times
+    dpi) they keep, then by the sum of both, then by keeping the width, so quality is
+    lowered evenly and the layout of the frames changes as little as possible.
+    Args:
+        df (pd.DataFrame): DataFrame containing the selected GPX tracks.
+        anim_params (dict): Parameters as returned by show_animation_options.
+        budget_seconds (float): Time the render may take.
+        model (CostModel, optional): Cost model, get_cost_model() if None.
+    Returns:
+        RenderPlan: The best settings within the budget, or the cheapest settings if none fit.
+    """
+    model = get_cost_model() if model is None else model
+    stats = workload_stats(df, anim_params)
+    chosen_fps = anim_params["anim_fps"]
+    chosen_dpi = anim_params["anim_dpi"]
+    chosen_width = anim_params["anim_fig_width"]
+    duration = anim_params["anim_duration"]
+
+    best = None
+    best_rank = None
+    cheapest = None
+    for fps in _option_values(FPS_RANGE, chosen_fps):
+        for dpi in _option_values(DPI_RANGE, chosen_dpi):
+            for fig_width in _option_values(FIG_WIDTH_RANGE, chosen_width):
+                seconds = model.estimate(workload_for(stats, int(fps), duration, int(dpi), float(fig_width)))
+                plan = RenderPlan(fps=int(fps), dpi=int(dpi), fig_width=float(fig_width), estimate_seconds=seconds, fits=seconds <= budget_seconds)
+                if cheapest is None or seconds < cheapest.estimate_seconds:
+                    cheapest = plan
+                if not plan.fits:
+                    continue
+                fps_fraction = fps / chosen_fps
+                resolution_fraction = (fig_width * dpi) / (chosen_width * chosen_dpi)
+                rank = (min(fps_fraction, resolution_fraction), fps_fraction + resolution_fraction, -abs(fig_width - chosen_width))
+                if best_rank is None or rank > best_rank:
+                    best, best_rank = plan, rank
+    return best if best is not None else cheapest
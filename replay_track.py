@@ -0,0 +1,173 @@
+# Replay a recorded track as a live stream, for testing live tracking
+
+"""
+Write the points of a recorded GPX track at their recorded pace, sped up, as a
+growing GPX file, a growing NMEA log or NMEA sentences sent to a local TCP port.
+
+Usage:
+    python replay_track.py TRACK.gpx --output live/skier-1.gpx [--speed 60]
+    python replay_track.py TRACK.gpx --output live/skier-1.nmea [--speed 60]
+    python replay_track.py TRACK.gpx --socket 127.0.0.1:10110 [--speed 60]
+
+The output format follows the extension of --output: .nmea, .nmea0183, .log or
+.txt are written as NMEA sentences, anything else as GPX. Point in the app's live
+tracking at the output file or socket port to follow the replay.
+"""
+
+import argparse
+import socket
+import sys
+import time
+from datetime import datetime, timezone
+from typing import List, Optional, Tuple
+from xml.sax.saxutils import escape
+
+import gpxpy
+
+# Output extensions written as NMEA, as live_ingest reads them
+NMEA_EXTENSIONS = (".nmea", ".nmea0183", ".log", ".txt")
+
+# Points written at once, so fast replays do not write one point per system call
+MIN_WRITE_INTERVAL_SECONDS = 0.1
+
+# A recorded point is (time, latitude, longitude, elevation)
+RecordedPoint = Tuple[datetime, float, float, Optional[float]]
+
+
+def read_track(path:str, track_index:int=0) -> Tuple[str, List[RecordedPoint]]:
+    """Read the name and the time-stamped points of one track of a GPX file"""
+    with open(path, "r") as f:
+        gpx = gpxpy.parse(f)
+    if track_index >= len(gpx.tracks):
+        raise ValueError(f"{path} has {len(gpx.tracks)} track(s), track {track_index} does not exist")
+    track = gpx.tracks[track_index]
+    points = []
+    for segment in track.segments:
+        for point in segment.points:
+            if point.time is None:
+                continue
+            point_time = point.time if point.time.tzinfo is not None else point.time.replace(tzinfo=timezone.utc)
+            points.append((point_time.astimezone(timezone.utc), point.latitude, point.longitude, point.elevation))
+    points.sort(key=lambda point: point[0])
+    return track.name or "Track", points
+
+
+def _nmea_sentence(body:str) -> str:
+    checksum = 0
+    for char in body:
+        checksum ^= ord(char)
+    return f"${body}*{checksum:02X}\r\n"
+
+
+def _nmea_coordinate(value:float, positive:str, negative:str, degree_digits:int) -> Tuple[str, str]:
+    hemisphere = positive if value >= 0 else negative
+    value = abs(value)
+    degrees = int(value)
+    minutes = (value - degrees) * 60
+    return f"{degrees:0{degree_digits}d}{minutes:07.4f}", hemisphere
+
+
+def nmea_sentences(point:RecordedPoint) -> str:
+    """RMC and GGA sentences of a point"""
+    point_time, latitude, longitude, elevation = point
+    time_str = point_time.strftime("%H%M%S.") + f"{point_time.microsecond // 10000:02d}"
+    lat, lat_hemisphere = _nmea_coordinate(latitude, "N", "S", 2)
+    lon, lon_hemisphere = _nmea_coordinate(longitude, "E", "W", 3)
+    altitude = "" if elevation is None else f"{elevation:.1f}"
+    return (
+        _nmea_sentence(f"GPRMC,{time_str},A,{lat},{lat_hemisphere},{lon},{lon_hemisphere},0.0,0.0,{point_time:%d%m%y},,")
+        + _nmea_sentence(f"GPGGA,{time_str},{lat},{lat_hemisphere},{lon},{lon_hemisphere},1,08,0.9,{altitude},M,0.0,M,,")
+    )
+
+
+def gpx_point(point:RecordedPoint) -> str:
+    point_time, latitude, longitude, elevation = point
+    elevation_tag = "" if elevation is None else f"<ele>{elevation:.1f}</ele>"
+    return f'      <trkpt lat="{latitude:.7f}" lon="{longitude:.7f}">{elevation_tag}<time>{point_time:%Y-%m-%dT%H:%M:%SZ}</time></trkpt>\n'
+
+
+def gpx_header(track_name:str) -> str:
+    return (
+        '<?xml version="1.0" encoding="UTF-8"?>\n'
+        '<gpx version="1.1" creator="replay_track" xmlns="http://www.topografix.com/GPX/1/1">\n'
+        f"  <trk>\n    <name>{escape(track_name)}</name>\n    <trkseg>\n"
+    )
+
+
+GPX_FOOTER = "    </trkseg>\n  </trk>\n</gpx>\n"
+
+
+def replay(points:List[RecordedPoint], write, speed:float, shift_to_now:bool=False) -> int:
+    """
+    Call write with the text of the points as their replayed time comes.
+    Args:
+        points (list): Recorded points sorted by time.
+        write (callable): Called with a list of points that are due.
+        speed (float): Replay speed, recorded seconds per wall-clock second.
+        shift_to_now (bool): Move the points in time so the replay starts now.
+    Returns:
+        int: Number of points written.
+    """
+    if not points:
+        return 0
+    if shift_to_now:
+        offset = datetime.now(timezone.utc) - points[0][0]
+        points = [(point_time + offset, latitude, longitude, elevation) for point_time, latitude, longitude, elevation in points]
+    start_wall = time.monotonic()
+    start_recorded = points[0][0]
+    written = 0
+    while written < len(points):
+        elapsed_recorded = (time.monotonic() - start_wall) * speed
+        due = written
+        while due < len(points) and (points[due][0] - start_recorded).total_seconds() <= elapsed_recorded:
+            due += 1
+        if due > written:
+            write(points[written:due])
+            written = due
+        if written < len(points):
+            wait = (points[written][0] - start_recorded).total_seconds() / speed - (time.monotonic() - start_wall)
+            time.sleep(max(wait, MIN_WRITE_INTERVAL_SECONDS))
+    return written
+
+
+def main(argv:Optional[List[str]]=None) -> int:
+    parser = argparse.ArgumentParser(description="Replay a recorded GPX track as a growing GPX or NMEA file or an NMEA socket stream.")
+    parser.add_argument("track", help="Recorded GPX file")
+    target = parser.add_mutually_exclusive_group(required=True)
+    target.add_argument("--output", help="Growing GPX or NMEA file to write")
+    target.add_argument("--socket", metavar="HOST:PORT", help="Send NMEA sentences to a TCP port")
+    parser.add_argument("--speed", type=float, default=60.0, help="Replay speed, recorded seconds per second (default: 60)")
+    parser.add_argument("--track-index", type=int, default=0, help="Track of the GPX file to replay")
+    parser.add_argument("--now", action="store_true", help="Shift the timestamps so the replay starts at the current time")
+    args = parser.parse_args(argv)
+
+    track_name, points = read_track(args.track, args.track_index)
+    if not points:
+        print(f"{args.track} has no time-stamped points", file=sys.stderr)
+        return 1
+
+    if args.socket:
+        host, port = args.socket.rsplit(":", 1)
+        with socket.create_connection((host, int(port))) as connection:
+            written = replay(points, lambda due: connection.sendall("".join(nmea_sentences(point) for point in due).encode("ascii")), args.speed, args.now)
+    elif args.output.lower().endswith(NMEA_EXTENSIONS):
+        with open(args.output, "w", newline="") as f:
+            def write_nmea(due):
+                f.write("".join(nmea_sentences(point) for point in due))
+                f.flush()
+            written = replay(points, write_nmea, args.speed, args.now)
+    else:
+        with open(args.output, "w") as f:
+            f.write(gpx_header(track_name))
+            def write_gpx(due):
+                f.write("".join(gpx_point(point) for point in due))
+                f.flush()
+            written = replay(points, write_gpx, args.speed, args.now)
+            f.write(GPX_FOOTER)
+
+    print(f"Replayed {written} points of '{track_name}'")
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,176 @@
+# Resampling of tracks onto a shared uniform time grid
+
+import numpy as np
+import pandas as pd
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import List, Optional
+
+from profiling import stage
+from util import get_dataframe_hash
+
+# Tracks are not interpolated across recording gaps longer than this
+MAX_INTERPOLATION_GAP_SECONDS = 300.0
+
+# Number of grid samples interpolated per grid chunk, bounds peak memory
+RESAMPLE_CHUNK_SIZE = 2_000_000
+
+# Resampled grid samples per animation frame when the step is tied to the frame rate
+RESAMPLE_SAMPLES_PER_FRAME = 4
+
+_RESAMPLE_CACHE_SIZE = 8
+_resample_cache = OrderedDict()
+_resample_cache_lock = threading.Lock()
+
+
+@dataclass
+class ResampledTracks:
+    """
+    Coordinates of every track at the same uniformly spaced times.
+    Row g of longitude and latitude holds track names[g] at times, with NaN where the
+    track has no data (before its start, after its end and across long gaps).
+    last_valid[g, k] is the last column at or before k where track g has data, or -1.
+    """
+    names: List[str]
+    times: np.ndarray
+    step: float
+    longitude: np.ndarray
+    latitude: np.ndarray
+    last_valid: np.ndarray
+
+    def time_index(self, seconds:float) -> int:
+        """Column of the grid time at or just before a time"""
+        return int(self.time_indices(seconds))
+
+    def time_indices(self, seconds) -> np.ndarray:
+        """Columns of the grid times at or just before an array of times"""
+        return np.clip(np.floor((np.asarray(seconds) - self.times[0]) / self.step + 1e-9), 0, self.times.size - 1).astype(np.int64)
+
+
+def resample_tracks(
+    df:pd.DataFrame,
+    step:float,
+    mode:str="track",
+    start_time:Optional[float]=None,
+    end_time:Optional[float]=None,
+    max_gap_seconds:float=MAX_INTERPOLATION_GAP_SECONDS
+) -> ResampledTracks:
+    """
+    Linearly interpolate every track onto a shared time grid in one vectorized pass.
+    Points are sorted by a composite (track, time) key, so the neighbors of all grid
+    times of all tracks are found with a single binary search.
+    Args:
+        df (pd.DataFrame): Track data.
+        step (float): Spacing of the time grid in seconds.
+        mode (str): Group points by "track" name or "file" name.
+        start_time, end_time (float, optional): Range of the grid, the data range if None.
+        max_gap_seconds (float): Gaps between recorded points longer than this are left empty.
+    Returns:
+        ResampledTracks: Resampled coordinates.
+    """
+    if mode == "track":
+        group_column = "track_name"
+    elif mode == "file":
+        group_column = "file_name"
+    else:
+        raise ValueError("Invalid mode specified. Use 'track' or 'file'.")
+    if step <= 0:
+        raise ValueError("The resampling step must be positive.")
+
+    elapsed = df["elapsed_seconds"].to_numpy(dtype=np.float64)
+    if start_time is None:
+        start_time = float(elapsed.min())
+    if end_time is None:
+        end_time = float(elapsed.max())
+
+    names = sorted(df[group_column].unique())
+    codes = pd.Categorical(df[group_column], categories=names).codes.astype(np.int64)
+    order = np.lexsort((elapsed, codes))
+    codes = codes[order]
+    elapsed = elapsed[order]
+    longitude = df["longitude"].to_numpy(dtype=np.float64)[order]
+    latitude = df["latitude"].to_numpy(dtype=np.float64)[order]
+
+    num_steps = int(np.floor((end_time - start_time) / step + 1e-9)) + 1
+    times = start_time + np.arange(num_steps) * step
+    num_groups = len(names)
+
+    # Composite key separating the groups on one sorted axis
+    time_origin = min(elapsed.min(), start_time)
+    group_span = max(elapsed.max(), times[-1]) - time_origin + 1.0
+    key = codes * group_span + (elapsed - time_origin)
+
+    out_lon = np.full((num_groups, num_steps), np.nan)
+    out_lat = np.full((num_groups, num_steps), np.nan)
+    n = elapsed.size
+    groups_per_chunk = max(RESAMPLE_CHUNK_SIZE // num_steps, 1)
+    with stage("resample_tracks", tracks=num_groups, samples=num_groups * num_steps):
+        for chunk_first in range(0, num_groups, groups_per_chunk):
+            chunk_groups = np.arange(chunk_first, min(chunk_first + groups_per_chunk, num_groups))
+            grid_group = np.repeat(chunk_groups, num_steps)
+            grid_time = np.tile(times, chunk_groups.size)
+            grid_key = grid_group * group_span + (grid_time - time_origin)
+
+            right = np.searchsorted(key, grid_key, side="left")
+            left = right - 1
+            right_clipped = np.minimum(right, n - 1)
+            left_clipped = np.maximum(left, 0)
+            right_ok = (right < n) & (codes[right_clipped] == grid_group)
+            left_ok = (left >= 0) & (codes[left_clipped] == grid_group)
+
+            t_left = elapsed[left_clipped]
+            t_right = elapsed[right_clipped]
+            exact = right_ok & (t_right == grid_time)
+            between = left_ok & right_ok & (t_right - t_left <= max_gap_seconds)
+            weight = np.where(between & ~exact, (grid_time - t_left) / np.where(t_right > t_left, t_right - t_left, 1.0), 1.0)
+
+            chunk_lon = np.where(exact | between, longitude[left_clipped] + weight * (longitude[right_clipped] - longitude[left_clipped]), np.nan)
+            chunk_lat = np.where(exact | between, latitude[left_clipped] + weight * (latitude[right_clipped] - latitude[left_clipped]), np.nan)
+            # Exact matches at the first point of a group have no left neighbor
+            chunk_lon[exact] = longitude[right_clipped[exact]]
+            chunk_lat[exact] = latitude[right_clipped[exact]]
+
+            out_lon[chunk_groups] = chunk_lon.reshape(chunk_groups.size, num_steps)
+            out_lat[chunk_groups] = chunk_lat.reshape(chunk_groups.size, num_steps)
+
+    columns = np.arange(num_steps)
+    last_valid = np.maximum.accumulate(np.where(np.isnan(out_lon), -1, columns[None, :]), axis=1)
+    return ResampledTracks(names=names, times=times, step=float(step), longitude=out_lon, latitude=out_lat, last_valid=last_valid)
+
+
+def frame_resample_step(start_time:float, end_time:float, fps:int, duration:float) -> float:
+    """Grid step in seconds giving RESAMPLE_SAMPLES_PER_FRAME samples per frame of an animation, at least one second"""
+    frame_step = (end_time - start_time) / max(fps * duration, 1)
+    return max(frame_step / RESAMPLE_SAMPLES_PER_FRAME, 1.0)
+
+
+def get_resampled_tracks(
+    df:pd.DataFrame,
+    step:float,
+    mode:str="track",
+    start_time:Optional[float]=None,
+    end_time:Optional[float]=None,
+    max_gap_seconds:float=MAX_INTERPOLATION_GAP_SECONDS
+) -> ResampledTracks:
+    """Return the resampled tracks for a selection and grid, resampling only on a cache miss"""
+    group_column = "file_name" if mode == "file" else "track_name"
+    cache_key = (
+        get_dataframe_hash(df, [group_column, "elapsed_seconds", "latitude", "longitude"]),
+        mode, float(step),
+        None if start_time is None else float(start_time),
+        None if end_time is None else float(end_time),
+        float(max_gap_seconds)
+    )
+    with _resample_cache_lock:
+        resampled = _resample_cache.get(cache_key)
+        if resampled is not None:
+            _resample_cache.move_to_end(cache_key)
+            return resampled
+
+    resampled = resample_tracks(df, step, mode=mode, start_time=start_time, end_time=end_time, max_gap_seconds=max_gap_seconds)
+    with _resample_cache_lock:
+        _resample_cache[cache_key] = resampled
+        while len(_resample_cache) > _RESAMPLE_CACHE_SIZE:
+            _resample_cache.popitem(last=False)
+    return resampled
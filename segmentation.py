@@ -0,0 +1,245 @@
+# Lift, run and idle segmentation of ski tracks
+
+import heapq
+import numpy as np
+import pandas as pd
+from typing import Tuple
+
+from geo import haversine_distance
+from profiling import stage
+
+SEGMENT_TYPES = ["idle", "lift", "run"]
+IDLE, LIFT, RUN = 0, 1, 2
+
+# Colors used when rendering tracks colored by segment type
+SEGMENT_COLORS = {
+    "idle": (0.55, 0.55, 0.55),
+    "lift": (0.12, 0.47, 0.85),
+    "run": (0.85, 0.16, 0.16),
+}
+
+# Classification thresholds
+SMOOTHING_SECONDS = 30.0
+IDLE_MAX_SPEED_MPS = 0.6
+LIFT_MIN_VERTICAL_SPEED_MPS = 0.25
+LIFT_MIN_STRAIGHTNESS = 0.8
+MIN_SEGMENT_SECONDS = 40.0
+
+
+def _track_sort_order(df:pd.DataFrame) -> Tuple[np.ndarray, np.ndarray]:
+    """Return per-row track codes and the row order sorting the table by track and time"""
+    track_codes = df.groupby(["file_name", "track_name"], sort=True).ngroup().to_numpy()
+    order = np.lexsort((df["elapsed_seconds"].to_numpy(), track_codes))
+    return track_codes, order
+
+
+def _run_starts(values:np.ndarray, track_start:np.ndarray) -> np.ndarray:
+    """Boolean array marking the first row of every run of equal values within a track"""
+    starts = np.ones(values.size, dtype=bool)
+    starts[1:] = values[1:] != values[:-1]
+    return starts | track_start
+
+
+def classify_points(
+    track_codes:np.ndarray,
+    elapsed:np.ndarray,
+    latitude:np.ndarray,
+    longitude:np.ndarray,
+    elevation:np.ndarray,
+    smoothing_seconds:float=SMOOTHING_SECONDS
+) -> np.ndarray:
+    """
+    Classify points sorted by track and time as idle, lift or run.
+    Speeds are measured over a centered time window found by binary search, with
+    path length from cumulative sums. Heading consistency is the straightness of
+    the path over the window (displacement divided by distance travelled).
+    Args:
+        track_codes (np.ndarray): Integer track code of each point, sorted.
+        elapsed (np.ndarray): Time of each point in seconds, sorted within each track.
+        latitude, longitude, elevation (np.ndarray): Point coordinates.
+        smoothing_seconds (float): Width of the smoothing window.
+    Returns:
+        np.ndarray: int8 segment type code of each point.
+    """
+    n = elapsed.size
+    track_start = np.ones(n, dtype=bool)
+    track_start[1:] = track_codes[1:] != track_codes[:-1]
+
+    step_distance = np.zeros(n)
+    step_distance[1:] = haversine_distance(latitude[:-1], longitude[:-1], latitude[1:], longitude[1:])
+    step_distance[track_start] = 0.0
+    cumulative_distance = np.cumsum(step_distance)
+
+    # Missing elevations are carried forward within the sorted table
+    elevation = pd.Series(elevation).ffill().bfill().fillna(0.0).to_numpy()
+
+    # Window bounds by binary search on a composite key that keeps tracks apart
+    half_window = smoothing_seconds / 2
+    time_offset = elapsed - elapsed.min() if n else elapsed
+    track_span = (time_offset.max() if n else 0.0) + 4 * smoothing_seconds + 1.0
+    key = track_codes * track_span + time_offset
+    lo = np.searchsorted(key, key - half_window, side="left")
+    hi = np.searchsorted(key, key + half_window, side="right") - 1
+
+    window_seconds = elapsed[hi] - elapsed[lo]
+    valid = window_seconds > 0
+    safe_seconds = np.where(valid, window_seconds, 1.0)
+    path_distance = cumulative_distance[hi] - cumulative_distance[lo]
+    displacement = haversine_distance(latitude[lo], longitude[lo], latitude[hi], longitude[hi])
+    # Net ground speed is robust to GPS jitter while standing still
+    ground_speed = np.where(valid, displacement / safe_seconds, 0.0)
+    vertical_speed = np.where(valid, (elevation[hi] - elevation[lo]) / safe_seconds, 0.0)
+    straightness = np.where(path_distance > 0, displacement / np.maximum(path_distance, 1e-9), 0.0)
+
+    segment_codes = np.full(n, RUN, dtype=np.int8)
+    segment_codes[ground_speed < IDLE_MAX_SPEED_MPS] = IDLE
+    is_lift = (vertical_speed >= LIFT_MIN_VERTICAL_SPEED_MPS) & (straightness >= LIFT_MIN_STRAIGHTNESS)
+    segment_codes[is_lift] = LIFT
+    return segment_codes
+
+
+def merge_short_segments(
+    segment_codes:np.ndarray,
+    track_codes:np.ndarray,
+    elapsed:np.ndarray,
+    min_segment_seconds:float=MIN_SEGMENT_SECONDS
+) -> np.ndarray:
+    """
+    Merge segments shorter than min_segment_seconds into their neighbors, one at a time.
+    The shortest segment is absorbed by the longer of its neighbors in the same track
+    (the previous one on a tie), which also joins the neighbor on its other side if that
+    has the same type. This repeats until no segment is short, except a track of a
+    single segment. Merging one at a time lets alternating short segments collapse
+    instead of swapping types.
+    Args:
+        segment_codes (np.ndarray): Segment type code of each point, sorted by track and time.
+        track_codes (np.ndarray): Integer track code of each point.
+        elapsed (np.ndarray): Time of each point in seconds.
+        min_segment_seconds (float): Minimum duration of a segment.
+    Returns:
+        np.ndarray: Merged segment type codes.
+    """
+    n = segment_codes.size
+    if n == 0:
+        return segment_codes.copy()
+    track_start = np.ones(n, dtype=bool)
+    track_start[1:] = track_codes[1:] != track_codes[:-1]
+
+    starts = _run_starts(segment_codes, track_start)
+    first_rows = np.flatnonzero(starts)
+    last_rows = np.append(first_rows[1:], n) - 1
+    run_types = segment_codes[first_rows].tolist()
+    run_first = first_rows.tolist()
+    run_last = last_rows.tolist()
+    num_runs = len(run_first)
+    # Neighbors within the same track as a linked list, -1 at track ends
+    run_prev = [k1 - 1 for k1 in range(num_runs)]
+    run_next = [k1 + 1 for k1 in range(num_runs)]
+    for k1 in np.flatnonzero(track_start[first_rows]).tolist():
+        run_prev[k1] = -1
+        if k1 > 0:
+            run_next[k1 - 1] = -1
+    run_next[-1] = -1
+    alive = [True] * num_runs
+    elapsed = np.asarray(elapsed, dtype=np.float64)
+
+    def duration(run):
+        return elapsed[run_last[run]] - elapsed[run_first[run]]
+
+    def is_short(run):
+        return duration(run) < min_segment_seconds and (run_prev[run] != -1 or run_next[run] != -1)
+
+    # Heap of (duration, first row, run), entries of merged or grown runs are skipped when stale
+    heap = [(duration(run), run_first[run], run) for run in range(num_runs) if is_short(run)]
+    heapq.heapify(heap)
+    while heap:
+        run_duration, first_row, run = heapq.heappop(heap)
+        if not alive[run] or run_first[run] != first_row or run_duration != duration(run) or not is_short(run):
+            continue
+        prev_run, next_run = run_prev[run], run_next[run]
+        if next_run == -1 or (prev_run != -1 and duration(prev_run) >= duration(next_run)):
+            target, other = prev_run, next_run
+        else:
+            target, other = next_run, prev_run
+
+        # The target takes the rows of the short run, and of the run beyond it if of the same type
+        absorbed = [run]
+        if other != -1 and run_types[other] == run_types[target]:
+            absorbed.append(other)
+        for merged in absorbed:
+            alive[merged] = False
+            run_first[target] = min(run_first[target], run_first[merged])
+            run_last[target] = max(run_last[target], run_last[merged])
+        left, right = run_prev[target], run_next[target]
+        while left in absorbed:
+            left = run_prev[left]
+        while right in absorbed:
+            right = run_next[right]
+        run_prev[target], run_next[target] = left, right
+        if left != -1:
+            run_next[left] = target
+        if right != -1:
+            run_prev[right] = target
+        if is_short(target):
+            heapq.heappush(heap, (duration(target), run_first[target], target))
+
+    merged_codes = np.empty(n, dtype=segment_codes.dtype)
+    for run in range(num_runs):
+        if alive[run]:
+            merged_codes[run_first[run]:run_last[run] + 1] = run_types[run]
+    return merged_codes
+
+
+def segment_tracks(
+    df:pd.DataFrame,
+    smoothing_seconds:float=SMOOTHING_SECONDS,
+    min_segment_seconds:float=MIN_SEGMENT_SECONDS
+) -> Tuple[pd.DataFrame, pd.DataFrame]:
+    """
+    Classify every point of every track as lift, run or idle in one vectorized pass.
+    Args:
+        df (pd.DataFrame): Combined track data as returned by parse_gpx_files.
+        smoothing_seconds (float): Width of the window used to smooth speeds.
+        min_segment_seconds (float): Segments shorter than this are merged into their neighbors.
+    Returns:
+        tuple:
+            pd.DataFrame: Track data sorted by file, track and time with 'segment_type' and 'segment_id' columns.
+            pd.DataFrame: Segment index with one row per segment and its [start_row, end_row) row range.
+    """
+    with stage("segment_tracks", points=len(df)):
+        track_codes, order = _track_sort_order(df)
+        df = df.iloc[order].reset_index(drop=True)
+        track_codes = track_codes[order]
+
+        elapsed = df["elapsed_seconds"].to_numpy(dtype=np.float64)
+        segment_codes = classify_points(
+            track_codes,
+            elapsed,
+            df["latitude"].to_numpy(dtype=np.float64),
+            df["longitude"].to_numpy(dtype=np.float64),
+            df["elevation"].to_numpy(dtype=np.float64, na_value=np.nan),
+            smoothing_seconds=smoothing_seconds
+        )
+
+        track_start = np.ones(len(df), dtype=bool)
+        track_start[1:] = track_codes[1:] != track_codes[:-1]
+        segment_codes = merge_short_segments(segment_codes, track_codes, elapsed, min_segment_seconds)
+
+        starts = _run_starts(segment_codes, track_start)
+        segment_ids = (np.cumsum(starts) - 1).astype(np.int32)
+        df["segment_type"] = pd.Categorical.from_codes(segment_codes, categories=SEGMENT_TYPES)
+        df["segment_id"] = segment_ids
+
+        first_rows = np.flatnonzero(starts)
+        end_rows = np.append(first_rows[1:], len(df))
+        segment_index = pd.DataFrame({
+            "segment_id": np.arange(first_rows.size, dtype=np.int32),
+            "file_name": df["file_name"].to_numpy()[first_rows],
+            "track_name": df["track_name"].to_numpy()[first_rows],
+            "segment_type": pd.Categorical.from_codes(segment_codes[first_rows], categories=SEGMENT_TYPES),
+            "start_row": first_rows,
+            "end_row": end_rows,
+            "start_seconds": elapsed[first_rows],
+            "end_seconds": elapsed[end_rows - 1],
+        })
+    return df, segment_index
@@ -0,0 +1,210 @@
+# Columnar export and reload of processed sessions
+
+"""
+A session is the processed combined table with its segment index, statistics and
+duplicate report, stored as Parquet files with zstd compression:
+
+    manifest.json
+    points/day_index=0/part-0.parquet     one partition per day of the timeline
+    points/day_index=1/part-0.parquet
+    segments.parquet                      segment index from segment_tracks
+    track_stats.parquet                   per-track statistics
+    segment_stats.parquet                 per-segment statistics
+    duplicates.parquet                    duplicate report, if any
+
+The point partitions use Hive-style directory names, so the 'points' directory can be
+read as one dataset by pyarrow, pandas, DuckDB or Polars. A session is written to a
+directory or packed into a zip archive for download.
+"""
+
+import io
+import json
+import os
+import zipfile
+from datetime import datetime, timezone
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from duplicates import REPORT_COLUMNS
+from profiling import stage
+from segmentation import SEGMENT_TYPES
+from timeline import get_timeline_origin
+from track_stats import get_track_stats, seed_track_stats
+
+SESSION_FORMAT = "gpx-track-session"
+SESSION_VERSION = 1
+MANIFEST_NAME = "manifest.json"
+PARQUET_COMPRESSION = "zstd"
+
+# Columns derived again on reload instead of being stored
+_DERIVED_COLUMNS = ["track_id"]
+
+
+def _parquet_bytes(df:pd.DataFrame) -> bytes:
+    sink = io.BytesIO()
+    pq.write_table(pa.Table.from_pandas(df, preserve_index=False), sink, compression=PARQUET_COMPRESSION)
+    return sink.getvalue()
+
+
+def session_files(
+    df:pd.DataFrame,
+    segment_index:Optional[pd.DataFrame]=None,
+    duplicate_report:Optional[List[Dict[str, Any]]]=None
+) -> Dict[str, bytes]:
+    """
+    Serialize a processed session.
+    Args:
+        df (pd.DataFrame): Combined track data after add_timeline and segment_tracks.
+        segment_index (pd.DataFrame, optional): Segment index from segment_tracks.
+        duplicate_report (list, optional): Report rows from the duplicate detection.
+    Returns:
+        dict: Contents of every session file keyed by its relative path.
+    """
+    with stage("session_export", points=len(df)) as export_stage:
+        points = df.drop(columns=[column for column in _DERIVED_COLUMNS if column in df.columns])
+        day_index = points["day_index"].to_numpy()
+        points = points.drop(columns=["day_index"])
+        days = np.unique(day_index)
+
+        files = {}
+        # Rows keep their order within each day, which restores the full order on reload
+        for day in days:
+            files[f"points/day_index={int(day)}/part-0.parquet"] = _parquet_bytes(points[day_index == day])
+        if segment_index is not None:
+            files["segments.parquet"] = _parquet_bytes(segment_index)
+        track_stats, segment_stats = get_track_stats(df)
+        files["track_stats.parquet"] = _parquet_bytes(track_stats)
+        files["segment_stats.parquet"] = _parquet_bytes(segment_stats)
+        if duplicate_report:
+            files["duplicates.parquet"] = _parquet_bytes(pd.DataFrame(duplicate_report, columns=REPORT_COLUMNS))
+
+        manifest = {
+            "format": SESSION_FORMAT,
+            "version": SESSION_VERSION,
+            "created": datetime.now(timezone.utc).isoformat(),
+            "timeline_origin": get_timeline_origin(df).isoformat(),
+            "points": int(len(df)),
+            "tracks": int(len(track_stats)),
+            "days": [int(day) for day in days],
+            "columns": [str(column) for column in df.columns if column not in _DERIVED_COLUMNS],
+        }
+        files[MANIFEST_NAME] = json.dumps(manifest, indent=2).encode()
+        export_stage.add(files=len(files), bytes=sum(len(data) for data in files.values()))
+    return files
+
+
+def write_session(path:str, df:pd.DataFrame, segment_index:Optional[pd.DataFrame]=None, duplicate_report:Optional[List[Dict[str, Any]]]=None) -> None:
+    """Write a session to a directory, see session_files"""
+    for name, data in session_files(df, segment_index, duplicate_report).items():
+        file_path = os.path.join(path, *name.split("/"))
+        os.makedirs(os.path.dirname(file_path), exist_ok=True)
+        with open(file_path, "wb") as f:
+            f.write(data)
+
+
+def session_to_zip(df:pd.DataFrame, segment_index:Optional[pd.DataFrame]=None, duplicate_report:Optional[List[Dict[str, Any]]]=None) -> bytes:
+    """Pack a session into zip archive bytes, see session_files"""
+    buffer = io.BytesIO()
+    # Parquet files are already compressed, so they are stored as they are
+    with zipfile.ZipFile(buffer, "w", compression=zipfile.ZIP_STORED) as archive:
+        for name, data in session_files(df, segment_index, duplicate_report).items():
+            archive.writestr(name, data)
+    return buffer.getvalue()
+
+
+def _session_reader(source) -> Dict[str, Any]:
+    """Map the relative path of every session file to something pyarrow can read"""
+    if isinstance(source, (str, os.PathLike)) and os.path.isdir(source):
+        files = {}
+        for root, _, file_names in os.walk(source):
+            for file_name in file_names:
+                file_path = os.path.join(root, file_name)
+                files[os.path.relpath(file_path, source).replace(os.sep, "/")] = file_path
+        return files
+    with zipfile.ZipFile(source) as archive:
+        names = [name for name in archive.namelist() if not name.endswith("/")]
+        # Archives made by zipping a session directory have one common top-level folder
+        prefix = ""
+        manifests = [name for name in names if name.split("/")[-1] == MANIFEST_NAME]
+        if manifests:
+            prefix = manifests[0][:-len(MANIFEST_NAME)]
+        return {name[len(prefix):]: io.BytesIO(archive.read(name)) for name in names if name.startswith(prefix)}
+
+
+def _read_manifest(files:Dict[str, Any]) -> Dict[str, Any]:
+    if MANIFEST_NAME not in files:
+        raise ValueError("Not a saved session: manifest.json is missing")
+    manifest_source = files[MANIFEST_NAME]
+    if isinstance(manifest_source, str):
+        with open(manifest_source, "rb") as f:
+            manifest = json.loads(f.read())
+    else:
+        manifest = json.loads(manifest_source.getvalue())
+    if manifest.get("format") != SESSION_FORMAT:
+        raise ValueError("Not a saved session: unknown format")
+    if manifest.get("version", 0) > SESSION_VERSION:
+        raise ValueError(f"Saved session version {manifest['version']} is newer than the supported version {SESSION_VERSION}")
+    return manifest
+
+
+def is_session(path:str) -> bool:
+    """Whether a path is a session directory or archive written by this module"""
+    if os.path.isdir(path):
+        return os.path.isfile(os.path.join(path, MANIFEST_NAME))
+    if not zipfile.is_zipfile(path):
+        return False
+    with zipfile.ZipFile(path) as archive:
+        return any(name.split("/")[-1] == MANIFEST_NAME for name in archive.namelist())
+
+
+def read_session(source) -> Tuple[pd.DataFrame, Optional[pd.DataFrame], List[Dict[str, Any]]]:
+    """
+    Reload a saved session without parsing any GPX files.
+    The statistics of the session are put back in the statistics cache.
+    Args:
+        source: Session directory, zip archive path, or file-like zip archive.
+    Returns:
+        tuple:
+            pd.DataFrame: Combined track data sorted by file, track and time, as segment_tracks
+                leaves it, without 'track_id'.
+            pd.DataFrame: Segment index, or None if the session has none.
+            list: Duplicate report rows.
+    """
+    with stage("session_import") as import_stage:
+        files = _session_reader(source)
+        manifest = _read_manifest(files)
+
+        parts = []
+        for day in manifest["days"]:
+            part = pq.read_table(files[f"points/day_index={day}/part-0.parquet"]).to_pandas()
+            part["day_index"] = np.int16(day)
+            parts.append(part)
+        df = pd.concat(parts, ignore_index=True)
+
+        # Restore the order by track and time; rows of a track on the same day kept their saved order
+        track_codes = df.groupby(["file_name", "track_name"], sort=True).ngroup().to_numpy()
+        df = df.iloc[np.lexsort((df["elapsed_seconds"].to_numpy(), track_codes))].reset_index(drop=True)
+        df = df[[column for column in manifest["columns"] if column in df.columns]]
+        if "segment_type" in df.columns:
+            df["segment_type"] = pd.Categorical(df["segment_type"].astype(str), categories=SEGMENT_TYPES)
+
+        segment_index = None
+        if "segments.parquet" in files:
+            segment_index = pq.read_table(files["segments.parquet"]).to_pandas()
+            segment_index["segment_type"] = pd.Categorical(segment_index["segment_type"].astype(str), categories=SEGMENT_TYPES)
+
+        seed_track_stats(
+            df,
+            pq.read_table(files["track_stats.parquet"]).to_pandas(),
+            pq.read_table(files["segment_stats.parquet"]).to_pandas()
+        )
+
+        duplicate_report = []
+        if "duplicates.parquet" in files:
+            duplicate_report = pq.read_table(files["duplicates.parquet"]).to_pandas().to_dict("records")
+        import_stage.add(points=len(df), days=len(manifest["days"]))
+    return df, segment_index, duplicate_report
@@ -0,0 +1,145 @@
+# Process-wide caches shared by all sessions of the Streamlit server
+
+"""
+Streamlit runs every session in a thread of the same process, so module-level
+caches are shared by all users. SharedCache bounds a cache by the total size of
+its values and makes concurrent sessions asking for the same missing value wait
+for one computation instead of each computing it (single flight).
+"""
+
+import os
+import threading
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Hashable, List, Optional
+
+# Registry of the shared caches, for diagnostics
+_caches = {}
+_caches_lock = threading.Lock()
+
+
+def cache_size_mb(env_var:str, default_mb:int) -> int:
+    """Size bound in bytes read from an environment variable in megabytes"""
+    return int(os.environ.get(env_var, str(default_mb))) * 1024 * 1024
+
+
+class SharedCache:
+    """
+    Least-recently-used cache with a bound on the total size of its values.
+    Entries are evicted oldest first once the total size exceeds max_bytes.
+    Args:
+        max_bytes (int): Bound on the total size of the values.
+        size_of (callable): Size of a value in bytes, len by default.
+        name (str, optional): Name listed by cache_stats.
+    """
+
+    def __init__(self, max_bytes:int, size_of:Callable[[Any], int]=len, name:Optional[str]=None):
+        self.max_bytes = max_bytes
+        self.size_of = size_of
+        self.name = name
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._sizes = {}
+        self._total_bytes = 0
+        self._lock = threading.Lock()
+        self._pending = {}
+        if name is not None:
+            with _caches_lock:
+                _caches[name] = self
+
+    def get(self, key:Hashable) -> Optional[Any]:
+        """Return the cached value for key, or None if not cached"""
+        with self._lock:
+            value = self._entries.get(key)
+            if value is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+            else:
+                self.misses += 1
+            return value
+
+    def put(self, key:Hashable, value:Any) -> None:
+        """Store a value under key and evict old entries to stay within the size bound"""
+        size = self.size_of(value)
+        with self._lock:
+            if key in self._entries:
+                self._entries.pop(key)
+                self._total_bytes -= self._sizes.pop(key)
+            if size > self.max_bytes:
+                return
+            self._entries[key] = value
+            self._sizes[key] = size
+            self._total_bytes += size
+            while self._total_bytes > self.max_bytes:
+                evicted_key, _ = self._entries.popitem(last=False)
+                self._total_bytes -= self._sizes.pop(evicted_key)
+
+    def get_or_create(self, key:Hashable, create:Callable[[], Any]) -> Any:
+        """
+        Return the cached value for key, creating and caching it on a miss.
+        Concurrent callers with the same key wait for the first one's value.
+        """
+        value = self.get(key)
+        if value is not None:
+            return value
+        with self._lock:
+            key_lock = self._pending.setdefault(key, threading.Lock())
+        try:
+            with key_lock:
+                # Another caller may have created the value while this one waited
+                with self._lock:
+                    value = self._entries.get(key)
+                if value is None:
+                    value = create()
+                    self.put(key, value)
+        finally:
+            with self._lock:
+                if self._pending.get(key) is key_lock and not key_lock.locked():
+                    del self._pending[key]
+        return value
+
+    def discard(self, key:Hashable) -> None:
+        """Remove an entry if it is cached"""
+        with self._lock:
+            if key in self._entries:
+                self._entries.pop(key)
+                self._total_bytes -= self._sizes.pop(key)
+
+    def values(self) -> List[Any]:
+        with self._lock:
+            return list(self._entries.values())
+
+    def __contains__(self, key:Hashable) -> bool:
+        with self._lock:
+            return key in self._entries
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._entries)
+
+    @property
+    def total_bytes(self) -> int:
+        return self._total_bytes
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self._sizes.clear()
+            self._total_bytes = 0
+
+
+def cache_stats() -> List[Dict[str, Any]]:
+    """Entries, size, bound and hit counts of every named shared cache"""
+    with _caches_lock:
+        caches = list(_caches.values())
+    return [
+        {
+            "cache": cache.name,
+            "entries": len(cache),
+            "mb": round(cache.total_bytes / 1024**2, 1),
+            "max_mb": round(cache.max_bytes / 1024**2, 1),
+            "hits": cache.hits,
+            "misses": cache.misses,
+        }
+        for cache in caches
+    ]
@@ -0,0 +1,301 @@
+# Small multiples: one static map panel per track, file or day, composited into one image
+
+"""
+The selection is split into panels by track, file or day. With shared bounds every
+panel shows the bounds of the whole selection, so a single basemap mosaic is fetched.
+With bounds fitted to each panel, one mosaic is fetched per distinct bounds. Mosaics
+are fetched in the calling process and placed in shared memory, and each worker
+process copies a mosaic into its own BASEMAP_CACHE once. Panels are rendered in a
+pool of worker processes kept for the life of the server, as RGBA arrays that are
+pasted into a grid with numpy. Tracks keep the colors they have on the combined map.
+"""
+
+import concurrent.futures
+import io
+import multiprocessing
+import os
+import threading
+from multiprocessing import shared_memory
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+
+from map_bounds import get_default_map_bounds
+from map_layers import BASEMAP_CACHE, BasemapLayer, get_basemap_layer, put_basemap_layer
+from timeline import SECONDS_PER_DAY, get_timeline_origin
+from util import get_distinct_colors
+
+PANEL_GROUPS = ["Track", "File", "Day"]
+PANEL_BOUNDS = ["Shared", "Fit each panel"]
+
+# Panels are at least this wide in inches so titles and markers stay legible
+MIN_PANEL_WIDTH = 3
+# Gap between panels in pixels
+PANEL_GAP_PIXELS = 12
+
+# Worker processes shared by the small multiples renders of all sessions
+PANEL_WORKERS = int(os.environ.get("SKI_TRACKS_PANEL_WORKERS", os.cpu_count() or 1))
+
+_panel_executor = None
+_panel_executor_lock = threading.Lock()
+
+# Columns of the track data used to draw a panel
+_PANEL_COLUMNS = ["file_name", "track_name", "elapsed_seconds", "latitude", "longitude", "segment_type"]
+
+
+def split_panels(df:pd.DataFrame, group_by:str="Track") -> List[Tuple[str, pd.DataFrame]]:
+    """
+    Split track data into the data of each panel.
+    Args:
+        df (pd.DataFrame): DataFrame containing the selected GPX tracks.
+        group_by (str): One of PANEL_GROUPS.
+    Returns:
+        list: (title, data) of each panel, sorted by title, or by date for days.
+    """
+    if group_by == "Track":
+        keys = df["track_name"]
+    elif group_by == "File":
+        keys = df["file_name"]
+    elif group_by == "Day":
+        keys = (df["elapsed_seconds"] // SECONDS_PER_DAY).astype(np.int64)
+    else:
+        raise ValueError(f"Invalid panel grouping '{group_by}'. Use one of {PANEL_GROUPS}.")
+
+    origin = get_timeline_origin(df) if group_by == "Day" else None
+    columns = [column for column in _PANEL_COLUMNS if column in df.columns]
+    panels = []
+    for key, panel_df in df[columns].groupby(keys, observed=True, sort=True):
+        title = (origin + pd.Timedelta(days=int(key))).strftime("%a %d %b %Y") if origin is not None else str(key)
+        panels.append((title, panel_df))
+    return panels
+
+
+def count_panels(df:pd.DataFrame, group_by:str="Track") -> int:
+    """Number of panels of the track data without splitting it"""
+    if group_by == "Day":
+        return int((df["elapsed_seconds"] // SECONDS_PER_DAY).nunique())
+    return int(df["file_name" if group_by == "File" else "track_name"].nunique())
+
+
+def grid_columns(num_panels:int, columns:int=0) -> int:
+    """Number of grid columns, close to a square grid when columns is 0"""
+    if columns > 0:
+        return min(columns, max(num_panels, 1))
+    return max(int(np.ceil(np.sqrt(num_panels))), 1)
+
+
+def composite_panels(images:List[np.ndarray], columns:int, gap:int=PANEL_GAP_PIXELS) -> np.ndarray:
+    """
+    Paste panel images into a grid on a white background.
+    Panels of different sizes are centered in cells of the largest panel size.
+    Args:
+        images (list): RGBA arrays of the panels in reading order.
+        columns (int): Number of grid columns.
+        gap (int): Gap between panels in pixels.
+    Returns:
+        np.ndarray: RGBA array of the composite image.
+    """
+    rows = int(np.ceil(len(images) / columns))
+    cell_height = max(image.shape[0] for image in images)
+    cell_width = max(image.shape[1] for image in images)
+    canvas = np.full((rows * cell_height + (rows - 1) * gap, columns * cell_width + (columns - 1) * gap, 4), 255, dtype=np.uint8)
+    for k1, image in enumerate(images):
+        row, column = divmod(k1, columns)
+        top = row * (cell_height + gap) + (cell_height - image.shape[0]) // 2
+        left = column * (cell_width + gap) + (cell_width - image.shape[1]) // 2
+        canvas[top:top + image.shape[0], left:left + image.shape[1]] = image
+    return canvas
+
+
+def image_to_bytes(image:np.ndarray, fmt:str="png") -> bytes:
+    """Encode an RGBA array as image bytes"""
+    # Pillow is installed with matplotlib
+    from PIL import Image
+
+    buffer = io.BytesIO()
+    Image.fromarray(image[..., :3]).save(buffer, format="JPEG" if fmt.lower() == "jpg" else fmt.upper())
+    return buffer.getvalue()
+
+
+def _get_panel_executor() -> concurrent.futures.ProcessPoolExecutor:
+    global _panel_executor
+    with _panel_executor_lock:
+        if _panel_executor is None:
+            # Workers are started fresh, forking the threads of a server is not safe
+            _panel_executor = concurrent.futures.ProcessPoolExecutor(
+                max_workers=PANEL_WORKERS,
+                mp_context=multiprocessing.get_context("spawn")
+            )
+        return _panel_executor
+
+
+def _share_basemap(layer:BasemapLayer) -> Tuple[shared_memory.SharedMemory, Dict[str, Any]]:
+    """Copy a basemap mosaic into shared memory and return it with the handle workers attach to"""
+    block = shared_memory.SharedMemory(create=True, size=max(layer.image.nbytes, 1))
+    np.ndarray(layer.image.shape, dtype=layer.image.dtype, buffer=block.buf)[...] = layer.image
+    handle = {
+        "name": block.name,
+        "shape": layer.image.shape,
+        "dtype": layer.image.dtype.str,
+        "extent": layer.extent,
+        "attribution": layer.attribution,
+    }
+    return block, handle
+
+
+def _attach_basemap(key:tuple, handle:Dict[str, Any]) -> None:
+    """Cache a basemap mosaic shared by the parent process, once per worker"""
+    if key in BASEMAP_CACHE:
+        return
+    # Workers share the resource tracker of the parent, which unlinks the block
+    block = shared_memory.SharedMemory(name=handle["name"])
+    try:
+        image = np.ndarray(handle["shape"], dtype=np.dtype(handle["dtype"]), buffer=block.buf).copy()
+    finally:
+        block.close()
+    put_basemap_layer(*key, BasemapLayer(image=image, extent=tuple(handle["extent"]), attribution=handle["attribution"]))
+
+
+def render_panel(task:Dict[str, Any]) -> np.ndarray:
+    """
+    Render one panel to an RGBA array.
+    Args:
+        task (dict): 'df', 'params', 'colors' and 'dpi' of the panel, and in a worker process
+            the 'basemap' (key, handle) of its mosaic in shared memory.
+    """
+    import matplotlib
+    matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
+
+    from generate_map import render_static_map
+
+    if task.get("basemap") is not None:
+        _attach_basemap(*task["basemap"])
+    fig = render_static_map(task["df"], task["params"], track_colors=task["colors"])
+    try:
+        fig.set_dpi(task["dpi"])
+        fig.canvas.draw()
+        return np.array(fig.canvas.buffer_rgba())
+    finally:
+        plt.close(fig)
+
+
+def _render_panels_in_workers(tasks:List[Dict[str, Any]], workers:int) -> List[np.ndarray]:
+    """Render panels on the worker pool, at most workers at a time"""
+    executor = _get_panel_executor()
+    images = [None] * len(tasks)
+    pending = {}
+    next_task = 0
+    try:
+        while next_task < len(tasks) or pending:
+            while next_task < len(tasks) and len(pending) < workers:
+                pending[executor.submit(render_panel, tasks[next_task])] = next_task
+                next_task += 1
+            done, _ = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                images[pending.pop(future)] = future.result()
+    except concurrent.futures.process.BrokenProcessPool:
+        # A worker died, the next render starts a new pool
+        global _panel_executor
+        with _panel_executor_lock:
+            if _panel_executor is executor:
+                _panel_executor = None
+        raise
+    finally:
+        for future in pending:
+            future.cancel()
+    return images
+
+
+def render_small_multiples(
+    df:pd.DataFrame,
+    stat_params:Dict[str, Any],
+    group_by:str="Track",
+    columns:int=0,
+    bounds_mode:str="Shared",
+    dpi:int=200,
+    workers:Optional[int]=None
+) -> np.ndarray:
+    """
+    Render one static map panel per track, file or day and composite them into one image.
+    Args:
+        df (pd.DataFrame): DataFrame containing the selected GPX tracks.
+        stat_params (dict): Parameters as returned by show_static_map_options. The figure width
+            is the width of the composite, the title is prefixed to the panel titles.
+        group_by (str): One of PANEL_GROUPS.
+        columns (int): Number of grid columns, about square if 0.
+        bounds_mode (str): One of PANEL_BOUNDS.
+        dpi (int): Resolution of the panels.
+        workers (int, optional): Number of panels rendered at once, by default one per panel up
+            to PANEL_WORKERS. Panels are rendered in this process with one worker.
+    Returns:
+        np.ndarray: RGBA array of the composite image.
+    """
+    if bounds_mode not in PANEL_BOUNDS:
+        raise ValueError(f"Invalid panel bounds '{bounds_mode}'. Use one of {PANEL_BOUNDS}.")
+    panels = split_panels(df, group_by)
+    # Panels without points in the time range are left out
+    start_time = stat_params["stat_start_seconds"]
+    end_time = stat_params["stat_end_seconds"]
+    if start_time is not None or end_time is not None:
+        panels = [
+            (title, panel_df) for title, panel_df in panels
+            if panel_df["elapsed_seconds"].between(-np.inf if start_time is None else start_time, np.inf if end_time is None else end_time).any()
+        ]
+    if not panels:
+        raise ValueError("No points to draw in the selected time range")
+
+    columns = grid_columns(len(panels), columns)
+    track_names = sorted(df["track_name"].unique())
+    track_colors = dict(zip(track_names, get_distinct_colors(len(track_names))))
+    map_style = stat_params["stat_map_style"]
+    panel_params = {
+        **stat_params,
+        "stat_render_mode": "Tracks",
+        "stat_fig_width": max(int(round(stat_params["stat_fig_width"] / columns)), MIN_PANEL_WIDTH),
+    }
+
+    # The renderers fall back to the default bound for each missing bound
+    bound_keys = ["stat_lat_min", "stat_lat_max", "stat_lon_min", "stat_lon_max"]
+    shared_bounds = tuple(
+        float(stat_params[key] if stat_params[key] else default)
+        for key, default in zip(bound_keys, get_default_map_bounds(df))
+    )
+    tasks = []
+    basemap_keys = []
+    for title, panel_df in panels:
+        params = dict(panel_params)
+        params["stat_title"] = f"{stat_params['stat_title']}: {title}" if stat_params["stat_title"] else title
+        panel_bounds = shared_bounds
+        if bounds_mode == "Fit each panel":
+            lat_min, lat_max, lon_min, lon_max = (float(bound) for bound in get_default_map_bounds(panel_df))
+            # A panel of a single position keeps the shared bounds
+            if lat_max > lat_min and lon_max > lon_min:
+                panel_bounds = (lat_min, lat_max, lon_min, lon_max)
+        params.update(zip(bound_keys, panel_bounds))
+        tasks.append({"df": panel_df, "params": params, "colors": track_colors, "dpi": dpi})
+        basemap_keys.append((map_style, *panel_bounds))
+
+    # Each mosaic is fetched once, here, and panels with the same bounds share it
+    layers = {key: get_basemap_layer(*key) for key in dict.fromkeys(basemap_keys)}
+
+    if workers is None:
+        workers = min(len(tasks), PANEL_WORKERS)
+    if workers <= 1:
+        return composite_panels([render_panel(task) for task in tasks], columns)
+
+    blocks = []
+    try:
+        handles = {}
+        for key, layer in layers.items():
+            block, handles[key] = _share_basemap(layer)
+            blocks.append(block)
+        for task, key in zip(tasks, basemap_keys):
+            task["basemap"] = (key, handles[key])
+        images = _render_panels_in_workers(tasks, workers)
+    finally:
+        for block in blocks:
+            block.close()
+            block.unlink()
+    return composite_panels(images, columns)
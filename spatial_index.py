@@ -0,0 +1,254 @@
+# Uniform grid index over track segments for bounding-box and area queries
+
+import numpy as np
+import pandas as pd
+import threading
+from collections import OrderedDict
+from typing import List, Optional, Sequence, Tuple
+
+from profiling import stage
+from util import get_dataframe_hash
+
+# Average number of segments per occupied cell the grid is sized for
+TARGET_SEGMENTS_PER_CELL = 16
+MAX_CELLS_PER_AXIS = 1024
+# Segments covering more cells than this (GPS glitches, long gaps) are kept in a separate list
+MAX_CELLS_PER_SEGMENT = 64
+
+# Columns the index is built from and keyed by
+INDEX_COLUMNS = ["file_name", "track_name", "elapsed_seconds", "latitude", "longitude"]
+
+_INDEX_CACHE_SIZE = 8
+_index_cache = OrderedDict()
+_index_cache_lock = threading.Lock()
+
+
+class GridIndex:
+    """
+    Uniform grid over the bounding boxes of track segments, stored in CSR layout.
+    A segment joins two consecutive points of the same track, identified by its
+    position in the table sorted by file, track and time. The segments of cell c
+    are cell_segments[cell_offsets[c]:cell_offsets[c + 1]].
+    """
+
+    def __init__(self, df:pd.DataFrame):
+        track_groups = df.groupby(["file_name", "track_name"], sort=True)
+        track_codes = track_groups.ngroup().to_numpy()
+        self.track_keys = list(track_groups.size().index)
+        self.order = np.lexsort((df["elapsed_seconds"].to_numpy(), track_codes))
+        self.point_tracks = track_codes[self.order]
+        lon = df["longitude"].to_numpy(dtype=np.float64)[self.order]
+        lat = df["latitude"].to_numpy(dtype=np.float64)[self.order]
+        self.lon = lon
+        self.lat = lat
+
+        track_start = np.ones(self.point_tracks.size, dtype=bool)
+        track_start[1:] = self.point_tracks[1:] != self.point_tracks[:-1]
+        self.track_first = np.flatnonzero(track_start)
+        self.track_last = np.append(self.track_first[1:], self.point_tracks.size) - 1
+
+        self.segment_first = np.flatnonzero(self.point_tracks[1:] == self.point_tracks[:-1])
+        self.segment_tracks = self.point_tracks[self.segment_first]
+        a = self.segment_first
+        self.seg_lon_min = np.minimum(lon[a], lon[a + 1])
+        self.seg_lon_max = np.maximum(lon[a], lon[a + 1])
+        self.seg_lat_min = np.minimum(lat[a], lat[a + 1])
+        self.seg_lat_max = np.maximum(lat[a], lat[a + 1])
+
+        num_segments = a.size
+        if num_segments:
+            self.extent = (float(lon.min()), float(lon.max()), float(lat.min()), float(lat.max()))
+        else:
+            self.extent = (0.0, 0.0, 0.0, 0.0)
+        lon_span = max(self.extent[1] - self.extent[0], 1e-9)
+        lat_span = max(self.extent[3] - self.extent[2], 1e-9)
+        num_cells = max(num_segments // TARGET_SEGMENTS_PER_CELL, 1)
+        nx = int(np.clip(np.sqrt(num_cells * lon_span / lat_span), 1, MAX_CELLS_PER_AXIS))
+        ny = int(np.clip(num_cells / nx, 1, MAX_CELLS_PER_AXIS))
+        self.shape = (ny, nx)
+        self.cell_lon = lon_span / nx
+        self.cell_lat = lat_span / ny
+
+        ix0, ix1 = self._cell_x(self.seg_lon_min), self._cell_x(self.seg_lon_max)
+        iy0, iy1 = self._cell_y(self.seg_lat_min), self._cell_y(self.seg_lat_max)
+        widths = ix1 - ix0 + 1
+        cells_covered = widths * (iy1 - iy0 + 1)
+        oversize = cells_covered > MAX_CELLS_PER_SEGMENT
+        self.oversize_segments = np.flatnonzero(oversize)
+
+        # Expand each segment to every cell its bounding box covers
+        counts = np.where(oversize, 0, cells_covered)
+        seg_ids = np.repeat(np.arange(num_segments), counts)
+        local = np.arange(seg_ids.size) - np.repeat(np.cumsum(counts) - counts, counts)
+        cells = (iy0[seg_ids] + local // widths[seg_ids]) * nx + ix0[seg_ids] + local % widths[seg_ids]
+
+        cell_order = np.argsort(cells, kind="stable")
+        self.cell_segments = seg_ids[cell_order]
+        self.cell_offsets = np.zeros(nx * ny + 1, dtype=np.int64)
+        np.cumsum(np.bincount(cells, minlength=nx * ny), out=self.cell_offsets[1:])
+
+    def _cell_x(self, lon) -> np.ndarray:
+        return np.clip(((np.asarray(lon) - self.extent[0]) / self.cell_lon).astype(np.int64), 0, self.shape[1] - 1)
+
+    def _cell_y(self, lat) -> np.ndarray:
+        return np.clip(((np.asarray(lat) - self.extent[2]) / self.cell_lat).astype(np.int64), 0, self.shape[0] - 1)
+
+    @property
+    def num_segments(self) -> int:
+        return self.segment_first.size
+
+    def covers(self, lat_min:float, lat_max:float, lon_min:float, lon_max:float) -> bool:
+        """Whether the bounds contain every indexed point"""
+        return lon_min <= self.extent[0] and lon_max >= self.extent[1] and lat_min <= self.extent[2] and lat_max >= self.extent[3]
+
+    def query_bbox(self, lat_min:float, lat_max:float, lon_min:float, lon_max:float) -> np.ndarray:
+        """
+        Find the segments whose bounding box intersects a bounding box.
+        Returns:
+            np.ndarray: Sorted segment ids.
+        """
+        if self.num_segments == 0 or lon_max < self.extent[0] or lon_min > self.extent[1] or lat_max < self.extent[2] or lat_min > self.extent[3]:
+            return np.empty(0, dtype=np.int64)
+        nx = self.shape[1]
+        ix0, ix1 = int(self._cell_x(lon_min)), int(self._cell_x(lon_max))
+        iy0, iy1 = int(self._cell_y(lat_min)), int(self._cell_y(lat_max))
+        # Cells of one grid row are contiguous in the CSR arrays
+        candidates = [self.cell_segments[self.cell_offsets[iy * nx + ix0]:self.cell_offsets[iy * nx + ix1 + 1]] for iy in range(iy0, iy1 + 1)]
+        candidates.append(self.oversize_segments)
+        candidates = np.unique(np.concatenate(candidates))
+        hit = (
+            (self.seg_lon_max[candidates] >= lon_min) & (self.seg_lon_min[candidates] <= lon_max)
+            & (self.seg_lat_max[candidates] >= lat_min) & (self.seg_lat_min[candidates] <= lat_max)
+        )
+        return candidates[hit]
+
+    def query_polygon(self, vertices:Sequence[Tuple[float, float]]) -> np.ndarray:
+        """
+        Find the segments with an end point inside a polygon or crossing one of its edges.
+        Args:
+            vertices (list): Polygon vertices as (lat, lon) pairs.
+        Returns:
+            np.ndarray: Sorted segment ids.
+        """
+        polygon = np.asarray(vertices, dtype=np.float64)
+        candidates = self.query_bbox(polygon[:, 0].min(), polygon[:, 0].max(), polygon[:, 1].min(), polygon[:, 1].max())
+        if candidates.size == 0:
+            return candidates
+        first = self.segment_first[candidates]
+        inside = points_in_polygon(self.lat[first], self.lon[first], polygon) | points_in_polygon(self.lat[first + 1], self.lon[first + 1], polygon)
+        # A segment with both end points outside can still cross the polygon, such as a
+        # sparsely sampled lift line crossing a narrow corridor
+        outside = np.flatnonzero(~inside)
+        if outside.size:
+            inside[outside] = segments_cross_polygon(
+                self.lat[first[outside]], self.lon[first[outside]],
+                self.lat[first[outside] + 1], self.lon[first[outside] + 1],
+                polygon
+            )
+        return candidates[inside]
+
+    def tracks_for_segments(self, segment_ids:np.ndarray) -> List[Tuple[str, str]]:
+        """Return the (file_name, track_name) keys of the tracks the segments belong to"""
+        return [self.track_keys[code] for code in np.unique(self.segment_tracks[segment_ids])]
+
+    def row_mask(self, segment_ids:np.ndarray, num_rows:int) -> np.ndarray:
+        """Boolean mask over the rows of the indexed table marking both end points of the segments"""
+        mask = np.zeros(num_rows, dtype=bool)
+        first = self.segment_first[segment_ids]
+        mask[self.order[first]] = True
+        mask[self.order[first + 1]] = True
+        return mask
+
+    def visible_rows(self, segment_ids:np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Return the rows covered by the segments in track and time order, with a piece id
+        that changes wherever consecutive returned rows are not consecutive points of a track.
+        """
+        first = self.segment_first[segment_ids]
+        positions = np.unique(np.concatenate([first, first + 1]))
+        new_piece = np.ones(positions.size, dtype=bool)
+        new_piece[1:] = (np.diff(positions) > 1) | (self.point_tracks[positions[1:]] != self.point_tracks[positions[:-1]])
+        return self.order[positions], np.cumsum(new_piece) - 1
+
+
+def points_in_polygon(lat:np.ndarray, lon:np.ndarray, polygon:np.ndarray) -> np.ndarray:
+    """Even-odd ray casting test of points against a polygon of (lat, lon) vertices"""
+    inside = np.zeros(lat.shape, dtype=bool)
+    poly_lat = polygon[:, 0]
+    poly_lon = polygon[:, 1]
+    for k1 in range(len(polygon)):
+        lat_a, lon_a = poly_lat[k1 - 1], poly_lon[k1 - 1]
+        lat_b, lon_b = poly_lat[k1], poly_lon[k1]
+        crosses = (lat_a > lat) != (lat_b > lat)
+        if lat_b != lat_a:
+            lon_cross = lon_a + (lat - lat_a) * (lon_b - lon_a) / (lat_b - lat_a)
+            inside ^= crosses & (lon < lon_cross)
+    return inside
+
+
+def segments_cross_polygon(
+    lat_a:np.ndarray,
+    lon_a:np.ndarray,
+    lat_b:np.ndarray,
+    lon_b:np.ndarray,
+    polygon:np.ndarray
+) -> np.ndarray:
+    """Whether each segment from (lat_a, lon_a) to (lat_b, lon_b) properly crosses an edge of a polygon of (lat, lon) vertices"""
+    crosses = np.zeros(lat_a.shape, dtype=bool)
+    d_lat = lat_b - lat_a
+    d_lon = lon_b - lon_a
+    for k1 in range(len(polygon)):
+        edge_lat_a, edge_lon_a = polygon[k1 - 1]
+        edge_lat_b, edge_lon_b = polygon[k1]
+        # The end points of each segment are on opposite sides of the edge and vice versa
+        side_a = (edge_lon_b - edge_lon_a) * (lat_a - edge_lat_a) - (edge_lat_b - edge_lat_a) * (lon_a - edge_lon_a)
+        side_b = (edge_lon_b - edge_lon_a) * (lat_b - edge_lat_a) - (edge_lat_b - edge_lat_a) * (lon_b - edge_lon_a)
+        side_edge_a = d_lon * (edge_lat_a - lat_a) - d_lat * (edge_lon_a - lon_a)
+        side_edge_b = d_lon * (edge_lat_b - lat_a) - d_lat * (edge_lon_b - lon_a)
+        crosses |= (side_a * side_b < 0) & (side_edge_a * side_edge_b < 0)
+    return crosses
+
+
+def get_spatial_index(df:pd.DataFrame) -> GridIndex:
+    """Return the grid index of a dataset, building it only on a cache miss"""
+    cache_key = get_dataframe_hash(df, INDEX_COLUMNS)
+    with _index_cache_lock:
+        index = _index_cache.get(cache_key)
+        if index is not None:
+            _index_cache.move_to_end(cache_key)
+            return index
+
+    with stage("spatial_index_build", points=len(df)):
+        index = GridIndex(df)
+
+    with _index_cache_lock:
+        _index_cache[cache_key] = index
+        while len(_index_cache) > _INDEX_CACHE_SIZE:
+            _index_cache.popitem(last=False)
+    return index
+
+
+def tracks_in_area(
+    df:pd.DataFrame,
+    lat_min:Optional[float]=None,
+    lat_max:Optional[float]=None,
+    lon_min:Optional[float]=None,
+    lon_max:Optional[float]=None,
+    polygon:Optional[Sequence[Tuple[float, float]]]=None
+) -> List[Tuple[str, str]]:
+    """
+    Find the tracks passing through a bounding box or a polygon.
+    Args:
+        df (pd.DataFrame): Track data.
+        lat_min, lat_max, lon_min, lon_max (float): Bounding box, used if no polygon is given.
+        polygon (list, optional): Polygon vertices as (lat, lon) pairs.
+    Returns:
+        list: (file_name, track_name) keys of the matching tracks.
+    """
+    index = get_spatial_index(df)
+    with stage("spatial_query"):
+        if polygon is not None and len(polygon) >= 3:
+            segment_ids = index.query_polygon(polygon)
+        else:
+            segment_ids = index.query_bbox(lat_min, lat_max, lon_min, lon_max)
+    return index.tracks_for_segments(segment_ids)
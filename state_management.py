@@ -1,23 +1,39 @@
 import streamlit as st
-import os
+
+from video_store import cleanup_videos, delete_video
 
 def initialize_session_state():
     """Initialize all session state variables"""
     state_vars = {
         "df_combined": None,
+        "segment_index": None,
         "selected_tracks": None,
+        "selected_track_ids": None,
+        "known_track_ids": None,
+        "track_summary": None,
+        "duplicate_report": [],
+        "live_sources": None,
+        "live_table": None,
+        "live_map_view": None,
+        "session_export": None,
+        "track_selection_version": 0,
         "df_selected_tracks": None,
         "stat_map_generated": False,
-        "stat_map_fig": None,
+        "stat_map_cache_key": None,
         "animation_generated": False,
-        "animation_file": None,        
-        "animation_bytes": None,
+        "animation_file": None,
         "stat_params_hash": "",
         "anim_params_hash": "",
         "stat_current_params": {},
-        "anim_current_params": {}
+        "anim_current_params": {},
+        "profiler": None,
+        "warmup_job": None
     }
     
+    # Remove expired videos of earlier sessions when a new session starts
+    if "animation_file" not in st.session_state:
+        cleanup_videos()
+
     for var, default in state_vars.items():
         if var not in st.session_state:
             st.session_state[var] = default
@@ -30,9 +46,12 @@ def on_files_uploaded():
     # Reset visualization flags
     st.session_state.stat_map_generated = False
     st.session_state.animation_generated = False
-    st.session_state.stat_map_fig = None
-    st.session_state.animation_bytes = None
+    st.session_state.stat_map_cache_key = None
     st.session_state.df_combined = None
+    st.session_state.segment_index = None
+    st.session_state.track_summary = None
+    st.session_state.duplicate_report = []
+    st.session_state.session_export = None
     
     # Reset parameter tracking
     st.session_state.stat_params_hash = ""
@@ -40,15 +59,10 @@ def on_files_uploaded():
     st.session_state.stat_current_params = {}
     st.session_state.anim_current_params = {}
     
-    # Clean up temporary animation file if it exists
+    # Delete the rendered animation of the previous files
     if animation_file_path is not None:
         try:
-            if os.path.exists(animation_file_path):
-                os.unlink(animation_file_path)
-                st.session_state.animation_file = None
+            delete_video(animation_file_path)
+            st.session_state.animation_file = None
         except OSError as e:
-            st.warning(f"Could not delete temporary file: {e}")
-    
-    # Reset checkbox states to ensure track selection is refreshed
-    if "checkbox_states" in st.session_state:
-        del st.session_state.checkbox_states
\ No newline at end of file
+            st.warning(f"Could not delete rendered animation: {e}")
@@ -1,17 +1,22 @@
 #
 
-import contextily as ctx
-import matplotlib.pyplot as plt
-import numpy as np
 import pandas as pd
 import streamlit as st
-from providers import PROVIDERS
 from typing import Any, Dict, List
 
-from custom_map_bounds import get_custom_map_bounds, get_default_map_bounds
+from admission import RENDER_ADMISSION, estimate_render_memory
+from custom_map_bounds import get_custom_map_bounds
+from map_bounds import get_default_map_bounds
 from custom_time_range import get_custom_time_range
+from density_map import DENSITY_COLORMAPS, DENSITY_SCALINGS
+from profiling import stage
 from providers import PROVIDERS
-from util import get_distinct_colors
+from render_cache import STATIC_MAP_CACHE, figure_to_bytes
+from segmentation import SEGMENT_TYPES
+from small_multiples import PANEL_BOUNDS, PANEL_GROUPS, count_panels
+from util import get_dataframe_hash, get_params_hash
+
+STATIC_MAP_DPI = 200
 
 def show_static_map_options(
     df_selected_tracks:pd.DataFrame,
@@ -47,18 +52,53 @@ def show_static_map_options(
     
     with vis_col:
         st.subheader("Visualization Options")
+        stat_render_mode = st.radio("Render mode", ["Tracks", "Density heatmap", "Small multiples"], index=0, horizontal=True, key="stat_render_mode")
         stat_show_start_end_points = st.checkbox("Show start and end points", value=True, key="stat_show_start_end")
         stat_show_legend = st.checkbox("Show legend", value=False, key="stat_show_legend")
         stat_show_coordinates = st.checkbox("Show coordinates", value=False, key="stat_show_coordinates")
 
         stat_line_width = st.slider("Line width", min_value=1, max_value=6, value=3, step=1, key="stat_line_width")
         stat_marker_size = st.slider("Start and end point marker size", min_value=2, max_value=12, value=6, step=1, key="stat_marker_size")
+
+        stat_segment_types = None
+        stat_color_by = "Track"
+        if df_selected_tracks is not None and "segment_type" in df_selected_tracks.columns:
+            selected_segment_types = st.multiselect("Segment types", SEGMENT_TYPES, default=SEGMENT_TYPES, key="stat_segment_types")
+            # All types selected means no filtering
+            if set(selected_segment_types) != set(SEGMENT_TYPES):
+                stat_segment_types = sorted(selected_segment_types)
+            stat_color_by = st.radio("Color by", ["Track", "Segment type"], index=0, horizontal=True, key="stat_color_by")
+
+        stat_density_resolution = 512
+        stat_density_scaling = "log"
+        stat_density_cmap = "inferno"
+        stat_density_interpolate = True
+        if stat_render_mode == "Density heatmap":
+            stat_density_resolution = st.slider("Heatmap resolution (cells)", min_value=128, max_value=2048, value=512, step=64, key="stat_density_resolution")
+            stat_density_scaling = st.selectbox("Heatmap scaling", DENSITY_SCALINGS, index=0, key="stat_density_scaling")
+            stat_density_cmap = st.selectbox("Heatmap colormap", DENSITY_COLORMAPS, index=0, key="stat_density_cmap")
+            stat_density_interpolate = st.checkbox("Interpolate along segments", value=True, key="stat_density_interpolate")
+
+        stat_panel_group = "Track"
+        stat_panel_columns = 0
+        stat_panel_bounds = "Shared"
+        if stat_render_mode == "Small multiples":
+            stat_panel_group = st.radio("One panel per", PANEL_GROUPS, index=0, horizontal=True, key="stat_panel_group")
+            stat_panel_columns = st.number_input("Panel columns (0 for automatic)", min_value=0, max_value=12, value=0, step=1, key="stat_panel_columns")
+            stat_panel_bounds = st.radio(
+                "Panel bounds",
+                PANEL_BOUNDS,
+                index=0,
+                horizontal=True,
+                key="stat_panel_bounds",
+                help="Shared bounds show every panel at the same place and scale with one basemap, fitted bounds zoom in on the tracks of each panel"
+            )
         
         # Get time range
         # stat_start_seconds, stat_end_seconds = get_time_range(df_selected_tracks)
 
-        stat_start_seconds = 0
-        stat_end_seconds = 24 * 3600
+        stat_start_seconds = None
+        stat_end_seconds = None
         if df_selected_tracks is not None and not df_selected_tracks.empty:
             stat_start_seconds, stat_end_seconds = get_custom_time_range(df_selected_tracks=df_selected_tracks, prefix="stat")
 
@@ -85,6 +125,18 @@ def show_static_map_options(
         "stat_title": stat_title,
         "stat_start_seconds": stat_start_seconds,
         "stat_end_seconds": stat_end_seconds,
+        "stat_render_mode": stat_render_mode,
+        "stat_density_resolution": stat_density_resolution,
+        "stat_density_scaling": stat_density_scaling,
+        "stat_density_cmap": stat_density_cmap,
+        "stat_density_interpolate": stat_density_interpolate,
+        "stat_panel_group": stat_panel_group,
+        "stat_panel_columns": int(stat_panel_columns),
+        "stat_panel_bounds": stat_panel_bounds,
+        "stat_segment_types": stat_segment_types,
+        "stat_color_by": stat_color_by,
+        # Set in the file information panel, names the runs in the legend
+        "stat_resort_map_path": st.session_state.get("resort_map_path") or None,
     }
 
 def generate_display_static_map(
@@ -98,22 +150,21 @@ def generate_display_static_map(
     
     # Use the appropriate session state variables based on the prefix
     map_generated_key = f"{session_key_prefix}_map_generated"
-    map_fig_key = f"{session_key_prefix}_map_fig"
+    map_cache_key = f"{session_key_prefix}_map_cache_key"
     params_hash_key = f"{session_key_prefix}_params_hash"
     current_params_key = f"{session_key_prefix}_current_params"
     
     # Initialize session state variables if they don't exist
     if map_generated_key not in st.session_state:
         st.session_state[map_generated_key] = False
-    if map_fig_key not in st.session_state:
-        st.session_state[map_fig_key] = None
+    if map_cache_key not in st.session_state:
+        st.session_state[map_cache_key] = None
     if params_hash_key not in st.session_state:
         st.session_state[params_hash_key] = ""
     if current_params_key not in st.session_state:
         st.session_state[current_params_key] = {}
     
     # Get parameter hash for comparison
-    from util import get_params_hash
     current_hash = get_params_hash(stat_params)
     params_changed = current_hash != st.session_state[params_hash_key]
     
@@ -133,178 +184,64 @@ def generate_display_static_map(
         
         # Generate new map if button clicked
         if generate_stat_clicked:
+            # Rendered maps are cached as encoded bytes by data and parameters
+            data_hash = get_dataframe_hash(df_selected_tracks)
+            cache_key = (data_hash, current_hash)
             with st.spinner("Generating map..."):
-                fig = generate_map(
-                    df_selected_tracks,
-                    mode=vis_mode,
-                    map_style=stat_params["stat_map_style"],
-                    fig_width=int(stat_params["stat_fig_width"]),
-                    lat_min=stat_params["stat_lat_min"],
-                    lat_max=stat_params["stat_lat_max"],
-                    lon_min=stat_params["stat_lon_min"],
-                    lon_max=stat_params["stat_lon_max"],
-                    show_start_end_points=stat_params["stat_show_start_end_points"],
-                    show_legend=stat_params["stat_show_legend"],
-                    show_coordinates=stat_params["stat_show_coordinates"],
-                    line_width=stat_params["stat_line_width"],
-                    start_end_marker_size=stat_params["stat_marker_size"],
-                    title=stat_params["stat_title"],
-                    start_time=stat_params["stat_start_seconds"],
-                    end_time=stat_params["stat_end_seconds"]
-                )
+                if cache_key not in STATIC_MAP_CACHE:
+                    # Renders of all sessions are queued within the server's CPU and memory budgets
+                    wait_placeholder = st.empty()
+                    aspect = (stat_params["stat_lat_max"] - stat_params["stat_lat_min"]) / max(stat_params["stat_lon_max"] - stat_params["stat_lon_min"], 1e-9)
+                    memory_bytes = estimate_render_memory(stat_params["stat_fig_width"], aspect, STATIC_MAP_DPI, points=len(df_selected_tracks))
+                    cpu = 1
+                    small_multiples = stat_params["stat_render_mode"] == "Small multiples"
+                    if small_multiples:
+                        # One worker process per panel within the server's CPU budget, each holding a panel
+                        cpu = max(min(count_panels(df_selected_tracks, stat_params["stat_panel_group"]), int(RENDER_ADMISSION.cpu_budget)), 1)
+                        memory_bytes *= cpu
+                    try:
+                        with RENDER_ADMISSION.admit(
+                            cpu=cpu,
+                            memory_bytes=memory_bytes,
+                            on_wait=lambda position, queued: wait_placeholder.info(f"Waiting for a render slot: position {position} of {queued}")
+                        ):
+                            wait_placeholder.empty()
+                            if small_multiples:
+                                from small_multiples import image_to_bytes, render_small_multiples
+                                with stage("small_multiples_render", points=len(df_selected_tracks)):
+                                    image = render_small_multiples(
+                                        df_selected_tracks,
+                                        stat_params,
+                                        group_by=stat_params["stat_panel_group"],
+                                        columns=stat_params["stat_panel_columns"],
+                                        bounds_mode=stat_params["stat_panel_bounds"],
+                                        dpi=STATIC_MAP_DPI,
+                                        workers=cpu
+                                    )
+                                STATIC_MAP_CACHE.put(cache_key, image_to_bytes(image))
+                            else:
+                                # The rendering stack (matplotlib, contextily) is loaded on the first render
+                                from generate_map import render_static_map
+                                with stage("static_render", points=len(df_selected_tracks)):
+                                    fig = render_static_map(df_selected_tracks, stat_params, mode=vis_mode)
+                                STATIC_MAP_CACHE.put(cache_key, figure_to_bytes(fig, dpi=STATIC_MAP_DPI))
+                    except Exception as e:
+                        st.error(f"Error generating map: {e}")
+                    wait_placeholder.empty()
                 # Update session state with new map
-                st.session_state[map_fig_key] = fig
+                st.session_state[map_cache_key] = cache_key if cache_key in STATIC_MAP_CACHE else None
                 st.session_state[map_generated_key] = True
                 st.session_state[params_hash_key] = current_hash
                 st.session_state[current_params_key] = stat_params.copy()
         
         # Display the map in the container
         with map_container:
-            if st.session_state[map_fig_key] is not None:
-                st.pyplot(st.session_state[map_fig_key])
+            map_bytes = None
+            if st.session_state[map_cache_key] is not None:
+                map_bytes = STATIC_MAP_CACHE.get(st.session_state[map_cache_key])
+            if map_bytes is not None:
+                st.image(map_bytes)
+            elif st.session_state[map_cache_key] is not None:
+                st.info("The rendered map is no longer cached. Click 'Generate Static Map' to render it again.")
             elif not st.session_state[map_generated_key]:
                 st.info("Click 'Generate Static Map' to create visualization")
-
-
-def generate_map(
-    df,
-    *,
-    mode="track",
-    map_style="USTopo",
-    fig_width=8, 
-    lat_min=None,
-    lat_max=None,
-    lon_min=None,
-    lon_max=None,
-    title="",
-    show_start_end_points=False,
-    show_legend=False,
-    show_coordinates=False,
-    line_width=4,
-    start_end_marker_size=8,
-    start_time=0,
-    end_time=24*3600
-):
-    """
-    Generate a static map with GPX tracks plotted on it.
-    Args:
-        df (pd.DataFrame): DataFrame containing GPX track data with columns 'latitude', 'longitude', 'track_name', 'file_name', and 'elapsed_seconds'.
-        mode (str): Mode of plotting, either "track" or "file".
-        map_style (str): Style of the basemap to use.
-        fig_width (float): Width of the figure in inches.
-        lat_min, lat_max, lon_min, lon_max (float): Optional latitude and longitude bounds for the map.
-        title (str): Title of the map.
-        show_start_end_points (bool): Whether to show start and end points of tracks.
-        show_legend (bool): Whether to show a legend for the tracks.
-        show_coordinates (bool): Whether to show coordinates on the axes.
-        line_width (float): Width of the lines representing tracks.
-        start_end_marker_size (int): Size of markers for start and end points.
-        start_time, end_time (int): Time range in seconds to filter tracks.
-    Returns:
-        fig (matplotlib.figure.Figure): The generated map figure.
-    """
-
-    try:
-
-        # Determine the latitude and longitude difference of the tracks
-        track_lat_delta = df["latitude"].max() - df["latitude"].min()
-        track_lon_delta = df["longitude"].max() - df["longitude"].min()
-        
-        # Calculate default latitude and longitude bounds if not provided
-        fig_lat_min = lat_min if lat_min else df["latitude"].min() - 0.125 * track_lat_delta
-        fig_lat_max = lat_max if lat_min else df["latitude"].max() + 0.125 * track_lat_delta
-        fig_lon_min = lon_min if lon_min else df["longitude"].min() - 0.125 * track_lon_delta
-        fig_lon_max = lon_max if lon_max else df["longitude"].max() + 0.125 * track_lon_delta
-        
-        # Calculate figure aspect ratio and height from latitude and longitude bounds
-        fig_lat_diff = fig_lat_max - fig_lat_min
-        fig_lon_diff = fig_lon_max - fig_lon_min    
-        fig_lat_lon_ratio = fig_lat_diff / fig_lon_diff
-        fig_height = np.round(fig_width * fig_lat_lon_ratio, 2)
-        
-        # Create figure and axis
-        fig, ax = plt.subplots(figsize=(fig_width, fig_height))
-        
-        # Set limits
-        ax.set_xlim(fig_lon_min, fig_lon_max)
-        ax.set_ylim(fig_lat_min, fig_lat_max)
-        
-        provider = PROVIDERS.get(map_style, ctx.providers.USGS.USTopo)
-    
-        # Add the basemap
-        ctx.add_basemap(
-            ax, 
-            source=provider,
-            crs="EPSG:4326",
-            attribution_size=2
-        )
-
-        ax.set_xlabel("")
-        ax.set_ylabel("")
-        
-        
-        # Generate colors for all tracks
-        track_names = []
-        if mode == "track":
-            track_names = sorted(df["track_name"].unique())
-        elif mode == "file":
-            track_names = sorted(df["file_name"].unique())
-        else:
-            st.error("Invalid mode specified. Use 'track' or 'file'.")
-            return None
-        colors = get_distinct_colors(len(track_names))
-        color_map = dict(zip(track_names, colors))
-
-        # Plot all tracks with their full paths
-        for track_name in track_names:
-            track_data = df[
-                (df["track_name"] == track_name) & 
-                (df["elapsed_seconds"] >= start_time) & 
-                (df["elapsed_seconds"] <= end_time)
-            ]
-
-            if len(track_data) == 0:
-                continue
-            else:
-
-                # Sort by timestamp to ensure proper path drawing
-                track_data = track_data.sort_values(by="elapsed_seconds")
-                
-                # Plot the full track
-                ax.plot(
-                    track_data["longitude"],
-                    track_data["latitude"], 
-                    color=color_map[track_name],
-                    linewidth=line_width,
-                    alpha=1.0,
-                    label=track_name
-                )
-                
-                if show_start_end_points:
-                    # Mark the start point with a green circle
-                    start_point = track_data.iloc[0]
-                    ax.plot(start_point["longitude"], start_point["latitude"], 'go', markersize=start_end_marker_size)
-                    
-                    # Mark the end point with a red square
-                    end_point = track_data.iloc[-1]
-                    ax.plot(end_point["longitude"], end_point["latitude"], 'rs', markersize=start_end_marker_size)
-        
-        # Add legend if there are multiple tracks
-        if show_legend:
-            ax.legend(loc='upper right', fontsize=8)
-
-        if show_coordinates:
-            pass
-        else:
-            ax.tick_params(left=False, bottom=False, labelleft=False, labelbottom=False)
-        
-        if title != "":
-            ax.set_title(title, fontsize=12)
-        
-        plt.tight_layout()
-        
-        return fig
-    
-    except Exception as e:
-        st.error(f"Error loading basemap: {e}")
-        return None
\ No newline at end of file
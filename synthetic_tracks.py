@@ -0,0 +1,190 @@
+# Synthetic ski day generator for benchmarks and offline testing
+
+import numpy as np
+import pandas as pd
+from typing import List, Tuple
+
+# Meters per degree of latitude
+METERS_PER_DEGREE = 111320.0
+
+LIFT_SPEED_MPS = 5.0
+RUN_SPEED_RANGE_MPS = (7.0, 14.0)
+IDLE_DURATION_RANGE_S = (30.0, 300.0)
+
+
+def _make_lifts(rng:np.random.Generator, num_lifts:int) -> List[Tuple[float, float, float]]:
+    """Return lift tops as (east meters, north meters, vertical rise meters) relative to the base"""
+    lifts = []
+    for _ in range(num_lifts):
+        heading = rng.uniform(-np.pi / 3, np.pi / 3)
+        length = rng.uniform(1200.0, 2500.0)
+        rise = length * rng.uniform(0.25, 0.4)
+        lifts.append((length * np.sin(heading), length * np.cos(heading), rise))
+    return lifts
+
+
+def generate_ski_day(
+    track_name:str="Synthetic Day",
+    file_name:str="synthetic",
+    *,
+    date:str="2024-02-10",
+    start_hour:float=9.0,
+    duration_hours:float=6.0,
+    sample_interval:float=1.0,
+    sample_jitter:float=0.0,
+    num_lifts:int=3,
+    base_lat:float=39.6,
+    base_lon:float=-106.37,
+    base_elevation:float=2500.0,
+    timezone:str="US/Pacific",
+    seed:int=0
+) -> pd.DataFrame:
+    """
+    Generate a realistic lift-and-run ski day with the same columns as parse_gpx_files.
+    The day alternates idle time at the base, a chairlift ride up a straight lift line,
+    and a winding descent back to the base.
+    Args:
+        track_name (str): Name of the generated track.
+        file_name (str): File name the track is attributed to.
+        date (str): Local date of the ski day.
+        start_hour (float): Local hour the recording starts.
+        duration_hours (float): Length of the recording in hours.
+        sample_interval (float): Mean seconds between recorded points.
+        sample_jitter (float): Relative random variation of the sample interval, 0 for uniform sampling.
+        num_lifts (int): Number of lifts in the synthetic resort.
+        base_lat, base_lon, base_elevation (float): Location of the resort base.
+        timezone (str): Timezone of the timestamps.
+        seed (int): Random seed.
+    Returns:
+        pd.DataFrame: Track points.
+    """
+    rng = np.random.default_rng(seed)
+    lifts = _make_lifts(rng, num_lifts)
+    total_seconds = duration_hours * 3600.0
+
+    # Sample times, optionally with uneven intervals
+    num_samples = int(total_seconds / sample_interval) + 1
+    if sample_jitter > 0:
+        intervals = sample_interval * rng.uniform(1 - sample_jitter, 1 + sample_jitter, num_samples)
+        times = np.concatenate([[0.0], np.cumsum(intervals[:-1])])
+        times = times[times <= total_seconds]
+    else:
+        times = np.arange(num_samples) * float(sample_interval)
+
+    east = np.zeros_like(times)
+    north = np.zeros_like(times)
+    up = np.zeros_like(times)
+
+    # Build the phases of the day and fill the samples of each phase
+    phase_start = 0.0
+    while phase_start < total_seconds:
+        east_top, north_top, rise = lifts[rng.integers(len(lifts))]
+        lift_length = np.hypot(np.hypot(east_top, north_top), rise)
+        run_speed = rng.uniform(*RUN_SPEED_RANGE_MPS)
+        turn_amplitude = rng.uniform(40.0, 150.0)
+        turn_count = rng.integers(4, 12)
+        idle_end = phase_start + rng.uniform(*IDLE_DURATION_RANGE_S)
+        lift_end = idle_end + lift_length / LIFT_SPEED_MPS
+        run_end = lift_end + 1.6 * lift_length / run_speed
+
+        idle_mask = (times >= phase_start) & (times < idle_end)
+        east[idle_mask] = rng.normal(0.0, 3.0, idle_mask.sum())
+        north[idle_mask] = rng.normal(0.0, 3.0, idle_mask.sum())
+
+        lift_mask = (times >= idle_end) & (times < lift_end)
+        fraction = (times[lift_mask] - idle_end) / (lift_end - idle_end)
+        east[lift_mask] = fraction * east_top
+        north[lift_mask] = fraction * north_top
+        up[lift_mask] = fraction * rise
+
+        run_mask = (times >= lift_end) & (times < run_end)
+        fraction = (times[run_mask] - lift_end) / (run_end - lift_end)
+        # Wind back down with lateral turns perpendicular to the fall line
+        lateral = turn_amplitude * np.sin(np.pi * turn_count * fraction) * np.sin(np.pi * fraction)
+        perp_east, perp_north = north_top / np.hypot(east_top, north_top), -east_top / np.hypot(east_top, north_top)
+        east[run_mask] = (1 - fraction) * east_top + lateral * perp_east
+        north[run_mask] = (1 - fraction) * north_top + lateral * perp_north
+        up[run_mask] = (1 - fraction) ** 1.2 * rise
+
+        phase_start = run_end
+
+    # GPS noise
+    east += rng.normal(0.0, 1.5, times.size)
+    north += rng.normal(0.0, 1.5, times.size)
+    up += rng.normal(0.0, 2.0, times.size)
+
+    start = pd.Timestamp(date, tz=timezone) + pd.Timedelta(hours=start_hour)
+    midnight = pd.Timestamp(date, tz=timezone)
+    timestamps = start + pd.to_timedelta(times, unit="s")
+
+    df = pd.DataFrame({
+        "file_name": file_name,
+        "track_name": track_name,
+        "timestamp": timestamps,
+        "latitude": base_lat + north / METERS_PER_DEGREE,
+        "longitude": base_lon + east / (METERS_PER_DEGREE * np.cos(np.radians(base_lat))),
+        "elevation": base_elevation + up,
+    })
+    df["elapsed_seconds"] = (df["timestamp"] - midnight).dt.total_seconds()
+    df["time"] = df["timestamp"].dt.strftime("%H:%M:%S")
+    return df
+
+
+def generate_ski_days(
+    num_tracks:int=4,
+    *,
+    num_days:int=1,
+    duration_hours:float=6.0,
+    sample_interval:float=1.0,
+    sample_jitter:float=0.0,
+    seed:int=0
+) -> pd.DataFrame:
+    """
+    Generate several synthetic ski days in the same resort.
+    Tracks are spread over num_days consecutive days, one file per track.
+    Returns:
+        pd.DataFrame: Combined track points.
+    """
+    dates = pd.date_range("2024-02-10", periods=num_days, freq="D")
+    df_list = []
+    for k1 in range(num_tracks):
+        df_list.append(generate_ski_day(
+            track_name=f"Skier {k1 + 1:03d}",
+            file_name=f"synthetic_{k1 + 1:03d}",
+            date=dates[k1 % num_days].strftime("%Y-%m-%d"),
+            start_hour=8.5 + (k1 % 5) * 0.25,
+            duration_hours=duration_hours,
+            sample_interval=sample_interval,
+            sample_jitter=sample_jitter,
+            seed=seed + k1
+        ))
+    return pd.concat(df_list, ignore_index=True)
+
+
+def track_to_gpx(df:pd.DataFrame) -> str:
+    """
+    Serialize the points of one or more tracks to a GPX document.
+    Returns:
+        str: GPX XML.
+    """
+    parts = ['<?xml version="1.0" encoding="UTF-8"?>\n<gpx version="1.1" creator="ski-tracks synthetic" xmlns="http://www.topografix.com/GPX/1/1">\n']
+    for track_name, track_data in df.groupby("track_name", sort=True):
+        times = track_data["timestamp"].dt.tz_convert("UTC").dt.strftime("%Y-%m-%dT%H:%M:%S.%fZ")
+        points = [
+            f'<trkpt lat="{lat:.7f}" lon="{lon:.7f}"><ele>{ele:.1f}</ele><time>{time}</time></trkpt>\n'
+            for lat, lon, ele, time in zip(track_data["latitude"], track_data["longitude"], track_data["elevation"], times)
+        ]
+        parts.append(f"<trk><name>{track_name}</name><trkseg>\n")
+        parts.extend(points)
+        parts.append("</trkseg></trk>\n")
+    parts.append("</gpx>\n")
+    return "".join(parts)
+
+
+def stub_fetch_basemap_image(provider, lat_min:float, lat_max:float, lon_min:float, lon_max:float):
+    """Offline replacement for map_layers.fetch_basemap_image returning a generated terrain-like raster"""
+    height, width = 512, 512
+    yy, xx = np.mgrid[0:height, 0:width]
+    shade = 170 + 40 * np.sin(xx / 37.0) * np.cos(yy / 53.0)
+    image = np.stack([shade, shade + 10, shade - 10], axis=-1).clip(0, 255).astype(np.uint8)
+    return image, (lon_min, lon_max, lat_min, lat_max)
@@ -0,0 +1,9 @@
+# Test configuration: the modules of the app live in the repository root
+
+import os
+import sys
+
+import matplotlib
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+matplotlib.use("Agg")
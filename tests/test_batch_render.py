@@ -0,0 +1,73 @@
+import matplotlib.animation as animation
+import pytest
+
+import batch_render
+import map_layers
+from benchmark import FrameDrawWriter
+from synthetic_tracks import generate_ski_days, stub_fetch_basemap_image, track_to_gpx
+
+
+class _FrameCountWriter(FrameDrawWriter):
+    """Draws every frame like the FFmpeg writer and writes the frame count, ffmpeg is not needed"""
+
+    def __init__(self, fps=5, metadata=None, bitrate=None):
+        super().__init__(fps=fps)
+
+    def finish(self):
+        with open(self.outfile, "w") as f:
+            f.write(str(self.frames))
+
+
+@pytest.fixture
+def tracks_dir(tmp_path):
+    tracks = generate_ski_days(3, num_days=2, duration_hours=0.5, sample_interval=10.0)
+    for file_name, track in tracks.groupby("file_name", sort=True):
+        # Files of the same name in different folders are separate files
+        folder = tmp_path / "tracks" / file_name
+        folder.mkdir(parents=True)
+        (folder / "day.gpx").write_text(track_to_gpx(track))
+    return tmp_path / "tracks"
+
+
+@pytest.fixture
+def offline(monkeypatch):
+    monkeypatch.setattr(map_layers, "fetch_basemap_image", stub_fetch_basemap_image)
+    monkeypatch.setattr(animation, "FFMpegWriter", _FrameCountWriter)
+    # The worker globals are restored after the test
+    for name in ("_worker_df", "_worker_store", "_worker_chunk_rows"):
+        monkeypatch.setattr(batch_render, name, None)
+
+
+JOBS = [
+    {"name": "map", "type": "static", "params": {}},
+    {"name": "heatmap", "type": "static", "files": ["synthetic_001/*"], "params": {"stat_render_mode": "Density heatmap"}},
+    {"name": "movie", "type": "animation", "params": {"anim_duration": 1, "anim_fps": 4, "anim_dpi": 40}},
+]
+
+
+def _run_jobs(output_dir):
+    return [batch_render.run_job(job, str(output_dir)) for job in batch_render.build_jobs({"jobs": JOBS})]
+
+
+def test_sources_are_named_by_relative_path(tracks_dir):
+    names = [source.name for source in batch_render.load_track_sources(str(tracks_dir))]
+    assert names == ["synthetic_001/day.gpx", "synthetic_002/day.gpx", "synthetic_003/day.gpx"]
+
+
+def test_jobs_in_memory(tracks_dir, tmp_path, offline):
+    batch_render._init_worker(str(tracks_dir), str(tmp_path / "cache"))
+    assert batch_render._worker_df["file_name"].nunique() == 3
+    results = _run_jobs(tmp_path / "out")
+    assert [result["status"] for result in results] == ["ok", "ok", "ok"], results
+    assert results[1]["tracks"] == 1
+    assert int((tmp_path / "out" / "movie.mp4").read_text()) == 5
+
+
+def test_jobs_chunked(tracks_dir, tmp_path, offline):
+    store, num_files = batch_render.build_chunked_store(str(tracks_dir), str(tmp_path / "cache"), str(tmp_path / "store"))
+    assert num_files == 3
+    batch_render._init_worker(str(tracks_dir), str(tmp_path / "cache"), store_path=str(tmp_path / "store"), chunk_rows=100)
+    results = _run_jobs(tmp_path / "out")
+    assert [result["status"] for result in results] == ["ok", "ok", "ok"], results
+    assert results[2]["points"] == store.num_rows
+    assert int((tmp_path / "out" / "movie.mp4").read_text()) == 5
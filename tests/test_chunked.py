@@ -0,0 +1,65 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from batch_render import LocalGpxFile
+from chunked import ChunkedTrackStore, chunked_density_grid
+from density_map import compute_density_grid
+from parse_gpx import parse_gpx_files
+from segmentation import segment_tracks
+from synthetic_tracks import generate_ski_days, track_to_gpx
+from timeline import add_timeline
+
+
+@pytest.fixture(scope="module")
+def sources():
+    tracks = generate_ski_days(4, num_days=2, duration_hours=1, sample_interval=5.0)
+    return [
+        LocalGpxFile(f"{file_name}.gpx", track_to_gpx(track).encode())
+        for file_name, track in tracks.groupby("file_name", sort=True)
+    ]
+
+
+@pytest.fixture(scope="module")
+def store(sources, tmp_path_factory):
+    path = str(tmp_path_factory.mktemp("store"))
+    return ChunkedTrackStore.create(path, iter(sources), parse=lambda source: parse_gpx_files([source]))
+
+
+@pytest.fixture(scope="module")
+def tracks(sources):
+    df, _ = segment_tracks(add_timeline(parse_gpx_files(sources)))
+    return df
+
+
+def test_store_holds_every_point(store, tracks):
+    assert store.num_rows == len(tracks)
+    assert len(store.tracks) == tracks.groupby(["file_name", "track_name"]).ngroups
+    frame = store.to_frame(store.track_ids())
+    np.testing.assert_allclose(np.sort(frame["elapsed_seconds"].to_numpy()), np.sort(tracks["elapsed_seconds"].to_numpy()))
+
+
+@pytest.mark.parametrize("interpolate", [True, False])
+@pytest.mark.parametrize("time_range", [(None, None), (9.5 * 3600, 24 * 3600 + 9.5 * 3600)])
+def test_chunked_density_matches_in_memory(store, tracks, interpolate, time_range):
+    bounds = dict(
+        lat_min=tracks["latitude"].min() - 0.01, lat_max=tracks["latitude"].max() + 0.01,
+        lon_min=tracks["longitude"].min() - 0.01, lon_max=tracks["longitude"].max() + 0.01,
+    )
+    start_time, end_time = time_range
+    expected = compute_density_grid(tracks, resolution=128, interpolate=interpolate, start_time=start_time, end_time=end_time, **bounds)
+    # Small chunks split tracks across chunks
+    chunked = chunked_density_grid(
+        store, store.track_ids(), resolution=128, interpolate=interpolate,
+        start_time=start_time, end_time=end_time, max_rows=777, **bounds
+    )
+    assert expected.sum() > 0
+    np.testing.assert_allclose(chunked, expected)
+
+
+def test_track_selection_by_file_pattern(store):
+    ids = store.track_ids(files=["synthetic_00[12]"])
+    assert sorted(store.tracks.loc[ids, "file_name"]) == ["synthetic_001", "synthetic_002"]
+    frame = store.to_frame(ids)
+    assert set(frame["file_name"]) == {"synthetic_001", "synthetic_002"}
+    assert isinstance(frame, pd.DataFrame)
@@ -0,0 +1,77 @@
+import numpy as np
+import pandas as pd
+
+from duplicates import find_duplicate_files, resolve_duplicate_tracks
+
+
+def _track(file_name, track_name, elapsed, latitude, longitude):
+    return pd.DataFrame({
+        "file_name": file_name,
+        "track_name": track_name,
+        "elapsed_seconds": elapsed,
+        "latitude": latitude,
+        "longitude": longitude,
+        "elevation": 3000.0,
+    })
+
+
+def _recordings():
+    elapsed = 9 * 3600 + np.arange(600, dtype=np.float64) * 2.0
+    latitude = 39.6 + np.linspace(0, 0.01, elapsed.size)
+    longitude = -106.0 + 0.002 * np.sin(np.linspace(0, 6, elapsed.size))
+    watch = _track("watch", "Day", elapsed, latitude, longitude)
+    # A phone sampling every 6 s, about 5 m to the east
+    phone = _track("phone", "Day", elapsed[::3], latitude[::3], longitude[::3] + 6e-5)
+    return watch, phone
+
+
+class _File:
+    def __init__(self, name, data):
+        self.name = name
+        self.data = data
+
+    def getvalue(self):
+        return self.data
+
+
+def test_identical_files_are_dropped():
+    files = [_File("a.gpx", b"x"), _File("b.gpx", b"y"), _File("c.gpx", b"x")]
+    unique_files, report = find_duplicate_files(files)
+    assert [file.name for file in unique_files] == ["a.gpx", "b.gpx"]
+    assert report[0]["file_name"] == "c.gpx" and report[0]["duplicate_of_file"] == "a.gpx"
+
+
+def test_overlapping_recordings_are_skipped():
+    watch, phone = _recordings()
+    df, report = resolve_duplicate_tracks(pd.concat([watch, phone], ignore_index=True), "Skip")
+    assert set(df["file_name"]) == {"watch"}
+    assert len(report) == 1
+    assert report[0]["kind"] == "overlapping recording"
+    assert report[0]["duplicate_of_file"] == "watch"
+    assert 3.0 < report[0]["median_distance_m"] < 8.0
+
+
+def test_report_compares_each_duplicate_with_the_primary():
+    watch, phone = _recordings()
+    # A copy of the phone recording is identical to the phone, not to the kept watch recording
+    phone_copy = phone.assign(file_name="phone copy")
+    df, report = resolve_duplicate_tracks(pd.concat([watch, phone, phone_copy], ignore_index=True), "Keep")
+    assert len(df) == len(watch) + 2 * len(phone)
+    rows = {row["file_name"]: row for row in report}
+    assert set(rows) == {"phone", "phone copy"}
+    for row in rows.values():
+        assert row["duplicate_of_file"] == "watch"
+        assert row["kind"] == "overlapping recording"
+        assert row["time_overlap"] > 0.99
+        assert 3.0 < row["median_distance_m"] < 8.0
+
+
+def test_merge_fills_gaps_of_the_primary():
+    watch, phone = _recordings()
+    # The watch lost its signal for 10 minutes
+    gap = (watch["elapsed_seconds"] > 9.2 * 3600) & (watch["elapsed_seconds"] < 9.2 * 3600 + 600)
+    watch = watch[~gap]
+    df, _ = resolve_duplicate_tracks(pd.concat([watch, phone], ignore_index=True), "Merge")
+    assert set(df["file_name"]) == {"watch"}
+    filled = df[(df["elapsed_seconds"] > 9.2 * 3600) & (df["elapsed_seconds"] < 9.2 * 3600 + 600)]
+    assert len(filled) > 0
@@ -0,0 +1,56 @@
+import numpy as np
+
+from profiles import lttb_indices, minmax_indices
+
+
+def _lttb_reference(x, y, num_out):
+    """Direct implementation of Largest-Triangle-Three-Buckets on the same buckets"""
+    n = x.size
+    edges = np.linspace(1, n - 1, num_out - 1).astype(np.int64)
+    selected = [0]
+    for k1 in range(num_out - 2):
+        lo, hi = edges[k1], edges[k1 + 1]
+        if k1 + 2 < num_out - 1:
+            next_lo, next_hi = edges[k1 + 1], edges[k1 + 2]
+            mean_x, mean_y = x[next_lo:next_hi].mean(), y[next_lo:next_hi].mean()
+        else:
+            mean_x, mean_y = x[-1], y[-1]
+        a = selected[-1]
+        areas = [abs((x[a] - mean_x) * (y[k2] - y[a]) - (x[a] - x[k2]) * (mean_y - y[a])) for k2 in range(lo, hi)]
+        selected.append(lo + int(np.argmax(areas)))
+    selected.append(n - 1)
+    return np.array(selected)
+
+
+def test_lttb_matches_reference():
+    rng = np.random.default_rng(0)
+    x = np.cumsum(rng.uniform(0.5, 1.5, 2000))
+    y = np.cumsum(rng.normal(0, 1, 2000))
+    for num_out in (3, 10, 101, 500):
+        np.testing.assert_array_equal(lttb_indices(x, y, num_out), _lttb_reference(x, y, num_out))
+
+
+def test_lttb_keeps_ends_and_spikes():
+    x = np.arange(1000, dtype=np.float64)
+    y = np.zeros(1000)
+    y[437] = 50.0
+    kept = lttb_indices(x, y, 20)
+    assert kept.size == 20
+    assert kept[0] == 0 and kept[-1] == 999
+    assert 437 in kept
+    assert (np.diff(kept) > 0).all()
+
+
+def test_lttb_returns_all_points_when_few():
+    x = np.arange(10, dtype=np.float64)
+    np.testing.assert_array_equal(lttb_indices(x, x, 50), np.arange(10))
+
+
+def test_minmax_keeps_extremes_of_each_bucket():
+    rng = np.random.default_rng(1)
+    y = rng.normal(0, 1, 1000)
+    x = np.arange(y.size, dtype=np.float64)
+    kept = minmax_indices(x, y, 42)
+    assert kept[0] == 0 and kept[-1] == 999
+    assert np.argmin(y) in kept and np.argmax(y) in kept
+    assert kept.size <= 42
@@ -0,0 +1,49 @@
+import numpy as np
+import pytest
+
+from resample import frame_resample_step, resample_tracks
+from synthetic_tracks import generate_ski_days
+from timeline import add_timeline
+
+
+@pytest.fixture(scope="module")
+def tracks():
+    return add_timeline(generate_ski_days(3, duration_hours=1, sample_interval=5.0, sample_jitter=0.5))
+
+
+def test_resample_matches_np_interp(tracks):
+    resampled = resample_tracks(tracks, step=7.0, max_gap_seconds=np.inf)
+    for row, name in enumerate(resampled.names):
+        track = tracks[tracks["track_name"] == name].sort_values("elapsed_seconds")
+        times = track["elapsed_seconds"].to_numpy()
+        inside = (resampled.times >= times[0]) & (resampled.times <= times[-1])
+        np.testing.assert_allclose(resampled.longitude[row, inside], np.interp(resampled.times[inside], times, track["longitude"].to_numpy()))
+        np.testing.assert_allclose(resampled.latitude[row, inside], np.interp(resampled.times[inside], times, track["latitude"].to_numpy()))
+        # No data before the start or after the end of a track
+        assert np.isnan(resampled.longitude[row, ~inside]).all()
+
+
+def test_long_gaps_are_left_empty(tracks):
+    track = tracks[tracks["track_name"] == "Skier 001"]
+    elapsed = track["elapsed_seconds"]
+    gap = (elapsed > elapsed.min() + 600) & (elapsed < elapsed.min() + 1200)
+    resampled = resample_tracks(track[~gap], step=5.0, max_gap_seconds=300.0)
+    in_gap = (resampled.times > elapsed.min() + 700) & (resampled.times < elapsed.min() + 1100)
+    assert np.isnan(resampled.longitude[0, in_gap]).all()
+    # Positions in the gap hold the last sample before it
+    last_valid = resampled.last_valid[0, in_gap]
+    assert (last_valid == last_valid[0]).all()
+    assert resampled.times[last_valid[0]] <= elapsed.min() + 600
+
+
+def test_time_indices(tracks):
+    resampled = resample_tracks(tracks, step=10.0, start_time=1000.0, end_time=2000.0)
+    assert resampled.times[0] == 1000.0 and resampled.times[-1] == 2000.0
+    np.testing.assert_array_equal(resampled.time_indices([900.0, 1000.0, 1015.0, 5000.0]), [0, 0, 1, 100])
+
+
+def test_frame_resample_step():
+    # One day at 24 fps for 20 s, four samples per frame
+    assert frame_resample_step(0.0, 86400.0, 24, 20) == pytest.approx(86400.0 / 480 / 4)
+    # Never finer than one second
+    assert frame_resample_step(0.0, 60.0, 24, 20) == 1.0
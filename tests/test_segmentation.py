@@ -0,0 +1,43 @@
+import numpy as np
+
+from segmentation import IDLE, LIFT, MIN_SEGMENT_SECONDS, RUN, merge_short_segments, segment_tracks
+from synthetic_tracks import generate_ski_days
+
+
+def _segment_durations(segment_index):
+    return segment_index["end_seconds"] - segment_index["start_seconds"]
+
+
+def test_alternating_short_segments_collapse():
+    # run/lift/run of one second each between two long runs used to swap types forever
+    codes = np.array([RUN] * 60 + [LIFT, RUN, LIFT, RUN, LIFT] + [RUN] * 60, dtype=np.int8)
+    elapsed = np.arange(codes.size, dtype=np.float64)
+    merged = merge_short_segments(codes, np.zeros(codes.size, dtype=np.int64), elapsed)
+    assert np.all(merged == RUN)
+
+
+def test_short_segment_joins_longer_neighbor():
+    codes = np.array([IDLE] * 50 + [LIFT] * 5 + [RUN] * 100, dtype=np.int8)
+    elapsed = np.arange(codes.size, dtype=np.float64)
+    merged = merge_short_segments(codes, np.zeros(codes.size, dtype=np.int64), elapsed)
+    np.testing.assert_array_equal(merged, np.array([IDLE] * 50 + [RUN] * 105, dtype=np.int8))
+
+
+def test_segments_do_not_merge_across_tracks():
+    codes = np.array([RUN] * 100 + [LIFT] * 5, dtype=np.int8)
+    track_codes = np.array([0] * 100 + [1] * 5)
+    elapsed = np.arange(codes.size, dtype=np.float64)
+    merged = merge_short_segments(codes, track_codes, elapsed)
+    np.testing.assert_array_equal(merged, codes)
+
+
+def test_no_short_segments_with_jittered_sampling():
+    df = generate_ski_days(3, duration_hours=3, sample_interval=1.0, sample_jitter=0.5)
+    df, segment_index = segment_tracks(df)
+    single = segment_index.groupby(["file_name", "track_name"])["segment_id"].transform("size") == 1
+    assert not ((_segment_durations(segment_index) < MIN_SEGMENT_SECONDS) & ~single).any()
+    # Neighboring segments of a track have different types
+    same_track = segment_index["track_name"].to_numpy()[1:] == segment_index["track_name"].to_numpy()[:-1]
+    same_type = segment_index["segment_type"].to_numpy()[1:] == segment_index["segment_type"].to_numpy()[:-1]
+    assert not (same_track & same_type).any()
+    assert (df["segment_id"].diff().fillna(0) >= 0).all()
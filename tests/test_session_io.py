@@ -0,0 +1,54 @@
+import io
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from duplicates import REPORT_COLUMNS
+from segmentation import segment_tracks
+from session_io import is_session, read_session, session_to_zip, write_session
+from synthetic_tracks import generate_ski_days
+from timeline import add_timeline
+
+
+@pytest.fixture(scope="module")
+def session():
+    df = add_timeline(generate_ski_days(4, num_days=2, duration_hours=1, sample_interval=5.0))
+    df, segment_index = segment_tracks(df)
+    report = [dict(zip(REPORT_COLUMNS, ["identical file", "b.gpx", "", "a.gpx", "", 1.0, 0.0, "skipped"]))]
+    return df, segment_index, report
+
+
+def _assert_same_session(session, loaded):
+    df, segment_index, report = session
+    loaded_df, loaded_segments, loaded_report = loaded
+    assert list(loaded_df.columns) == list(df.columns)
+    pd.testing.assert_frame_equal(loaded_df, df, check_dtype=False, check_categorical=False)
+    pd.testing.assert_frame_equal(loaded_segments, segment_index, check_dtype=False, check_categorical=False)
+    assert loaded_report == report
+
+
+def test_zip_round_trip(session):
+    data = session_to_zip(*session)
+    _assert_same_session(session, read_session(io.BytesIO(data)))
+
+
+def test_directory_round_trip(session, tmp_path):
+    write_session(str(tmp_path), *session)
+    assert is_session(str(tmp_path))
+    assert (tmp_path / "points" / "day_index=1" / "part-0.parquet").exists()
+    _assert_same_session(session, read_session(str(tmp_path)))
+
+
+def test_timestamps_keep_their_timezone(session):
+    df = session[0]
+    loaded_df, _, _ = read_session(io.BytesIO(session_to_zip(*session)))
+    assert str(loaded_df["timestamp"].dt.tz) == str(df["timestamp"].dt.tz)
+    np.testing.assert_array_equal(loaded_df["day_index"].to_numpy(), df["day_index"].to_numpy())
+
+
+def test_not_a_session(tmp_path):
+    (tmp_path / "day.gpx").write_text("<gpx/>")
+    assert not is_session(str(tmp_path))
+    with pytest.raises(ValueError):
+        read_session(str(tmp_path))
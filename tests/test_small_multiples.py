@@ -0,0 +1,31 @@
+import numpy as np
+
+from small_multiples import composite_panels, count_panels, grid_columns, split_panels
+from synthetic_tracks import generate_ski_days
+from timeline import add_timeline
+
+
+def test_panels_per_group():
+    df = add_timeline(generate_ski_days(5, num_days=2, duration_hours=0.5, sample_interval=30.0))
+    for group_by, expected in [("Track", 5), ("File", 5), ("Day", 2)]:
+        panels = split_panels(df, group_by)
+        assert len(panels) == expected == count_panels(df, group_by)
+        assert sum(len(panel_df) for _, panel_df in panels) == len(df)
+    assert split_panels(df, "Day")[0][0] == "Sat 10 Feb 2024"
+
+
+def test_grid_columns():
+    assert grid_columns(5) == 3
+    assert grid_columns(9) == 3
+    assert grid_columns(2, columns=4) == 2
+
+
+def test_composite_centers_panels_in_cells():
+    small = np.zeros((2, 2, 4), dtype=np.uint8)
+    large = np.full((4, 6, 4), 7, dtype=np.uint8)
+    canvas = composite_panels([large, small, small], columns=2, gap=1)
+    assert canvas.shape == (4 * 2 + 1, 6 * 2 + 1, 4)
+    np.testing.assert_array_equal(canvas[:4, :6], large)
+    # The small panel is centered in the second cell of the first row
+    np.testing.assert_array_equal(canvas[1:3, 7 + 2:7 + 4], small)
+    assert (canvas[:, 6] == 255).all()
@@ -0,0 +1,69 @@
+import numpy as np
+import pandas as pd
+
+from spatial_index import GridIndex, points_in_polygon
+
+
+def _random_tracks(num_tracks=5, points=400, seed=0):
+    rng = np.random.default_rng(seed)
+    parts = []
+    for k1 in range(num_tracks):
+        parts.append(pd.DataFrame({
+            "file_name": f"file_{k1 % 2}",
+            "track_name": f"track_{k1}",
+            "elapsed_seconds": np.arange(points, dtype=np.float64) * 5.0,
+            "latitude": 39.6 + np.cumsum(rng.normal(0, 2e-4, points)),
+            "longitude": -106.0 + np.cumsum(rng.normal(0, 2e-4, points)),
+        }))
+    # Shuffled rows, the index sorts by track and time itself
+    return pd.concat(parts, ignore_index=True).sample(frac=1.0, random_state=seed).reset_index(drop=True)
+
+
+def _brute_force_bbox(index, lat_min, lat_max, lon_min, lon_max):
+    return np.flatnonzero(
+        (index.seg_lon_max >= lon_min) & (index.seg_lon_min <= lon_max)
+        & (index.seg_lat_max >= lat_min) & (index.seg_lat_min <= lat_max)
+    )
+
+
+def test_query_bbox_matches_brute_force():
+    index = GridIndex(_random_tracks())
+    rng = np.random.default_rng(1)
+    lon_min, lon_max, lat_min, lat_max = index.extent
+    for _ in range(50):
+        lats = np.sort(rng.uniform(lat_min, lat_max, 2))
+        lons = np.sort(rng.uniform(lon_min, lon_max, 2))
+        np.testing.assert_array_equal(
+            index.query_bbox(lats[0], lats[1], lons[0], lons[1]),
+            _brute_force_bbox(index, lats[0], lats[1], lons[0], lons[1])
+        )
+
+
+def test_query_bbox_outside_extent_is_empty():
+    index = GridIndex(_random_tracks())
+    assert index.query_bbox(0.0, 1.0, 0.0, 1.0).size == 0
+
+
+def test_points_in_polygon():
+    square = np.array([(0.0, 0.0), (0.0, 1.0), (1.0, 1.0), (1.0, 0.0)])
+    inside = points_in_polygon(np.array([0.5, 1.5, 0.2]), np.array([0.5, 0.5, 0.9]), square)
+    np.testing.assert_array_equal(inside, [True, False, True])
+
+
+def test_query_polygon_finds_segment_crossing_thin_polygon():
+    # Two points of a lift line far apart, on either side of a thin corridor
+    df = pd.DataFrame({
+        "file_name": "f",
+        "track_name": "lift",
+        "elapsed_seconds": [0.0, 60.0, 120.0],
+        "latitude": [39.60, 39.61, 39.62],
+        "longitude": [-106.00, -106.00, -106.00],
+    })
+    index = GridIndex(df)
+    corridor = [(39.6049, -106.01), (39.6049, -105.99), (39.6051, -105.99), (39.6051, -106.01)]
+    segments = index.query_polygon(corridor)
+    assert index.tracks_for_segments(segments) == [("f", "lift")]
+    assert segments.tolist() == [0]
+    # A polygon beside the track is not crossed
+    beside = [(39.6049, -105.98), (39.6049, -105.97), (39.6051, -105.97), (39.6051, -105.98)]
+    assert index.query_polygon(beside).size == 0
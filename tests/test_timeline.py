@@ -0,0 +1,51 @@
+import numpy as np
+import pandas as pd
+
+from synthetic_tracks import generate_ski_days
+from timeline import SECONDS_PER_DAY, add_timeline, apply_time_axis, get_timeline_index, select_time_range
+from util import get_dataframe_hash
+
+
+def _tracks():
+    return add_timeline(generate_ski_days(4, num_days=3, duration_hours=1, sample_interval=10.0))
+
+
+def test_days_do_not_overlap():
+    df = _tracks()
+    assert sorted(df["day_index"].unique()) == [0, 1, 2]
+    np.testing.assert_allclose(df["elapsed_seconds"], df["day_index"].astype(np.int64) * SECONDS_PER_DAY + df["time_of_day"])
+
+
+def test_select_time_range_matches_mask():
+    df = _tracks()
+    for start_time, end_time in [(None, None), (SECONDS_PER_DAY, None), (None, 9.5 * 3600), (9.2 * 3600, 2 * SECONDS_PER_DAY + 9.4 * 3600)]:
+        mask = np.ones(len(df), dtype=bool)
+        if start_time is not None:
+            mask &= df["elapsed_seconds"].to_numpy() >= start_time
+        if end_time is not None:
+            mask &= df["elapsed_seconds"].to_numpy() <= end_time
+        pd.testing.assert_frame_equal(select_time_range(df, start_time, end_time), df[mask])
+
+
+def test_day_rows():
+    df = _tracks()
+    index = get_timeline_index(df)
+    np.testing.assert_array_equal(index.active_days(), [0, 1, 2])
+    np.testing.assert_array_equal(index.day_rows(1), np.flatnonzero(df["day_index"].to_numpy() == 1))
+
+
+def test_collapsed_gaps_map_back_to_the_timeline():
+    df = _tracks()
+    collapsed, format_time = apply_time_axis(df, "Sequential, gaps collapsed")
+    assert collapsed["elapsed_seconds"].max() - collapsed["elapsed_seconds"].min() < SECONDS_PER_DAY
+    assert format_time(collapsed["elapsed_seconds"].max()).startswith("Day 3")
+
+
+def test_dataframe_hash_follows_replaced_columns():
+    df = _tracks()
+    original = get_dataframe_hash(df, ["elapsed_seconds"])
+    assert get_dataframe_hash(df.copy(), ["elapsed_seconds"]) == original
+    df["elapsed_seconds"] = df["elapsed_seconds"] + 1.0
+    assert get_dataframe_hash(df, ["elapsed_seconds"]) != original
+    # The index of the new times is built again
+    assert get_timeline_index(df).start == df["elapsed_seconds"].min()
@@ -0,0 +1,207 @@
+# Absolute multi-day timeline shared by all tracks
+
+"""
+After add_timeline, 'elapsed_seconds' is the local wall-clock time in seconds
+since midnight of the earliest day of the loaded data, so tracks recorded on
+different days never overlap in time. 'day_index' (0 for the first day) and
+'time_of_day' partition that timeline into days.
+"""
+
+import numpy as np
+import pandas as pd
+import threading
+from collections import OrderedDict
+from typing import Callable, Optional, Tuple
+
+from profiling import stage
+from util import get_dataframe_hash
+
+SECONDS_PER_DAY = 24 * 3600
+
+# Animation time axes
+TIME_AXES = ["Absolute", "Same time of day", "Sequential, gaps collapsed"]
+
+# Gaps without any recorded point longer than this are shortened when collapsing gaps
+COLLAPSE_GAP_THRESHOLD_SECONDS = 30 * 60
+COLLAPSED_GAP_SECONDS = 60
+
+_TIMELINE_INDEX_CACHE_SIZE = 8
+_timeline_index_cache = OrderedDict()
+_timeline_index_lock = threading.Lock()
+
+
+def _wall_clock(timestamps:pd.Series) -> pd.Series:
+    """Drop the timezone of timestamps, keeping their local wall-clock time"""
+    if getattr(timestamps.dt, "tz", None) is not None:
+        return timestamps.dt.tz_localize(None)
+    return timestamps
+
+
+def add_timeline(df:pd.DataFrame) -> pd.DataFrame:
+    """
+    Put every track on one absolute timeline starting at midnight of the earliest day.
+    Args:
+        df (pd.DataFrame): Track data with a 'timestamp' column.
+    Returns:
+        pd.DataFrame: The same table with 'elapsed_seconds' rewritten and 'day_index' and 'time_of_day' added.
+    """
+    if df is None or df.empty:
+        return df
+    local_time = _wall_clock(df["timestamp"])
+    origin = local_time.min().normalize()
+    elapsed = (local_time - origin).dt.total_seconds().to_numpy()
+    day_index = np.floor(elapsed / SECONDS_PER_DAY)
+    df["elapsed_seconds"] = elapsed
+    df["day_index"] = day_index.astype(np.int16)
+    df["time_of_day"] = elapsed - day_index * SECONDS_PER_DAY
+    return df
+
+
+def get_timeline_origin(df:pd.DataFrame) -> pd.Timestamp:
+    """Return the naive local midnight that 'elapsed_seconds' is counted from"""
+    first_row = df.iloc[0]
+    timestamp = first_row["timestamp"]
+    if timestamp.tzinfo is not None:
+        timestamp = timestamp.tz_localize(None)
+    return (timestamp - pd.Timedelta(seconds=float(first_row["elapsed_seconds"]))).round("s")
+
+
+def format_timeline_time(seconds:float, show_day:bool=True) -> str:
+    """Format a time on the timeline as "Day N HH:MM", or "HH:MM" without the day"""
+    seconds = int(np.floor(seconds))
+    day, seconds_of_day = divmod(seconds, SECONDS_PER_DAY)
+    time_str = f"{seconds_of_day // 3600:02d}:{seconds_of_day % 3600 // 60:02d}"
+    if show_day:
+        return f"Day {day + 1} {time_str}"
+    return time_str
+
+
+class TimelineIndex:
+    """
+    Row positions sorted by time with per-day partitions.
+    The rows of day d are order[day_offsets[d]:day_offsets[d + 1]].
+    """
+
+    def __init__(self, df:pd.DataFrame):
+        elapsed = df["elapsed_seconds"].to_numpy(dtype=np.float64)
+        self.order = np.argsort(elapsed, kind="stable")
+        self.times = elapsed[self.order]
+        self.num_days = int(self.times[-1] // SECONDS_PER_DAY) + 1 if self.times.size else 0
+        self.day_offsets = np.searchsorted(self.times, np.arange(self.num_days + 1) * SECONDS_PER_DAY, side="left")
+
+    @property
+    def start(self) -> float:
+        return float(self.times[0])
+
+    @property
+    def end(self) -> float:
+        return float(self.times[-1])
+
+    def rows_in_range(self, start_time:Optional[float]=None, end_time:Optional[float]=None) -> np.ndarray:
+        """Positions of the rows with start_time <= time <= end_time, found by binary search"""
+        lo = 0 if start_time is None else np.searchsorted(self.times, start_time, side="left")
+        hi = self.times.size if end_time is None else np.searchsorted(self.times, end_time, side="right")
+        return np.sort(self.order[lo:hi])
+
+    def day_rows(self, day:int) -> np.ndarray:
+        """Positions of the rows recorded on a day"""
+        return np.sort(self.order[self.day_offsets[day]:self.day_offsets[day + 1]])
+
+    def active_days(self) -> np.ndarray:
+        """Indices of the days with at least one point"""
+        return np.flatnonzero(np.diff(self.day_offsets) > 0)
+
+
+def get_timeline_index(df:pd.DataFrame) -> TimelineIndex:
+    """Return the timeline index of a dataset, building it only on a cache miss"""
+    cache_key = get_dataframe_hash(df, ["elapsed_seconds"])
+    with _timeline_index_lock:
+        index = _timeline_index_cache.get(cache_key)
+        if index is not None:
+            _timeline_index_cache.move_to_end(cache_key)
+            return index
+
+    with stage("timeline_index_build", points=len(df)):
+        index = TimelineIndex(df)
+
+    with _timeline_index_lock:
+        _timeline_index_cache[cache_key] = index
+        while len(_timeline_index_cache) > _TIMELINE_INDEX_CACHE_SIZE:
+            _timeline_index_cache.popitem(last=False)
+    return index
+
+
+def select_time_range(df:pd.DataFrame, start_time:Optional[float]=None, end_time:Optional[float]=None) -> pd.DataFrame:
+    """Return the rows within a time range, using the timeline index instead of comparing every row"""
+    index = get_timeline_index(df)
+    if (start_time is None or start_time <= index.start) and (end_time is None or end_time >= index.end):
+        return df
+    return df.iloc[index.rows_in_range(start_time, end_time)]
+
+
+def same_time_of_day_axis(df:pd.DataFrame) -> pd.DataFrame:
+    """
+    Overlay days on one 24 hour axis. Tracks that span several days are split per day
+    so that points of different days are not joined.
+    """
+    df = df.copy(deep=False)
+    day_index = (df["elapsed_seconds"].to_numpy() // SECONDS_PER_DAY).astype(np.int64)
+    df["elapsed_seconds"] = df["elapsed_seconds"].to_numpy() - day_index * SECONDS_PER_DAY
+    for column in ["track_name", "file_name"]:
+        days_per_group = pd.Series(day_index).groupby(df[column].to_numpy()).transform("nunique").to_numpy()
+        if (days_per_group > 1).any():
+            day_labels = pd.Series(day_index + 1).astype(str).to_numpy()
+            names = df[column].astype(str).to_numpy()
+            df[column] = np.where(days_per_group > 1, names + " (Day " + day_labels + ")", names)
+    return df
+
+
+def collapse_gaps(
+    df:pd.DataFrame,
+    threshold_seconds:float=COLLAPSE_GAP_THRESHOLD_SECONDS,
+    collapsed_gap_seconds:float=COLLAPSED_GAP_SECONDS
+) -> Tuple[pd.DataFrame, Callable[[float], float]]:
+    """
+    Shorten every gap without recorded points (nights, breaks between days) to collapsed_gap_seconds.
+    Returns:
+        tuple:
+            pd.DataFrame: Table with 'elapsed_seconds' on the collapsed axis.
+            callable: Maps a time on the collapsed axis back to the absolute timeline.
+    """
+    index = get_timeline_index(df)
+    gaps = np.diff(index.times)
+    gap_after = np.flatnonzero(gaps > threshold_seconds)
+    gap_ends = index.times[gap_after + 1]
+    # Total time removed before each gap end, with 0 before the first gap
+    removed = np.concatenate([[0.0], np.cumsum(gaps[gap_after] - collapsed_gap_seconds)])
+
+    elapsed = df["elapsed_seconds"].to_numpy()
+    collapsed = elapsed - removed[np.searchsorted(gap_ends, elapsed, side="right")]
+    collapsed_gap_ends = gap_ends - removed[1:]
+
+    def to_absolute(seconds:float) -> float:
+        return seconds + removed[np.searchsorted(collapsed_gap_ends, seconds, side="right")]
+
+    df = df.copy(deep=False)
+    df["elapsed_seconds"] = collapsed
+    return df, to_absolute
+
+
+def apply_time_axis(df:pd.DataFrame, time_axis:str="Absolute") -> Tuple[pd.DataFrame, Callable[[float], str]]:
+    """
+    Map the timeline to one of TIME_AXES for animation.
+    Returns:
+        tuple:
+            pd.DataFrame: Table with 'elapsed_seconds' on the chosen axis.
+            callable: Formats a time on the chosen axis for display.
+    """
+    if time_axis == "Absolute":
+        elapsed = df["elapsed_seconds"].to_numpy()
+        show_day = elapsed.size > 0 and elapsed.max() // SECONDS_PER_DAY > elapsed.min() // SECONDS_PER_DAY
+        return df, lambda seconds: format_timeline_time(seconds, show_day=show_day)
+    if time_axis == "Same time of day":
+        return same_time_of_day_axis(df), lambda seconds: format_timeline_time(seconds, show_day=False)
+    if time_axis == "Sequential, gaps collapsed":
+        df, to_absolute = collapse_gaps(df)
+        return df, lambda seconds: format_timeline_time(to_absolute(seconds))
+    raise ValueError(f"Invalid time axis {time_axis!r}. Use one of {TIME_AXES}.")
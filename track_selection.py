@@ -1,5 +1,64 @@
+import hashlib
+import numpy as np
+import pandas as pd
 import streamlit as st
 
+from spatial_index import tracks_in_area
+from timeline import SECONDS_PER_DAY
+from track_stats import get_track_stats
+from util import format_seconds
+
+PAGE_SIZES = [25, 50, 100, 250]
+
+
+def get_track_id(file_name, track_name):
+    """Stable ID of a track, independent of the order files were uploaded in"""
+    return f"{file_name}/{track_name}"
+
+def add_track_ids(df_combined):
+    """
+    Add a categorical 'track_id' column so that selections can be applied with the
+    precomputed integer codes instead of comparing strings
+    """
+    track_groups = df_combined.groupby(["file_name", "track_name"], sort=True)
+    categories = [get_track_id(file_name, track_name) for file_name, track_name in track_groups.size().index]
+    df_combined["track_id"] = pd.Categorical.from_codes(track_groups.ngroup().to_numpy(), categories=categories)
+    return df_combined
+
+def build_track_summary(df_combined):
+    """
+    Build the table listing every track once, used to search, filter and select tracks
+    Returns:
+        pd.DataFrame: One row per track indexed by track ID
+    """
+    track_stats, _ = get_track_stats(df_combined)
+    track_stats["track_id"] = [get_track_id(file_name, track_name) for file_name, track_name in zip(track_stats["file_name"], track_stats["track_name"])]
+    first_timestamps = df_combined.groupby(["file_name", "track_name"], sort=True)["timestamp"].min()
+    track_stats["date"] = [timestamp.date() for timestamp in first_timestamps.reindex(pd.MultiIndex.from_frame(track_stats[["file_name", "track_name"]]))]
+    return track_stats.set_index("track_id")
+
+def get_track_summary(df_combined):
+    """Return the track summary of the loaded data, built once per upload"""
+    if st.session_state.get("track_summary") is None:
+        st.session_state.track_summary = build_track_summary(df_combined)
+    return st.session_state.track_summary
+
+def sync_selected_track_ids(track_ids):
+    """
+    Keep the selection in session state in step with the loaded tracks.
+    Tracks seen for the first time are selected, and the selection of tracks that were
+    already loaded is kept even when other files are added or removed.
+    """
+    if st.session_state.get("selected_track_ids") is None:
+        st.session_state.selected_track_ids = set()
+    if st.session_state.get("known_track_ids") is None:
+        st.session_state.known_track_ids = set()
+    new_ids = set(track_ids) - st.session_state.known_track_ids
+    st.session_state.selected_track_ids |= new_ids
+    st.session_state.known_track_ids |= new_ids
+    st.session_state.selected_track_ids &= set(track_ids)
+    return st.session_state.selected_track_ids
+
 def show_track_selection(df_combined):
     """
     Display track selection UI and return selected tracks
@@ -16,30 +75,183 @@ def show_track_selection(df_combined):
     if df_combined is None or df_combined.empty:
         st.write("No data available. Upload one or more GPX files.")
         return [], None
-    
-    all_tracks = sorted(df_combined["track_name"].unique().tolist())
-    selected_tracks = show_checklist(all_tracks)
-    
+
+    track_summary = get_track_summary(df_combined)
+    selected_track_ids = sync_selected_track_ids(track_summary.index)
+
+    # Narrow down the listed tracks
+    filtered_summary = show_track_filters(df_combined, track_summary)
+
+    # Filled in after the bulk buttons and the table have updated the selection
+    count_placeholder = st.empty()
+    show_bulk_selection(filtered_summary.index)
+    show_track_table(filtered_summary)
+
+    selected_track_ids = st.session_state.selected_track_ids
+    count_placeholder.write(f"{len(selected_track_ids)} of {len(track_summary)} track(s) selected, {len(filtered_summary)} listed")
+    selected_tracks = sorted(track_summary.loc[sorted(selected_track_ids), "track_name"].unique().tolist())
+
     # Filter dataframe to selected tracks
-    df_selected_tracks = df_combined[df_combined["track_name"].isin(selected_tracks)].copy() if selected_tracks else None
+    df_selected_tracks = filter_selected_tracks(df_combined, selected_track_ids)
     
     return selected_tracks, df_selected_tracks
 
-def show_checklist(options_list):
-    """Display a checklist of options and return selected items"""
-    # Create a list to store the status of each checkbox (True = checked)
-    if "checkbox_states" not in st.session_state:
-        # Initialize all checkboxes as checked (True)
-        st.session_state.checkbox_states = [True] * len(options_list)
-    
-    # Display checkboxes and update their states
-    for k1, option in enumerate(options_list):
-        st.session_state.checkbox_states[k1] = st.checkbox(
-            option, 
-            value=st.session_state.checkbox_states[k1],
-            key=f"checkbox_{k1}"
-        )
-    
-    # Return only the selected options
-    selected_options = [opt for opt, state in zip(options_list, st.session_state.checkbox_states) if state]
-    return selected_options
\ No newline at end of file
+def show_track_filters(df_combined, track_summary):
+    """Display the search, date, duration and area filters and return the matching rows of the summary"""
+    search_col, date_col, duration_col = st.columns(3)
+    with search_col:
+        search_text = st.text_input("Search tracks and files", value="", key="track_search")
+    with date_col:
+        first_date = min(track_summary["date"])
+        last_date = max(track_summary["date"])
+        date_range = st.date_input("Dates", value=(first_date, last_date), min_value=first_date, max_value=last_date, key="track_date_range")
+    with duration_col:
+        max_minutes = max(int(np.ceil(track_summary["duration_seconds"].max() / 60)), 1)
+        duration_range = st.slider("Duration (minutes)", min_value=0, max_value=max_minutes, value=(0, max_minutes), key="track_duration_range")
+
+    keep = np.ones(len(track_summary), dtype=bool)
+    if search_text:
+        search_text = search_text.lower()
+        keep &= (
+            track_summary["track_name"].str.lower().str.contains(search_text, regex=False)
+            | track_summary["file_name"].str.lower().str.contains(search_text, regex=False)
+        ).to_numpy()
+    # The date input returns a single date while a range is being picked
+    if isinstance(date_range, (tuple, list)) and len(date_range) == 2:
+        dates = track_summary["date"].to_numpy()
+        keep &= (dates >= date_range[0]) & (dates <= date_range[1])
+    duration_minutes = track_summary["duration_seconds"].to_numpy() / 60
+    keep &= (duration_minutes >= duration_range[0]) & (duration_minutes <= duration_range[1])
+
+    area_track_ids = show_area_filter(df_combined)
+    if area_track_ids is not None:
+        keep &= track_summary.index.isin(list(area_track_ids))
+
+    return track_summary[keep]
+
+def show_bulk_selection(track_ids):
+    """Display buttons that change the selection of all listed tracks at once"""
+    select_col, deselect_col, only_col = st.columns(3)
+    changed = False
+    with select_col:
+        if st.button("Select listed", key="select_listed"):
+            st.session_state.selected_track_ids |= set(track_ids)
+            changed = True
+    with deselect_col:
+        if st.button("Deselect listed", key="deselect_listed"):
+            st.session_state.selected_track_ids -= set(track_ids)
+            changed = True
+    with only_col:
+        if st.button("Select only listed", key="select_only_listed"):
+            st.session_state.selected_track_ids = set(track_ids)
+            changed = True
+    if changed:
+        # Start the table editor from the new selection
+        st.session_state.track_selection_version = st.session_state.get("track_selection_version", 0) + 1
+
+def show_track_table(filtered_summary):
+    """Display one page of the listed tracks with an editable selection column"""
+    if filtered_summary.empty:
+        st.write("No tracks match the filters.")
+        return
+
+    size_col, page_col = st.columns(2)
+    with size_col:
+        page_size = st.selectbox("Tracks per page", PAGE_SIZES, index=1, key="track_page_size")
+    num_pages = int(np.ceil(len(filtered_summary) / page_size))
+    with page_col:
+        page = st.number_input("Page", min_value=1, max_value=num_pages, value=1, step=1, key="track_page")
+    page = min(int(page), num_pages)
+    page_summary = filtered_summary.iloc[(page - 1) * page_size:page * page_size]
+
+    page_table = pd.DataFrame({
+        "Selected": page_summary.index.isin(list(st.session_state.selected_track_ids)),
+        "Track": page_summary["track_name"],
+        "File": page_summary["file_name"],
+        "Date": page_summary["date"],
+        "Start": (page_summary["start_seconds"] % SECONDS_PER_DAY).map(format_seconds),
+        "Duration": page_summary["duration_seconds"].map(format_seconds),
+        "Distance (km)": (page_summary["distance_m"] / 1000).round(2),
+        "Points": page_summary["points"],
+    }, index=page_summary.index)
+
+    # Edits are stored per editor key, so the key changes with the listed tracks and bulk selections
+    page_hash = hashlib.md5("\n".join(page_summary.index).encode()).hexdigest()
+    version = st.session_state.get("track_selection_version", 0)
+    edited_table = st.data_editor(
+        page_table,
+        hide_index=True,
+        disabled=[column for column in page_table.columns if column != "Selected"],
+        key=f"track_table_{page_hash}_{version}"
+    )
+    for track_id, selected in zip(edited_table.index, edited_table["Selected"]):
+        if selected:
+            st.session_state.selected_track_ids.add(track_id)
+        else:
+            st.session_state.selected_track_ids.discard(track_id)
+
+def parse_polygon(text):
+    """Parse polygon vertices given as one "lat, lon" pair per line"""
+    vertices = []
+    for line in text.splitlines():
+        if not line.strip():
+            continue
+        lat, lon = line.split(",")
+        vertices.append((float(lat), float(lon)))
+    return vertices
+
+def show_area_filter(df_combined):
+    """
+    Display the area filter and return the IDs of the tracks passing through the area,
+    or None if the filter is disabled
+    """
+    with st.expander("Filter by area", expanded=False):
+        area_enabled = st.checkbox("Only list tracks passing through an area", value=False, key="area_filter_enabled")
+        area_shape = st.radio("Area", ["Bounding box", "Polygon"], index=0, horizontal=True, key="area_filter_shape")
+        if area_shape == "Bounding box":
+            lat_col, lon_col = st.columns(2)
+            with lat_col:
+                area_lat_min = st.number_input("Latitude min", value=float(df_combined["latitude"].min()), format="%.5f", key="area_lat_min")
+                area_lat_max = st.number_input("Latitude max", value=float(df_combined["latitude"].max()), format="%.5f", key="area_lat_max")
+            with lon_col:
+                area_lon_min = st.number_input("Longitude min", value=float(df_combined["longitude"].min()), format="%.5f", key="area_lon_min")
+                area_lon_max = st.number_input("Longitude max", value=float(df_combined["longitude"].max()), format="%.5f", key="area_lon_max")
+            polygon = None
+        else:
+            polygon_text = st.text_area("Polygon vertices, one \"lat, lon\" pair per line", value="", key="area_polygon")
+            try:
+                polygon = parse_polygon(polygon_text)
+            except ValueError:
+                st.error("Could not parse the polygon vertices")
+                polygon = []
+            if area_enabled and len(polygon) < 3:
+                st.warning("Enter at least three vertices")
+                return None
+            area_lat_min = area_lat_max = area_lon_min = area_lon_max = None
+
+    if not area_enabled:
+        return None
+    area_tracks = tracks_in_area(
+        df_combined,
+        lat_min=area_lat_min,
+        lat_max=area_lat_max,
+        lon_min=area_lon_min,
+        lon_max=area_lon_max,
+        polygon=polygon
+    )
+    return {get_track_id(file_name, track_name) for file_name, track_name in area_tracks}
+
+def filter_selected_tracks(df_combined, selected_track_ids):
+    """Return the rows of the selected tracks, or None if no tracks are selected"""
+    if not selected_track_ids:
+        return None
+    if "track_id" not in df_combined.columns:
+        df_combined = add_track_ids(df_combined.copy(deep=False))
+    track_categories = df_combined["track_id"].cat.categories
+    if len(selected_track_ids) >= len(track_categories) and set(track_categories) <= set(selected_track_ids):
+        return df_combined
+    # Look up each row's selection by its track code
+    selected_codes = np.zeros(len(track_categories), dtype=bool)
+    code_positions = track_categories.get_indexer(list(selected_track_ids))
+    selected_codes[code_positions[code_positions >= 0]] = True
+    return df_combined[selected_codes[df_combined["track_id"].cat.codes.to_numpy()]]
@@ -0,0 +1,254 @@
+# Per-track and per-segment statistics computed in one vectorized pass
+
+import hashlib
+import numpy as np
+import pandas as pd
+import threading
+from collections import OrderedDict
+from typing import Tuple
+
+from geo import haversine_distance
+from profiling import stage
+
+# Speeds are measured over at least this many seconds to suppress GPS spikes
+MAX_SPEED_WINDOW_SECONDS = 5.0
+
+_STATS_CACHE_SIZE = 4096
+_stats_cache = OrderedDict()
+_stats_cache_lock = threading.Lock()
+
+TRACK_STATS_COLUMNS = [
+    "file_name", "track_name", "points", "start_seconds", "end_seconds", "duration_seconds",
+    "distance_m", "vertical_drop_m", "max_speed_mps", "avg_speed_mps", "runs", "lifts",
+]
+SEGMENT_STATS_COLUMNS = [
+    "file_name", "track_name", "segment_number", "segment_type", "start_seconds", "end_seconds",
+    "duration_seconds", "distance_m", "vertical_drop_m", "max_speed_mps", "avg_speed_mps",
+]
+
+
+def _sorted_by_track(df:pd.DataFrame) -> pd.DataFrame:
+    """Return the table sorted by file, track and time, skipping the sort if it already is"""
+    track_codes = df.groupby(["file_name", "track_name"], sort=True).ngroup().to_numpy()
+    elapsed = df["elapsed_seconds"].to_numpy()
+    code_step = np.diff(track_codes)
+    if np.all((code_step > 0) | ((code_step == 0) & (np.diff(elapsed) >= 0))):
+        return df.reset_index(drop=True)
+    return df.iloc[np.lexsort((elapsed, track_codes))].reset_index(drop=True)
+
+
+def _window_max_speed(group_starts:np.ndarray, group_ids:np.ndarray, elapsed:np.ndarray, cumulative_distance:np.ndarray) -> np.ndarray:
+    """Maximum speed of each contiguous group, measured over windows of MAX_SPEED_WINDOW_SECONDS"""
+    n = elapsed.size
+    # Composite key keeps the forward search inside each group
+    time_offset = elapsed - elapsed.min()
+    group_span = time_offset.max() + 2 * MAX_SPEED_WINDOW_SECONDS + 1.0
+    key = group_ids * group_span + time_offset
+    ahead = np.minimum(np.searchsorted(key, key + MAX_SPEED_WINDOW_SECONDS, side="left"), n - 1)
+    same_group = group_ids[ahead] == group_ids
+    window_seconds = elapsed[ahead] - elapsed
+    valid = same_group & (window_seconds > 0)
+    speed = np.where(valid, (cumulative_distance[ahead] - cumulative_distance) / np.where(valid, window_seconds, 1.0), 0.0)
+    return np.maximum.reduceat(speed, group_starts)
+
+
+def compute_stats(df:pd.DataFrame) -> Tuple[pd.DataFrame, pd.DataFrame]:
+    """
+    Compute per-track and per-segment statistics without caching.
+    Step distances and elevation deltas are computed once over the columnar arrays and
+    aggregated per track and per segment with reductions over contiguous row ranges.
+    Args:
+        df (pd.DataFrame): Track data, with optional 'segment_type' column from segment_tracks.
+    Returns:
+        tuple:
+            pd.DataFrame: One row per track (TRACK_STATS_COLUMNS).
+            pd.DataFrame: One row per segment (SEGMENT_STATS_COLUMNS), empty without segmentation.
+    """
+    if df.empty:
+        return pd.DataFrame(columns=TRACK_STATS_COLUMNS), pd.DataFrame(columns=SEGMENT_STATS_COLUMNS)
+
+    df = _sorted_by_track(df)
+    n = len(df)
+    file_names = df["file_name"].to_numpy()
+    track_names = df["track_name"].to_numpy()
+    elapsed = df["elapsed_seconds"].to_numpy(dtype=np.float64)
+    latitude = df["latitude"].to_numpy(dtype=np.float64)
+    longitude = df["longitude"].to_numpy(dtype=np.float64)
+    elevation = pd.Series(df["elevation"].to_numpy(dtype=np.float64, na_value=np.nan)).ffill().bfill().fillna(0.0).to_numpy()
+
+    track_start = np.ones(n, dtype=bool)
+    track_start[1:] = (file_names[1:] != file_names[:-1]) | (track_names[1:] != track_names[:-1])
+    track_ids = np.cumsum(track_start) - 1
+    track_first = np.flatnonzero(track_start)
+    track_last = np.append(track_first[1:], n) - 1
+
+    step_distance = np.zeros(n)
+    step_distance[1:] = haversine_distance(latitude[:-1], longitude[:-1], latitude[1:], longitude[1:])
+    step_distance[track_start] = 0.0
+    cumulative_distance = np.cumsum(step_distance)
+
+    track_duration = elapsed[track_last] - elapsed[track_first]
+    track_distance = np.add.reduceat(step_distance, track_first)
+    track_max_speed = _window_max_speed(track_first, track_ids, elapsed, cumulative_distance)
+
+    has_segments = "segment_type" in df.columns
+    if has_segments:
+        segment_codes = pd.Categorical(df["segment_type"]).codes
+        segment_names = np.asarray(pd.Categorical(df["segment_type"]).categories, dtype=object)
+        segment_start = track_start.copy()
+        segment_start[1:] |= segment_codes[1:] != segment_codes[:-1]
+        segment_ids = np.cumsum(segment_start) - 1
+        segment_first = np.flatnonzero(segment_start)
+        # Segments end on the first point of the next segment of the same track so no time is lost between them
+        next_first = np.append(segment_first[1:], n)
+        continues = next_first < n
+        continues[continues] = ~track_start[next_first[continues]]
+        segment_end = np.where(continues, next_first, next_first - 1)
+
+        segment_type = segment_names[segment_codes[segment_first]]
+        segment_track = track_ids[segment_first]
+        segment_duration = elapsed[segment_end] - elapsed[segment_first]
+        segment_distance = cumulative_distance[segment_end] - cumulative_distance[segment_first]
+        segment_drop = elevation[segment_first] - elevation[segment_end]
+        segment_max_speed = _window_max_speed(segment_first, segment_ids, elapsed, cumulative_distance)
+        segment_number = np.arange(segment_first.size) - segment_ids[track_first][segment_track] + 1
+
+        is_run = segment_type == "run"
+        is_lift = segment_type == "lift"
+        num_tracks = track_first.size
+        track_runs = np.bincount(segment_track[is_run], minlength=num_tracks)
+        track_lifts = np.bincount(segment_track[is_lift], minlength=num_tracks)
+        # Vertical drop and average speed of a track are taken over its runs
+        track_drop = np.bincount(segment_track[is_run], weights=np.maximum(segment_drop[is_run], 0.0), minlength=num_tracks)
+        run_distance = np.bincount(segment_track[is_run], weights=segment_distance[is_run], minlength=num_tracks)
+        run_seconds = np.bincount(segment_track[is_run], weights=segment_duration[is_run], minlength=num_tracks)
+        track_avg_speed = np.divide(run_distance, run_seconds, out=np.zeros(num_tracks), where=run_seconds > 0)
+
+        segment_stats = pd.DataFrame({
+            "file_name": file_names[segment_first],
+            "track_name": track_names[segment_first],
+            "segment_number": segment_number.astype(np.int32),
+            "segment_type": segment_type,
+            "start_seconds": elapsed[segment_first],
+            "end_seconds": elapsed[segment_end],
+            "duration_seconds": segment_duration,
+            "distance_m": segment_distance,
+            "vertical_drop_m": segment_drop,
+            "max_speed_mps": segment_max_speed,
+            "avg_speed_mps": np.divide(segment_distance, segment_duration, out=np.zeros(segment_first.size), where=segment_duration > 0),
+        })
+    else:
+        num_tracks = track_first.size
+        track_runs = np.zeros(num_tracks, dtype=np.int64)
+        track_lifts = np.zeros(num_tracks, dtype=np.int64)
+        track_drop = np.maximum.reduceat(elevation, track_first) - np.minimum.reduceat(elevation, track_first)
+        track_avg_speed = np.divide(track_distance, track_duration, out=np.zeros(num_tracks), where=track_duration > 0)
+        segment_stats = pd.DataFrame(columns=SEGMENT_STATS_COLUMNS)
+
+    track_stats = pd.DataFrame({
+        "file_name": file_names[track_first],
+        "track_name": track_names[track_first],
+        "points": track_last - track_first + 1,
+        "start_seconds": elapsed[track_first],
+        "end_seconds": elapsed[track_last],
+        "duration_seconds": track_duration,
+        "distance_m": track_distance,
+        "vertical_drop_m": track_drop,
+        "max_speed_mps": track_max_speed,
+        "avg_speed_mps": track_avg_speed,
+        "runs": track_runs,
+        "lifts": track_lifts,
+    })
+    return track_stats, segment_stats
+
+
+def _track_hashes(df:pd.DataFrame, track_first:np.ndarray, track_end:np.ndarray) -> list:
+    """Content hash of each contiguous track of a sorted table"""
+    columns = [column for column in ["elapsed_seconds", "latitude", "longitude", "elevation", "segment_type"] if column in df.columns]
+    row_hashes = pd.util.hash_pandas_object(df[columns], index=False).to_numpy()
+    return [hashlib.md5(row_hashes[first:end].tobytes()).hexdigest() for first, end in zip(track_first, track_end)]
+
+
+def _track_keys(df:pd.DataFrame) -> Tuple[pd.DataFrame, np.ndarray, np.ndarray, list]:
+    """Sort a table by track and return it with the row range and cache key of every track"""
+    df = _sorted_by_track(df)
+    n = len(df)
+    file_names = df["file_name"].to_numpy()
+    track_names = df["track_name"].to_numpy()
+    track_start = np.ones(n, dtype=bool)
+    track_start[1:] = (file_names[1:] != file_names[:-1]) | (track_names[1:] != track_names[:-1])
+    track_first = np.flatnonzero(track_start)
+    track_end = np.append(track_first[1:], n)
+    keys = [
+        (file_names[first], track_names[first], track_hash)
+        for first, track_hash in zip(track_first, _track_hashes(df, track_first, track_end))
+    ]
+    return df, track_first, track_end, keys
+
+
+def _store_stats(entries:dict) -> None:
+    with _stats_cache_lock:
+        for key, entry in entries.items():
+            _stats_cache[key] = entry
+            _stats_cache.move_to_end(key)
+        while len(_stats_cache) > _STATS_CACHE_SIZE:
+            _stats_cache.popitem(last=False)
+
+
+def seed_track_stats(df:pd.DataFrame, track_stats:pd.DataFrame, segment_stats:pd.DataFrame) -> None:
+    """
+    Fill the statistics cache with previously computed statistics of a table, for
+    example ones restored from a saved session, so they are not computed again.
+    """
+    if df is None or df.empty or track_stats.empty:
+        return
+    _, _, _, keys = _track_keys(df)
+    track_rows = {(row["file_name"], row["track_name"]): row for row in track_stats[TRACK_STATS_COLUMNS].to_dict("records")}
+    segment_groups = dict(list(segment_stats.groupby(["file_name", "track_name"], sort=False))) if not segment_stats.empty else {}
+    empty_segments = pd.DataFrame(columns=SEGMENT_STATS_COLUMNS)
+    _store_stats({
+        key: (track_rows[(key[0], key[1])], segment_groups.get((key[0], key[1]), empty_segments).reset_index(drop=True))
+        for key in keys if (key[0], key[1]) in track_rows
+    })
+
+
+def get_track_stats(df:pd.DataFrame) -> Tuple[pd.DataFrame, pd.DataFrame]:
+    """
+    Return per-track and per-segment statistics, memoized per track.
+    Each track is keyed by its names and a hash of its points, so adding or removing files
+    only computes the statistics of tracks that were not seen before.
+    Args:
+        df (pd.DataFrame): Track data, with optional 'segment_type' column from segment_tracks.
+    Returns:
+        tuple: Track statistics and segment statistics as returned by compute_stats.
+    """
+    if df is None or df.empty:
+        return compute_stats(pd.DataFrame())
+
+    with stage("track_stats") as stats_stage:
+        df, track_first, track_end, keys = _track_keys(df)
+        with _stats_cache_lock:
+            cached = {key: _stats_cache[key] for key in keys if key in _stats_cache}
+            for key in cached:
+                _stats_cache.move_to_end(key)
+
+        missing = [k1 for k1, key in enumerate(keys) if key not in cached]
+        if missing:
+            rows = np.concatenate([np.arange(track_first[k1], track_end[k1]) for k1 in missing])
+            track_stats, segment_stats = compute_stats(df.iloc[rows])
+            segment_groups = dict(list(segment_stats.groupby(["file_name", "track_name"], sort=False))) if not segment_stats.empty else {}
+            computed = {}
+            for k1, track_row in zip(missing, track_stats.itertuples(index=False)):
+                key = keys[k1]
+                computed[key] = (track_row._asdict(), segment_groups.get((key[0], key[1]), segment_stats.iloc[0:0]))
+            cached.update(computed)
+            _store_stats(computed)
+        stats_stage.add(tracks=len(keys), computed=len(missing))
+
+        track_stats = pd.DataFrame([cached[key][0] for key in keys], columns=TRACK_STATS_COLUMNS)
+        segment_frames = [cached[key][1] for key in keys if not cached[key][1].empty]
+        if segment_frames:
+            segment_stats = pd.concat(segment_frames, ignore_index=True)
+        else:
+            segment_stats = pd.DataFrame(columns=SEGMENT_STATS_COLUMNS)
+    return track_stats, segment_stats
@@ -1,11 +1,19 @@
 #
 
-import base64
+import colorsys
 import hashlib
 import json
-import matplotlib.colors as mcolors
-import os
-import streamlit as st
+import numpy as np
+import pandas as pd
+import threading
+import weakref
+from collections import OrderedDict
+
+# Hashes of recently hashed DataFrames by object identity, checked against a weak
+# reference so a new table that reuses the id of a freed one is hashed again
+_DATAFRAME_HASH_MEMO_SIZE = 64
+_dataframe_hashes = OrderedDict()
+_dataframe_hash_lock = threading.Lock()
 
 
 # Function to generate random distinct colors for different tracks
@@ -26,26 +34,62 @@ def get_distinct_colors(n):
         saturation = 0.7
         value = 0.9
         # Convert HSV to RGB
-        r, g, b = mcolors.hsv_to_rgb([hue, saturation, value])
+        r, g, b = colorsys.hsv_to_rgb(hue, saturation, value)
         colors.append((r, 0, b))  # Changed to include all color channels
     
     return colors
 
-def get_binary_file_downloader_html(bin_file, file_label="File"):
-    """Create HTML for a download link for binary file"""
-    with open(bin_file, "rb") as f:
-        data = f.read()
-    bin_str = base64.b64encode(data).decode()
-    href = f"""<a href="data:application/octet-stream;base64,{bin_str}" download="{os.path.basename(bin_file)}" class="btn btn-primary">Download {file_label}</a>"""
-    return href
-
 def get_params_hash(params):
     """Generate a hash of a parameter dictionary"""
     params_str = json.dumps(params, sort_keys=True)
     return hashlib.md5(params_str.encode()).hexdigest()
 
+def _column_buffers(df, columns):
+    """Address and length of the data buffer of each column, which change when a column is replaced"""
+    buffers = []
+    for column in columns:
+        values = df[column].array
+        # Categorical codes and datetime integers are views, converting them would copy
+        data = getattr(values, "codes", None)
+        if data is None:
+            data = getattr(values, "asi8", None)
+        if data is None:
+            data = np.asarray(values)
+        buffers.append((data.__array_interface__["data"][0], data.size))
+    return tuple(buffers)
+
+def get_dataframe_hash(df, columns=None):
+    """
+    Generate a hash of the contents of a DataFrame, optionally restricted to some columns.
+    The hash is remembered per DataFrame object, so the caches keyed by it look up a table
+    they have seen before without hashing every row again. Tables are not modified in place
+    once loaded; replacing a column is detected by its new data buffer.
+    """
+    columns = list(df.columns) if columns is None else list(columns)
+    memo_key = (id(df), tuple(columns))
+    buffers = _column_buffers(df, columns)
+    with _dataframe_hash_lock:
+        memo = _dataframe_hashes.get(memo_key)
+        if memo is not None and memo[0]() is df and memo[1] == buffers:
+            _dataframe_hashes.move_to_end(memo_key)
+            return memo[2]
+
+    row_hashes = pd.util.hash_pandas_object(df[columns], index=False).to_numpy()
+    data_hash = hashlib.md5(row_hashes.tobytes()).hexdigest()
+    with _dataframe_hash_lock:
+        _dataframe_hashes[memo_key] = (weakref.ref(df), buffers, data_hash)
+        while len(_dataframe_hashes) > _DATAFRAME_HASH_MEMO_SIZE:
+            _dataframe_hashes.popitem(last=False)
+    return data_hash
+
+def format_seconds(seconds):
+    """Format a number of seconds as H:MM:SS"""
+    seconds = int(round(seconds))
+    return f"{seconds // 3600}:{seconds % 3600 // 60:02d}:{seconds % 60:02d}"
+
 def check_params_changed(current_params, hash_key):
     """Check if parameters have changed from last generation"""
+    import streamlit as st
     current_hash = get_params_hash(current_params)
     params_changed = current_hash != st.session_state[hash_key]
     return params_changed, current_hash
\ No newline at end of file
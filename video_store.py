@@ -0,0 +1,144 @@
+# Rendered videos served from disk through Streamlit static file serving
+
+"""
+Animations are rendered straight into the app's static/videos directory and the
+browser plays and downloads them from /app/static/videos/<name> with ranged reads,
+so no copy of the video is kept in session state or inlined into the page.
+Static serving must be enabled with server.enableStaticServing (see
+.streamlit/config.toml). Files are removed when replaced, and by cleanup_videos
+once they are older than VIDEO_TTL_SECONDS or the directory exceeds
+MAX_VIDEO_DIR_BYTES, since Streamlit has no hook for the end of a session.
+
+Finished renders are shared by all sessions through RENDER_CACHE, keyed by the data
+and parameter hashes, so a session asking for an animation that another session has
+already rendered reuses its file. Shared files are only removed by cleanup_videos.
+"""
+
+import html
+import os
+import time
+import uuid
+from typing import Callable, Hashable, List, Optional
+
+from shared_cache import SharedCache
+
+VIDEO_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "static", "videos")
+VIDEO_URL_PREFIX = "/app/static/videos"
+
+# Lifecycle rules for rendered videos
+VIDEO_TTL_SECONDS = 6 * 3600
+MAX_VIDEO_DIR_BYTES = 2 * 1024**3
+# Streamlit does not serve static files larger than this
+MAX_STATIC_FILE_BYTES = 200 * 1024**2
+
+# Process-wide paths of finished renders keyed by (data hash, params hash)
+RENDER_CACHE = SharedCache(max_bytes=MAX_VIDEO_DIR_BYTES, size_of=os.path.getsize, name="rendered videos")
+
+
+def new_video_path(suffix:str=".mp4") -> str:
+    """Return an unused path in the video directory with an unguessable name"""
+    os.makedirs(VIDEO_DIR, exist_ok=True)
+    return os.path.join(VIDEO_DIR, f"{uuid.uuid4().hex}{suffix}")
+
+
+def is_stored_video(path:Optional[str]) -> bool:
+    """Whether a path is a video in the video directory"""
+    return path is not None and os.path.dirname(os.path.abspath(path)) == VIDEO_DIR
+
+
+def video_url(path:str) -> Optional[str]:
+    """
+    Return the static URL of a stored video, or None if it cannot be served statically
+    (outside the video directory, or too large for static serving).
+    """
+    if not is_stored_video(path) or not os.path.exists(path) or os.path.getsize(path) > MAX_STATIC_FILE_BYTES:
+        return None
+    return f"{VIDEO_URL_PREFIX}/{os.path.basename(path)}"
+
+
+def video_download_link_html(path:str, file_name:str="animation.mp4", label:str="Download Animation") -> Optional[str]:
+    """HTML link that downloads a stored video from its static URL, or None if it is not served statically"""
+    url = video_url(path)
+    if url is None:
+        return None
+    # Relative to the page, so the link also works under server.baseUrlPath
+    return f"""<a href="{html.escape(url.lstrip("/"))}" download="{html.escape(file_name)}" class="btn btn-primary">{html.escape(label)}</a>"""
+
+
+def is_shared_render(path:Optional[str]) -> bool:
+    """Whether a path is a finished render that other sessions may reuse"""
+    return path is not None and os.path.abspath(path) in {os.path.abspath(shared) for shared in RENDER_CACHE.values()}
+
+
+def get_or_render_video(key:Hashable, render:Callable[[str], None], suffix:str=".mp4") -> str:
+    """
+    Return the path of the shared render for key, rendering it on a miss.
+    Sessions asking for the same key at the same time wait for a single render.
+    Args:
+        key: Cache key, such as (data hash, params hash).
+        render (callable): Renders the video to the path it is given.
+    Returns:
+        str: Path of the rendered video.
+    """
+    path = RENDER_CACHE.get(key)
+    if path is not None and not os.path.exists(path):
+        # Removed by cleanup_videos since it was rendered
+        RENDER_CACHE.discard(key)
+
+    def render_new() -> str:
+        new_path = new_video_path(suffix)
+        try:
+            render(new_path)
+        except BaseException:
+            delete_video(new_path)
+            raise
+        return new_path
+
+    return RENDER_CACHE.get_or_create(key, render_new)
+
+
+def delete_video(path:Optional[str]) -> None:
+    """Delete a stored video if it exists, ignoring files outside the video directory and shared renders"""
+    if not is_stored_video(path) or is_shared_render(path):
+        return
+    try:
+        os.unlink(path)
+    except FileNotFoundError:
+        pass
+
+
+def cleanup_videos(
+    ttl_seconds:float=VIDEO_TTL_SECONDS,
+    max_total_bytes:int=MAX_VIDEO_DIR_BYTES,
+    keep:Optional[List[str]]=None
+) -> int:
+    """
+    Delete videos older than ttl_seconds, then the oldest videos until the directory
+    is below max_total_bytes.
+    Args:
+        keep (list, optional): Paths that are never deleted, such as a video just rendered.
+    Returns:
+        int: Number of deleted files.
+    """
+    if not os.path.isdir(VIDEO_DIR):
+        return 0
+    keep = {os.path.abspath(path) for path in keep or []}
+    now = time.time()
+    videos = []
+    for entry in os.scandir(VIDEO_DIR):
+        if entry.is_file() and entry.path not in keep:
+            entry_stat = entry.stat()
+            videos.append((entry_stat.st_mtime, entry_stat.st_size, entry.path))
+    total_bytes = sum(size for _, size, _ in videos) + sum(os.path.getsize(path) for path in keep if os.path.exists(path))
+
+    deleted = 0
+    for mtime, size, path in sorted(videos):
+        if now - mtime <= ttl_seconds and total_bytes <= max_total_bytes:
+            break
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+        total_bytes -= size
+        deleted += 1
+    return deleted
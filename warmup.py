@@ -0,0 +1,174 @@
+# Speculative warm-up of basemaps and indexes when the track selection changes
+
+"""
+The bounds of the maps are known as soon as tracks are selected, so the basemap tiles
+and the indexes of the selected tracks can be prepared before a map or an animation
+is generated. A warm-up runs on a small thread pool shared by all sessions as two
+chains of steps, one downloading basemaps and one building indexes, so the network
+and CPU work overlap. The results land in the process-wide caches the renderers read:
+BASEMAP_CACHE, the geometry, spatial and timeline index caches and the resample cache.
+A render asking for a basemap that is still being downloaded waits for that download
+instead of starting its own.
+
+A session has at most one warm-up. When the selection changes again the warm-up is
+cancelled: steps that have not started are skipped, and a step that is running
+finishes and its result is cached.
+"""
+
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import pandas as pd
+
+from map_bounds import get_default_map_bounds
+from map_layers import get_basemap_layer, get_track_geometry_layer
+from resample import frame_resample_step, get_resampled_tracks
+from spatial_index import get_spatial_index
+from timeline import get_timeline_index
+
+# Worker threads shared by the warm-ups of all sessions
+WARMUP_WORKERS = int(os.environ.get("SKI_TRACKS_WARMUP_WORKERS", 2))
+
+_executor = None
+_executor_lock = threading.Lock()
+
+WarmupStep = Tuple[str, Callable[[], Any]]
+
+
+def _get_executor() -> ThreadPoolExecutor:
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=WARMUP_WORKERS, thread_name_prefix="warmup")
+        return _executor
+
+
+class WarmupJob:
+    """
+    Background warm-up of one selection.
+    Each chain of steps runs in order on a worker thread. A failed step, for example a
+    basemap download without network, is recorded and the chain carries on.
+    Args:
+        key: Identifies the selection and settings being warmed up.
+        chains (list): Lists of (name, callable) steps.
+    """
+
+    def __init__(self, key, chains:List[List[WarmupStep]]):
+        self.key = key
+        self._cancelled = threading.Event()
+        self._lock = threading.Lock()
+        self._status = {name: "pending" for chain in chains for name, _ in chain}
+        executor = _get_executor()
+        self.futures = [executor.submit(self._run_chain, chain) for chain in chains if chain]
+
+    def _set_status(self, name:str, status:str) -> None:
+        with self._lock:
+            self._status[name] = status
+
+    def _run_chain(self, chain:List[WarmupStep]) -> None:
+        for name, step in chain:
+            if self._cancelled.is_set():
+                self._set_status(name, "cancelled")
+                continue
+            self._set_status(name, "running")
+            try:
+                step()
+            except Exception as e:
+                self._set_status(name, f"failed: {e}")
+            else:
+                self._set_status(name, "done")
+
+    def cancel(self) -> None:
+        """Skip the steps that have not started"""
+        self._cancelled.set()
+        for future in self.futures:
+            future.cancel()
+        # Chains cancelled before they started do not update their steps
+        with self._lock:
+            for name, status in self._status.items():
+                if status == "pending":
+                    self._status[name] = "cancelled"
+
+    @property
+    def cancelled(self) -> bool:
+        return self._cancelled.is_set()
+
+    def done(self) -> bool:
+        return all(future.done() for future in self.futures)
+
+    def wait(self, timeout:Optional[float]=None) -> bool:
+        """Wait for all steps to finish and return whether they did within the timeout"""
+        _, not_done = wait(self.futures, timeout=timeout)
+        return not not_done
+
+    def status(self) -> List[Dict[str, str]]:
+        with self._lock:
+            return [{"step": name, "status": status} for name, status in self._status.items()]
+
+
+def _bounds_or_default(df:pd.DataFrame, params:Dict[str, Any], prefix:str) -> Tuple[float, float, float, float]:
+    """The bounds of the map options, or the default bounds of the tracks where they are not set"""
+    bounds = tuple(params.get(f"{prefix}_{name}") for name in ("lat_min", "lat_max", "lon_min", "lon_max"))
+    default_bounds = get_default_map_bounds(df)
+    # The renderers fall back to the default bound for each missing bound
+    return tuple(bound if bound else default for bound, default in zip(bounds, default_bounds))
+
+
+def plan_warmup(df:pd.DataFrame, stat_params:Dict[str, Any], anim_params:Dict[str, Any], mode:str="track") -> List[List[WarmupStep]]:
+    """
+    Plan the warm-up of the basemaps and indexes the static map and the animation of the
+    selected tracks need with these options, so their cache keys match those of the renders.
+    Args:
+        df (pd.DataFrame): DataFrame containing the selected GPX tracks.
+        stat_params (dict): Parameters as returned by show_static_map_options.
+        anim_params (dict): Parameters as returned by show_animation_options.
+        mode (str): Mode of plotting, either "track" or "file".
+    Returns:
+        list: The basemap chain and the index chain of (name, callable) steps.
+    """
+    stat_bounds = _bounds_or_default(df, stat_params, "stat")
+    anim_bounds = _bounds_or_default(df, anim_params, "anim")
+
+    basemap_chain = [("static map basemap", lambda: get_basemap_layer(stat_params["stat_map_style"], *stat_bounds))]
+    if (anim_params["anim_map_style"], anim_bounds) != (stat_params["stat_map_style"], stat_bounds):
+        basemap_chain.append(("animation basemap", lambda: get_basemap_layer(anim_params["anim_map_style"], *anim_bounds)))
+
+    index_chain = [("timeline index", lambda: get_timeline_index(df))]
+    if stat_params["stat_render_mode"] == "Density heatmap":
+        index_chain.append(("spatial index", lambda: get_spatial_index(df)))
+    else:
+        index_chain.append(("static map geometry", lambda: get_track_geometry_layer(
+            df, mode=mode, segment_types=stat_params["stat_segment_types"], bounds=stat_bounds
+        )))
+
+    # Other time axes animate a transformed copy of the table, which is built at render time
+    if anim_params["anim_time_axis"] == "Absolute":
+        # Trails are drawn from the geometry, positions from the resampled frames
+        index_chain.append(("animation geometry", lambda: get_track_geometry_layer(df, mode=mode, bounds=anim_bounds)))
+        if anim_params["anim_resample"]:
+            start_time = anim_params["anim_start_seconds"]
+            end_time = anim_params["anim_end_seconds"]
+            if start_time is None:
+                start_time = df["elapsed_seconds"].min()
+            if end_time is None:
+                end_time = df["elapsed_seconds"].max()
+            step = frame_resample_step(start_time, end_time, anim_params["anim_fps"], anim_params["anim_duration"])
+            index_chain.append(("animation frames", lambda: get_resampled_tracks(df, step, mode=mode, start_time=start_time, end_time=end_time)))
+
+    return [basemap_chain, index_chain]
+
+
+def restart_warmup(current:Optional[WarmupJob], key, df:pd.DataFrame, stat_params:Dict[str, Any], anim_params:Dict[str, Any], mode:str="track") -> WarmupJob:
+    """
+    Return the warm-up of a selection, cancelling the current warm-up if it is for another one.
+    Args:
+        current (WarmupJob, optional): Warm-up of the session.
+        key: Identifies the selection and the options the warm-up depends on.
+    """
+    if current is not None:
+        if current.key == key:
+            return current
+        current.cancel()
+    return WarmupJob(key, plan_warmup(df, stat_params, anim_params, mode=mode))